@@ -111,50 +111,47 @@ if __name__ == '__main__':
     all_scores = []  # for EER
     all_labels = []
     result_file_path = os.path.join(save_dir, 'attackResult.txt')
-    for item in dataloader:
-        enroll_waveforms = item[
-            config.data[dataset_name].enroll_waveform_index]  # shape: (batch_size, channels, audio_len)
-        eval_waveforms = item[config.data[dataset_name].eval_waveform_index]
-        sample_rate = item[config.data[dataset_name].sample_rate_index]
-        labels = item[config.data[dataset_name].label_index]
-        enroll_files = item[config.data[dataset_name].enroll_file_index]
-        eval_files = item[config.data[dataset_name].eval_file_index]
-        enroll_speakers = item[config.data[dataset_name].enroll_speaker_index]
-        eval_speakers = item[config.data[dataset_name].eval_speaker_index]
-
-        enroll_waveforms, eval_waveforms, labels = enroll_waveforms.to(device), eval_waveforms.to(device), labels.to(
-            device)
-
-        adv_waveforms, is_successes, similarity_scores, average_pertubations = multi_attacker(enroll_waveforms,
-                                                                                              eval_waveforms,
-                                                                                              labels)  # [batch, C, L]
 
+    def iterate_samples():
+        # split the dataloader items into the samples of multi_attacker.attack_stream
+        for item in dataloader:
+            enroll_waveforms = item[
+                config.data[dataset_name].enroll_waveform_index]  # shape: (batch_size, channels, audio_len)
+            eval_waveforms = item[config.data[dataset_name].eval_waveform_index]
+            sample_rates = item[config.data[dataset_name].sample_rate_index]
+            labels = item[config.data[dataset_name].label_index]
+            enroll_files = item[config.data[dataset_name].enroll_file_index]
+            eval_files = item[config.data[dataset_name].eval_file_index]
+            for i in range(len(labels)):
+                key = (enroll_files[i], eval_files[i], int(sample_rates[i]), labels[i])
+                yield key, enroll_waveforms[i:i + 1], eval_waveforms[i:i + 1], labels[i:i + 1]
+
+    # a sample leaves the attacked batch when all the attacks succeed, the next sample takes its slot
+    stream = multi_attacker.attack_stream(iterate_samples(), config.attack.stream_batch_size)
+    for (enroll_file, eval_file, sample_rate, label), adv_waveforms, is_successes, similarity_scores, \
+            average_pertubations in stream:
         # record adversarial results and save adversarial audios
         result_file = open(result_file_path, mode='a+')
-        is_successes = is_successes.detach().cpu()
-        adv_waveforms = adv_waveforms.detach().cpu()
-        labels = labels.detach().cpu()
+        is_success = is_successes.detach().cpu()[0]
+        adv_waveform = adv_waveforms.detach().cpu()[0]
         all_scores.append(similarity_scores.detach().cpu())
-        similarity_scores = similarity_scores.detach().cpu().mean(dim=1)  # recode all attack average similarity score
-
-        for adv_waveform, is_success, enroll_file, eval_file, label, similarity_score, average_pertubation in zip(
-                adv_waveforms, is_successes,
-                enroll_files, eval_files, labels,
-                similarity_scores, average_pertubations):
-            adv_file_name = '{}_{}'.format(enroll_file, eval_file)
-            adv_file_path = os.path.join(adv_dir, adv_file_name + ".wav")
-            save_waveform_torch(adv_file_path, adv_waveform, sample_rate)
-            result_file.write(
-                '{} {} {} {} {} {}\n'.format(enroll_file, adv_file_name, is_success, label, similarity_score.item(),
-                                             average_pertubation.item()))
-            if label == 1:
-                untarget_cnt += 1
-                untarget_success_cnt += is_success.item()
-            else:  # label == 0
-                target_cnt += 1
-                target_success_cnt += is_success.item()
-            all_labels.append(label.item())
-            perturbation += average_pertubation.item()
+        similarity_score = similarity_scores.detach().cpu().mean(dim=1)[0]  # recode all attack average similarity score
+        average_pertubation = average_pertubations[0]
+
+        adv_file_name = '{}_{}'.format(enroll_file, eval_file)
+        adv_file_path = os.path.join(adv_dir, adv_file_name + ".wav")
+        save_waveform_torch(adv_file_path, adv_waveform, sample_rate)
+        result_file.write(
+            '{} {} {} {} {} {}\n'.format(enroll_file, adv_file_name, is_success, label, similarity_score.item(),
+                                         average_pertubation.item()))
+        if label == 1:
+            untarget_cnt += 1
+            untarget_success_cnt += is_success.item()
+        else:  # label == 0
+            target_cnt += 1
+            target_success_cnt += is_success.item()
+        all_labels.append(label.item())
+        perturbation += average_pertubation.item()
         result_file.close()
 
         success_rate = (target_success_cnt + untarget_success_cnt) / (target_cnt + untarget_cnt)
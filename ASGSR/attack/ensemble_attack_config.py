@@ -6,6 +6,8 @@ config.adv_sample_root = '/mntcephfs/lab_data/wangli/ASGSR/ensemble'
 
 config.attack = edict()
 config.attack.until_all_success = True
+# maximum number of samples attacked at the same time, a successful sample is replaced by the next one
+config.attack.stream_batch_size = 16
 # config.attack.names = ['PGD_XVector', 'PGD_ResNetSE34V2', 'PGD_ECAPATDNN', 'PGD_RawNet3']
 config.attack.names = ['PGD_XVector', 'PGD_ResNetSE34V2', 'PGD_ECAPATDNN', 'PGD_RawNet3']
 config.attack.mark = 'Step20'
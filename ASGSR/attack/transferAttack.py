@@ -1,6 +1,9 @@
 import torch
 import os
-from torch.utils.data import DataLoader
+import csv
+import queue
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Dataset
 
 import sys
 
@@ -9,62 +12,90 @@ sys.path.append('../')
 # import dataset
 from utils.logger import create_logger
 from utils.shell_info import read_num_workers
-from utils.io_utils import load_voxcelebtrainer_model, load_yaml_to_dict
+from utils.io_utils import load_voxcelebtrainer_model, load_yaml_to_dict, load_waveform_torch
 from attacks import score_functions
 from attacks import decision_functions
 from voxceleb_trainer.tuneThreshold import ComputeEqualErrorRate
 from transfer_attack_config import config
 
+# the columns of the transferability table, one row per (attack sample dir, defense model)
+RESULT_COLUMNS = ['attack', 'defense_model', 'target_cnt', 'untarget_cnt', 'success_rate', 'target_success_rate',
+                  'untarget_success_rate', 'eer']
 
-def transfer_attack(num_gpu, gpu_id, attack_sample_dir, defense_model_name, config):
-    import dataset
+
+class WaveformDataset(Dataset):
+    '''
+    The waveforms of a list of files, with their index in the list.
+    '''
+
+    def __init__(self, file_paths):
+        self.file_paths = file_paths
+
+    def __getitem__(self, i):
+        waveform, _ = load_waveform_torch(self.file_paths[i])
+        return waveform, i
+
+    def __len__(self):
+        return len(self.file_paths)
+
+
+def load_defense_model(defense_model_name, config, device):
+    defence_model_config_path = config.model[defense_model_name].config_path
+    defence_model_config = load_yaml_to_dict(defence_model_config_path)
+    defense_model_param_path = config.model[defense_model_name].save_path
+    defence_model = load_voxcelebtrainer_model(defense_model_name, defence_model_config, defense_model_param_path)
+    defence_model = defence_model.to(device)
+    defence_model.eval()
+    return defence_model
+
+
+@torch.no_grad()
+def embed_files(model, file_paths, device, num_workers, dataloader_config):
+    # the embeddings of the files, in the order of file_paths, kept on the device
+    embeddings = [None] * len(file_paths)
+    dataloader = DataLoader(WaveformDataset(file_paths), num_workers=num_workers, **dataloader_config)
+    for waveforms, indexes in dataloader:
+        for index, embedding in zip(indexes.tolist(), model(waveforms.to(device))):
+            embeddings[index] = embedding
+    return torch.stack(embeddings)
+
+
+@torch.no_grad()
+def transfer_attack(attack_sample_dir, attack_dataset, defense_model_name, defence_model, enroll_embeddings,
+                    enroll_index, device, num_workers, config):
+    '''
+    Evaluate the adversarial samples of attack_sample_dir on a defense model.
+    enroll_embeddings are the embeddings of the clean enrollment utterances by the defense model, computed once for
+    all attack sample dirs, and enroll_index maps an enrollment file id to its row in enroll_embeddings.
+    '''
     # save dir
     if attack_sample_dir[-1] == '/':
         attack_sample_dir = attack_sample_dir[:-1]  # not include '/'
     attack_info = attack_sample_dir.split('/')[-1]  # PGD_XVEC-20230305192215_eps-0.001
-    defence_model_config_path = config.model[defense_model_name].config_path
-    defence_model_config = load_yaml_to_dict(defence_model_config_path)
     defense_model_param_path = config.model[defense_model_name].save_path
     defence_model_info = '{}-{}'.format(defense_model_name, defense_model_param_path.split('/')[-1].split('.')[0])
+    exp_id = '{}_VS_{}'.format(attack_info, defence_model_info)
     save_dir = os.path.join(
         'transfer_attack_exps',
         config.data.dataset_name,
         'flip',
-        '{}_VS_{}'.format(attack_info, defence_model_info)
+        exp_id
     )
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    # logger
-    logger = create_logger(__name__, save_dir)
+    # logger, one per (attack, defense model) in the worker process
+    logger = create_logger(exp_id, save_dir)
     logger.info('save dir: {}'.format(save_dir))
 
     logger.info('attack: {}'.format(attack_sample_dir))
     logger.info('defense model: {}'.format(defence_model_info))
 
-    # gpu device
-    gpu_id = gpu_id % num_gpu
-    device = torch.device('cuda:{}'.format(gpu_id))
-
-    # defense model
-    defence_model = load_voxcelebtrainer_model(defense_model_name, defence_model_config, defense_model_param_path)
-    # defence_model.threshold = config.model[defense_model_name].threshold
-    defence_model = defence_model.to(device)
-    defence_model.eval()
-    logger.info('load defense model from: {}'.format(defense_model_param_path))
-
-    # num workers
-    sh_file_path = config.sh_file_path
-    num_workers = read_num_workers(sh_file_path) // num_gpu
-
-    # dataset & dataloader
+    # the file ids, labels and evaluation (adversarial) file paths of the pairs
     dataset_name = config.data.dataset_name
-    dataset_config = config.data[dataset_name].dataset
-    dataloader_config = config.data[dataset_name].dataloader
-    attack_result_file = os.path.join(attack_sample_dir, 'attackResult.txt')
-    dataset = getattr(dataset, dataset_name)(attack_result_file=attack_result_file, attack_file_dir=attack_sample_dir,
-                                             **dataset_config)
-    dataloader = DataLoader(dataset, num_workers=num_workers, **dataloader_config)
+    data_config = config.data[dataset_name]
+    pairs = [attack_dataset.file_info(i) for i in range(len(attack_dataset))]
+    eval_file_paths = [pair[data_config.eval_waveform_index] for pair in pairs]
 
     # score & decision function
     score_function_name = config.attack.score_function.name
@@ -76,85 +107,187 @@ def transfer_attack(num_gpu, gpu_id, attack_sample_dir, defense_model_name, conf
                                                                             threshold=config.model[
                                                                                 defense_model_name].threshold)
 
-    # transfer attack
+    # transfer attack, only the adversarial samples are embedded, the results are streamed to the result file
     target_success_cnt = 0
     untarget_success_cnt = 0
     target_cnt = 0
     untarget_cnt = 0
     all_scores = []  # for EER
     all_labels = []
-    for item in dataloader:
-        transfer_attack_result_file = open(os.path.join(save_dir, 'transfer_attack_result.txt'), mode='a+')
-        enroll_waveforms = item[config.data[dataset_name].enroll_waveform_index]
-        eval_waveforms = item[config.data[dataset_name].eval_waveform_index]
-        enroll_file_ids = item[config.data[dataset_name].enroll_file_id_index]
-        eval_file_ids = item[config.data[dataset_name].eval_file_id_index]
-        labels = item[config.data[dataset_name].label_index]
-        is_ori_successes = item[config.data[dataset_name].is_ori_success_index]
-
-        enroll_waveforms = enroll_waveforms.to(device)
-        eval_waveforms = eval_waveforms.to(device)
-        labels = labels.to(device)
-
-        enroll_embeddings = defence_model(enroll_waveforms)
-        eval_embeddings = defence_model(eval_waveforms)
-
-        similarity_scores = score_funciton(enroll_embeddings, eval_embeddings)
-        decisions = decision_function(enroll_embeddings, eval_embeddings)
-        is_transfer_successes = torch.logical_xor(decisions.bool(), labels.bool())
-
-        for enroll_file_id, eval_file_id, is_ori_success, is_transfer_success, label, similarity_score in zip(
-                enroll_file_ids, eval_file_ids,
-                is_ori_successes,
-                is_transfer_successes,
-                labels, similarity_scores):
-            transfer_attack_result_file.write(
-                '{} {} {} {} {} {}\n'.format(enroll_file_id, eval_file_id, is_ori_success.item(),
-                                             is_transfer_success.item(), label.item(),
-                                             similarity_score.item()))
-            if label == 1:
-                untarget_cnt += 1
-                if is_transfer_success == 1:
-                    untarget_success_cnt += 1
-            else:
-                target_cnt += 1
-                if is_transfer_success == 1:
-                    target_success_cnt += 1
-            all_scores.append(similarity_score.item())
-            all_labels.append(label.item())
-        transfer_attack_result_file.close()
-
-        success_rate = (target_success_cnt + untarget_success_cnt) / (target_cnt + untarget_cnt)
-
-        target_success_rate = 0 if target_cnt == 0 else target_success_cnt / target_cnt
-        untarget_success_rate = 0 if untarget_cnt == 0 else untarget_success_cnt / untarget_cnt
-        logger.info(
-            'success rate: {}/{}={}'.format(target_success_cnt + untarget_success_cnt, target_cnt + untarget_cnt,
-                                            success_rate))
-        logger.info('target success rate: {}/{}={}'.format(target_success_cnt, target_cnt, target_success_rate))
-        logger.info('untarget success rate: {}/{}={}'.format(untarget_success_cnt, untarget_cnt, untarget_success_rate))
+    dataloader = DataLoader(WaveformDataset(eval_file_paths), num_workers=num_workers, **data_config.dataloader)
+    with open(os.path.join(save_dir, 'transfer_attack_result.txt'), mode='w') as transfer_attack_result_file:
+        for eval_waveforms, indexes in dataloader:
+            batch = [pairs[i] for i in indexes.tolist()]
+            enroll_file_ids = [pair[data_config.enroll_file_id_index] for pair in batch]
+            eval_file_ids = [pair[data_config.eval_file_id_index] for pair in batch]
+            labels = torch.tensor([int(pair[data_config.label_index]) for pair in batch], device=device)
+            is_ori_successes = [pair[data_config.is_ori_success_index] for pair in batch]
+
+            enroll_embeddings_batch = enroll_embeddings[[enroll_index[file_id] for file_id in enroll_file_ids]]
+            eval_embeddings = defence_model(eval_waveforms.to(device))
+
+            similarity_scores = score_funciton(enroll_embeddings_batch, eval_embeddings)
+            decisions = decision_function(enroll_embeddings_batch, eval_embeddings)
+            is_transfer_successes = torch.logical_xor(decisions.bool(), labels.bool())
+
+            for enroll_file_id, eval_file_id, is_ori_success, is_transfer_success, label, similarity_score in zip(
+                    enroll_file_ids, eval_file_ids,
+                    is_ori_successes,
+                    is_transfer_successes.tolist(),
+                    labels.tolist(), similarity_scores.tolist()):
+                transfer_attack_result_file.write(
+                    '{} {} {} {} {} {}\n'.format(enroll_file_id, eval_file_id, is_ori_success,
+                                                 is_transfer_success, label, similarity_score))
+                if label == 1:
+                    untarget_cnt += 1
+                    if is_transfer_success:
+                        untarget_success_cnt += 1
+                else:
+                    target_cnt += 1
+                    if is_transfer_success:
+                        target_success_cnt += 1
+                all_scores.append(similarity_score)
+                all_labels.append(label)
+            transfer_attack_result_file.flush()
+
+    success_rate = (target_success_cnt + untarget_success_cnt) / max(target_cnt + untarget_cnt, 1)
+    target_success_rate = 0 if target_cnt == 0 else target_success_cnt / target_cnt
+    untarget_success_rate = 0 if untarget_cnt == 0 else untarget_success_cnt / untarget_cnt
+    logger.info(
+        'success rate: {}/{}={}'.format(target_success_cnt + untarget_success_cnt, target_cnt + untarget_cnt,
+                                        success_rate))
+    logger.info('target success rate: {}/{}={}'.format(target_success_cnt, target_cnt, target_success_rate))
+    logger.info('untarget success rate: {}/{}={}'.format(untarget_success_cnt, untarget_cnt, untarget_success_rate))
 
     if target_cnt > 0 and untarget_cnt > 0:
         eer = ComputeEqualErrorRate(all_scores, all_labels)
         logger.info('EER: {}'.format(eer))
     else:
+        eer = None
         logger.info('target count: {}, untarget count: {}, EER: None'.format(target_cnt, untarget_cnt))
     logger.info('arrange attack result: success rate: {}, target success rate: {}, untarget success rate {}'.format(
         round(success_rate * 100, 1), round(target_success_rate * 100, 1), round(untarget_success_rate * 100, 1)))
     logger.handlers.clear()
 
+    return {
+        'attack': attack_info,
+        'defense_model': defence_model_info,
+        'target_cnt': target_cnt,
+        'untarget_cnt': untarget_cnt,
+        'success_rate': round(success_rate * 100, 1),
+        'target_success_rate': round(target_success_rate * 100, 1),
+        'untarget_success_rate': round(untarget_success_rate * 100, 1),
+        'eer': eer,
+    }
+
+
+def transfer_attack_worker(gpu_id, jobs, num_workers, config, result_queue):
+    '''
+    Run the jobs [(defense model, [attack sample dir, ...]), ...] of a gpu. Each defense model is loaded once and
+    embeds the clean enrollment utterances of all its attack sample dirs once, the results of each
+    (attack sample dir, defense model) are put in result_queue, followed by None when all the jobs are done.
+    '''
+    import dataset
+    device = torch.device('cuda:{}'.format(gpu_id))
+    dataset_name = config.data.dataset_name
+    data_config = config.data[dataset_name]
+
+    for defense_model_name, attack_sample_dirs in jobs:
+        defence_model = load_defense_model(defense_model_name, config, device)
+
+        attack_datasets = []
+        enroll_files = {}  # enrollment file id -> path
+        for attack_sample_dir in attack_sample_dirs:
+            attack_result_file = os.path.join(attack_sample_dir, 'attackResult.txt')
+            attack_dataset = getattr(dataset, dataset_name)(attack_result_file=attack_result_file,
+                                                            attack_file_dir=attack_sample_dir, **data_config.dataset)
+            for i in range(len(attack_dataset)):
+                pair = attack_dataset.file_info(i)
+                enroll_files[pair[data_config.enroll_file_id_index]] = pair[data_config.enroll_waveform_index]
+            attack_datasets.append(attack_dataset)
+
+        enroll_file_ids = list(enroll_files.keys())
+        enroll_embeddings = embed_files(defence_model, [enroll_files[file_id] for file_id in enroll_file_ids], device,
+                                        num_workers, data_config.dataloader)
+        enroll_index = {file_id: i for i, file_id in enumerate(enroll_file_ids)}
+        print('gpu {}: {} embedded {} enrollment utterances'.format(gpu_id, defense_model_name, len(enroll_file_ids)))
+
+        for attack_sample_dir, attack_dataset in zip(attack_sample_dirs, attack_datasets):
+            result_queue.put(transfer_attack(attack_sample_dir, attack_dataset, defense_model_name, defence_model,
+                                             enroll_embeddings, enroll_index, device, num_workers, config))
+
+        del defence_model, enroll_embeddings
+        torch.cuda.empty_cache()
+    result_queue.put(None)
+
+
+def schedule_jobs(attack_sample_dirs, defense_models, num_gpu):
+    '''
+    Split the (defense model, attack sample dir) matrix into num_gpu balanced contiguous chunks ordered by defense model,
+    so that each gpu loads as few defense models as possible. Return the jobs [(defense model, [attack sample dir, ...]), ...]
+    of each gpu.
+    '''
+    pairs = [(defense_model_name, attack_sample_dir) for defense_model_name in defense_models for attack_sample_dir in
+             attack_sample_dirs]
+    gpu_jobs = []
+    for gpu_id in range(num_gpu):
+        jobs = []
+        start, end = gpu_id * len(pairs) // num_gpu, (gpu_id + 1) * len(pairs) // num_gpu
+        for defense_model_name, attack_sample_dir in pairs[start:end]:
+            if len(jobs) > 0 and jobs[-1][0] == defense_model_name:
+                jobs[-1][1].append(attack_sample_dir)
+            else:
+                jobs.append((defense_model_name, [attack_sample_dir]))
+        gpu_jobs.append(jobs)
+    return gpu_jobs
+
 
 if __name__ == '__main__':
     num_gpu = torch.cuda.device_count()
     if num_gpu == 0:
         print('No GPU available!')
         exit(1)
-    gpu_id = 0
-    # pool = Pool(processes=num_gpu * 4)
-    for attack_sample_dir in config.attack.attack_sample_dirs:
-        for defense_model_name in config.attack.defense_models:
-            transfer_attack(num_gpu, gpu_id, attack_sample_dir, defense_model_name, config)
-            gpu_id = (gpu_id + 1) % num_gpu
-            # pool.apply_async(transfer_attack, args=(num_gpu, gpu_id, attack_sample_dir, defense_model_name, config))
-    # pool.close()
-    # pool.join()
+
+    # num workers
+    sh_file_path = config.sh_file_path
+    num_workers = read_num_workers(sh_file_path) // num_gpu
+
+    gpu_jobs = schedule_jobs(config.attack.attack_sample_dirs, config.attack.defense_models, num_gpu)
+    matrix_dir = os.path.join('transfer_attack_exps', config.data.dataset_name, 'flip')
+    if not os.path.exists(matrix_dir):
+        os.makedirs(matrix_dir)
+    matrix_file_path = os.path.join(matrix_dir, 'transfer_attack_matrix.csv')
+
+    # one process per gpu, the results are written to the table as soon as they arrive
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    processes = []
+    for gpu_id, jobs in enumerate(gpu_jobs):
+        if len(jobs) == 0:
+            continue
+        process = ctx.Process(target=transfer_attack_worker, args=(gpu_id, jobs, num_workers, config, result_queue))
+        process.start()
+        processes.append(process)
+
+    with open(matrix_file_path, mode='w', newline='') as matrix_file:
+        writer = csv.DictWriter(matrix_file, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        num_finished = 0
+        while num_finished < len(processes):
+            try:
+                result = result_queue.get(timeout=60)
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    for process in processes:
+                        process.terminate()
+                    raise RuntimeError('a transfer attack worker failed')
+                continue
+            if result is None:
+                num_finished += 1
+                continue
+            writer.writerow(result)
+            matrix_file.flush()
+
+    for process in processes:
+        process.join()
+    print('transfer attack matrix: {}'.format(matrix_file_path))
@@ -16,6 +16,7 @@ class FGSM(Attack):
     Arguments:
         model (nn.Module): model to attack.
         eps (float): maximum perturbation. (Default: 0.01)
+        early_stop (bool): keep the samples which are already successful unperturbed. (Default: False)
 
     Shape:
         - waveforms: :math:`(N, C, L)` where `N = number of batches`, `C = number of channels, only support single channel`,`L = length`. It must have a range [-1, 1].
@@ -31,6 +32,7 @@ class FGSM(Attack):
     def __init__(self, model, **kwargs):
         super().__init__('FGSM', model)
         self.eps = kwargs['eps']
+        self.early_stop = kwargs.get('early_stop', False)
 
         loss_function_name = kwargs['loss_function']['name']
         loss_function_config = kwargs['loss_function'][loss_function_name]
@@ -57,19 +59,32 @@ class FGSM(Attack):
 
         eval_waveforms.requires_grad = True
 
-        enroll_embeddings = self.model(enroll_waveforms)
+        with torch.no_grad():
+            enroll_embeddings = self.model(enroll_waveforms)
         eval_embeddings = self.model(eval_waveforms)
 
         similarity_scores = self.score_function(enroll_embeddings, eval_embeddings)
         cost = self.loss_function(similarity_scores, labels)
 
-        # Update adversarial images
+        # samples already successful before the attack, from the forward pass of the gradient
+        decisions = self.decision_function(enroll_embeddings, eval_embeddings)
+        frozen = (decisions != labels) if self.early_stop else torch.zeros_like(labels, dtype=torch.bool)
+
+        # Update adversarial images, the gradient of the sum is the per-sample gradient
+        cost = torch.sum(cost * (~frozen).to(cost.dtype))
         grad = torch.autograd.grad(cost, eval_waveforms, retain_graph=False, create_graph=False)[0]
 
         adv_eval_waveforms = eval_waveforms + self.eps * grad.sign()
         adv_eval_waveforms = torch.clamp(adv_eval_waveforms, min=-1, max=1).detach()
-
-        adv_eval_embeddings = self.model(adv_eval_waveforms)
-        decisions = self.decision_function(enroll_embeddings, adv_eval_embeddings)  # 0 for different, 1 for same
-        is_successes = (decisions != labels)
-        return adv_eval_waveforms, is_successes, similarity_scores, {}  # 0 for not success, 1 for success, {} for no additional info
+        keep = frozen.view(-1, *([1] * (adv_eval_waveforms.dim() - 1)))
+        adv_eval_waveforms = torch.where(keep, eval_waveforms.detach(), adv_eval_waveforms)
+
+        # only the perturbed samples need a new decision
+        is_successes = frozen.clone()
+        attacked = ~frozen
+        if torch.any(attacked):
+            with torch.no_grad():
+                adv_eval_embeddings = self.model(adv_eval_waveforms[attacked])
+            decisions = self.decision_function(enroll_embeddings[attacked], adv_eval_embeddings)  # 0 for different, 1 for same
+            is_successes[attacked] = (decisions != labels[attacked])
+        return adv_eval_waveforms, is_successes, similarity_scores.detach()  # 0 for not success, 1 for success
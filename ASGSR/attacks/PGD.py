@@ -39,52 +39,148 @@ class PGD(Attack):
         eval_waveforms = eval_waveforms.clone().detach().to(self.device)
         labels = labels.clone().detach().to(self.device)
 
-        adv_eval_waveforms = eval_waveforms.clone().detach()
+        if self.until_success:
+            return self.attack_until_success(enroll_waveforms, eval_waveforms, labels)
+
+        adv_eval_waveforms = self.init_adv(eval_waveforms)
+        with torch.no_grad():
+            enroll_embeddings = self.model(enroll_waveforms)
+        for _ in range(self.steps):
+            adv_eval_waveforms, _, _ = self.attack_step(enroll_embeddings, eval_waveforms, adv_eval_waveforms, labels,
+                                                        freeze_successes=False)
+
+        with torch.no_grad():
+            adv_eval_embeddings = self.model(adv_eval_waveforms)
+        similarity_scores = self.score_function(enroll_embeddings, adv_eval_embeddings)
+        decisions = self.decision_function(enroll_embeddings, adv_eval_embeddings)
+        is_successes = torch.logical_xor(decisions.bool(), labels.bool())
+        self.update_info(self.steps)
+        return adv_eval_waveforms, is_successes, similarity_scores
 
+    def init_adv(self, eval_waveforms):
+        adv_eval_waveforms = eval_waveforms.clone().detach()
         if self.random_start:
             adv_eval_waveforms = adv_eval_waveforms + torch.empty_like(adv_eval_waveforms).uniform_(-self.eps, self.eps)
             adv_eval_waveforms = torch.clamp(adv_eval_waveforms, min=-1, max=1).detach()
+        return adv_eval_waveforms
+
+    def attack_step(self, enroll_embeddings, eval_waveforms, adv_eval_waveforms, labels, freeze_successes=True):
+        """
+        One PGD step. The scores and successes are those of the input adv_eval_waveforms, computed
+        by the forward pass of the gradient, so checking success costs no extra model forward.
+        With freeze_successes, samples which are already successful are returned unchanged.
+        """
+        adv_eval_waveforms = adv_eval_waveforms.clone().detach().requires_grad_(True)
+        adv_eval_embeddings = self.model(adv_eval_waveforms)
 
+        similarity_scores = self.score_function(enroll_embeddings, adv_eval_embeddings)
+        decisions = self.decision_function(enroll_embeddings, adv_eval_embeddings)
+        is_successes = torch.logical_xor(decisions.bool(), labels.bool())
+        frozen = is_successes if freeze_successes else torch.zeros_like(is_successes)
+        if torch.all(frozen):
+            return adv_eval_waveforms.detach(), is_successes, similarity_scores.detach()
+
+        # samples are independent, the gradient of the sum is the per-sample gradient
+        cost = self.loss_function(similarity_scores, labels)
+        cost = torch.sum(cost * (~frozen).to(cost.dtype))
+        grad = torch.autograd.grad(cost, adv_eval_waveforms, retain_graph=False, create_graph=False)[0]
+
+        new_adv_eval_waveforms = adv_eval_waveforms.detach() + self.alpha * grad.sign()
+        delta = torch.clamp(new_adv_eval_waveforms - eval_waveforms, min=-self.eps, max=self.eps)
+        new_adv_eval_waveforms = torch.clamp(eval_waveforms + delta, min=-1, max=1).detach()
+        keep = frozen.view(-1, *([1] * (adv_eval_waveforms.dim() - 1)))
+        new_adv_eval_waveforms = torch.where(keep, adv_eval_waveforms.detach(), new_adv_eval_waveforms)
+        return new_adv_eval_waveforms, is_successes, similarity_scores.detach()
+
+    def attack_until_success(self, enroll_waveforms, eval_waveforms, labels):
+        """
+        Attack until success with an active set: a sample leaves the batch at its first success, so every
+        step only runs the model on the samples still being attacked.
+        As before, update_info is called once per batch, with the steps of its last successful sample.
+        """
+        with torch.no_grad():
+            enroll_embeddings = self.model(enroll_waveforms)
+        adv_eval_waveforms = self.init_adv(eval_waveforms)
+        is_successes = torch.zeros_like(labels, dtype=torch.bool)
+        similarity_scores = None
+        active = torch.arange(labels.shape[0], device=labels.device)
         step = 0
-
-        enroll_embeddings = self.model(enroll_waveforms)
         while True:
-            adv_eval_waveforms.requires_grad = True
-
-            adv_eval_embeddings = self.model(adv_eval_waveforms)
-
-            similarity_scores = self.score_function(enroll_embeddings, adv_eval_embeddings)
-            cost = self.loss_function(similarity_scores, labels)
-
-            grad = torch.autograd.grad(cost, adv_eval_waveforms, retain_graph=False, create_graph=False)[0]
-
-            adv_eval_waveforms = adv_eval_waveforms.detach() + self.alpha * grad.sign()
-            delta = torch.clamp(adv_eval_waveforms - eval_waveforms, min=-self.eps, max=self.eps)
-            adv_eval_waveforms = torch.clamp(eval_waveforms + delta, min=-1, max=1).detach()
-
+            adv_eval_waveforms[active], successes, scores = self.attack_step(
+                enroll_embeddings[active], eval_waveforms[active], adv_eval_waveforms[active], labels[active])
+            if similarity_scores is None:
+                similarity_scores = scores.new_zeros((labels.shape[0],) + scores.shape[1:])
+            similarity_scores[active] = scores
+            is_successes[active] = successes
+            active = active[~successes]
+            if len(active) == 0:
+                break
             step += 1
+        self.update_info(step)
+        return adv_eval_waveforms, is_successes, similarity_scores
 
-            # attack until success
-            # Note: if a batch has both successful and unsuccessful attacks, the successful ones will be attacked too, until they are all successful
-            # Todo: Attack only those samples in the batch that have not yet been successfully attacked.
-            if self.until_success:
-                adv_eval_embeddings = self.model(adv_eval_waveforms)
-                similarity_scores = self.score_function(enroll_embeddings, adv_eval_embeddings)
-                decisions = self.decision_function(enroll_embeddings, adv_eval_embeddings)
-                is_successes = torch.logical_xor(decisions.bool(), labels.bool())
-                if torch.all(is_successes):
-                    self.update_info(step)
-                    return adv_eval_waveforms, is_successes, similarity_scores
-
-            if step == self.steps and not self.until_success:
+    def attack_stream(self, samples, batch_size):
+        """
+        Attack until success with an active set over a stream of samples: a sample leaves the batch at its
+        first success and its slot is refilled with the next sample, so a batch only holds samples still
+        being attacked. There is no batch to account for, update_info is called once per sample with its
+        own steps.
+
+        Args:
+            samples: iterable of (key, enroll_waveforms, eval_waveforms, labels), waveforms of shape
+                (1, C, L) and labels of shape (1,), e.g. a dataloader with batch_size=1.
+                Samples whose eval waveforms have the same length are attacked in one batch.
+            batch_size: maximum number of samples attacked at the same time
+
+        Yields:
+            (key, adv_eval_waveforms, is_successes, similarity_scores, steps) in order of completion
+        """
+        samples = iter(samples)
+        active = []
+        exhausted = False
+        while True:
+            while not exhausted and len(active) < batch_size:
+                try:
+                    key, enroll_waveforms, eval_waveforms, labels = next(samples)
+                except StopIteration:
+                    exhausted = True
+                    break
+                eval_waveforms = eval_waveforms.clone().detach().to(self.device)
+                with torch.no_grad():
+                    enroll_embeddings = self.model(enroll_waveforms.clone().detach().to(self.device))
+                active.append({
+                    'key': key,
+                    'enroll_embeddings': enroll_embeddings,
+                    'eval_waveforms': eval_waveforms,
+                    'adv_eval_waveforms': self.init_adv(eval_waveforms),
+                    'labels': labels.clone().detach().to(self.device),
+                    'step': 0,
+                })
+            if len(active) == 0:
                 break
 
-        adv_eval_embeddings = self.model(adv_eval_waveforms)
-        similarity_scores = self.score_function(enroll_embeddings, adv_eval_embeddings)
-        decisions = self.decision_function(enroll_embeddings, adv_eval_embeddings)
-        is_successes = torch.logical_xor(decisions.bool(), labels.bool())
-        self.update_info(step)
-        return adv_eval_waveforms, is_successes, similarity_scores
+            # one step for every group of samples of the same length
+            groups = {}
+            for state in active:
+                groups.setdefault(state['eval_waveforms'].shape, []).append(state)
+            remaining = []
+            for group in groups.values():
+                adv_eval_waveforms, is_successes, similarity_scores = self.attack_step(
+                    torch.cat([state['enroll_embeddings'] for state in group], dim=0),
+                    torch.cat([state['eval_waveforms'] for state in group], dim=0),
+                    torch.cat([state['adv_eval_waveforms'] for state in group], dim=0),
+                    torch.cat([state['labels'] for state in group], dim=0),
+                )
+                for i, state in enumerate(group):
+                    if is_successes[i]:
+                        self.update_info(state['step'])
+                        yield (state['key'], adv_eval_waveforms[i:i + 1], is_successes[i:i + 1],
+                               similarity_scores[i:i + 1], state['step'])
+                    else:
+                        state['adv_eval_waveforms'] = adv_eval_waveforms[i:i + 1]
+                        state['step'] += 1
+                        remaining.append(state)
+            active = remaining
 
     def init_info(self):
         self.max_step = 10000000
@@ -43,24 +43,14 @@ class MultiAttack(Attack):
         enroll_waveforms = enroll_waveforms.clone().detach().to(self.device)
         adv_eval_waveforms = eval_waveforms.clone().detach().to(self.device)  # save final adversarial waveforms and intermediate adversarial waveforms
         similarity_scores = torch.zeros(batch_size, len(self.attacks)).to(self.device)
+        is_successes = torch.zeros(batch_size, dtype=torch.bool).to(self.device)
         labels = labels.clone().detach().to(self.device)
         fails_index = torch.arange(batch_size).to(self.device)
 
         while True:
-            for _, attack in enumerate(self.attacks):
-                adv_eval_waveforms[fails_index], _, _, _ = attack(enroll_waveforms[fails_index], adv_eval_waveforms[fails_index], labels[fails_index])
-
-            # check succeeds
-            is_successes = torch.zeros(batch_size, len(self.attacks)).to(self.device)
-            for i, attack in enumerate(self.attacks):
-                enroll_embeddings = attack.model(enroll_waveforms[fails_index])
-                adv_eval_embeddings = attack.model(adv_eval_waveforms[fails_index])
-                similarity_scores[:, i] = attack.score_function(enroll_embeddings, adv_eval_embeddings)
-                decisions = attack.decision_function(enroll_embeddings, adv_eval_embeddings)
-                is_successes[:, i] = torch.logical_xor(decisions, labels[fails_index])
-            is_successes = torch.min(is_successes, dim=1)[0].bool()  # if all attacks succeed, then the adversarial waveform is successful
-            fails_mask = ~is_successes
-            fails_index = torch.masked_select(fails_index, fails_mask)
+            adv_eval_waveforms[fails_index], is_successes[fails_index], similarity_scores[fails_index] = self.attack_round(
+                enroll_waveforms[fails_index], adv_eval_waveforms[fails_index], labels[fails_index])
+            fails_index = fails_index[~is_successes[fails_index]]
 
             if self.until_all_success:
                 if len(fails_index) == 0:
@@ -69,3 +59,87 @@ class MultiAttack(Attack):
                 break
 
         return adv_eval_waveforms, is_successes, similarity_scores
+
+    def attack_round(self, enroll_waveforms, adv_eval_waveforms, labels):
+        """
+        Run every attack once, each one starting from the adversarial waveforms of the previous one.
+
+        Returns:
+            adv_eval_waveforms, is_successes (a sample is successful if all attacks succeed) and the
+            similarity scores (batch, num_attacks) of every attack's model
+        """
+        for attack in self.attacks:
+            adv_eval_waveforms, _, _, _ = attack(enroll_waveforms, adv_eval_waveforms, labels)
+
+        # check succeeds
+        similarity_scores = torch.zeros(labels.shape[0], len(self.attacks)).to(self.device)
+        is_successes = torch.zeros(labels.shape[0], len(self.attacks)).to(self.device)
+        with torch.no_grad():
+            for i, attack in enumerate(self.attacks):
+                enroll_embeddings = attack.model(enroll_waveforms)
+                adv_eval_embeddings = attack.model(adv_eval_waveforms)
+                similarity_scores[:, i] = attack.score_function(enroll_embeddings, adv_eval_embeddings)
+                decisions = attack.decision_function(enroll_embeddings, adv_eval_embeddings)
+                is_successes[:, i] = torch.logical_xor(decisions, labels)
+        is_successes = torch.min(is_successes, dim=1)[0].bool()  # if all attacks succeed, then the adversarial waveform is successful
+        return adv_eval_waveforms, is_successes, similarity_scores
+
+    def attack_stream(self, samples, batch_size):
+        """
+        Attack a stream of samples with an active set: every round runs all the attacks on the samples
+        being attacked, a sample leaves the batch when all the attacks succeed (or after its first round
+        without until_all_success) and its slot is refilled with the next sample, so a batch never waits
+        for its slowest sample.
+
+        Args:
+            samples: iterable of (key, enroll_waveforms, eval_waveforms, labels), waveforms of shape
+                (1, C, L) and labels of shape (1,), e.g. the items of a dataloader split into samples.
+                Samples whose enroll and eval waveforms have the same lengths are attacked in one batch.
+            batch_size: maximum number of samples attacked at the same time
+
+        Yields:
+            (key, adv_eval_waveforms, is_successes, similarity_scores, average_pertubations) in order of
+            completion, as returned by __call__ for a batch of one sample
+        """
+        samples = iter(samples)
+        active = []
+        exhausted = False
+        while True:
+            while not exhausted and len(active) < batch_size:
+                try:
+                    key, enroll_waveforms, eval_waveforms, labels = next(samples)
+                except StopIteration:
+                    exhausted = True
+                    break
+                eval_waveforms = eval_waveforms.clone().detach().to(self.device)
+                active.append({
+                    'key': key,
+                    'enroll_waveforms': enroll_waveforms.clone().detach().to(self.device),
+                    'eval_waveforms': eval_waveforms,
+                    'adv_eval_waveforms': eval_waveforms.clone(),
+                    'labels': labels.clone().detach().to(self.device),
+                })
+            if len(active) == 0:
+                break
+
+            # one round for every group of samples of the same lengths
+            groups = {}
+            for state in active:
+                groups.setdefault((state['enroll_waveforms'].shape, state['eval_waveforms'].shape), []).append(state)
+            remaining = []
+            for group in groups.values():
+                eval_waveforms = torch.cat([state['eval_waveforms'] for state in group], dim=0)
+                adv_eval_waveforms, is_successes, similarity_scores = self.attack_round(
+                    torch.cat([state['enroll_waveforms'] for state in group], dim=0),
+                    torch.cat([state['adv_eval_waveforms'] for state in group], dim=0),
+                    torch.cat([state['labels'] for state in group], dim=0),
+                )
+                average_pertubations = torch.mean(torch.abs(adv_eval_waveforms - eval_waveforms), dim=2)
+                for i, state in enumerate(group):
+                    if is_successes[i] or not self.until_all_success:
+                        yield (state['key'], adv_eval_waveforms[i:i + 1], is_successes[i:i + 1],
+                               similarity_scores[i:i + 1], average_pertubations[i:i + 1])
+                    else:
+                        state['adv_eval_waveforms'] = adv_eval_waveforms[i:i + 1]
+                        remaining.append(state)
+            active = remaining
@@ -188,6 +188,10 @@ class VoxCeleb1VerificationAttack(Dataset):
         eval_waveform, _ = load_waveform_torch(eval_file_path)
         return enroll_waveform, eval_waveform, enroll_file_id, eval_file_id, ori_label, is_ori_success
 
+    def file_info(self, i):
+        # the item i without loading the audio, i.e. with the file paths in place of the waveforms
+        return tuple(self._flist[i])
+
     def __len__(self):
         return len(self._flist)
 
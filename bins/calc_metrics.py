@@ -8,12 +8,14 @@ import sys
 import numpy as np
 import json
 import argparse
+import multiprocessing
+from multiprocessing import cpu_count
 
 from glob import glob
 from tqdm import tqdm
 from collections import defaultdict
 
-
+from evaluation.metrics.audio_pair import AudioPair
 from evaluation.metrics.energy.energy_rmse import extract_energy_rmse
 from evaluation.metrics.energy.energy_pearson_coefficients import (
     extract_energy_pearson_coeffcients,
@@ -65,6 +67,101 @@ METRIC_FUNC = {
 }
 
 
+# Metrics computed on the whole folders
+FOLDER_METRICS = ["fad", "rawnet3_similarity", "wavlm_similarity"]
+# Metrics using a whisper model on GPU, computed in the main process
+ASR_METRICS = ["wer", "cer"]
+# Metrics of audio pairs using a model on GPU, computed in the main process
+GPU_PAIR_METRICS = ["f0_periodicity_rmse"]
+
+
+def calc_pair_metrics(audio_ref, audio_deg, metrics, fs=None):
+    """Compute the metrics of an utterance, decoding the audio pair once.
+
+    The decoded audios and the shared features (F0, energy, resampled audio) are
+    cached in an AudioPair passed to all the metrics.
+    """
+    pair = AudioPair(audio_ref, audio_deg, fs)
+    scores = {}
+    for metric in metrics:
+        score = METRIC_FUNC[metric](
+            audio_ref=audio_ref, audio_deg=audio_deg, fs=fs, pair=pair
+        )
+        # v_uv_f1 gives (tp, fp, fn), the other metrics a number or a 0-d tensor
+        scores[metric] = np.asarray(score, dtype=np.float64).tolist()
+    return scores
+
+
+def _calc_pair_metrics(args):
+    uid, audio_ref, audio_deg, metrics, fs = args
+    return uid, calc_pair_metrics(audio_ref, audio_deg, metrics, fs)
+
+
+def calc_asr_metric(
+    metric,
+    audios_ref,
+    audios_deg,
+    fs=None,
+    wer_choose=1,
+    ltr_path=None,
+    language="english",
+):
+    """Compute WER or CER of each utterance, with the whisper model loaded once"""
+    scores = []
+    if metric == "wer":
+        import whisper
+
+        model = whisper.load_model("large").cuda()
+        if wer_choose == 2:
+            tmpltrs = {}
+            with open(ltr_path, "r") as f:
+                for line in f:
+                    paras = line.replace("\n", "").split("|")
+                    paras[1] = paras[1].replace(" ", "")
+                    paras[1] = paras[1].replace(".", "")
+                    paras[1] = paras[1].replace("'", "")
+                    paras[1] = paras[1].replace("-", "")
+                    paras[1] = paras[1].replace(",", "")
+                    paras[1] = paras[1].replace("!", "")
+                    paras[1] = paras[1].lower()
+                    tmpltrs[paras[0]] = paras[1]
+            ltrs = []
+            for file in audios_ref:
+                ltrs.append(tmpltrs[os.path.basename(file)])
+    for i in tqdm(range(len(audios_ref))):
+        audio_ref = audios_ref[i]
+        audio_deg = audios_deg[i]
+
+        if metric == "wer":
+            if wer_choose == 1:
+                score = METRIC_FUNC[metric](
+                    audio_ref=audio_ref,
+                    audio_deg=audio_deg,
+                    fs=fs,
+                    model=model,
+                    language=language,
+                )
+            elif wer_choose == 2:
+                content_ref = ltrs[i]
+                score = METRIC_FUNC[metric](
+                    audio_ref=audio_ref,
+                    audio_deg=audio_deg,
+                    fs=fs,
+                    model=model,
+                    content_gt=content_ref,
+                    mode="gt_content",
+                    language=language,
+                )
+        else:
+            score = METRIC_FUNC[metric](
+                audio_ref=audio_ref,
+                audio_deg=audio_deg,
+                fs=fs,
+            )
+        scores.append(score)
+    return scores
+
+
 def calc_metric(
     ref_dir,
     deg_dir,
@@ -74,98 +171,76 @@ def calc_metric(
     wer_choose=1,
     ltr_path=None,
     language="english",
+    num_workers=1,
 ):
+    """Compute the metrics of the audios in deg_dir against those of ref_dir.
+
+    The metrics of audio pairs are computed per utterance: each pair is decoded once
+    and fanned out to all the metrics, by a pool of num_workers processes. The
+    aggregated results are dumped to result.json, the scores of each utterance to
+    utterance_result.json.
+    """
     result = defaultdict()
 
+    files = sorted(glob(ref_dir + "/*.wav"))
+    uids = [file.split("/")[-1].split(".wav")[0] for file in files]
+    audios_ref = files
+    audios_deg = [deg_dir + "/{}.wav".format(uid) for uid in uids]
+
+    utt_result = defaultdict(dict)
+    pair_metrics = [
+        metric
+        for metric in metrics
+        if metric not in FOLDER_METRICS + ["resemblyzer_similarity"] + ASR_METRICS
+    ]
+    cpu_metrics = [metric for metric in pair_metrics if metric not in GPU_PAIR_METRICS]
+    gpu_metrics = [metric for metric in pair_metrics if metric in GPU_PAIR_METRICS]
+
+    # Metrics of audio pairs, fanned out from a single decoding of each pair
+    if len(cpu_metrics) > 0:
+        tasks = [
+            (uid, audio_ref, audio_deg, cpu_metrics, fs)
+            for uid, audio_ref, audio_deg in zip(uids, audios_ref, audios_deg)
+        ]
+        if num_workers > 1:
+            # spawn: the main process may have initialized CUDA
+            pool = multiprocessing.get_context("spawn").Pool(num_workers)
+            results = pool.imap_unordered(_calc_pair_metrics, tasks)
+        else:
+            pool = None
+            results = map(_calc_pair_metrics, tasks)
+        for uid, scores in tqdm(results, total=len(tasks)):
+            utt_result[uid].update(scores)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if len(gpu_metrics) > 0:
+        for uid, audio_ref, audio_deg in tqdm(list(zip(uids, audios_ref, audios_deg))):
+            scores = calc_pair_metrics(audio_ref, audio_deg, gpu_metrics, fs)
+            utt_result[uid].update(scores)
+
     for metric in tqdm(metrics):
-        if metric in ["fad", "rawnet3_similarity", "wavlm_similarity"]:
+        if metric in FOLDER_METRICS:
             result[metric] = str(METRIC_FUNC[metric](ref_dir, deg_dir))
             continue
         elif metric in ["resemblyzer_similarity"]:
             result[metric] = str(METRIC_FUNC[metric](deg_dir, ref_dir, dump_dir))
             continue
-
-        audios_ref = []
-        audios_deg = []
-
-        files = glob(ref_dir + "/*.wav")
-
-        for file in files:
-            audios_ref.append(file)
-            uid = file.split("/")[-1].split(".wav")[0]
-            file_gt = deg_dir + "/{}.wav".format(uid)
-            audios_deg.append(file_gt)
+        elif metric in ASR_METRICS:
+            scores = calc_asr_metric(
+                metric, audios_ref, audios_deg, fs, wer_choose, ltr_path, language
+            )
+            for uid, score in zip(uids, scores):
+                utt_result[uid][metric] = score
 
         if metric in ["v_uv_f1"]:
-            tp_total = 0
-            fp_total = 0
-            fn_total = 0
-
-            for i in tqdm(range(len(audios_ref))):
-                audio_ref = audios_ref[i]
-                audio_deg = audios_deg[i]
-                tp, fp, fn = METRIC_FUNC[metric](audio_ref, audio_deg, fs)
-                tp_total += tp
-                fp_total += fp
-                fn_total += fn
-
+            tp_total, fp_total, fn_total = np.sum(
+                [utt_result[uid][metric] for uid in uids], axis=0
+            )
             result[metric] = str(tp_total / (tp_total + (fp_total + fn_total) / 2))
         else:
-            scores = []
-            if metric == "wer":
-                import whisper
-
-                model = whisper.load_model("large").cuda()
-                if wer_choose == 2:
-                    tmpltrs = {}
-                    with open(ltr_path, "r") as f:
-                        for line in f:
-                            paras = line.replace("\n", "").split("|")
-                            paras[1] = paras[1].replace(" ", "")
-                            paras[1] = paras[1].replace(".", "")
-                            paras[1] = paras[1].replace("'", "")
-                            paras[1] = paras[1].replace("-", "")
-                            paras[1] = paras[1].replace(",", "")
-                            paras[1] = paras[1].replace("!", "")
-                            paras[1] = paras[1].lower()
-                            tmpltrs[paras[0]] = paras[1]
-                    ltrs = []
-                    for file in files:
-                        ltrs.append(tmpltrs[os.path.basename(file)])
-            for i in tqdm(range(len(audios_ref))):
-                audio_ref = audios_ref[i]
-                audio_deg = audios_deg[i]
-
-                if metric == "wer":
-                    if wer_choose == 1:
-                        score = METRIC_FUNC[metric](
-                            audio_ref=audio_ref,
-                            audio_deg=audio_deg,
-                            fs=fs,
-                            model=model,
-                            language=language,
-                        )
-                    elif wer_choose == 2:
-                        content_ref = ltrs[i]
-                        score = METRIC_FUNC[metric](
-                            audio_ref=audio_ref,
-                            audio_deg=audio_deg,
-                            fs=fs,
-                            model=model,
-                            content_gt=content_ref,
-                            mode="gt_content",
-                            language=language,
-                        )
-                else:
-                    score = METRIC_FUNC[metric](
-                        audio_ref=audio_ref,
-                        audio_deg=audio_deg,
-                        fs=fs,
-                    )
-                if not np.isnan(score):
-                    scores.append(score)
-
-            scores = np.array(scores)
+            scores = np.array([utt_result[uid][metric] for uid in uids])
+            scores = scores[~np.isnan(scores)]
             result["{}_mean".format(metric)] = str(np.mean(scores))
             result["{}_std".format(metric)] = str(np.std(scores))
 
@@ -174,6 +249,9 @@ def calc_metric(
     with open(os.path.join(dump_dir, "result.json"), "w", newline="\n") as f:
         f.write(data)
 
+    with open(os.path.join(dump_dir, "utterance_result.json"), "w", newline="\n") as f:
+        f.write(json.dumps(utt_result, indent=4))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -199,7 +277,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--fs",
-        type=str,
+        type=int,
         help="(Optional) Sampling rate",
     )
     parser.add_argument(
@@ -222,6 +300,12 @@ if __name__ == "__main__":
         default="english",
         help="(Optional)['english','chinese']",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=int(cpu_count()),
+        help="(Optional) Number of processes computing the metrics of audio pairs",
+    )
 
     args = parser.parse_args()
 
@@ -234,4 +318,5 @@ if __name__ == "__main__":
         args.wer_choose,
         args.ltr_path,
         args.language,
+        args.num_workers,
     )
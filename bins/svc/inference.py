@@ -6,8 +6,6 @@
 import argparse
 import os
 import glob
-from tqdm import tqdm
-import json
 import torch
 import time
 
@@ -15,9 +13,8 @@ from models.svc.diffusion.diffusion_inference import DiffusionInference
 from models.svc.comosvc.comosvc_inference import ComoSVCInference
 from models.svc.transformer.transformer_inference import TransformerInference
 from models.svc.vits.vits_inference import VitsInference
+from models.svc.base.svc_engine import SVCEngine
 from utils.util import load_config
-from utils.audio_slicer import split_audio, merge_segments_encodec
-from processors import acoustic_extractor, content_extractor
 
 
 def build_inference(args, cfg, infer_type="from_dataset"):
@@ -32,87 +29,6 @@ def build_inference(args, cfg, infer_type="from_dataset"):
     return inference_class(args, cfg, infer_type)
 
 
-def prepare_for_audio_file(args, cfg, num_workers=1):
-    preprocess_path = cfg.preprocess.processed_dir
-    audio_name = cfg.inference.source_audio_name
-    temp_audio_dir = os.path.join(preprocess_path, audio_name)
-
-    ### eval file
-    t = time.time()
-    eval_file = prepare_source_eval_file(cfg, temp_audio_dir, audio_name)
-    args.source = eval_file
-    with open(eval_file, "r") as f:
-        metadata = json.load(f)
-    print("Prepare for meta eval data: {:.1f}s".format(time.time() - t))
-
-    ### acoustic features
-    t = time.time()
-    acoustic_extractor.extract_utt_acoustic_features_serial(
-        metadata, temp_audio_dir, cfg
-    )
-    if cfg.preprocess.use_min_max_norm_mel == True:
-        acoustic_extractor.cal_mel_min_max(
-            dataset=audio_name, output_path=preprocess_path, cfg=cfg, metadata=metadata
-        )
-    acoustic_extractor.cal_pitch_statistics_svc(
-        dataset=audio_name, output_path=preprocess_path, cfg=cfg, metadata=metadata
-    )
-    print("Prepare for acoustic features: {:.1f}s".format(time.time() - t))
-
-    ### content features
-    t = time.time()
-    content_extractor.extract_utt_content_features_dataloader(
-        cfg, metadata, num_workers
-    )
-    print("Prepare for content features: {:.1f}s".format(time.time() - t))
-    return args, cfg, temp_audio_dir
-
-
-def merge_for_audio_segments(audio_files, args, cfg):
-    audio_name = cfg.inference.source_audio_name
-    target_singer_name = args.target_singer
-
-    merge_segments_encodec(
-        wav_files=audio_files,
-        fs=cfg.preprocess.sample_rate,
-        output_path=os.path.join(
-            args.output_dir, "{}_{}.wav".format(audio_name, target_singer_name)
-        ),
-        overlap_duration=cfg.inference.segments_overlap_duration,
-    )
-
-    for tmp_file in audio_files:
-        os.remove(tmp_file)
-
-
-def prepare_source_eval_file(cfg, temp_audio_dir, audio_name):
-    """
-    Prepare the eval file (json) for an audio
-    """
-
-    audio_chunks_results = split_audio(
-        wav_file=cfg.inference.source_audio_path,
-        target_sr=cfg.preprocess.sample_rate,
-        output_dir=os.path.join(temp_audio_dir, "wavs"),
-        max_duration_of_segment=cfg.inference.segments_max_duration,
-        overlap_duration=cfg.inference.segments_overlap_duration,
-    )
-
-    metadata = []
-    for i, res in enumerate(audio_chunks_results):
-        res["index"] = i
-        res["Dataset"] = audio_name
-        res["Singer"] = audio_name
-        res["Uid"] = "{}_{}".format(audio_name, res["Uid"])
-        metadata.append(res)
-
-    eval_file = os.path.join(temp_audio_dir, "eval.json")
-    with open(eval_file, "w") as f:
-        json.dump(metadata, f, indent=4, ensure_ascii=False, sort_keys=True)
-
-    return eval_file
-
-
 def cuda_relevant(deterministic=False):
     torch.cuda.empty_cache()
     # TF32 on Ampere and above
@@ -200,7 +116,21 @@ def build_parser():
         "--keep_cache",
         action="store_true",
         default=True,
-        help="Keep cache files. Only applicable to inference from files.",
+        help="Deprecated, inference from files no longer writes cache files.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Number of segments converted together, segments of different "
+        "files share batches. Only applicable to inference from files.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of threads decoding and extracting acoustic features of "
+        "the next files. Only applicable to inference from files.",
     )
     parser.add_argument(
         "--diffusion_inference_steps",
@@ -231,30 +161,24 @@ def main():
             )
         print("There are {} source audios: ".format(len(audio_list)))
 
-        # Infer for every file as dataset
-        output_root_path = args.output_dir
-        for audio_path in tqdm(audio_list):
-            audio_name = audio_path.split("/")[-1].split(".")[0]
-            args.output_dir = os.path.join(output_root_path, audio_name)
-            print("\n{}\nConversion for {}...\n".format("*" * 10, audio_name))
-
-            cfg.inference.source_audio_path = audio_path
-            cfg.inference.source_audio_name = audio_name
-            cfg.inference.segments_max_duration = 10.0
-            cfg.inference.segments_overlap_duration = 1.0
-
-            # Prepare metadata and features
-            args, cfg, cache_dir = prepare_for_audio_file(args, cfg)
-
-            # Infer from file
-            output_audio_files = infer(args, cfg, infer_type="from_file")
-
-            # Merge the split segments
-            merge_for_audio_segments(output_audio_files, args, cfg)
+        # Load every model once, the files are converted in memory
+        t = time.time()
+        inference = build_inference(args, cfg, infer_type="from_memory")
+        engine = SVCEngine(
+            inference,
+            args,
+            cfg,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            max_duration_of_segment=10.0,
+            overlap_duration=1.0,
+        )
+        print("Model Init: {:.1f}s".format(time.time() - t))
 
-            # Keep or remove caches
-            if not args.keep_cache:
-                os.removedirs(cache_dir)
+        t = time.time()
+        for output_path in engine.convert(audio_list, args.output_dir):
+            print("Saved to {}".format(output_path))
+        print("Model inference: {:.1f}s".format(time.time() - t))
 
     else:
         ### Infer from dataset
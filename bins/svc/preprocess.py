@@ -37,11 +37,8 @@ def extract_acoustic_features(dataset, output_path, cfg, n_workers=1):
         with open(dataset_file, "r") as f:
             metadata.extend(json.load(f))
 
-        # acoustic_extractor.extract_utt_acoustic_features_parallel(
-        #     metadata, dataset_output, cfg, n_workers=n_workers
-        # )
-    acoustic_extractor.extract_utt_acoustic_features_serial(
-        metadata, dataset_output, cfg
+    acoustic_extractor.extract_utt_acoustic_features_parallel(
+        metadata, dataset_output, cfg, n_workers=n_workers
     )
 
 
@@ -124,11 +121,14 @@ def preprocess(cfg, args):
         )
         extract_acoustic_features(dataset, output_path, cfg, args.num_workers)
         # Calculate the statistics of acoustic features
-        if cfg.preprocess.mel_min_max_norm:
-            acoustic_extractor.cal_mel_min_max(dataset, output_path, cfg)
-
-        if cfg.preprocess.extract_pitch:
-            acoustic_extractor.cal_pitch_statistics_svc(dataset, output_path, cfg)
+        acoustic_extractor.cal_acoustic_statistics(
+            dataset,
+            output_path,
+            cfg,
+            mel_min_max=cfg.preprocess.mel_min_max_norm,
+            pitch="voiced" if cfg.preprocess.extract_pitch else None,
+            n_workers=args.num_workers,
+        )
 
     # Copy acoustic features for augmented datasets by creating soft-links
     for dataset in cfg.dataset:
@@ -153,11 +153,14 @@ def preprocess(cfg, args):
         acoustic_extractor.copy_acoustic_features(
             metadata, dataset_dir, src_dataset_dir, cfg
         )
-        if cfg.preprocess.mel_min_max_norm:
-            acoustic_extractor.cal_mel_min_max(dataset, output_path, cfg)
-
-        if cfg.preprocess.extract_pitch:
-            acoustic_extractor.cal_pitch_statistics(dataset, output_path, cfg)
+        acoustic_extractor.cal_acoustic_statistics(
+            dataset,
+            output_path,
+            cfg,
+            mel_min_max=cfg.preprocess.mel_min_max_norm,
+            pitch="outlier" if cfg.preprocess.extract_pitch else None,
+            n_workers=args.num_workers,
+        )
 
     # Prepare the content features
     for dataset in cfg.dataset:
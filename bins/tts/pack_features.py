@@ -0,0 +1,115 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import argparse
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
+
+from utils.util import load_config
+from utils.feature_store import PackedFeatureWriter
+from models.tts.naturalspeech2.ns2_dataset import NS2Dataset
+from models.uniamphion.uniamphion_dataset import UniAmphionDataset
+
+
+def _ns2_features(dataset, utt_info):
+    code, pitch, duration, phone_id = dataset.load_features(utt_info)
+    assert phone_id.dtype != object, "unknown phones in {}".format(utt_info["Uid"])
+    # (T, n_q) rows, so that every utterance is a contiguous slice of its shard
+    return {"code": code.T, "pitch": pitch, "duration": duration, "phone_id": phone_id}
+
+
+def _uniamphion_features(dataset, utt_info):
+    # the TextGrid durations and phone ids, the silence trimming and the DIO pitch
+    return dataset.compile_alignment(utt_info)
+
+
+# dataset class, packed features and how to compute them, for each model type
+PACKED_FEATURES = {
+    "NaturalSpeech2": (
+        NS2Dataset,
+        ["code", "pitch", "duration", "phone_id"],
+        _ns2_features,
+    ),
+    "UniAmphion": (
+        UniAmphionDataset,
+        ["trim", "duration", "phone_id", "pitch"],
+        _uniamphion_features,
+    ),
+}
+
+
+def _load_features(utt_info):
+    return utt_info["Uid"], _features_fn(_dataset, utt_info)
+
+
+def _init_worker(dataset, features_fn):
+    global _dataset, _features_fn
+    _dataset = dataset
+    _features_fn = features_fn
+
+
+def pack_features(cfg, dataset, utts_per_shard=10000, n_workers=1):
+    """Pack the per-utterance features of the train and valid utterances of dataset
+    into memory-mappable shards, read by the dataset class with read_packed:
+    the code, pitch, duration and phone ids for NaturalSpeech2, and the compiled
+    TextGrid alignments and DIO pitch for UniAmphion
+
+    Args:
+        cfg (dict): dictionary that stores configurations
+        dataset (str): name of dataset, e.g. libritts
+        utts_per_shard (int, optional): number of utterances of each shard.
+        n_workers (int, optional): num of processes to load features in parallel.
+    """
+    dataset_cls, feature_names, features_fn = PACKED_FEATURES[cfg.model_type]
+
+    # load the features from the per-utterance files
+    cfg.preprocess.read_packed = False
+
+    datasets = [dataset_cls(cfg, dataset, is_valid=False)]
+    valid_file = os.path.join(
+        cfg.preprocess.processed_dir, dataset, cfg.preprocess.valid_file
+    )
+    if os.path.exists(valid_file):
+        datasets.append(dataset_cls(cfg, dataset, is_valid=True))
+
+    output_dir = os.path.join(
+        cfg.preprocess.processed_dir, dataset, cfg.preprocess.packed_dir
+    )
+    print("Packing {} features to {}".format(dataset, output_dir))
+    packed = set()
+    with PackedFeatureWriter(output_dir, feature_names, utts_per_shard) as writer:
+        for split_dataset in datasets:
+            metadata = [
+                utt_info
+                for utt_info in split_dataset.metadata
+                if utt_info["Uid"] not in packed
+            ]
+            with Pool(n_workers, _init_worker, (split_dataset, features_fn)) as pool:
+                for uid, features in tqdm(
+                    pool.imap(_load_features, metadata, chunksize=64),
+                    total=len(metadata),
+                ):
+                    writer.add(uid, **features)
+                    packed.add(uid)
+    print("Packed {} utterances".format(len(packed)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config", default="config.json", help="json files for configurations."
+    )
+    parser.add_argument("--utts_per_shard", type=int, default=10000)
+    parser.add_argument("--num_workers", type=int, default=int(cpu_count()))
+    args = parser.parse_args()
+    cfg = load_config(args.config)
+
+    for dataset in cfg.dataset:
+        pack_features(cfg, dataset, args.utts_per_shard, args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
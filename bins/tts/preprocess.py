@@ -42,11 +42,8 @@ def extract_acoustic_features(dataset, output_path, cfg, dataset_types, n_worker
         with open(dataset_file, "r") as f:
             metadata.extend(json.load(f))
 
-        # acoustic_extractor.extract_utt_acoustic_features_parallel(
-        #     metadata, dataset_output, cfg, n_workers=n_workers
-        # )
-    acoustic_extractor.extract_utt_acoustic_features_serial(
-        metadata, dataset_output, cfg
+    acoustic_extractor.extract_utt_acoustic_features_parallel(
+        metadata, dataset_output, cfg, n_workers=n_workers
     )
 
 
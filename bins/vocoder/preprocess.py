@@ -37,8 +37,8 @@ def extract_acoustic_features(dataset, output_path, cfg, n_workers=1):
         with open(dataset_file, "r") as f:
             metadata.extend(json.load(f))
 
-    acoustic_extractor.extract_utt_acoustic_features_serial(
-        metadata, dataset_output, cfg
+    acoustic_extractor.extract_utt_acoustic_features_parallel(
+        metadata, dataset_output, cfg, n_workers=n_workers
     )
 
 
@@ -102,7 +102,9 @@ def preprocess(cfg, args):
         extract_acoustic_features(dataset, output_path, cfg, args.num_workers)
         # Calculate the statistics of acoustic features
         if cfg.preprocess.mel_min_max_norm:
-            acoustic_extractor.cal_mel_min_max(dataset, output_path, cfg)
+            acoustic_extractor.cal_mel_min_max(
+                dataset, output_path, cfg, n_workers=args.num_workers
+            )
 
     # Copy acoustic features for augmented datasets by creating soft-links
     for dataset in cfg.dataset:
@@ -127,11 +129,14 @@ def preprocess(cfg, args):
         acoustic_extractor.copy_acoustic_features(
             metadata, dataset_dir, src_dataset_dir, cfg
         )
-        if cfg.preprocess.mel_min_max_norm:
-            acoustic_extractor.cal_mel_min_max(dataset, output_path, cfg)
-
-        if cfg.preprocess.extract_pitch:
-            acoustic_extractor.cal_pitch_statistics(dataset, output_path, cfg)
+        acoustic_extractor.cal_acoustic_statistics(
+            dataset,
+            output_path,
+            cfg,
+            mel_min_max=cfg.preprocess.mel_min_max_norm,
+            pitch="outlier" if cfg.preprocess.extract_pitch else None,
+            n_workers=args.num_workers,
+        )
 
 
 def main():
@@ -0,0 +1,100 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import librosa
+
+import numpy as np
+from numpy import linalg as LA
+
+from utils.util import JsonHParams
+from utils.f0 import get_f0_features_using_parselmouth
+
+
+class AudioPair(object):
+    """The ground truth and the predicted audio of an utterance, decoded once.
+
+    The waveforms and the features shared by several metrics (resampled audio, F0,
+    energy) are computed on first use and cached, so the metrics computed on the same
+    pair neither reload the audio files nor extract the same features again.
+    audio_ref: path to the ground truth audio.
+    audio_deg: path to the predicted audio.
+    fs: sampling rate, the default one of librosa.load if None.
+    """
+
+    def __init__(self, audio_ref, audio_deg, fs=None):
+        self.audio_ref = audio_ref
+        self.audio_deg = audio_deg
+        self.fs = fs
+        self.cache = {}
+
+    def _cached(self, key, func):
+        if key not in self.cache:
+            self.cache[key] = func()
+        return self.cache[key]
+
+    def load(self):
+        """Return the ground truth audio, the predicted audio and the sampling rate"""
+        return self._cached("audio", self._load)
+
+    def _load(self):
+        if self.fs != None:
+            audio_ref, _ = librosa.load(self.audio_ref, sr=self.fs)
+            audio_deg, _ = librosa.load(self.audio_deg, sr=self.fs)
+            fs = self.fs
+        else:
+            audio_ref, fs = librosa.load(self.audio_ref)
+            audio_deg, fs = librosa.load(self.audio_deg)
+        return audio_ref, audio_deg, fs
+
+    def resample(self, target_sr):
+        """Return both audios resampled to target_sr"""
+
+        def resample():
+            audio_ref, audio_deg, fs = self.load()
+            if fs == target_sr:
+                return audio_ref, audio_deg
+            return (
+                librosa.resample(audio_ref, orig_sr=fs, target_sr=target_sr),
+                librosa.resample(audio_deg, orig_sr=fs, target_sr=target_sr),
+            )
+
+        return self._cached(("resample", target_sr), resample)
+
+    def f0(self, hop_length, f0_min, f0_max, pitch_bin, pitch_max, pitch_min):
+        """Return the parselmouth F0 of both audios"""
+
+        def f0():
+            audio_ref, audio_deg, fs = self.load()
+
+            cfg = JsonHParams()
+            cfg.sample_rate = fs
+            cfg.hop_size = hop_length
+            cfg.f0_min = f0_min
+            cfg.f0_max = f0_max
+            cfg.pitch_bin = pitch_bin
+            cfg.pitch_max = pitch_max
+            cfg.pitch_min = pitch_min
+
+            f0_ref = get_f0_features_using_parselmouth(audio_ref, cfg)[0]
+            f0_deg = get_f0_features_using_parselmouth(audio_deg, cfg)[0]
+            return f0_ref, f0_deg
+
+        key = ("f0", hop_length, f0_min, f0_max, pitch_bin, pitch_max, pitch_min)
+        return self._cached(key, f0)
+
+    def energy(self, n_fft, hop_length, win_length):
+        """Return the frame energy (the norm of the STFT magnitude) of both audios"""
+
+        def energy():
+            audio_ref, audio_deg, _ = self.load()
+            energies = []
+            for audio in [audio_ref, audio_deg]:
+                spec = librosa.stft(
+                    y=audio, n_fft=n_fft, hop_length=hop_length, win_length=win_length
+                )
+                energies.append(LA.norm(np.abs(spec).T, axis=1))
+            return tuple(energies)
+
+        return self._cached(("energy", n_fft, hop_length, win_length), energy)
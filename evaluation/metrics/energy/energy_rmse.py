@@ -8,7 +8,8 @@ import librosa
 import torch
 
 import numpy as np
-from numpy import linalg as LA
+
+from evaluation.metrics.audio_pair import AudioPair
 
 
 def extract_energy_rmse(
@@ -20,6 +21,7 @@ def extract_energy_rmse(
     win_length=1024,
     method="dtw",
     db_scale=True,
+    pair=None,
 ):
     """Compute Energy Root Mean Square Error (RMSE) between the predicted and the ground truth audio.
     audio_ref: path to the ground truth audio.
@@ -31,30 +33,12 @@ def extract_energy_rmse(
     method: "dtw" will use dtw algorithm to align the length of the ground truth and predicted audio.
             "cut" will cut both audios into a same length according to the one with the shorter length.
     db_scale: the ground truth and predicted audio will be converted to db_scale if "True".
+    pair: AudioPair of the two audios, to share the decoded audio and features with other metrics.
     """
-    # Load audio
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
-
-    # STFT
-    spec_ref = librosa.stft(
-        y=audio_ref, n_fft=n_fft, hop_length=hop_length, win_length=win_length
-    )
-    spec_deg = librosa.stft(
-        y=audio_deg, n_fft=n_fft, hop_length=hop_length, win_length=win_length
-    )
-
-    # Get magnitudes
-    mag_ref = np.abs(spec_ref).T
-    mag_deg = np.abs(spec_deg).T
-
-    # Convert spectrogram to energy
-    energy_ref = LA.norm(mag_ref, axis=1)
-    energy_deg = LA.norm(mag_deg, axis=1)
+    # Get energy from the STFT magnitudes
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    energy_ref, energy_deg = pair.energy(n_fft, hop_length, win_length)
 
     # Convert to db_scale
     if db_scale:
@@ -9,6 +9,7 @@ import librosa
 import torch
 
 import numpy as np
+from evaluation.metrics.audio_pair import AudioPair
 
 
 def extract_f0_periodicity_rmse(
@@ -17,6 +18,7 @@ def extract_f0_periodicity_rmse(
     fs=None,
     hop_length=256,
     method="dtw",
+    pair=None,
 ):
     """Compute f0 periodicity Root Mean Square Error (RMSE) between the predicted and the ground truth audio.
     audio_ref: path to the ground truth audio.
@@ -25,14 +27,12 @@ def extract_f0_periodicity_rmse(
     hop_length: hop length.
     method: "dtw" will use dtw algorithm to align the length of the ground truth and predicted audio.
             "cut" will cut both audios into a same length according to the one with the shorter length.
+    pair: AudioPair of the two audios, to share the decoded audio and features with other metrics.
     """
     # Load audio
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    audio_ref, audio_deg, fs = pair.load()
 
     # Convert to torch
     audio_ref = torch.from_numpy(audio_ref).unsqueeze(0)
@@ -9,8 +9,8 @@ import torch
 
 import numpy as np
 
-from utils.util import JsonHParams
-from utils.f0 import get_f0_features_using_parselmouth, get_pitch_sub_median
+from evaluation.metrics.audio_pair import AudioPair
+from utils.f0 import get_pitch_sub_median
 
 
 ZERO = 1e-8
@@ -28,6 +28,7 @@ def extract_f0rmse(
     pitch_min=50.0,
     need_mean=True,
     method="dtw",
+    pair=None,
 ):
     """Compute F0 Root Mean Square Error (RMSE) between the predicted and the ground truth audio.
     audio_ref: path to the ground truth audio.
@@ -42,35 +43,14 @@ def extract_f0rmse(
     need_mean: subtract the mean value from f0 if "True".
     method: "dtw" will use dtw algorithm to align the length of the ground truth and predicted audio.
             "cut" will cut both audios into a same length according to the one with the shorter length.
+    pair: AudioPair of the two audios, to share the decoded audio and features with other metrics.
     """
-    # Load audio
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
-
-    # Initialize config for f0 extraction
-    cfg = JsonHParams()
-    cfg.sample_rate = fs
-    cfg.hop_size = hop_length
-    cfg.f0_min = f0_min
-    cfg.f0_max = f0_max
-    cfg.pitch_bin = pitch_bin
-    cfg.pitch_max = pitch_max
-    cfg.pitch_min = pitch_min
-
     # Extract f0
-    f0_ref = get_f0_features_using_parselmouth(
-        audio_ref,
-        cfg,
-    )[0]
-
-    f0_deg = get_f0_features_using_parselmouth(
-        audio_deg,
-        cfg,
-    )[0]
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    f0_ref, f0_deg = pair.f0(
+        hop_length, f0_min, f0_max, pitch_bin, pitch_max, pitch_min
+    )
 
     # Subtract mean value from f0
     if need_mean:
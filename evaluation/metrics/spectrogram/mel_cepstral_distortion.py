@@ -5,17 +5,31 @@
 
 from pymcd.mcd import Calculate_MCD
 
+from evaluation.metrics.audio_pair import AudioPair
 
-def extract_mcd(audio_ref, audio_deg, fs=None, mode="dtw_sl"):
+
+class _ArrayMCD(Calculate_MCD):
+    """Calculate_MCD of decoded audios: calculate_mcd takes the audio arrays."""
+
+    def load_wav(self, wav, sample_rate):
+        return wav
+
+
+def extract_mcd(audio_ref, audio_deg, fs=None, mode="dtw_sl", pair=None):
     """Extract Mel-Cepstral Distance for a two given audio.
     Args:
         audio_ref: The given reference audio. It is an audio path.
         audio_deg: The given synthesized audio. It is an audio path.
         mode: "plain", "dtw" and "dtw_sl".
+        pair: AudioPair of the two audios, to share the decoded audio with other metrics.
     """
-    mcd_toolbox = Calculate_MCD(MCD_mode=mode)
-    if fs != None:
-        mcd_toolbox.SAMPLING_RATE = fs
+    mcd_toolbox = _ArrayMCD(MCD_mode=mode)
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    audio_ref, audio_deg, fs = pair.load()
+    mcd_toolbox.SAMPLING_RATE = fs
+
+    # Use the decoded audios instead of loading the files again
     mcd_value = mcd_toolbox.calculate_mcd(audio_ref, audio_deg)
 
     return mcd_value
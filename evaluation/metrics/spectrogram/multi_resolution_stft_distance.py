@@ -7,6 +7,7 @@ import librosa
 import torch
 
 import numpy as np
+from evaluation.metrics.audio_pair import AudioPair
 
 
 def extract_mstft(
@@ -17,6 +18,7 @@ def extract_mstft(
     high_freq=None,
     method="cut",
     version="pwg",
+    pair=None,
 ):
     """Compute Multi-Scale STFT Distance (mstft) between the predicted and the ground truth audio.
     audio_ref: path to the ground truth audio.
@@ -28,14 +30,12 @@ def extract_mstft(
             "cut" will cut both audios into a same length according to the one with the shorter length.
     version: "pwg" will use the computational version provided by ParallelWaveGAN.
              "encodec" will use the computational version provided by Encodec.
+    pair: AudioPair of the two audios, to share the decoded audio and features with other metrics.
     """
     # Load audio
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    audio_ref, audio_deg, fs = pair.load()
 
     # Automatically choose mid_freq and high_freq if they are not given
     if mid_freq == None:
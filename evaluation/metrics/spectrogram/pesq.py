@@ -8,28 +8,26 @@ import librosa
 import numpy as np
 
 from pypesq import pesq
+from evaluation.metrics.audio_pair import AudioPair
 
 
-def extract_pesq(audio_ref, audio_deg, fs=None, method="cut"):
+def extract_pesq(audio_ref, audio_deg, fs=None, method="cut", pair=None):
     """Extract PESQ for a two given audio.
     audio1: the given reference audio. It is a numpy array.
     audio2: the given synthesized audio. It is a numpy array.
     fs: sampling rate.
     method: "dtw" will use dtw algorithm to align the length of the ground truth and predicted audio.
             "cut" will cut both audios into a same length according to the one with the shorter length.
+    pair: AudioPair of the two audios, to share the decoded audio and features with other metrics.
     """
     # Load audio
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    audio_ref, audio_deg, fs = pair.load()
 
     # Resample
     if fs != 16000:
-        audio_ref = librosa.resample(audio_ref, orig_sr=fs, target_sr=16000)
-        audio_deg = librosa.resample(audio_deg, orig_sr=fs, target_sr=16000)
+        audio_ref, audio_deg = pair.resample(16000)
         fs = 16000
 
     # Audio length alignment
@@ -9,17 +9,15 @@ import librosa
 import numpy as np
 
 from torchmetrics import ScaleInvariantSignalDistortionRatio
+from evaluation.metrics.audio_pair import AudioPair
 
 
-def extract_si_sdr(audio_ref, audio_deg, fs=None, method="cut"):
+def extract_si_sdr(audio_ref, audio_deg, fs=None, method="cut", pair=None):
     si_sdr = ScaleInvariantSignalDistortionRatio()
 
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    audio_ref, audio_deg, fs = pair.load()
 
     if len(audio_ref) != len(audio_deg):
         if method == "cut":
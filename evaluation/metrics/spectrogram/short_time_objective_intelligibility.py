@@ -9,23 +9,24 @@ import librosa
 import numpy as np
 
 from torchmetrics.audio.stoi import ShortTimeObjectiveIntelligibility
+from evaluation.metrics.audio_pair import AudioPair
 
 
-def extract_stoi(audio_ref, audio_deg, fs=None, extended=False, method="cut"):
+def extract_stoi(
+    audio_ref, audio_deg, fs=None, extended=False, method="cut", pair=None
+):
     """Compute Short-Time Objective Intelligibility between the predicted and the ground truth audio.
     audio_ref: path to the ground truth audio.
     audio_deg: path to the predicted audio.
     fs: sampling rate.
     method: "dtw" will use dtw algorithm to align the length of the ground truth and predicted audio.
             "cut" will cut both audios into a same length according to the one with the shorter length.
+    pair: AudioPair of the two audios, to share the decoded audio and features with other metrics.
     """
     # Load audio
-    if fs != None:
-        audio_ref, _ = librosa.load(audio_ref, sr=fs)
-        audio_deg, _ = librosa.load(audio_deg, sr=fs)
-    else:
-        audio_ref, fs = librosa.load(audio_ref)
-        audio_deg, fs = librosa.load(audio_deg)
+    if pair is None:
+        pair = AudioPair(audio_ref, audio_deg, fs)
+    audio_ref, audio_deg, fs = pair.load()
 
     # Initialize method
     stoi = ShortTimeObjectiveIntelligibility(fs, extended)
@@ -33,7 +33,8 @@ class BaseInference(object):
         self.args = args
         self.cfg = cfg
 
-        assert infer_type in ["from_dataset", "from_file"]
+        # from_memory: the caller feeds batches to _inference_each_batch itself
+        assert infer_type in ["from_dataset", "from_file", "from_memory"]
         self.infer_type = infer_type
 
         # init with accelerate
@@ -74,12 +75,15 @@ class BaseInference(object):
             self.logger.debug(f"Random seed: {self.cfg.train.random_seed}")
 
         # setup data_loader
-        with self.accelerator.main_process_first():
-            self.logger.info("Building dataset...")
-            start = time.monotonic_ns()
-            self.test_dataloader = self._build_dataloader()
-            end = time.monotonic_ns()
-            self.logger.info(f"Building dataset done in {(end - start) / 1e6:.2f}ms")
+        if infer_type != "from_memory":
+            with self.accelerator.main_process_first():
+                self.logger.info("Building dataset...")
+                start = time.monotonic_ns()
+                self.test_dataloader = self._build_dataloader()
+                end = time.monotonic_ns()
+                self.logger.info(
+                    f"Building dataset done in {(end - start) / 1e6:.2f}ms"
+                )
 
         # setup model
         with self.accelerator.main_process_first():
@@ -10,6 +10,7 @@ import json
 import os
 import numpy as np
 from utils.data_utils import *
+from utils.feature_store import UtteranceFeatures
 from processors.acoustic_extractor import cal_normalized_mel, load_mel_extrema
 from processors.content_extractor import (
     ContentvecExtractor,
@@ -33,25 +34,25 @@ class SVCDataset(BaseDataset):
 
         if cfg.model.condition_encoder.use_whisper:
             self.whisper_aligner = WhisperExtractor(self.cfg)
-            self.utt2whisper_path = load_content_feature_path(
+            self.utt2whisper = UtteranceFeatures(
                 self.metadata, cfg.preprocess.processed_dir, cfg.preprocess.whisper_dir
             )
 
         if cfg.model.condition_encoder.use_contentvec:
             self.contentvec_aligner = ContentvecExtractor(self.cfg)
-            self.utt2contentVec_path = load_content_feature_path(
+            self.utt2contentVec = UtteranceFeatures(
                 self.metadata,
                 cfg.preprocess.processed_dir,
                 cfg.preprocess.contentvec_dir,
             )
 
         if cfg.model.condition_encoder.use_mert:
-            self.utt2mert_path = load_content_feature_path(
+            self.utt2mert = UtteranceFeatures(
                 self.metadata, cfg.preprocess.processed_dir, cfg.preprocess.mert_dir
             )
         if cfg.model.condition_encoder.use_wenet:
             self.wenet_aligner = WenetExtractor(self.cfg)
-            self.utt2wenet_path = load_content_feature_path(
+            self.utt2wenet = UtteranceFeatures(
                 self.metadata, cfg.preprocess.processed_dir, cfg.preprocess.wenet_dir
             )
 
@@ -66,21 +67,21 @@ class SVCDataset(BaseDataset):
         if self.cfg.model.condition_encoder.use_whisper:
             assert "target_len" in single_feature.keys()
             aligned_whisper_feat = self.whisper_aligner.offline_align(
-                np.load(self.utt2whisper_path[utt]), single_feature["target_len"]
+                self.utt2whisper[utt], single_feature["target_len"]
             )
             single_feature["whisper_feat"] = aligned_whisper_feat
 
         if self.cfg.model.condition_encoder.use_contentvec:
             assert "target_len" in single_feature.keys()
             aligned_contentvec = self.contentvec_aligner.offline_align(
-                np.load(self.utt2contentVec_path[utt]), single_feature["target_len"]
+                self.utt2contentVec[utt], single_feature["target_len"]
             )
             single_feature["contentvec_feat"] = aligned_contentvec
 
         if self.cfg.model.condition_encoder.use_mert:
             assert "target_len" in single_feature.keys()
             aligned_mert_feat = align_content_feature_length(
-                np.load(self.utt2mert_path[utt]),
+                self.utt2mert[utt],
                 single_feature["target_len"],
                 source_hop=self.cfg.preprocess.mert_hop_size,
             )
@@ -89,7 +90,7 @@ class SVCDataset(BaseDataset):
         if self.cfg.model.condition_encoder.use_wenet:
             assert "target_len" in single_feature.keys()
             aligned_wenet_feat = self.wenet_aligner.offline_align(
-                np.load(self.utt2wenet_path[utt]), single_feature["target_len"]
+                self.utt2wenet[utt], single_feature["target_len"]
             )
             single_feature["wenet_feat"] = aligned_wenet_feat
 
@@ -272,25 +273,25 @@ class SVCTestDataset(BaseTestDataset):
         ######### Load source content features' path #########
         if cfg.model.condition_encoder.use_whisper:
             self.whisper_aligner = WhisperExtractor(cfg)
-            self.utt2whisper_path = load_content_feature_path(
+            self.utt2whisper = UtteranceFeatures(
                 self.metadata, cfg.preprocess.processed_dir, cfg.preprocess.whisper_dir
             )
 
         if cfg.model.condition_encoder.use_contentvec:
             self.contentvec_aligner = ContentvecExtractor(cfg)
-            self.utt2contentVec_path = load_content_feature_path(
+            self.utt2contentVec = UtteranceFeatures(
                 self.metadata,
                 cfg.preprocess.processed_dir,
                 cfg.preprocess.contentvec_dir,
             )
 
         if cfg.model.condition_encoder.use_mert:
-            self.utt2mert_path = load_content_feature_path(
+            self.utt2mert = UtteranceFeatures(
                 self.metadata, cfg.preprocess.processed_dir, cfg.preprocess.mert_dir
             )
         if cfg.model.condition_encoder.use_wenet:
             self.wenet_aligner = WenetExtractor(cfg)
-            self.utt2wenet_path = load_content_feature_path(
+            self.utt2wenet = UtteranceFeatures(
                 self.metadata, cfg.preprocess.processed_dir, cfg.preprocess.wenet_dir
             )
 
@@ -371,21 +372,21 @@ class SVCTestDataset(BaseTestDataset):
         if self.cfg.model.condition_encoder.use_whisper:
             assert "target_len" in single_feature.keys()
             aligned_whisper_feat = self.whisper_aligner.offline_align(
-                np.load(self.utt2whisper_path[utt]), single_feature["target_len"]
+                self.utt2whisper[utt], single_feature["target_len"]
             )
             single_feature["whisper_feat"] = aligned_whisper_feat
 
         if self.cfg.model.condition_encoder.use_contentvec:
             assert "target_len" in single_feature.keys()
             aligned_contentvec = self.contentvec_aligner.offline_align(
-                np.load(self.utt2contentVec_path[utt]), single_feature["target_len"]
+                self.utt2contentVec[utt], single_feature["target_len"]
             )
             single_feature["contentvec_feat"] = aligned_contentvec
 
         if self.cfg.model.condition_encoder.use_mert:
             assert "target_len" in single_feature.keys()
             aligned_mert_feat = align_content_feature_length(
-                np.load(self.utt2mert_path[utt]),
+                self.utt2mert[utt],
                 single_feature["target_len"],
                 source_hop=self.cfg.preprocess.mert_hop_size,
             )
@@ -394,7 +395,7 @@ class SVCTestDataset(BaseTestDataset):
         if self.cfg.model.condition_encoder.use_wenet:
             assert "target_len" in single_feature.keys()
             aligned_wenet_feat = self.wenet_aligner.offline_align(
-                np.load(self.utt2wenet_path[utt]), single_feature["target_len"]
+                self.utt2wenet[utt], single_feature["target_len"]
             )
             single_feature["wenet_feat"] = aligned_wenet_feat
 
@@ -0,0 +1,366 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import json
+import itertools
+import collections
+import concurrent.futures
+import numpy as np
+import torch
+import torchaudio
+from torch.nn.utils.rnn import pad_sequence
+
+from utils.io import save_audio
+from utils.audio_slicer import is_silence, merge_waveforms_encodec
+from utils.data_utils import (
+    align_length,
+    align_content_feature_length,
+    transpose_key,
+    pitch_shift_to_target,
+)
+from processors.acoustic_extractor import (
+    extract_acoustic_features_from_wav,
+    load_mel_extrema,
+    normalize_mel_channel,
+)
+from processors.content_extractor import (
+    WhisperExtractor,
+    ContentvecExtractor,
+    WenetExtractor,
+    MertExtractor,
+)
+from models.svc.base.svc_dataset import SVCTestCollator
+from models.vocoders.vocoder_inference import load_nnvocoder, _vocoder_infer_funcs
+
+EPS = 1.0e-12
+
+
+class SVCEngine:
+    """Conversion of many source files with every model loaded only once.
+
+    The acoustic model (an ``SVCInference`` built with ``infer_type="from_memory"``),
+    the content extractors and the vocoder stay resident. Every source file is
+    decoded and split into overlapping segments in memory, and its acoustic
+    features are extracted by a thread pool while the GPU converts the segments of
+    the previous files. Segments of different files share batches, only the merged
+    conversion of each file is written to disk.
+
+    The features are the same as ``prepare_for_audio_file`` + ``SVCTestDataset``
+    would produce: the source mel extrema and f0 median are computed over the
+    segments of the file, and the target side comes from ``args.target_singer``.
+    """
+
+    def __init__(
+        self,
+        inference,
+        args,
+        cfg,
+        batch_size=8,
+        num_workers=4,
+        max_duration_of_segment=10.0,
+        overlap_duration=1.0,
+    ):
+        self.inference = inference
+        self.args = args
+        self.cfg = cfg
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+        self.sample_rate = cfg.preprocess.sample_rate
+        self.segment_len = int(max_duration_of_segment * self.sample_rate)
+        self.stride = int(
+            (max_duration_of_segment - overlap_duration) * self.sample_rate
+        )
+        self.overlap_len = int(overlap_duration * self.sample_rate)
+        self.collator = SVCTestCollator(cfg)
+
+        self._load_target()
+        self._load_content_extractors()
+        if cfg.model_type != "VitsSVC":
+            self._load_vocoder()
+
+    def _load_target(self):
+        cfg = self.cfg
+        target_singer = self.args.target_singer
+        self.target_singer = target_singer.split("_")[-1]
+        self.target_dataset = target_singer.replace(
+            "_{}".format(self.target_singer), ""
+        )
+        # int: key shift, otherwise autoshift
+        try:
+            self.trans_key = int(self.args.trans_key)
+        except ValueError:
+            self.trans_key = self.args.trans_key
+
+        if cfg.preprocess.use_spkid:
+            spk2id_path = os.path.join(self.args.acoustics_dir, cfg.preprocess.spk2id)
+            with open(spk2id_path, "r", encoding="utf-8") as f:
+                spk2id = json.load(f)
+            self.spk_id = np.array(
+                [spk2id[f"{self.target_dataset}_{self.target_singer}"]],
+                dtype=np.int32,
+            )
+
+        if cfg.preprocess.mel_min_max_norm:
+            mel_min, mel_max = load_mel_extrema(cfg.preprocess, self.target_dataset)
+            device = self.inference.accelerator.device
+            self.target_mel_extrema = (
+                torch.as_tensor(mel_min, device=device),
+                torch.as_tensor(mel_max, device=device),
+            )
+
+        if cfg.preprocess.use_frame_pitch:
+            target_f0_statistics_path = os.path.join(
+                cfg.preprocess.processed_dir,
+                self.target_dataset,
+                cfg.preprocess.pitch_dir,
+                "statistics.json",
+            )
+            with open(target_f0_statistics_path, "r", encoding="utf-8") as f:
+                self.target_pitch_median = json.load(f)[
+                    f"{self.target_dataset}_{self.target_singer}"
+                ]["voiced_positions"]["median"]
+
+    def _load_content_extractors(self):
+        extractor_classes = {
+            "whisper": WhisperExtractor,
+            "contentvec": ContentvecExtractor,
+            "wenet": WenetExtractor,
+            "mert": MertExtractor,
+        }
+        self.content_extractors = {}
+        for name, extractor_class in extractor_classes.items():
+            if getattr(self.cfg.model.condition_encoder, "use_{}".format(name)):
+                extractor = extractor_class(self.cfg)
+                extractor.load_model()
+                self.content_extractors[name] = extractor
+
+    def _load_vocoder(self):
+        self.vocoder_cfg, vocoder_ckpt = self.inference._parse_vocoder(
+            self.args.vocoder_dir
+        )
+        self.vocoder = load_nnvocoder(
+            self.vocoder_cfg,
+            self.vocoder_cfg.model.generator,
+            weights_file=vocoder_ckpt,
+            from_multi_gpu=True,
+        )
+
+    def prepare_file(self, audio_path):
+        """Decode, split and extract the acoustic features of a source file (CPU)."""
+        # (#channel, T) -> (T,), as split_audio
+        waveform, fs = torchaudio.load(audio_path)
+        waveform = torchaudio.functional.resample(
+            waveform, orig_freq=fs, new_freq=self.sample_rate
+        )
+        waveform = torch.mean(waveform, dim=0)
+
+        segments = []
+        for i in range(0, len(waveform), self.stride):
+            segment = waveform[i : i + self.segment_len]
+            # the segments used to be saved turned up and then reloaded
+            if not is_silence(segment.numpy(), self.sample_rate):
+                segment = segment * (0.9 / segment.abs().max())
+            segments.append(segment)
+            if i + self.segment_len >= len(waveform):
+                break
+        features = [
+            extract_acoustic_features_from_wav(segment, self.cfg)
+            for segment in segments
+        ]
+
+        # statistics of the source, over all the segments of the file
+        mel_extrema, pitch_median = None, None
+        if self.cfg.preprocess.use_min_max_norm_mel:
+            mel_extrema = (
+                np.min([f["mel"].min(axis=-1) for f in features], axis=0),
+                np.max([f["mel"].max(axis=-1) for f in features], axis=0),
+            )
+        if self.cfg.preprocess.use_frame_pitch:
+            pitch = np.concatenate([f["pitch"] for f in features])
+            pitch_median = np.median(pitch[pitch != 0])
+
+        return {
+            "name": os.path.basename(audio_path).split(".")[0],
+            "segments": segments,
+            "features": features,
+            "mel_extrema": mel_extrema,
+            "pitch_median": pitch_median,
+            "audios": [None] * len(segments),
+        }
+
+    def extract_content_features(self, segments):
+        """Content features of a batch of segments, {name: [(frames, dim)]}"""
+        content_features = {}
+        for name, extractor in self.content_extractors.items():
+            sr = getattr(self.cfg.preprocess, "{}_sample_rate".format(name))
+            wavs = [
+                torchaudio.functional.resample(segment, self.sample_rate, sr)
+                for segment in segments
+            ]
+            lens = [len(wav) for wav in wavs]
+            with torch.no_grad():
+                features = extractor.extract_content_features(
+                    pad_sequence(wavs, batch_first=True), lens
+                )
+            content_features[name] = [
+                extractor.trim_feature(features[i], lens[i] / sr)
+                for i in range(len(wavs))
+            ]
+        return content_features
+
+    def get_item(self, job, index):
+        """The single_feature dict of SVCTestDataset.__getitem__, from memory, without
+        the content features (aligned for the whole batch in run_batch)."""
+        cfg = self.cfg
+        features = job["features"][index]
+        single_feature = {}
+
+        if cfg.preprocess.use_spkid:
+            single_feature["spk_id"] = self.spk_id
+
+        if cfg.preprocess.use_mel:
+            mel = features["mel"]
+            assert mel.shape[0] == cfg.preprocess.n_mel  # [n_mels, T]
+            if cfg.preprocess.use_min_max_norm_mel:
+                mel = normalize_mel_channel(mel, *job["mel_extrema"])
+            single_feature["target_len"] = mel.shape[1]
+            single_feature["mel"] = mel.T  # [T, n_mels]
+
+        if cfg.preprocess.use_frame_pitch:
+            frame_pitch = features["pitch"]
+            if self.trans_key:
+                if type(self.trans_key) == int:
+                    frame_pitch = transpose_key(frame_pitch, self.trans_key)
+                else:
+                    frame_pitch = pitch_shift_to_target(
+                        frame_pitch, self.target_pitch_median, job["pitch_median"]
+                    )
+            if "target_len" not in single_feature.keys():
+                single_feature["target_len"] = len(frame_pitch)
+            single_feature["frame_pitch"] = align_length(
+                frame_pitch, single_feature["target_len"]
+            )
+
+            if cfg.preprocess.use_uv:
+                frame_uv = align_length(features["uv"], single_feature["target_len"])
+                single_feature["frame_uv"] = np.where(frame_uv, 0, 1)
+
+        if cfg.preprocess.use_frame_energy:
+            frame_energy = features["energy"]
+            if "target_len" not in single_feature.keys():
+                single_feature["target_len"] = len(frame_energy)
+            single_feature["frame_energy"] = align_length(
+                frame_energy, single_feature["target_len"]
+            )
+
+        return single_feature
+
+    @torch.inference_mode()
+    def convert_batch(self, items):
+        """Convert collated segments into waveforms (list of (T,) cpu tensors)."""
+        batch = self.collator(items)
+        target_lens = batch["target_len"].tolist()
+        hop_size = self.cfg.preprocess.hop_size
+
+        y_pred = self.inference._inference_each_batch(batch)
+        if self.cfg.model_type == "VitsSVC":
+            return [
+                audio.reshape(-1)[: frames * hop_size].float().cpu()
+                for audio, frames in zip(y_pred, target_lens)
+            ]
+
+        if self.cfg.preprocess.mel_min_max_norm:
+            mel_min, mel_max = self.target_mel_extrema
+            y_pred = (y_pred + 1.0) / 2.0 * (mel_max - mel_min + EPS) + mel_min
+        # (T, n_mels) -> (n_mels, T)
+        mels = [y[:frames].T for y, frames in zip(y_pred, target_lens)]
+        vocoder_name = self.vocoder_cfg.model.generator
+        return _vocoder_infer_funcs[vocoder_name](
+            self.vocoder_cfg, self.vocoder, mels, batch_size=len(mels)
+        )
+
+    def run_batch(self, entries):
+        """Convert a batch of (job, segment index) and store the audios in the jobs."""
+        segments = [job["segments"][index] for job, index in entries]
+        content_features = self.extract_content_features(segments)
+        items = [self.get_item(job, index) for job, index in entries]
+
+        target_lens = [item["target_len"] for item in items]
+        for name, extractor in self.content_extractors.items():
+            if name == "mert":
+                aligned_features = [
+                    align_content_feature_length(
+                        feature,
+                        target_len,
+                        source_hop=self.cfg.preprocess.mert_hop_size,
+                    )
+                    for feature, target_len in zip(content_features[name], target_lens)
+                ]
+            else:
+                aligned_features = extractor.offline_align_batch(
+                    content_features[name], target_lens
+                )
+            for item, feature in zip(items, aligned_features):
+                item["{}_feat".format(name)] = feature
+        for (job, index), audio in zip(entries, self.convert_batch(items)):
+            job["audios"][index] = audio
+
+    def save(self, job, output_root):
+        """Merge the converted segments of a file, as merge_for_audio_segments."""
+        audios = []
+        for audio in job["audios"]:
+            audio = audio.float()
+            if not is_silence(audio.numpy(), self.sample_rate):
+                audio = audio * (0.9 / audio.abs().max())
+            audios.append(audio)
+
+        output_dir = os.path.join(output_root, job["name"])
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(
+            output_dir, "{}_{}.wav".format(job["name"], self.args.target_singer)
+        )
+        if len(audios) == 1:
+            save_audio(output_path, audios[0], self.sample_rate, turn_up=False)
+        else:
+            merged = merge_waveforms_encodec(audios, self.overlap_len)
+            save_audio(output_path, merged, self.sample_rate, turn_up=True)
+        return output_path
+
+    def prepare_files(self, audio_list):
+        """Yield prepared files in order, a few files are decoded ahead."""
+        executor = concurrent.futures.ThreadPoolExecutor(self.num_workers)
+        audio_iter = iter(audio_list)
+        futures = collections.deque(
+            executor.submit(self.prepare_file, audio_path)
+            for audio_path in itertools.islice(audio_iter, 2 * self.num_workers)
+        )
+        while futures:
+            job = futures.popleft().result()
+            for audio_path in itertools.islice(audio_iter, 1):
+                futures.append(executor.submit(self.prepare_file, audio_path))
+            yield job
+        executor.shutdown()
+
+    def convert(self, audio_list, output_root):
+        """Convert all the files, yield the output path of each finished file."""
+        queue, jobs = [], collections.deque()
+
+        def run(num_segments):
+            entries = queue[:num_segments]
+            del queue[:num_segments]
+            self.run_batch(entries)
+            # segments are converted in order, finished files are at the front
+            while jobs and all(audio is not None for audio in jobs[0]["audios"]):
+                yield self.save(jobs.popleft(), output_root)
+
+        for job in self.prepare_files(audio_list):
+            jobs.append(job)
+            queue.extend((job, index) for index in range(len(job["segments"])))
+            while len(queue) >= self.batch_size:
+                yield from run(self.batch_size)
+        while queue:
+            yield from run(self.batch_size)
@@ -21,7 +21,7 @@ from utils.audio_slicer import is_silence
 
 class VitsInference(SVCInference):
     def __init__(self, args=None, cfg=None, infer_type="from_dataset"):
-        SVCInference.__init__(self, args, cfg)
+        SVCInference.__init__(self, args, cfg, infer_type)
 
     def _build_model(self):
         net_g = SynthesizerTrn(
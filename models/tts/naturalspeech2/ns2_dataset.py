@@ -9,6 +9,7 @@ from torch.nn.utils.rnn import pad_sequence
 from utils.data_utils import *
 from processors.acoustic_extractor import cal_normalized_mel
 from processors.acoustic_extractor import load_normalized
+from utils.feature_store import PackedFeatureReader
 from models.base.base_dataset import (
     BaseCollator,
     BaseDataset,
@@ -145,6 +146,13 @@ class NS2Dataset(torch.utils.data.Dataset):
         # get phone to id / id to phone map
         self.phone2id, self.id2phone = self.get_phone_map()
 
+        # features packed by bins/tts/pack_features.py
+        self.packed_features = None
+        if cfg.preprocess.read_packed:
+            self.packed_features = PackedFeatureReader(
+                os.path.join(processed_data_dir, cfg.preprocess.packed_dir)
+            )
+
         self.all_num_frames = []
         for i in range(len(self.metadata)):
             self.all_num_frames.append(self.metadata[i]["num_frames"])
@@ -175,16 +183,32 @@ class NS2Dataset(torch.utils.data.Dataset):
         id2phone = {i: s for s, i in phone2id.items()}
         return phone2id, id2phone
 
-    def __getitem__(self, index):
-        utt_info = self.metadata[index]
+    def get_phone_id(self, utt):
+        return np.array(
+            [
+                *map(
+                    self.phone2id.get,
+                    self.utt2phone[utt].replace("{", "").replace("}", "").split(),
+                )
+            ]
+        )
 
+    def load_features(self, utt_info):
+        """Return the code (n_q, T), pitch (T,), duration (N,) and phone_id (N,)"""
         dataset = utt_info["Dataset"]
         uid = utt_info["Uid"]
         utt = "{}_{}".format(dataset, uid)
 
-        single_feature = dict()
+        if self.packed_features is not None:
+            # zero-copy slices of the memory-mapped shards, the code is stored as
+            # (T, n_q) rows; duration is modified in place by align_length
+            features = self.packed_features.get(uid)
+            code = features["code"].T
+            pitch = features["pitch"]
+            duration = np.array(features["duration"])
+            phone_id = features["phone_id"]
 
-        if self.cfg.preprocess.read_metadata:
+        elif self.cfg.preprocess.read_metadata:
             metadata_uid_path = os.path.join(
                 self.cfg.preprocess.processed_dir,
                 self.cfg.preprocess.metadata_dir,
@@ -196,40 +220,37 @@ class NS2Dataset(torch.utils.data.Dataset):
                 metadata_uid = pickle.load(f)
             # code
             code = metadata_uid["code"]
-            # frame_nums
-            frame_nums = code.shape[1]
             # pitch
             pitch = metadata_uid["pitch"]
             # duration
             duration = metadata_uid["duration"]
             # phone_id
-            phone_id = np.array(
-                [
-                    *map(
-                        self.phone2id.get,
-                        self.utt2phone[utt].replace("{", "").replace("}", "").split(),
-                    )
-                ]
-            )
+            phone_id = self.get_phone_id(utt)
 
         else:
             # code
             code = np.load(self.utt2code_path[utt])
-            # frame_nums
-            frame_nums = code.shape[1]
             # pitch
             pitch = np.load(self.utt2pitch_path[utt])
             # duration
             duration = np.load(self.utt2duration_path[utt])
             # phone_id
-            phone_id = np.array(
-                [
-                    *map(
-                        self.phone2id.get,
-                        self.utt2phone[utt].replace("{", "").replace("}", "").split(),
-                    )
-                ]
-            )
+            phone_id = self.get_phone_id(utt)
+
+        return code, pitch, duration, phone_id
+
+    def __getitem__(self, index):
+        utt_info = self.metadata[index]
+
+        dataset = utt_info["Dataset"]
+        uid = utt_info["Uid"]
+        utt = "{}_{}".format(dataset, uid)
+
+        single_feature = dict()
+
+        code, pitch, duration, phone_id = self.load_features(utt_info)
+        # frame_nums
+        frame_nums = code.shape[1]
 
         # align length
         code, pitch, duration, phone_id, frame_nums = self.align_length(
@@ -249,17 +270,11 @@ class NS2Dataset(torch.utils.data.Dataset):
 
         # phone_id_frame
         assert len(phone_id) == len(duration)
-        phone_id_frame = []
-        for i in range(len(phone_id)):
-            phone_id_frame.extend([phone_id[i] for _ in range(duration[i])])
-        phone_id_frame = np.array(phone_id_frame)
+        phone_id_frame = np.repeat(phone_id, duration)
 
         # ref_phone_id_frame
         assert len(ref_phone_id) == len(ref_duration)
-        ref_phone_id_frame = []
-        for i in range(len(ref_phone_id)):
-            ref_phone_id_frame.extend([ref_phone_id[i] for _ in range(ref_duration[i])])
-        ref_phone_id_frame = np.array(ref_phone_id_frame)
+        ref_phone_id_frame = np.repeat(ref_phone_id, ref_duration)
 
         single_feature.update(
             {
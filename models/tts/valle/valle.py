@@ -450,6 +450,7 @@ class VALLE(nn.Module):
         enroll_x_lens: torch.Tensor,
         top_k: int = -100,
         temperature: float = 1.0,
+        use_kv_cache: bool = True,
     ) -> torch.Tensor:
         """
         Args:
@@ -464,6 +465,9 @@ class VALLE(nn.Module):
             The number of highest probability tokens to keep for top-k-filtering. Default to -100.
           temperature: (`optional`) float
             The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          use_kv_cache: (`optional`) bool
+            Incremental AR decoding with key/value caches, otherwise the whole sequence
+            is run through the AR decoder at each step. Default to True.
         Returns:
           Return the predicted audio code matrix.
         """
@@ -475,10 +479,6 @@ class VALLE(nn.Module):
         assert torch.all(x_lens > 0)
 
         text = x
-        x = self.ar_text_embedding(text)
-        x = self.ar_text_prenet(x)
-        x = self.ar_text_position(x)
-
         text_len = x_lens.max()
         prompts = y
         prefix_len = y.shape[1]
@@ -488,6 +488,208 @@ class VALLE(nn.Module):
         if self.ar_audio_prepend_bos:
             y = F.pad(y, (1, 0), value=self.audio_token_num + 1)
 
+        if use_kv_cache:
+            samples = self._ar_inference_cached(
+                text,
+                x_lens,
+                prompts[..., 0],
+                torch.full_like(x_lens, prefix_len),
+                top_k=top_k,
+                temperature=temperature,
+            )[0]
+            y = torch.concat([y, samples[None]], dim=1)
+        else:
+            y = self._ar_inference_uncached(
+                text, x_lens, y, prefix_len, top_k, temperature
+            )
+
+        return self._nar_inference(text, text_len, prompts, y, enroll_x_lens)
+
+    def batch_inference(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        y_lens: torch.Tensor,
+        enroll_x_lens: torch.Tensor,
+        top_k: int = -100,
+        temperature: float = 1.0,
+    ) -> List[torch.Tensor]:
+        """
+        Batched inference, the AR decoder generates all the sequences together with
+        key/value caches and stops each one at its own EOS.
+        Args:
+          x:
+            A 2-D tensor of shape (N, S).
+          x_lens:
+            A 1-D tensor of shape (N,). It contains the number of tokens in `x`
+            before padding.
+          y:
+            A 3-D tensor of shape (N, T, 8), the padded prompt codes.
+          y_lens:
+            A 1-D tensor of shape (N,). It contains the number of frames in `y`
+            before padding.
+          enroll_x_lens:
+            A 1-D tensor of shape (N,), the number of tokens of the prompt texts.
+        Returns:
+          Return the N predicted audio code matrices, each of shape (1, T_n, 8).
+        """
+        assert x.ndim == 2, x.shape
+        assert x_lens.ndim == 1, x_lens.shape
+        assert y.ndim == 3, y.shape
+        assert y_lens.ndim == 1, y_lens.shape
+
+        assert torch.all(x_lens > 0)
+
+        generated = self._ar_inference_cached(
+            x, x_lens, y[..., 0], y_lens, top_k=top_k, temperature=temperature
+        )
+
+        # The NAR stages run once per quantizer, per sequence
+        codes = []
+        bos = y.new_full((1, int(self.ar_audio_prepend_bos)), self.audio_token_num + 1)
+        for n, samples in enumerate(generated):
+            text = x[n : n + 1, : x_lens[n]]
+            prompts = y[n : n + 1, : y_lens[n]]
+            y_n = torch.concat([bos, prompts[..., 0], samples[None]], dim=1)
+            codes.append(
+                self._nar_inference(
+                    text,
+                    x_lens[n : n + 1].max(),
+                    prompts,
+                    y_n,
+                    enroll_x_lens[n : n + 1] if enroll_x_lens is not None else None,
+                )
+            )
+        return codes
+
+    def _masked_ar_text_prenet(self, x, x_lens):
+        """
+        ar_text_prenet of padded texts (N, S, D). The padded frames are zeroed before
+        every conv, so each text sees the zero padding of its conversion alone.
+        """
+        if not isinstance(self.ar_text_prenet, nn.Sequential):
+            return self.ar_text_prenet(x)
+        valid = torch.arange(x.shape[1], device=x.device)[None, :] < x_lens[:, None]
+        for layer in self.ar_text_prenet:
+            if isinstance(layer, nn.Conv1d):
+                # (N, D, S) between the Transpose layers
+                x = x * valid[:, None, :].to(x.dtype)
+            x = layer(x)
+        return x
+
+    @torch.no_grad()
+    def _ar_inference_cached(
+        self, x, x_lens, prompts, prompt_lens, top_k=-100, temperature=1.0
+    ):
+        """
+        Incremental AR decoding. The text and the prompts are run through the AR
+        decoder once, then each step only runs the N new tokens over the per-layer
+        key/value caches. The caches, the positional encodings and the masks are
+        allocated once for the longest possible output.
+        Args:
+          x: (N, S) text tokens, x_lens: (N,)
+          prompts: (N, P) codes of the first quantizer, prompt_lens: (N,)
+        Returns:
+          Return the N 1-D tensors of generated codes, without EOS.
+        """
+        device = x.device
+        batch_size = x.shape[0]
+        bos = int(self.ar_audio_prepend_bos)
+
+        x = self.ar_text_embedding(x)
+        x = self._masked_ar_text_prenet(x, x_lens)
+        x = self.ar_text_position(x)
+        x_len = x.shape[1]
+
+        y = prompts
+        if bos:
+            y = F.pad(y, (1, 0), value=self.audio_token_num + 1)
+        y_lens = prompt_lens + bos
+        y_len = y.shape[1]
+
+        # Same stopping rule as the uncached decoding: once the generated codes (and
+        # BOS) exceed 16 per text token
+        limits = x_lens * 16
+        max_steps = int(limits.max()) - bos + 1
+        max_len = x_len + y_len + max_steps
+
+        # Padded text and prompt positions are never attended to
+        positions = torch.arange(max_len, device=device)
+        key_valid = torch.concat(
+            [
+                positions[None, :x_len] < x_lens[:, None],
+                positions[None, : max_len - x_len] < y_lens[:, None],
+            ],
+            dim=1,
+        )
+        key_valid[:, x_len + y_len :] = True
+        key_mask = torch.zeros(
+            (batch_size, 1, 1, max_len), dtype=x.dtype, device=device
+        ).masked_fill(~key_valid[:, None, None, :], float("-inf"))
+
+        # Text attends to the text, audio to the text and the previous audio
+        causal = torch.triu(
+            torch.ones(x_len + y_len, x_len + y_len, dtype=torch.bool, device=device),
+            diagonal=1,
+        )
+        causal[:x_len, :x_len] = False
+        prefill_mask = key_mask[..., : x_len + y_len].masked_fill(
+            causal[None, None], float("-inf")
+        )
+
+        y_emb = self.ar_audio_embedding(y)
+        y_emb = self.ar_audio_prenet(y_emb)
+        self.ar_audio_position.extend_pe(
+            torch.tensor(0.0).expand(1, int(y_lens.max()) + max_steps)
+        )
+        y_pos = self.ar_audio_position(y_emb)
+        xy_pos = torch.concat([x, y_pos], dim=1)
+
+        kv_caches = self.ar_decoder.init_kv_cache(
+            batch_size, max_len, device=device, dtype=xy_pos.dtype
+        )
+        xy_dec = self.ar_decoder.infer(xy_pos, kv_caches, 0, prefill_mask)
+        offset = x_len + y_len
+        last = x_len + y_lens - 1
+        logits = self.ar_predict_layer(xy_dec[torch.arange(batch_size), last])
+
+        samples_list = []
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        num_generated = torch.zeros_like(x_lens)
+        for step in range(max_steps + 1):
+            stop = torch.argmax(logits, dim=-1) == self.audio_token_num
+            samples = topk_sampling(
+                logits, top_k=top_k, top_p=1.0, temperature=temperature
+            )
+            stop = stop | (samples[:, 0] == self.audio_token_num)
+            stop = stop | (bos + step > limits)
+            if step == 0 and bos == 0 and stop.any():
+                raise SyntaxError("well trained model shouldn't reach here.")
+
+            finished = finished | stop
+            num_generated += (~finished).type(num_generated.dtype)
+            samples_list.append(samples)
+            if finished.all():
+                break
+
+            y_emb = self.ar_audio_embedding(samples)
+            y_emb = self.ar_audio_prenet(y_emb)
+            y_pos = self.ar_audio_position.forward_at(y_emb, (y_lens + step)[:, None])
+            xy_dec = self.ar_decoder.infer(
+                y_pos, kv_caches, offset, key_mask[..., : offset + 1]
+            )
+            offset += 1
+            logits = self.ar_predict_layer(xy_dec[:, -1])
+
+        samples = torch.concat(samples_list, dim=1)
+        return [samples[n, : num_generated[n]] for n in range(batch_size)]
+
+    def _ar_inference_uncached(self, text, x_lens, y, prefix_len, top_k, temperature):
+        x = self.ar_text_embedding(text)
+        x = self.ar_text_prenet(x)
+        x = self.ar_text_position(x)
+
         x_len = x_lens.max()
         x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
 
@@ -524,15 +726,19 @@ class VALLE(nn.Module):
             if (
                 torch.argmax(logits, dim=-1)[0] == self.audio_token_num
                 or samples[0, 0] == self.audio_token_num
-                or (y.shape[1] - prompts.shape[1]) > x_lens.max() * 16
+                or (y.shape[1] - prefix_len) > x_lens.max() * 16
             ):
-                if prompts.shape[1] == y.shape[1]:
+                if prefix_len == y.shape[1]:
                     raise SyntaxError("well trained model shouldn't reach here.")
 
                 break
 
             y = torch.concat([y, samples], dim=1)
 
+        return y
+
+    def _nar_inference(self, text, text_len, prompts, y, enroll_x_lens):
+        prefix_len = prompts.shape[1]
         codes = [y[:, prefix_len + int(self.ar_audio_prepend_bos) :]]
         if self.num_quantizers == 1:
             return torch.stack(codes, dim=-1)
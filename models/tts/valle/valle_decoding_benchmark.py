@@ -0,0 +1,132 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Tokens/sec of the VALL-E AR decoder vs. output length: the uncached decoding (the
+# whole sequence at every step), the key/value cached decoding, and the batched
+# cached decoding. EOS is disabled, so each run generates up to the length limit
+# (16 codes per text token).
+
+import argparse
+import json
+import time
+import torch
+
+from utils.util import load_config
+from models.tts.valle.valle import VALLE
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def run(model, x, x_lens, prompts, prompt_lens, mode, device):
+    synchronize(device)
+    start = time.time()
+    if mode == "uncached":
+        y = prompts
+        if model.ar_audio_prepend_bos:
+            y = torch.nn.functional.pad(y, (1, 0), value=model.audio_token_num + 1)
+        y = model._ar_inference_uncached(x, x_lens, y, prompts.shape[1], 1, 1.0)
+        num_tokens = y.shape[1] - prompts.shape[1]
+    else:
+        generated = model._ar_inference_cached(x, x_lens, prompts, prompt_lens, top_k=1)
+        num_tokens = sum(len(samples) for samples in generated)
+    synchronize(device)
+    return num_tokens, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="config/valle.json",
+        help="json files for configurations.",
+    )
+    parser.add_argument("--checkpoint_path", type=str, default=None)
+    parser.add_argument("--output_path", type=str, default="decoding_benchmark.json")
+    parser.add_argument(
+        "--text_lens",
+        type=str,
+        default="4,8,16,32",
+        help="comma separated text lengths, the outputs are 16 times longer",
+    )
+    parser.add_argument("--prompt_frames", type=int, default=225)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--skip_uncached", action="store_true")
+    parser.add_argument("--cuda_id", type=int, default=0)
+    args = parser.parse_args()
+    cfg = load_config(args.config)
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{args.cuda_id}")
+    else:
+        device = torch.device("cpu")
+
+    model = VALLE(cfg.model)
+    if args.checkpoint_path is not None:
+        model.load_state_dict(torch.load(args.checkpoint_path, map_location="cpu"))
+    model.to(device)
+    model.eval()
+
+    def disable_eos(module, input, output):
+        output[..., model.audio_token_num] = float("-inf")
+        return output
+
+    model.ar_predict_layer.register_forward_hook(disable_eos)
+
+    settings = [("cached", 1), ("batched", args.batch_size)]
+    if not args.skip_uncached:
+        settings.insert(0, ("uncached", 1))
+
+    results = []
+    print(
+        "{:<10}{:>10}{:>8}{:>12}{:>12}".format(
+            "mode", "tokens", "batch", "time(s)", "tokens/s"
+        )
+    )
+    for text_len in [int(n) for n in args.text_lens.split(",")]:
+        for mode, batch_size in settings:
+            x = torch.randint(
+                1, cfg.model.text_token_num, (batch_size, text_len), device=device
+            )
+            x_lens = torch.full((batch_size,), text_len, device=device)
+            prompts = torch.randint(
+                0,
+                cfg.model.audio_token_num,
+                (batch_size, args.prompt_frames),
+                device=device,
+            )
+            prompt_lens = torch.full((batch_size,), args.prompt_frames, device=device)
+
+            # warm up
+            run(model, x[:, :1], x_lens * 0 + 1, prompts, prompt_lens, mode, device)
+            num_tokens, elapsed = run(
+                model, x, x_lens, prompts, prompt_lens, mode, device
+            )
+            item = {
+                "mode": mode,
+                "batch_size": batch_size,
+                "output_len": num_tokens // batch_size,
+                "time": elapsed,
+                "tokens_per_second": num_tokens / elapsed,
+            }
+            results.append(item)
+            print(
+                "{:<10}{:>10}{:>8}{:>12.3f}{:>12.1f}".format(
+                    mode,
+                    item["output_len"],
+                    batch_size,
+                    elapsed,
+                    item["tokens_per_second"],
+                )
+            )
+
+    with open(args.output_path, "w") as f:
+        json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -133,6 +133,7 @@ class VALLEInference(TTSInference):
         assert test_list_file is not None
 
         pred_res = []
+        clips = []
         with open(test_list_file, "r") as fin:
             for idx, line in enumerate(fin.readlines()):
                 fields = line.strip().split("|")
@@ -144,57 +145,73 @@ class VALLEInference(TTSInference):
                     assert len(fields) == 3
                     text_prompt, audio_prompt_path, text = fields
 
-                audio = self.inference_one_clip(
-                    text, text_prompt, audio_prompt_path, str(idx)
-                )
-                pred_res.append(audio)
+                if self.args.continual or self.args.copysyn:
+                    audio = self.inference_one_clip(
+                        text, text_prompt, audio_prompt_path, str(idx)
+                    )
+                    pred_res.append(audio)
+                else:
+                    clips.append((text, text_prompt, audio_prompt_path))
+
+        # AR decoding of several clips at once, each one stops at its own EOS
+        for start in range(0, len(clips), self.args.ar_batch_size):
+            batch = [
+                self._prepare_clip(*clip)
+                for clip in clips[start : start + self.args.ar_batch_size]
+            ]
+            phone_id_seqs, audio_prompt_tokens, prompt_phone_lens = zip(*batch)
+            x_lens = torch.IntTensor([len(seq) for seq in phone_id_seqs])
+            y_lens = torch.IntTensor([token.shape[1] for token in audio_prompt_tokens])
+            x = torch.zeros(len(batch), x_lens.max(), dtype=torch.long)
+            y = torch.zeros(
+                (len(batch), y_lens.max(), audio_prompt_tokens[0].shape[2]),
+                dtype=audio_prompt_tokens[0].dtype,
+            )
+            for i, (phone_id_seq, token) in enumerate(
+                zip(phone_id_seqs, audio_prompt_tokens)
+            ):
+                x[i, : len(phone_id_seq)] = torch.from_numpy(np.array(phone_id_seq))
+                y[i, : token.shape[1]] = token[0].cpu()
+
+            encoded_frames = self.model.batch_inference(
+                x.to(self.device),
+                x_lens.to(self.device),
+                y.to(self.device),
+                y_lens.to(self.device),
+                enroll_x_lens=torch.IntTensor(prompt_phone_lens).to(self.device),
+                top_k=self.args.top_k,
+                temperature=self.args.temperature,
+            )
+            for frames in encoded_frames:
+                samples = self.audio_tokenizer.decode([(frames.transpose(2, 1), None)])
+                pred_res.append(samples[0].squeeze(0).cpu().detach())
 
         return pred_res
 
-        """
-        TODO: batch inference 
-        ###### Construct test_batch ######
-        n_batch = len(self.test_dataloader)
-        now = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
-        print(
-            "Model eval time: {}, batch_size = {}, n_batch = {}".format(
-                now, self.test_batch_size, n_batch
+    def _prepare_clip(self, text, text_prompt, audio_file):
+        """Phone ids of the prompt and target texts, the acoustic tokens of the audio
+        prompt and the number of phones of the text prompt"""
+        phone_symbol_file = None
+        if self.cfg.preprocess.phone_extractor != "lexicon":
+            phone_symbol_file = os.path.join(
+                self.exp_dir, self.cfg.preprocess.symbols_dict
             )
-        )       
-        
-        ###### Inference for each batch ######
-        pred_res = []
-        with torch.no_grad():
-            for i, batch_data in enumerate(
-                self.test_dataloader if n_batch == 1 else tqdm(self.test_dataloader)
-            ):
-                if self.args.continual:
-                    encoded_frames = self.model.continual(
-                        batch_data["phone_seq"],
-                        batch_data["phone_len"],
-                        batch_data["acoustic_token"],
-                    )
-                else:
-                    encoded_frames = self.model.inference(
-                        batch_data["phone_seq"],
-                        batch_data["phone_len"],
-                        batch_data["acoustic_token"],
-                        enroll_x_lens=batch_data["pmt_phone_len"],
-                        top_k=self.args.top_k,
-                        temperature=self.args.temperature
-                    )
-                    
-                samples = self.audio_tokenizer.decode(
-                    [(encoded_frames.transpose(2, 1), None)]
-                )
-                
-                            
-                for idx in range(samples.size(0)):
-                    audio = samples[idx].cpu()
-                    pred_res.append(audio)
-                    
-        return pred_res
-        """
+            assert os.path.exists(phone_symbol_file)
+        phone_extractor = phoneExtractor(self.cfg)
+        phon_id_collator = phoneIDCollation(
+            self.cfg, symbols_dict_file=phone_symbol_file
+        )
+
+        phone_seq = phone_extractor.extract_phone(f"{text_prompt} {text}".strip())
+        phone_id_seq = phon_id_collator.get_phone_id_sequence(self.cfg, phone_seq)
+        prompt_phone_seq = phone_extractor.extract_phone(f"{text_prompt}".strip())
+        prompt_phone_id_seq = phon_id_collator.get_phone_id_sequence(
+            self.cfg, prompt_phone_seq
+        )
+
+        encoded_frames = tokenize_audio(self.audio_tokenizer, audio_file)
+        audio_prompt_token = encoded_frames[0][0].transpose(2, 1)
+        return phone_id_seq, audio_prompt_token, len(prompt_phone_id_seq)
 
     def add_arguments(parser: argparse.ArgumentParser):
         parser.add_argument(
@@ -224,6 +241,13 @@ class VALLEInference(TTSInference):
             help="The temperature of AR Decoder top_k sampling.",
         )
 
+        parser.add_argument(
+            "--ar_batch_size",
+            type=int,
+            default=8,
+            help="Number of clips decoded together by the AR Decoder in batch mode.",
+        )
+
         parser.add_argument(
             "--continual",
             action="store_true",
@@ -1,5 +1,6 @@
 import json
 import os
+from collections import OrderedDict
 import Levenshtein
 import librosa
 import nltk
@@ -9,56 +10,259 @@ import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 from transformers import Wav2Vec2FeatureExtractor, WavLMForXVector
-from modelscope.pipelines import pipeline  # run !pip install -U funasr modelscope
-from modelscope.utils.constant import Tasks  # run !pip install -U funasr modelscope
-import whisper  # pip install -U openai-whisper
+
+# default ASR checkpoint of each backend
+ASR_MODELS = {"hubert": "facebook/hubert-large-ls960-ft", "whisper": "large-v2"}
+
+
+class LRUCache(OrderedDict):
+    """A dict that keeps its ``max_size`` most recently used entries"""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class VCEvaluator(object):
+    """Model-resident scorers for zero-shot VC/TTS outputs.
+
+    WavLM-SV (SIM), emotion2vec (FID) and the ASR model (WER) are each loaded once,
+    on first use. Waveforms are sorted by length and scored in batches of
+    ``batch_size``. Wavs given as paths are decoded once and their embeddings are
+    cached, so the references/prompts shared by many test pairs are embedded once.
+    The caches keep the ``wav_cache_size`` / ``embedding_cache_size`` most recently
+    used entries.
+
+    asr: "hubert" (batched HuBERT-CTC, ``asr_model`` a transformers model) or
+        "whisper" (``whisper.transcribe`` of every wav, ``asr_model`` a whisper model
+        name or checkpoint path), ``asr_model`` defaults to ASR_MODELS[asr]
+    language: language of whisper, detected for every wav if None
+    """
+
+    def __init__(
+        self,
+        device=None,
+        batch_size=16,
+        sv_model="microsoft/wavlm-base-plus-sv",
+        emotion_model="iic/emotion2vec_base",
+        asr="hubert",
+        asr_model=None,
+        language=None,
+        wav_cache_size=512,
+        embedding_cache_size=65536,
+    ):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.sv_model_name = sv_model
+        self.emotion_model_name = emotion_model
+        assert asr in ["hubert", "whisper"]
+        self.asr = asr
+        self.asr_model_name = asr_model if asr_model is not None else ASR_MODELS[asr]
+        self.language = language
+        self.sample_rate = 16000
+
+        self.sv_model = None
+        self.emotion_pipeline = None
+        self.asr_model = None
+        # (scorer, wav path) -> embedding
+        self.embedding_cache = LRUCache(embedding_cache_size)
+        self.wav_cache = LRUCache(wav_cache_size)
+
+    ### Scorers, loaded on first use ###
+    def _load_sv(self):
+        if self.sv_model is None:
+            self.sv_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
+                self.sv_model_name
+            )
+            self.sv_model = WavLMForXVector.from_pretrained(self.sv_model_name)
+            self.sv_model = self.sv_model.to(self.device).eval()
+
+    def _load_emotion(self):
+        if self.emotion_pipeline is None:
+            from modelscope.pipelines import pipeline
+            from modelscope.utils.constant import Tasks
+
+            self.emotion_pipeline = pipeline(
+                task=Tasks.emotion_recognition,
+                model=self.emotion_model_name,
+                model_revision="v2.0.4",
+                device=self.device.type,
+            )
+
+    def _load_asr(self):
+        if self.asr_model is not None:
+            return
+        if self.asr == "hubert":
+            from transformers import Wav2Vec2Processor, HubertForCTC
+
+            self.asr_processor = Wav2Vec2Processor.from_pretrained(self.asr_model_name)
+            self.asr_model = HubertForCTC.from_pretrained(self.asr_model_name)
+        else:
+            import whisper
+
+            self.asr_model = whisper.load_model(self.asr_model_name)
+        self.asr_model = self.asr_model.to(self.device).eval()
+
+    ### Inputs ###
+    def load_wav(self, wav):
+        """A path (decoded once) or a 16k waveform -> 16k float32 numpy waveform"""
+        if not isinstance(wav, str):
+            return np.asarray(wav, dtype=np.float32)
+        if wav not in self.wav_cache:
+            self.wav_cache[wav], _ = librosa.load(wav, sr=self.sample_rate)
+        return self.wav_cache[wav]
+
+    def _batches(self, wavs):
+        """Batches of (indices, waveforms) of similar lengths"""
+        wavs = [self.load_wav(wav) for wav in wavs]
+        order = sorted(range(len(wavs)), key=lambda i: len(wavs[i]), reverse=True)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            yield indices, [wavs[i] for i in indices]
+
+    def _embeddings(self, scorer, wavs, embed_batch):
+        """Embeddings of wavs, reusing the cached ones of paths"""
+        embeddings = [None] * len(wavs)
+        todo = []
+        for i, wav in enumerate(wavs):
+            if isinstance(wav, str) and (scorer, wav) in self.embedding_cache:
+                embeddings[i] = self.embedding_cache[(scorer, wav)]
+            else:
+                todo.append(i)
+
+        # the same path may be several times in todo, embed it once
+        unique = {}
+        for i in todo:
+            key = wavs[i] if isinstance(wavs[i], str) else i
+            unique.setdefault(key, []).append(i)
+        keys = list(unique.keys())
+        for indices, batch in self._batches([wavs[unique[k][0]] for k in keys]):
+            for index, embedding in zip(indices, embed_batch(batch)):
+                key = keys[index]
+                if isinstance(key, str):
+                    self.embedding_cache[(scorer, key)] = embedding
+                for i in unique[key]:
+                    embeddings[i] = embedding
+        return torch.stack(embeddings) if len(embeddings) > 0 else torch.zeros(0)
+
+    @torch.no_grad()
+    def _sv_embed_batch(self, batch):
+        inputs = self.sv_feature_extractor(
+            batch,
+            padding=True,
+            sampling_rate=self.sample_rate,
+            return_tensors="pt",
+        )
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        return self.sv_model(**inputs).embeddings.float().cpu()
+
+    def _emotion_embed_batch(self, batch):
+        results = self.emotion_pipeline(batch, granularity="utterance")
+        return [torch.as_tensor(result["feats"]).float() for result in results]
+
+    ### Scores ###
+    def speaker_embeddings(self, wavs):
+        self._load_sv()
+        return self._embeddings("sv", wavs, self._sv_embed_batch)
+
+    def emotion_embeddings(self, wavs):
+        self._load_emotion()
+        return self._embeddings("emotion", wavs, self._emotion_embed_batch)
+
+    def speaker_similarity(self, target_wavs, reference_wavs):
+        """SIM of each (target, reference) pair, a list of floats"""
+        target = self.speaker_embeddings(target_wavs)
+        reference = self.speaker_embeddings(reference_wavs)
+        return F.cosine_similarity(target, reference, dim=-1).tolist()
+
+    def emotion_similarity(self, target_wavs, reference_wavs):
+        """FID (emotion2vec cosine similarity) of each (target, reference) pair"""
+        target = self.emotion_embeddings(target_wavs)
+        reference = self.emotion_embeddings(reference_wavs)
+        return F.cosine_similarity(target, reference, dim=-1).tolist()
+
+    @torch.no_grad()
+    def transcribe(self, wavs):
+        """Transcripts of the wavs, a list of str"""
+        self._load_asr()
+        transcripts = [None] * len(wavs)
+        for indices, batch in self._batches(wavs):
+            if self.asr == "hubert":
+                texts = self._transcribe_hubert(batch)
+            else:
+                texts = self._transcribe_whisper(batch)
+            for i, text in zip(indices, texts):
+                transcripts[i] = text
+        return transcripts
+
+    def _transcribe_hubert(self, batch):
+        inputs = self.asr_processor(
+            batch,
+            padding=True,
+            sampling_rate=self.sample_rate,
+            return_tensors="pt",
+        )
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        logits = self.asr_model(**inputs).logits
+        predicted_ids = torch.argmax(logits, dim=-1)
+        return self.asr_processor.batch_decode(predicted_ids)
+
+    def _transcribe_whisper(self, batch):
+        # whisper.transcribe, with its temperature fallback and its windows of long
+        # audios, so the WER is the one of the reference whisper evaluation
+        return [
+            self.asr_model.transcribe(wav, language=self.language)["text"]
+            for wav in batch
+        ]
+
+    def wer(self, target_wavs, target_texts):
+        """WER of the transcript of each target wav against its text"""
+        transcripts = self.transcribe(target_wavs)
+        return [
+            calculate_wer(transcript, text, self.device)
+            for transcript, text in zip(transcripts, target_texts)
+        ]
+
+
+_evaluators = {}
+
+
+def _get_evaluator(device):
+    device = str(device)
+    if device not in _evaluators:
+        _evaluators[device] = VCEvaluator(
+            device=device, asr="whisper", asr_model=ASR_MODELS["whisper"]
+        )
+    return _evaluators[device]
 
 
 def calculate_fid(target_wav, reference_wav):
     """
     Calculate the cosine similarity between emotion embeddings of two waveforms.
     """
-    inference_pipeline = pipeline(
-        task=Tasks.emotion_recognition,
-        model="iic/emotion2vec_base",
-        model_revision="v2.0.4",
-        device="cuda" if torch.cuda.is_available() else "cpu",
-    )
-    results = inference_pipeline([target_wav, reference_wav], granularity="utterance")
-    rec_target = results[0]["feats"]  # (768,)
-    rec_reference = results[1]["feats"]  # (768,)
-    cos_sim_score = F.cosine_similarity(
-        torch.tensor(rec_target), torch.tensor(rec_reference), dim=-1
-    )
-    return cos_sim_score.item()
+    evaluator = _get_evaluator("cuda" if torch.cuda.is_available() else "cpu")
+    return evaluator.emotion_similarity([target_wav], [reference_wav])[0]
 
 
 def calculate_speaker_similarity(target_wav, reference_wav, device):
     """
     Extract acoustic embeddings and calculate cosine similarity.
     """
-    feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
-        "microsoft/wavlm-base-plus-sv"
-    )
-    model = WavLMForXVector.from_pretrained("microsoft/wavlm-base-plus-sv")
-    if device == "cuda":
-        print("Cuda available, conducting inference on GPU")
-        model = model.to(device)
-
-    inputs = feature_extractor(
-        [target_wav, reference_wav], padding=True, return_tensors="pt"
-    )
-
-    if device == "cuda":
-        for key in inputs.keys():
-            inputs[key] = inputs[key].cuda("cuda")
-
-    with torch.no_grad():
-        embeddings = model(**inputs).embeddings
-        embeddings = embeddings.cpu()
-        cos_sim_score = F.cosine_similarity(embeddings[0], embeddings[1], dim=-1)
-
-    return cos_sim_score.item()
+    evaluator = _get_evaluator(device)
+    return evaluator.speaker_similarity([target_wav], [reference_wav])[0]
 
 
 def calculate_wer(transcript_text, target_text, device):
@@ -77,7 +281,10 @@ if __name__ == "__main__":
     # Get device
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    whisper_model = whisper.load_model(".large-v2.pt") # load from local path
+    # all scorers are loaded once and run in length-sorted batches
+    evaluator = VCEvaluator(
+        device=device, asr="whisper", asr_model=".large-v2.pt"
+    )  # load from local path
 
     # Load model [Need to change]
     tts_model = torch.load("./tts.pth", map_location=device)
@@ -91,16 +298,17 @@ if __name__ == "__main__":
     data = json.loads(json_data)
     test_data = data["test_cases"]
 
-    wer_scores = []
-    similarity_scores = []
-    fid_scores = []
+    output_wavs = []
+    reference_paths = []
+    target_texts = []
     nltk.download("punkt")
     for wav_info in tqdm(test_data):
         wav_path = wav_info["wav_path"].split("/")[-1]
         reference_path = os.path.join(reference_folder, wav_path)
         assert os.path.exists(reference_path), f"File {reference_path} not found"
 
-        reference_wav, _ = librosa.load(reference_path, sr=16000)
+        # decoded once, also for the speaker and emotion embeddings
+        reference_wav = evaluator.load_wav(reference_path)
         source_text = wav_info["text"]
         target_text = wav_info["target_text"]
 
@@ -115,17 +323,16 @@ if __name__ == "__main__":
             language="en",
         )
 
-        # WER:
-        transcript_text = whisper_model.transcribe(output_wav)["text"]
-        wer = calculate_wer(transcript_text, target_text, device)
-        # SIM-O
-        sim_o = calculate_speaker_similarity(output_wav, reference_wav, device)
-        # FID:
-        fid = calculate_fid(output_wav, reference_wav)
-
-        wer_scores.append(wer)
-        similarity_scores.append(sim_o)
-        fid_scores.append(fid)
+        output_wavs.append(output_wav)
+        reference_paths.append(reference_path)
+        target_texts.append(target_text)
+
+    # WER:
+    wer_scores = evaluator.wer(output_wavs, target_texts)
+    # SIM-O
+    similarity_scores = evaluator.speaker_similarity(output_wavs, reference_paths)
+    # FID:
+    fid_scores = evaluator.emotion_similarity(output_wavs, reference_paths)
 
     print(f"WER: {np.mean(wer_scores)}")
     print(f"SIM-O: {np.mean(similarity_scores)}")
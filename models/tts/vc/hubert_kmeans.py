@@ -2,9 +2,15 @@ from pathlib import Path
 import torch
 from torch import nn, einsum
 from torchaudio.functional import resample
-from einops import rearrange, repeat, pack, unpack
+from einops import rearrange, pack, unpack
 import torch.nn.functional as F
 
+from models.tts.vc.kmeans_quantizer import (
+    KmeansQuantizer,
+    remap_cluster_centers,
+    resample_frames,
+)
+
 # from audiolm_pytorch.utils import curtail_to_multiple
 
 # suppress a few warnings
@@ -63,6 +69,8 @@ class HubertWithKmeans(nn.Module):
         target_sample_hz=16000,
         seq_len_multiple_of=None,
         output_layer=9,
+        search_dtype=None,
+        rerank_top_k=None,
     ):
         super().__init__()
 
@@ -89,10 +97,21 @@ class HubertWithKmeans(nn.Module):
 
         self.kmeans = kmeans
 
-        self.register_buffer(
-            "cluster_centers", torch.from_numpy(kmeans.cluster_centers_)
+        # see KmeansQuantizer for search_dtype (e.g. torch.float16) and rerank_top_k
+        self.quantizer = KmeansQuantizer(
+            torch.from_numpy(kmeans.cluster_centers_),
+            search_dtype=search_dtype,
+            rerank_top_k=rerank_top_k,
         )
 
+    @property
+    def cluster_centers(self):
+        return self.quantizer.cluster_centers
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_cluster_centers(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @property
     def groups(self):
         return 1
@@ -107,7 +126,16 @@ class HubertWithKmeans(nn.Module):
         return 320
 
     @torch.inference_mode()
-    def forward(self, wav_input, flatten=True, input_sample_hz=None):
+    def forward(self, wav_input, flatten=True, input_sample_hz=None, mask=None):
+        """
+        Args:
+            wav_input (tensor): (B, num_samples) waveforms
+            mask (tensor, optional): (B, T) valid frames of the output, whose padded
+                samples are masked in HuBERT and padded frames are not quantized
+        Returns:
+            clusters: (B, T) k-means clusters of the frames, of 200 samples hop
+            quantize: (B, T, dim) centroids of the clusters
+        """
         batch, device = wav_input.shape[0], wav_input.device
         wav_input = F.pad(wav_input, (40, 40), "reflect")
 
@@ -117,24 +145,27 @@ class HubertWithKmeans(nn.Module):
         if exists(self.seq_len_multiple_of):
             wav_input = curtail_to_multiple(wav_input, self.seq_len_multiple_of)
 
+        padding_mask = None
+        if exists(mask):
+            # padded samples of the reflect padded waveforms, frames of 200 samples
+            num_samples = mask.sum(dim=1) * 200 + 40
+            padding_mask = (
+                torch.arange(wav_input.shape[-1], device=device)[None, :]
+                >= num_samples[:, None]
+            )
+
         embed = self.model(
             wav_input,
+            padding_mask=padding_mask,
             features_only=True,
             mask=False,  # thanks to @maitycyrus for noticing that mask is defaulted to True in the fairseq code
             output_layer=self.output_layer,
         )["x"]
 
-        embed = embed.permute((0, 2, 1))
-        embed = F.interpolate(embed, scale_factor=8, mode="nearest")
-        embed = F.interpolate(embed, scale_factor=0.2, mode="nearest")
-        embed = embed.permute((0, 2, 1))
+        # 320 -> 200 samples hop, i.e. interpolate by 8 then by 0.2
+        embed = resample_frames(embed, (8, 0.2))
 
-        batched_cluster_centers = repeat(
-            self.cluster_centers, "c d -> b c d", b=embed.shape[0]
-        )
-        dists = -torch.cdist(embed, batched_cluster_centers, p=2)
-        clusters = dists.argmax(dim=-1) # (batch, seq_len)
-        quantize = F.embedding(clusters, self.cluster_centers)
+        clusters, quantize = self.quantizer(embed, mask)  # (batch, seq_len)
 
         if flatten:
             return clusters, quantize
@@ -0,0 +1,119 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from functools import lru_cache
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+@lru_cache(maxsize=None)
+def _resample_index(num_frames, scale_factors):
+    index = torch.arange(num_frames, dtype=torch.float64)[None, None]
+    for scale_factor in scale_factors:
+        index = F.interpolate(index, scale_factor=scale_factor, mode="nearest")
+    return index[0, 0].long()
+
+
+def resample_frames(embed, scale_factors=(8, 0.2)):
+    """Nearest-neighbour resampling of the frames of embed (B, T, D), equal to
+    successive F.interpolate(..., scale_factor, mode="nearest") on (B, D, T) (by
+    default the 320 -> 200 samples hop of the content features), but done with one
+    gather of the frames, whose index is computed once per length.
+    """
+    index = _resample_index(embed.shape[1], tuple(scale_factors))
+    return embed[:, index.to(embed.device)]
+
+
+class KmeansQuantizer(nn.Module):
+    """Nearest k-means centroid search of a batch of features.
+
+    The distances ``|x|^2 - 2 x.c + |c|^2`` only depend on the centroid through
+    ``|c|^2 / 2 - x.c``, so the search is one matmul of the (valid) frames with the
+    centroids, against the centroid norms that are precomputed and kept on device.
+
+    Args:
+        cluster_centers (tensor): (num_clusters, dim) centroids
+        search_dtype (torch.dtype, optional): dtype of the matmul, e.g. torch.float16
+            or torch.bfloat16, by default the dtype of the features
+        rerank_top_k (int, optional): with a search_dtype, keep the top_k centroids of
+            the low-precision search and pick the nearest of them in float32, which
+            gives the exact nearest centroid unless it is not among the top_k
+    """
+
+    def __init__(self, cluster_centers, search_dtype=None, rerank_top_k=None):
+        super().__init__()
+        self.search_dtype = search_dtype
+        self.rerank_top_k = rerank_top_k
+        self.register_buffer("cluster_centers", cluster_centers.float())
+        self.register_buffer(
+            "half_sq_norms", 0.5 * cluster_centers.float().pow(2).sum(-1)
+        )
+
+    @property
+    def num_clusters(self):
+        return self.cluster_centers.shape[0]
+
+    def search(self, x):
+        """The nearest centroids (N,) of the features x (N, dim)"""
+        dtype = self.search_dtype or x.dtype
+        # (N, num_clusters), x.c - |c|^2 / 2, the larger the nearer
+        scores = torch.addmm(
+            -self.half_sq_norms.to(dtype),
+            x.to(dtype),
+            self.cluster_centers.to(dtype).T,
+        )
+        if self.rerank_top_k is None or dtype == torch.float32:
+            return scores.argmax(dim=-1)
+
+        candidates = scores.topk(self.rerank_top_k, dim=-1).indices  # (N, k)
+        clusters = torch.empty_like(candidates[:, 0])
+        # exact scores of the candidates, by chunks of (chunk, k, dim) centroids
+        chunk = 4096
+        for start in range(0, len(x), chunk):
+            index = candidates[start : start + chunk]
+            exact = torch.einsum(
+                "nkd,nd->nk",
+                self.cluster_centers[index],
+                x[start : start + chunk].float(),
+            )
+            exact -= self.half_sq_norms[index]
+            best = exact.argmax(dim=-1, keepdim=True)
+            clusters[start : start + chunk] = index.gather(1, best)[:, 0]
+        return clusters
+
+    def forward(self, x, mask=None):
+        """
+        Args:
+            x (tensor): (B, T, dim) features
+            mask (tensor, optional): (B, T) valid frames, the padded frames are not
+                searched, they get the cluster 0 and a zero quantized feature
+        Returns:
+            clusters: (B, T)
+            quantize: (B, T, dim) centroids of the clusters, in the dtype of x
+        """
+        if mask is None:
+            clusters = self.search(x.reshape(-1, x.shape[-1])).view(x.shape[:-1])
+            quantize = F.embedding(clusters, self.cluster_centers)
+            return clusters, quantize.to(x.dtype)
+
+        mask = mask.bool()
+        clusters = torch.zeros(x.shape[:-1], dtype=torch.long, device=x.device)
+        clusters[mask] = self.search(x[mask])
+        quantize = F.embedding(clusters, self.cluster_centers).to(x.dtype)
+        quantize = quantize * mask[..., None].to(x.dtype)
+        return clusters, quantize
+
+
+def remap_cluster_centers(state_dict, prefix):
+    """Load the ``cluster_centers`` buffer of the checkpoints of the k-means models
+    saved before KmeansQuantizer into ``quantizer.*``, computing the centroid norms"""
+    key = prefix + "cluster_centers"
+    if key in state_dict:
+        cluster_centers = state_dict.pop(key).float()
+        state_dict[prefix + "quantizer.cluster_centers"] = cluster_centers
+        half_sq_norms = 0.5 * cluster_centers.pow(2).sum(-1)
+        state_dict[prefix + "quantizer.half_sq_norms"] = half_sq_norms
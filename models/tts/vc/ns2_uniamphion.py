@@ -4,6 +4,7 @@ import numpy as np
 import torch.nn.functional as F
 import math
 import json5
+import contextlib
 from librosa.filters import mel as librosa_mel_fn
 from einops.layers.torch import Rearrange
 from models.tts.vc.sv_scirpts.sv_model import XVector, AdMSoftmaxLoss
@@ -101,6 +102,11 @@ class Diffusion(nn.Module):
         self.beta_max = cfg.beta_max
         self.sigma = cfg.sigma
         self.noise_factor = cfg.noise_factor
+        self.nfe = 0
+        # step-invariant projections of the conditions, set during sampling with
+        # cfg.cache_condition (see cache_condition)
+        self.use_condition_cache = "cache_condition" in cfg and cfg.cache_condition
+        self.estimator_cache = None
 
     def forward(self, x, condition_embedding, x_mask, reference_embedding, offset=1e-5):
         diffusion_step = torch.rand(
@@ -148,7 +154,12 @@ class Diffusion(nn.Module):
         cum_beta = self.get_cum_beta(time_step=time_step)
         beta_t = self.get_beta_t(time_step=time_step)
         x0_pred = self.diff_estimator(
-            xt, condition_embedding, x_mask, reference_embedding, diffusion_step
+            xt,
+            condition_embedding,
+            x_mask,
+            reference_embedding,
+            diffusion_step,
+            cache=self.estimator_cache,
         )
         mean_pred = x0_pred * torch.exp(-0.5 * cum_beta / (self.sigma**2))
         noise_pred = xt - mean_pred
@@ -157,16 +168,168 @@ class Diffusion(nn.Module):
         dxt = -0.5 * h * beta_t * (logp + xt / (self.sigma**2))
         return dxt
 
+    @torch.no_grad()
+    def get_alpha_sigma(self, time_step):
+        # x_t = alpha_t * x_0 + sigma_t * z
+        cum_beta = self.get_cum_beta(time_step)
+        alpha = torch.exp(-0.5 * cum_beta / (self.sigma**2))
+        sigma = self.sigma * torch.sqrt(1.0 - torch.exp(-cum_beta / (self.sigma**2)))
+        return alpha, sigma
+
+    @torch.no_grad()
+    def cal_x0(
+        self, xt, condition_embedding, x_mask, reference_embedding, diffusion_step
+    ):
+        self.nfe += 1
+        return self.diff_estimator(
+            xt,
+            condition_embedding,
+            x_mask,
+            reference_embedding,
+            diffusion_step,
+            cache=self.estimator_cache,
+        )
+
+    @contextlib.contextmanager
+    def cache_condition(self, condition_embedding, reference_embedding):
+        """Project the conditions once for all the estimator calls inside the block.
+
+        condition_embedding and reference_embedding do not change across the
+        diffusion steps of one utterance, so the estimator only computes its
+        condition projections (and the cross-attention keys / values) once.
+
+        The cache holds the (B, 2 * hidden_size, T) condition projection of every
+        estimator layer for the whole sampling, i.e. num_layers * 2 * hidden_size * 4
+        bytes per frame of the batch (~190 KB with the 47 layers of hidden_size 512 of
+        config/vc.json, so ~3 GB for 16 utterances of 1000 frames). It is only used
+        with cfg.cache_condition; otherwise the block does nothing.
+        """
+        if not self.use_condition_cache:
+            yield
+            return
+        self.estimator_cache = self.diff_estimator.precompute(
+            condition_embedding, reference_embedding
+        )
+        try:
+            yield
+        finally:
+            self.estimator_cache = None
+
+    @torch.no_grad()
+    def cal_velocity(
+        self, xt, condition_embedding, x_mask, reference_embedding, t
+    ):
+        # dx/dt of the probability flow ODE, same as cal_dxt / h
+        diffusion_step = t * torch.ones(xt.shape[0], dtype=xt.dtype, device=xt.device)
+        x0_pred = self.cal_x0(
+            xt, condition_embedding, x_mask, reference_embedding, diffusion_step
+        )
+        time_step = diffusion_step.unsqueeze(-1).unsqueeze(-1)
+        alpha, sigma = self.get_alpha_sigma(time_step)
+        beta_t = self.get_beta_t(time_step=time_step)
+        logp = -(xt - x0_pred * alpha) / (sigma**2 + 1e-8)
+        return -0.5 * beta_t * (logp + xt / (self.sigma**2))
+
+    def get_time_steps(self, n_timesteps, time_schedule="uniform", t_end=1e-5):
+        """Decreasing time grid of n_timesteps + 1 points from 1 to t_end.
+
+        uniform: uniform in t
+        quadratic: uniform in sqrt(t - t_end), denser close to the data
+        logsnr: uniform in log(alpha_t / sigma_t), as in DPM-Solver
+        """
+        if time_schedule == "uniform":
+            return torch.linspace(1.0, t_end, n_timesteps + 1).tolist()
+        elif time_schedule == "quadratic":
+            steps = torch.linspace(1.0, 0.0, n_timesteps + 1) ** 2
+            return (t_end + (1.0 - t_end) * steps).tolist()
+        elif time_schedule == "logsnr":
+            alpha, sigma = self.get_alpha_sigma(torch.tensor([1.0, t_end], dtype=torch.float64))
+            lambdas = torch.linspace(
+                math.log(alpha[0] / sigma[0]), math.log(alpha[1] / sigma[1]), n_timesteps + 1,
+                dtype=torch.float64,
+            )
+            # invert lambda(t): cum_beta = sigma^2 * log(1 + exp(-2 lambda) / sigma^2)
+            cum_beta = self.sigma**2 * torch.log1p(torch.exp(-2 * lambdas) / self.sigma**2)
+            d_beta = self.beta_max - self.beta_min
+            t = (-self.beta_min + torch.sqrt(self.beta_min**2 + 2 * d_beta * cum_beta)) / d_beta
+            t[0], t[-1] = 1.0, t_end
+            return t.tolist()
+        else:
+            raise NotImplementedError("Unsupported time schedule: {}".format(time_schedule))
+
     @torch.no_grad()
     def reverse_diffusion(
-        self, z, condition_embedding, x_mask, reference_embedding, n_timesteps
+        self,
+        z,
+        condition_embedding,
+        x_mask,
+        reference_embedding,
+        n_timesteps,
+        ode_solve_method=None,
+        time_schedule=None,
     ):
+        """Solve the probability flow ODE from t = 1 to 0.
+
+        ode_solve_method (defaults to cfg.ode_solve_method):
+            euler / midpoint: fixed uniform steps, 1 / 2 NFE per step
+            heun: 2nd order, 2 * n_timesteps - 1 NFE
+            dpm_solver: DPM-Solver++(2M) multistep on the x0 prediction, n_timesteps NFE
+            rk45: adaptive Dormand-Prince with cfg.ode_rtol / cfg.ode_atol, n_timesteps is ignored
+        time_schedule (defaults to cfg.time_schedule) sets the grid of heun and dpm_solver.
+        The number of estimator calls of the last run is kept in self.nfe.
+        """
+        ode_solve_method = ode_solve_method or self.cfg.ode_solve_method
+        time_schedule = time_schedule or self.cfg.time_schedule
+        self.nfe = 0
+        with self.cache_condition(condition_embedding, reference_embedding):
+            return self._reverse_diffusion(
+                z,
+                condition_embedding,
+                x_mask,
+                reference_embedding,
+                n_timesteps,
+                ode_solve_method,
+                time_schedule,
+            )
+
+    @torch.no_grad()
+    def _reverse_diffusion(
+        self,
+        z,
+        condition_embedding,
+        x_mask,
+        reference_embedding,
+        n_timesteps,
+        ode_solve_method,
+        time_schedule,
+    ):
+        if ode_solve_method == "heun":
+            time_steps = self.get_time_steps(n_timesteps, time_schedule)
+            return self.heun_solver(
+                z, condition_embedding, x_mask, reference_embedding, time_steps
+            )
+        elif ode_solve_method == "dpm_solver":
+            time_steps = self.get_time_steps(n_timesteps, time_schedule)
+            return self.dpm_solver(
+                z, condition_embedding, x_mask, reference_embedding, time_steps
+            )
+        elif ode_solve_method == "rk45":
+            return self.rk45_solver(
+                z,
+                condition_embedding,
+                x_mask,
+                reference_embedding,
+                rtol=self.cfg.ode_rtol,
+                atol=self.cfg.ode_atol,
+            )
+
         h = 1.0 / max(n_timesteps, 1)
         xt = z
         for i in range(n_timesteps):
             t = (1.0 - (i + 0.5) * h) * torch.ones(
                 z.shape[0], dtype=z.dtype, device=z.device
             )
+            self.nfe += 1
             dxt = self.cal_dxt(
                 xt,
                 condition_embedding,
@@ -176,8 +339,9 @@ class Diffusion(nn.Module):
                 h=h,
             )
             xt_ = xt - dxt
-            if self.cfg.ode_solve_method == "midpoint":
+            if ode_solve_method == "midpoint":
                 x_mid = 0.5 * (xt_ + xt)
+                self.nfe += 1
                 dxt = self.cal_dxt(
                     x_mid,
                     condition_embedding,
@@ -187,13 +351,148 @@ class Diffusion(nn.Module):
                     h=h,
                 )
                 xt = xt - dxt
-            elif self.cfg.ode_solve_method == "euler":
+            elif ode_solve_method == "euler":
                 xt = xt_
         return xt
 
+    @torch.no_grad()
+    def heun_solver(
+        self, z, condition_embedding, x_mask, reference_embedding, time_steps
+    ):
+        xt = z
+        for i in range(len(time_steps) - 1):
+            t, t_next = time_steps[i], time_steps[i + 1]
+            h = t - t_next
+            v = self.cal_velocity(
+                xt, condition_embedding, x_mask, reference_embedding, t
+            )
+            x_next = xt - h * v
+            # the last step stays euler, the velocity is ill-conditioned at t_end
+            if i < len(time_steps) - 2:
+                v_next = self.cal_velocity(
+                    x_next, condition_embedding, x_mask, reference_embedding, t_next
+                )
+                x_next = xt - 0.5 * h * (v + v_next)
+            xt = x_next
+        return xt
+
+    @torch.no_grad()
+    def dpm_solver(
+        self, z, condition_embedding, x_mask, reference_embedding, time_steps
+    ):
+        # DPM-Solver++(2M), https://arxiv.org/abs/2211.01095
+        n_timesteps = len(time_steps) - 1
+        alphas, sigmas = self.get_alpha_sigma(
+            torch.tensor(time_steps, dtype=torch.float64)
+        )
+        lambdas = torch.log(alphas) - torch.log(sigmas)
+        xt = z
+        x0_prev, h_prev = None, None
+        for i in range(n_timesteps):
+            diffusion_step = time_steps[i] * torch.ones(
+                z.shape[0], dtype=z.dtype, device=z.device
+            )
+            x0_pred = self.cal_x0(
+                xt, condition_embedding, x_mask, reference_embedding, diffusion_step
+            )
+            h = (lambdas[i + 1] - lambdas[i]).item()
+            # first order at the first step, and at the last one for few steps
+            if x0_prev is None or (i == n_timesteps - 1 and n_timesteps < 15):
+                d = x0_pred
+            else:
+                r = h_prev / h
+                d = (1 + 0.5 / r) * x0_pred - (0.5 / r) * x0_prev
+            xt = (sigmas[i + 1] / sigmas[i]).item() * xt - (
+                alphas[i + 1] * math.expm1(-h)
+            ).item() * d
+            x0_prev, h_prev = x0_pred, h
+        return xt
+
+    @torch.no_grad()
+    def rk45_solver(
+        self,
+        z,
+        condition_embedding,
+        x_mask,
+        reference_embedding,
+        rtol=1e-3,
+        atol=1e-3,
+        t_end=1e-3,
+        max_steps=1000,
+    ):
+        # Dormand-Prince 5(4) with error control, integrating t from 1 to t_end
+        c = [0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0]
+        a = [
+            [],
+            [1 / 5],
+            [3 / 40, 9 / 40],
+            [44 / 45, -56 / 15, 32 / 9],
+            [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+            [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+            [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+        ]
+        b_err = [
+            35 / 384 - 5179 / 57600,
+            0.0,
+            500 / 1113 - 7571 / 16695,
+            125 / 192 - 393 / 640,
+            -2187 / 6784 + 92097 / 339200,
+            11 / 84 - 187 / 2100,
+            -1 / 40,
+        ]
+
+        def f(x, t):
+            return self.cal_velocity(
+                x, condition_embedding, x_mask, reference_embedding, t
+            )
+
+        t, xt = 1.0, z
+        dt = -0.1
+        k1 = f(xt, t)
+        for _ in range(max_steps):
+            if t <= t_end:
+                break
+            dt = max(dt, t_end - t)
+            ks = [k1]
+            for stage in range(1, 7):
+                x_stage = xt + dt * sum(
+                    coef * k for coef, k in zip(a[stage], ks) if coef != 0.0
+                )
+                ks.append(f(x_stage, t + c[stage] * dt))
+            # the 7th stage is the 5th order solution at t + dt (FSAL)
+            x_new = x_stage
+            err = dt * sum(coef * k for coef, k in zip(b_err, ks) if coef != 0.0)
+            scale = atol + rtol * torch.maximum(xt.abs(), x_new.abs())
+            err_norm = torch.sqrt(torch.mean((err / scale) ** 2)).item()
+            if err_norm <= 1.0:
+                t, xt, k1 = t + dt, x_new, ks[-1]
+            factor = 0.9 * err_norm ** (-0.2) if err_norm > 0 else 5.0
+            dt = dt * min(5.0, max(0.2, factor))
+        else:
+            if t > t_end:
+                raise RuntimeError(
+                    f"rk45 solver stopped at t={t:.4g} > t_end={t_end:g} after "
+                    f"max_steps={max_steps} steps, increase max_steps or the tolerances"
+                )
+        return xt
+
     @torch.no_grad()
     def reverse_diffusion_from_t(
         self, z, condition_embedding, x_mask, reference_embedding, n_timesteps, t_start
+    ):
+        with self.cache_condition(condition_embedding, reference_embedding):
+            return self._reverse_diffusion_from_t(
+                z,
+                condition_embedding,
+                x_mask,
+                reference_embedding,
+                n_timesteps,
+                t_start,
+            )
+
+    @torch.no_grad()
+    def _reverse_diffusion_from_t(
+        self, z, condition_embedding, x_mask, reference_embedding, n_timesteps, t_start
     ):
         h = t_start / max(n_timesteps, 1)
         xt = z
@@ -203,7 +502,6 @@ class Diffusion(nn.Module):
             )
             dxt = self.cal_dxt(
                 xt,
-                x_mask,
                 condition_embedding,
                 x_mask,
                 reference_embedding,
@@ -267,10 +565,14 @@ class StyleAdaptiveLayerNorm(nn.Module):
         self.style.bias.data[: self.in_dim] = 1
         self.style.bias.data[self.in_dim :] = 0
 
-    def forward(self, x, condition):
-        # x: (B, T, d); condition: (B, T, d)
+    def get_style(self, condition):
+        return self.style(torch.mean(condition, dim=1, keepdim=True))
+
+    def forward(self, x, condition, style=None):
+        # x: (B, T, d); condition: (B, T, d); style: precomputed get_style(condition)
 
-        style = self.style(torch.mean(condition, dim=1, keepdim=True))
+        if style is None:
+            style = self.get_style(condition)
 
         gamma, beta = style.chunk(2, -1)
 
@@ -295,7 +597,11 @@ class PositionalEncoding(nn.Module):
         self.register_buffer("pe", pe)
 
     def forward(self, x):
-        x = x + self.pe[: x.size(0)]
+        # x: (B, T, d), pe used to be indexed by the first dim, i.e. by the batch
+        # row. Every row gets the encoding of row 0, the one of an utterance on its
+        # own as the models are evaluated, so that a row does not depend on its
+        # position in the batch (the time positions are not encoded)
+        x = x + self.pe[0]
         return F.dropout(x, self.dropout, training=self.training)
 
 
@@ -416,10 +722,24 @@ class TransformerEncoderLayer(nn.Module):
             # self.encoder_hidden.weight.data.normal_(0.0, 0.02)
             self.diff_step_projection = Linear2(self.encoder_hidden)
 
+    def precompute(self, conditon):
+        # styles of the two norms, constant across diffusion steps
+        if not self.use_cln:
+            return (None, None)
+        return (self.ln_1.get_style(conditon), self.ln_2.get_style(conditon))
+
     def forward(
-        self, x, key_padding_mask, conditon=None, skip_res=None, diffusion_step=None
+        self,
+        x,
+        key_padding_mask,
+        conditon=None,
+        skip_res=None,
+        diffusion_step=None,
+        cache=None,
     ):
         # x: (B, T, d); key_padding_mask: (B, T), mask is 0; condition: (B, T, d); skip_res: (B, T, d); diffusion_step: (B,)
+        # cache: output of precompute(conditon)
+        style_1, style_2 = cache if cache is not None else (None, None)
 
         if self.use_skip_connection and skip_res != None:
             x = torch.cat([x, skip_res], dim=-1)  # (B, T, 2*d)
@@ -435,7 +755,7 @@ class TransformerEncoderLayer(nn.Module):
 
         # pre norm
         if self.use_cln:
-            x = self.ln_1(x, conditon)
+            x = self.ln_1(x, conditon, style_1)
         else:
             x = self.ln_1(x)
 
@@ -454,11 +774,13 @@ class TransformerEncoderLayer(nn.Module):
         # pre norm
         residual = x
         if self.use_cln:
-            x = self.ln_2(x, conditon)
+            x = self.ln_2(x, conditon, style_2)
         else:
             x = self.ln_2(x)
 
-        # ffn
+        # ffn, whose conv sees zeros on the padded frames
+        if key_padding_mask != None:
+            x = x * key_padding_mask[:, :, None].to(x.dtype)
         x = self.ffn(x)
 
         x = residual + x
@@ -589,7 +911,20 @@ class TransformerEncoder(nn.Module):
             # self.encoder_hidden.weight.data.normal_(0.0, 0.02)
             self.diff_step_projection = Linear2(self.encoder_hidden)
 
-    def forward(self, x, key_padding_mask, condition=None, diffusion_step=None):
+    def precompute(self, condition):
+        cache = {"layers": [layer.precompute(condition) for layer in self.layers]}
+        if self.use_cln:
+            cache["last_ln"] = self.last_ln.get_style(condition)
+        return cache
+
+    def forward(
+        self, x, key_padding_mask, condition=None, diffusion_step=None, cache=None
+    ):
+        if cache is not None:
+            layer_caches = cache["layers"]
+        else:
+            layer_caches = [None] * len(self.layers)
+
         if len(x.shape) == 2 and self.use_enc_emb:
             x = self.enc_emb_tokens(x)
             x = self.position_emb(x)
@@ -604,25 +939,29 @@ class TransformerEncoder(nn.Module):
         if self.use_skip_connection:
             skip_res_list = []
             # down
-            for layer in self.layers[: self.encoder_layer // 2]:
-                x = layer(x, key_padding_mask, condition)
+            for i in range(self.encoder_layer // 2):
+                x = self.layers[i](
+                    x, key_padding_mask, condition, cache=layer_caches[i]
+                )
                 res = x
                 skip_res_list.append(res)
             # middle
-            for layer in self.layers[
-                self.encoder_layer // 2 : (self.encoder_layer + 1) // 2
-            ]:
-                x = layer(x, key_padding_mask, condition)
+            for i in range(self.encoder_layer // 2, (self.encoder_layer + 1) // 2):
+                x = self.layers[i](
+                    x, key_padding_mask, condition, cache=layer_caches[i]
+                )
             # up
-            for layer in self.layers[(self.encoder_layer + 1) // 2 :]:
+            for i in range((self.encoder_layer + 1) // 2, self.encoder_layer):
                 skip_res = skip_res_list.pop()
-                x = layer(x, key_padding_mask, condition, skip_res)
+                x = self.layers[i](
+                    x, key_padding_mask, condition, skip_res, cache=layer_caches[i]
+                )
         else:
-            for layer in self.layers:
-                x = layer(x, key_padding_mask, condition)
+            for layer, layer_cache in zip(self.layers, layer_caches):
+                x = layer(x, key_padding_mask, condition, cache=layer_cache)
 
         if self.use_cln:
-            x = self.last_ln(x, condition)
+            x = self.last_ln(x, condition, None if cache is None else cache["last_ln"])
         else:
             x = self.last_ln(x)
 
@@ -721,6 +1060,15 @@ class DiffTransformer(nn.Module):
             self.diff_step_emb = SinusoidalPosEmb(dim=self.encoder_hidden)
             self.diff_step_projection = Linear2(self.encoder_hidden)
 
+    def precompute(self, condition_embedding, reference_embedding):
+        """Step-invariant part of forward, pass the result as cache when sampling."""
+        return {
+            "condition_embedding": self.cond_project(condition_embedding),
+            "transformer_encoder": self.transformer_encoder.precompute(
+                reference_embedding
+            ),
+        }
+
     def forward(
         self,
         x,
@@ -728,6 +1076,7 @@ class DiffTransformer(nn.Module):
         key_padding_mask=None,
         reference_embedding=None,
         diffusion_step=None,
+        cache=None,
     ):
         # x: shape is (B, T, d_x)
         # key_padding_mask: shape is (B, T),  mask is 0
@@ -743,7 +1092,10 @@ class DiffTransformer(nn.Module):
 
         if self.in_linear != None:
             x = self.in_linear(x)
-        condition_embedding = self.cond_project(condition_embedding)
+        if cache is not None:
+            condition_embedding = cache["condition_embedding"]
+        else:
+            condition_embedding = self.cond_project(condition_embedding)
 
         x = torch.cat([x, condition_embedding], dim=-1)
         x = self.cat_linear(x)
@@ -772,6 +1124,7 @@ class DiffTransformer(nn.Module):
             key_padding_mask=key_padding_mask,
             condition=reference_embedding,
             diffusion_step=diffusion_step,
+            cache=None if cache is None else cache["transformer_encoder"],
         )
 
         if self.cat_diff_step and diffusion_step != None:
@@ -994,9 +1347,42 @@ class ResidualBlock(nn.Module):
 
         self.dropout = nn.Dropout(self.drop_out)
 
-    def forward(self, x, x_mask, cond, diffusion_step, spk_query_emb):
+    def precompute(self, cond, spk_query_emb):
+        # cond_proj and the keys / values of the cross attention do not depend on
+        # x or the diffusion step
+        cache = {"cond": self.cond_proj(cond)}  # (B, 2*d, T)
+        if self.has_cattn:
+            d = self.hidden_dim
+            weight, bias = self.attn.in_proj_weight, self.attn.in_proj_bias
+            key = F.linear(spk_query_emb, weight[d : 2 * d], bias[d : 2 * d])
+            value = F.linear(spk_query_emb, weight[2 * d :], bias[2 * d :])
+            cache["key"] = self.split_heads(key)  # (B, h, N, d/h)
+            cache["value"] = self.split_heads(value)
+        return cache
+
+    def split_heads(self, x):
+        B, N, d = x.shape
+        return x.view(B, N, self.attn_head, d // self.attn_head).transpose(1, 2)
+
+    def cached_attn(self, query, key, value):
+        # self.attn(query, spk_query_emb, spk_query_emb) with precomputed keys / values
+        B, T, d = query.shape
+        weight, bias = self.attn.in_proj_weight, self.attn.in_proj_bias
+        query = self.split_heads(F.linear(query, weight[:d], bias[:d]))
+        out = F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            dropout_p=self.attn.dropout if self.training else 0.0,
+        )  # (B, h, T, d/h)
+        return self.attn.out_proj(out.transpose(1, 2).reshape(B, T, d))
+
+    def forward(self, x, x_mask, cond, diffusion_step, spk_query_emb, cache=None):
         diffusion_step = self.diffusion_proj(diffusion_step).unsqueeze(-1)  # (B, d, 1)
-        cond = self.cond_proj(cond)  # (B, 2*d, T)
+        if cache is not None:
+            cond = cache["cond"]
+        else:
+            cond = self.cond_proj(cond)  # (B, 2*d, T)
 
         y = x + diffusion_step
         if x_mask != None:
@@ -1006,7 +1392,10 @@ class ResidualBlock(nn.Module):
             y_ = y.transpose(1, 2)
             y_ = self.ln(y_)
 
-            y_, _ = self.attn(y_, spk_query_emb, spk_query_emb)  # (B, T, d)
+            if cache is not None:
+                y_ = self.cached_attn(y_, cache["key"], cache["value"])
+            else:
+                y_, _ = self.attn(y_, spk_query_emb, spk_query_emb)  # (B, T, d)
 
         y = self.dilated_conv(y) + cond  # (B, 2*d, T)
 
@@ -1074,6 +1463,13 @@ class DiffWaveNet(nn.Module):
 
         nn.init.zeros_(self.out_proj.weight)
 
+    def precompute(self, condition_embedding, reference_embedding):
+        """Step-invariant part of forward, pass the result as cache when sampling."""
+        cond_input = self.cond_ln(condition_embedding).transpose(1, 2)
+        return [
+            layer.precompute(cond_input, reference_embedding) for layer in self.layers
+        ]
+
     def forward(
         self,
         x,
@@ -1081,6 +1477,7 @@ class DiffWaveNet(nn.Module):
         key_padding_mask=None,
         reference_embedding=None,
         diffusion_step=None,
+        cache=None,
     ):
         x = x.transpose(1, 2)  # (B, T, d) -> (B, d, T)
         x_mask = key_padding_mask
@@ -1088,8 +1485,13 @@ class DiffWaveNet(nn.Module):
         spk_query_emb = reference_embedding
         diffusion_step = diffusion_step
 
-        cond = self.cond_ln(cond)
-        cond_input = cond.transpose(1, 2)
+        if cache is not None:
+            cond_input = None
+            layer_caches = cache
+        else:
+            cond = self.cond_ln(cond)
+            cond_input = cond.transpose(1, 2)
+            layer_caches = [None] * len(self.layers)
 
         x_input = self.in_proj(x)
 
@@ -1099,9 +1501,9 @@ class DiffWaveNet(nn.Module):
         diffusion_step = self.mlp(diffusion_step)
 
         skip = []
-        for _, layer in enumerate(self.layers):
+        for layer, layer_cache in zip(self.layers, layer_caches):
             x_input, skip_connection = layer(
-                x_input, x_mask, cond_input, diffusion_step, spk_query_emb
+                x_input, x_mask, cond_input, diffusion_step, spk_query_emb, layer_cache
             )
             skip.append(skip_connection)
 
@@ -1289,6 +1691,13 @@ class UniAmphionVC(nn.Module):
         )
         return diff_out, (reference_embedding, noisy_reference_embedding), (condition_embedding, noisy_condition_embedding)
 
+    @torch.no_grad()
+    def get_reference_embedding(self, x_ref, x_ref_mask=None):
+        reference_embedding, _ = self.reference_encoder(
+            x_ref=x_ref, key_padding_mask=x_ref_mask
+        )
+        return reference_embedding
+
     @torch.no_grad()
     def inference(
         self,
@@ -1298,13 +1707,27 @@ class UniAmphionVC(nn.Module):
         x_ref_mask=None,
         inference_steps=1000,
         sigma=1.2,
+        ode_solve_method=None,
+        time_schedule=None,
+        x_mask=None,
+        reference_embedding=None,
     ):
-        reference_embedding, _ = self.reference_encoder(
-            x_ref=x_ref, key_padding_mask=x_ref_mask
-        )
+        # x_mask: (B, T), 1 for the valid frames of padded content_feature / pitch
+        # reference_embedding: output of get_reference_embedding, replaces x_ref
+        if reference_embedding is None:
+            reference_embedding = self.get_reference_embedding(x_ref, x_ref_mask)
 
         condition_embedding = torch.cat([content_feature, pitch[:, :, None]], dim=-1)
-        condition_embedding = self.content_f0_enc(condition_embedding)
+        if x_mask is None:
+            condition_embedding = self.content_f0_enc(condition_embedding)
+        else:
+            # zero the padded frames after the LayerNorm, so that the conv sees the
+            # same zero padding as for an utterance on its own
+            condition_embedding = self.content_f0_enc[0](condition_embedding)
+            condition_embedding = condition_embedding * x_mask[:, :, None].to(
+                condition_embedding.dtype
+            )
+            condition_embedding = self.content_f0_enc[1:](condition_embedding)
 
         bsz, l, _ = condition_embedding.shape
         if self.cfg.diffusion.diff_model_type == "Transformer":
@@ -1325,9 +1748,11 @@ class UniAmphionVC(nn.Module):
         x0 = self.diffusion.reverse_diffusion(
             z=z,
             condition_embedding=condition_embedding,
-            x_mask=None,
+            x_mask=x_mask,
             reference_embedding=reference_embedding,
             n_timesteps=inference_steps,
+            ode_solve_method=ode_solve_method,
+            time_schedule=time_schedule,
         )
 
         return x0
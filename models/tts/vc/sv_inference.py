@@ -9,9 +9,24 @@ import os
 from models.tts.vc.vc_trainer import VCTrainer, mel_spectrogram
 from utils.util import load_config
 from models.tts.vc.ns2_uniamphion import UniAmphionVC
-from models.tts.vc.sv_scirpts.sv_utils import metric, get_sv_data, get_batch_cos_sim
+from models.tts.vc.sv_scirpts.sv_utils import (
+    metric,
+    get_sv_data,
+    get_batch_cos_sim,
+    get_trial_cos_sim,
+    SVEmbeddingStore,
+)
+from models.tts.vc.sv_scirpts.sv_dataset import (
+    SVFileDataset,
+    sv_file_collate,
+    get_length_batches,
+)
+import hashlib
+import tempfile
+import concurrent.futures
 from ASGSR.attack.attackMain import get_baseline_model
 import librosa
+import json
 from denoiser import pretrained
 import warnings
 warnings.filterwarnings('ignore')
@@ -67,6 +82,18 @@ def main():
         default=7, 
         help="Cuda id for training."
     )
+    parser.add_argument(
+        "--batch_size", type=int, default=32, help="Files per embedding batch."
+    )
+    parser.add_argument(
+        "--embedding_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of the embedding store, reused across runs. By default the "
+            "embeddings are kept in a temporary directory, removed at exit."
+        ),
+    )
     parser.add_argument("--local_rank", default=-1, type=int)
     args = parser.parse_args()
 
@@ -118,108 +145,87 @@ def main():
     data = data.sample(frac=split_rate, random_state=1126).reset_index(drop=True) #shuffle df
     print(len(data))
     
-    labels_all = []
-    socres_bsl_all = []
-    scores_sv_all = []
-    scores_all = []
-
     # denoiser
     denoiser_model = pretrained.dns64().cuda(args.local_rank)
 
-
-    print("--- start testing ---")
-    for idx in tqdm(range(len(data))):
-        first_wav = data['First'].iloc[idx]
-        second_wav = data['Second'].iloc[idx]
-        if not os.path.isabs(first_wav):
-            first_wav = os.path.join(folder_path, first_wav)
-        if not os.path.isabs(second_wav):
-            second_wav = os.path.join(folder_path, second_wav)
-        
-        label = torch.tensor(int(data['Label'].iloc[idx]))
-        with torch.no_grad():
-            first_wav, _ = librosa.load(first_wav, sr=16000)
-            second_wav, _ = librosa.load(second_wav, sr=16000)
-
-            # 取前5s
-            first_wav = first_wav[:16000*5]
-            second_wav = second_wav[:16000*5]
-
-
-            # first_wav = torch.from_numpy(first_wav).to(args.local_rank).unsqueeze(0)
-            # second_wav = torch.from_numpy(second_wav).to(args.local_rank).unsqueeze(0)
-            # first_wav = convert_audio(first_wav, 16000, denoiser_model.sample_rate, denoiser_model.chin)
-            # second_wav = convert_audio(second_wav, 16000, denoiser_model.sample_rate, denoiser_model.chin)
-
-            # with torch.no_grad():
-            #     first_wav = denoiser_model(first_wav[None])[0]
-            #     second_wav = denoiser_model(second_wav[None])[0]
-            # #resample to 16000
-            # first_wav = torchaudio.transforms.Resample(denoiser_model.sample_rate, 16000)(first_wav)
-            # second_wav = torchaudio.transforms.Resample(denoiser_model.sample_rate, 16000)(second_wav)
-            # first_wav = first_wav.cpu().numpy().squeeze()
-            # #print(first_wav.shape)
-            # second_wav = second_wav.cpu().numpy().squeeze()
-
-            first_wav = np.pad(first_wav, (0, 1600 - len(first_wav) % 1600))
-            first_audio = torch.from_numpy(first_wav).to(args.local_rank)
-            first_audio = first_audio[None, :]
-            # Load and process audio data
-            first_mel = mel_spectrogram(first_audio, n_fft=1024,
-                    num_mels=80,
-                    sampling_rate=16000,
-                    hop_size=200,
-                    win_size=800,
-                    fmin=0,
-                    fmax=8000,
-                    )
-            first_mel = first_mel.transpose(1, 2).to(device=args.local_rank)
-            first_mask = torch.ones(first_mel.shape[0], first_mel.shape[1]).to(args.local_rank)
-
-            second_wav = np.pad(second_wav, (0, 1600 - len(second_wav) % 1600))
-            second_audio = torch.from_numpy(second_wav).to(args.local_rank)
-            second_audio = second_audio[None, :]
-            # Load and process audio data
-            second_mel = mel_spectrogram(second_audio, n_fft=1024,
-                    num_mels=80,
-                    sampling_rate=16000,
-                    hop_size=200,
-                    win_size=800,
-                    fmin=0,
-                    fmax=8000,
-                    )
-            second_mel = second_mel.transpose(1, 2).to(device=args.local_rank)
-            second_mask = torch.ones(second_mel.shape[0], second_mel.shape[1]).to(args.local_rank)
-
-            first_emb = model.sv_inference(first_mel, first_mask)
-            #first_emb = torch.mean(first_emb, dim=1) # (B, 512) emb for the fist wav
-            second_emb = model.sv_inference(second_mel, second_mask)
-            #second_emb = torch.mean(second_emb, dim=1) # (B, 512) emb for the second wav
-            score = get_batch_cos_sim(first_emb,second_emb).to(torch.device('cpu'))
-
-            first_emb_sv = model_se.sv_inference(first_mel, first_mask)
-            #first_emb_sv = torch.mean(first_emb_sv, dim=1) # (B, 512) emb for the fist wav
-            second_emb_sv = model_se.sv_inference(second_mel, second_mask)
-            #second_emb_sv = torch.mean(second_emb_sv, dim=1) # (B, 512) emb for the second wav
-            score_sv = get_batch_cos_sim(first_emb_sv,second_emb_sv).to(torch.device('cpu'))
-
-            first_emb_bsl = baseline_model(first_audio.to(device=args.local_rank))
-            second_emb_bsl = baseline_model(second_audio.to(device=args.local_rank))
-            scores_bsl = get_batch_cos_sim(first_emb_bsl,second_emb_bsl).to(torch.device('cpu'))
-        
-            scores_all.append(score)
-            scores_sv_all.append(score_sv)
-            socres_bsl_all.append(scores_bsl)
-            labels_all.append(label)
+    def get_path(wav):
+        return wav if os.path.isabs(wav) else os.path.join(folder_path, wav)
+
+    first_files = [get_path(wav) for wav in data['First']]
+    second_files = [get_path(wav) for wav in data['Second']]
+    labels_all = data['Label'].astype(int).to_numpy()
+    files = sorted(set(first_files) | set(second_files))
+    print("unique files", len(files))
+
+    # phase 1: one embedding per unique file and model
+    names = ["ours", "ours_se", "ecapatdnn"]
+    embedding_dir = args.embedding_dir
+    if embedding_dir is None:
+        # nothing is reused across runs unless --embedding_dir is set
+        temp_dir = tempfile.TemporaryDirectory(prefix="sv_embeddings_")
+        embedding_dir = temp_dir.name
+    # the key changes when a checkpoint is rewritten in place
+    checkpoints = [args.checkpoint_path_1, args.checkpoint_path_2]
+    key = hashlib.md5(
+        json.dumps(
+            [(path, os.path.getmtime(path), os.path.getsize(path)) for path in checkpoints]
+        ).encode()
+    ).hexdigest()
+    store = SVEmbeddingStore(os.path.join(embedding_dir, key))
+    missing = store.missing(files, names)
+    print("--- extracting embeddings of {} files ---".format(len(missing)))
+    if len(missing) > 0:
+        dataset = SVFileDataset(missing)
+        with concurrent.futures.ThreadPoolExecutor(args.num_workers) as executor:
+            lengths = list(executor.map(dataset.get_padded_length, range(len(dataset))))
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=get_length_batches(lengths, args.batch_size),
+            collate_fn=sv_file_collate,
+            num_workers=args.num_workers,
+            pin_memory=True,
+        )
+        new_embs = {name: [None] * len(missing) for name in names}
+        for indices, audio, wav_lengths in tqdm(loader):
+            audio = audio.to(args.local_rank, non_blocking=True)
+            with torch.no_grad():
+                mel = mel_spectrogram(audio, n_fft=1024,
+                        num_mels=80,
+                        sampling_rate=16000,
+                        hop_size=200,
+                        win_size=800,
+                        fmin=0,
+                        fmax=8000,
+                        )
+                mel = mel.transpose(1, 2).to(device=args.local_rank)
+                frame_lengths = (wav_lengths // 200).to(args.local_rank)
+                mask = (
+                    torch.arange(mel.shape[1], device=args.local_rank)[None, :]
+                    < frame_lengths[:, None]
+                ).float()
+                batch_embs = {
+                    "ours": model.sv_inference(mel, mask),
+                    "ours_se": model_se.sv_inference(mel, mask),
+                    "ecapatdnn": baseline_model(audio),
+                }
+            for name, emb in batch_embs.items():
+                emb = emb.reshape(len(indices), -1).float().cpu().numpy()
+                for i, idx in enumerate(indices.tolist()):
+                    new_embs[name][idx] = emb[i]
+        store.add(missing, {name: np.stack(new_embs[name]) for name in names})
+
+    # phase 2: score all trials at once
+    first_index = [store.file2idx[file] for file in first_files]
+    second_index = [store.file2idx[file] for file in second_files]
+    scores = {
+        name: get_trial_cos_sim(store.load(name), first_index, second_index).numpy()
+        for name in names
+    }
     print("--- testing finished ---")
-    
-    scores_all = np.array(scores_all)
-    scores_all = scores_all.reshape(-1)
-    scores_sv_all = np.array(scores_sv_all)
-    scores_sv_all = scores_sv_all.reshape(-1)
-    socres_bsl_all = np.array(socres_bsl_all)
-    socres_bsl_all = socres_bsl_all.reshape(-1)
-    labels_all = np.array(labels_all)
+
+    scores_all = scores["ours"]
+    scores_sv_all = scores["ours_se"]
+    socres_bsl_all = scores["ecapatdnn"]
 
     print("---- ECAPATDNN----")
     metric(socres_bsl_all, labels_all)
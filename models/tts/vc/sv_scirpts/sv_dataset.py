@@ -1,7 +1,10 @@
 from torch.utils.data import Dataset
 import librosa
+import math
 import os
+import numpy as np
 import torch
+import torchaudio
 
 
 
@@ -35,4 +38,51 @@ class SVDataset(Dataset):
         first_wav = self.load_wav(first_file)
         second_wav = self.load_wav(second_file)
         return first_wav, second_wav, label
-    
\ No newline at end of file
+    
+
+class SVFileDataset(Dataset):
+    """Unique wav files of a trial list, loaded like the per-trial loop of sv_inference.py."""
+
+    def __init__(self, files, max_seconds=5):
+        self.files = files
+        self.max_samples = 16000 * max_seconds
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_padded_length(self, idx):
+        # length after load_wav, computed from the header only
+        info = torchaudio.info(self.files[idx])
+        length = int(math.ceil(info.num_frames * 16000 / info.sample_rate))
+        length = min(length, self.max_samples)
+        return length + 1600 - length % 1600
+
+    def load_wav(self, wav_path):
+        wav, _ = librosa.load(wav_path, sr=16000)
+        wav = wav[: self.max_samples]
+        wav = np.pad(wav, (0, 1600 - len(wav) % 1600))
+        return torch.from_numpy(wav)
+
+    def __getitem__(self, idx):
+        return idx, self.load_wav(self.files[idx])
+
+
+def sv_file_collate(batch):
+    indices, wavs = zip(*batch)
+    lengths = torch.tensor([len(wav) for wav in wavs])
+    wavs = torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True)
+    return torch.tensor(indices), wavs, lengths
+
+
+def get_length_batches(lengths, batch_size):
+    """Batches of indices with the same length, most batches need no padding."""
+    buckets = {}
+    for idx, length in enumerate(lengths):
+        buckets.setdefault(length, []).append(idx)
+    batches = []
+    for length in sorted(buckets):
+        indices = buckets[length]
+        batches.extend(
+            [indices[i : i + batch_size] for i in range(0, len(indices), batch_size)]
+        )
+    return batches
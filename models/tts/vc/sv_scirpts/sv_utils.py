@@ -1,4 +1,7 @@
 
+import os
+import json
+import numpy as np
 import pandas as pd
 from models.tts.vc.sv_scirpts.sv_metrics import compute_pmiss_pfa_rbst,compute_eer,compute_c_norm
 
@@ -32,4 +35,53 @@ def get_batch_cos_sim(emb1, emb2):
 
     # 计算余弦相似度
     scores = torch.sum(A_norm * B_norm, dim=1)
-    return scores
\ No newline at end of file
+    return scores
+
+def get_trial_cos_sim(embs, first_index, second_index):
+    """Cosine scores of all trials at once.
+
+    embs: (N, D) embeddings of the unique files
+    first_index, second_index: (num_trials,) rows of embs of both sides of a trial
+    """
+    embs = F.normalize(torch.as_tensor(embs, dtype=torch.float32), p=2, dim=1)
+    first_index = torch.as_tensor(first_index, dtype=torch.long)
+    second_index = torch.as_tensor(second_index, dtype=torch.long)
+    return torch.sum(embs[first_index] * embs[second_index], dim=1)
+
+
+class SVEmbeddingStore:
+    """Per-file embeddings on disk: files.json plus one {name}.npy (N, D) per model."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        files_path = os.path.join(root, "files.json")
+        self.files = []
+        if os.path.exists(files_path):
+            with open(files_path, "r") as f:
+                self.files = json.load(f)
+        self.file2idx = {file: i for i, file in enumerate(self.files)}
+
+    def missing(self, files, names):
+        if not all(os.path.exists(os.path.join(self.root, name + ".npy")) for name in names):
+            return list(files)
+        return [file for file in files if file not in self.file2idx]
+
+    def load(self, name):
+        return np.load(os.path.join(self.root, name + ".npy"))
+
+    def add(self, files, embs):
+        """Append the embeddings {name: (len(files), D)} of new files."""
+        if self.files and not all(
+            os.path.exists(os.path.join(self.root, name + ".npy")) for name in embs
+        ):
+            # a new model, start the store again
+            self.files, self.file2idx = [], {}
+        for name, emb in embs.items():
+            if self.files:
+                emb = np.concatenate([self.load(name), emb], axis=0)
+            np.save(os.path.join(self.root, name + ".npy"), emb)
+        self.files = self.files + list(files)
+        self.file2idx = {file: i for i, file in enumerate(self.files)}
+        with open(os.path.join(self.root, "files.json"), "w") as f:
+            json.dump(self.files, f)
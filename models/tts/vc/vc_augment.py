@@ -0,0 +1,211 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import fcntl
+import hashlib
+import contextlib
+import librosa
+import numpy as np
+import torch
+import rir_generator as rir
+from tqdm import tqdm
+from multiprocessing import Pool
+
+SAMPLE_RATE = 16000
+
+
+def load_noise(file_path):
+    noise, _ = librosa.load(file_path, sr=SAMPLE_RATE)
+    return noise.astype(np.float32)
+
+
+def save_npy(path, array):
+    tmp_path = f"{path}.tmp{os.getpid()}.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def build_lock(bank_dir):
+    """Exclusive lock on ``bank_dir``, so that a single process (e.g. out of all DDP
+    ranks) builds a bank while the others wait and then load it."""
+    os.makedirs(bank_dir, exist_ok=True)
+    with open(os.path.join(bank_dir, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class NoiseBank:
+    """All noise files decoded once at 16 kHz into a single memory-mapped array.
+
+    Files are concatenated with 0.2 s of silence in between, a noise segment is
+    a random (wrapping) window of the bank, which replaces reading a random file
+    and appending the next ones until the speech is covered.
+    """
+
+    def __init__(self, bank_dir):
+        self.bank_dir = bank_dir
+        self.noise = np.load(os.path.join(bank_dir, "noise.npy"), mmap_mode="r")
+
+    @staticmethod
+    def get_bank_dir(root, noise_dir):
+        key = hashlib.md5(os.path.abspath(noise_dir).encode()).hexdigest()
+        return os.path.join(root, "noise_bank", key)
+
+    @staticmethod
+    def exists(bank_dir):
+        return os.path.exists(os.path.join(bank_dir, "noise.npy"))
+
+    @staticmethod
+    def build(noise_files, bank_dir, num_workers=os.cpu_count()):
+        with build_lock(bank_dir):
+            if NoiseBank.exists(bank_dir):
+                return  # built by another process while waiting for the lock
+            silence = np.zeros(int(SAMPLE_RATE * 0.2), dtype=np.float32)
+            noises = []
+            with Pool(processes=num_workers) as pool:
+                for noise in tqdm(
+                    pool.imap(load_noise, sorted(noise_files)), total=len(noise_files)
+                ):
+                    noises.extend([noise, silence])
+            save_npy(os.path.join(bank_dir, "noise.npy"), np.concatenate(noises))
+            print(f"Saved noise bank of {len(noise_files)} files to {bank_dir}")
+
+    def sample(self, length, batch_size=None):
+        """Return random noise windows of shape (length,) or (batch_size, length)."""
+        num = 1 if batch_size is None else batch_size
+        starts = np.random.randint(0, len(self.noise), size=num)
+        segments = np.empty((num, length), dtype=np.float32)
+        for i, start in enumerate(starts):
+            filled = 0
+            while filled < length:
+                chunk = self.noise[start : start + length - filled]
+                segments[i, filled : filled + len(chunk)] = chunk
+                filled += len(chunk)
+                start = 0
+        return segments[0] if batch_size is None else segments
+
+
+def random_rir():
+    room_dim = [np.random.uniform(1, 12) for _ in range(3)]  # [length, width, height]
+    mic_pos = [np.random.uniform(0, dim) for dim in room_dim]  # 随机选择麦克风位置
+    distance = np.random.normal(2, 4)  # 确定声源与麦克风的距离
+    while distance <= 0 or distance > 5:
+        distance = np.random.normal(2, 4)
+    source_pos = [mic_pos[0] + distance, mic_pos[1], mic_pos[2]]  # 随机选择声源位置
+    rt60 = np.random.uniform(0.05, 1.0)  # 随机选择RT60值
+    rir_filter = rir.generate(
+        c=340,  # 声速
+        fs=SAMPLE_RATE,
+        r=[mic_pos],  # 麦克风位置
+        s=source_pos,  # 声源位置
+        L=room_dim,  # 房间尺寸
+        reverberation_time=rt60,  # RT60值
+        nsample=4096,  # IR长度
+    )
+    return rir_filter[:, 0].astype(np.float32)
+
+
+class RIRBank:
+    """Precomputed room impulse responses with the sampling of ``VCDataset.add_reverb``."""
+
+    def __init__(self, bank_dir):
+        self.rirs = np.load(os.path.join(bank_dir, "rir.npy"), mmap_mode="r")
+
+    @staticmethod
+    def exists(bank_dir):
+        return os.path.exists(os.path.join(bank_dir, "rir.npy"))
+
+    @staticmethod
+    def build(bank_dir, num_rirs=1000):
+        with build_lock(bank_dir):
+            if RIRBank.exists(bank_dir):
+                return  # built by another process while waiting for the lock
+            rirs = []
+            with tqdm(total=num_rirs) as pbar:
+                while len(rirs) < num_rirs:
+                    try:
+                        rirs.append(random_rir())
+                        pbar.update(1)
+                    except ValueError:
+                        continue  # s is outside the room
+            save_npy(os.path.join(bank_dir, "rir.npy"), np.stack(rirs, axis=0))
+            print(f"Saved {num_rirs} RIRs to {bank_dir}")
+
+    def sample(self, batch_size=None):
+        num = 1 if batch_size is None else batch_size
+        rirs = np.array(self.rirs[np.random.randint(0, len(self.rirs), size=num)])
+        return rirs[0] if batch_size is None else rirs
+
+
+def fft_convolve_same(x, h):
+    """Batched ``np.convolve(x, h, mode='same')`` for x (B, N) and h (B, M), N >= M."""
+    N, M = x.shape[-1], h.shape[-1]
+    n_fft = 1 << (N + M - 2).bit_length()
+    y = torch.fft.irfft(
+        torch.fft.rfft(x, n=n_fft) * torch.fft.rfft(h, n=n_fft), n=n_fft
+    )
+    start = (M - 1) // 2
+    return y[..., start : start + N]
+
+
+def snr_mixer_batch(clean, noise, snr, mask):
+    """Batched ``VCDataset.snr_mixer`` over the valid samples of each row."""
+    num = mask.sum(dim=1).clamp(min=1)
+    rmsclean = ((clean**2 * mask).sum(dim=1) / num).sqrt().clamp(min=1e-10)
+    # Normalizing to -25 dB FS
+    clean = clean * (10 ** (-25 / 20) / rmsclean).unsqueeze(1)
+    rmsnoise = ((noise**2 * mask).sum(dim=1) / num).sqrt().clamp(min=1e-10)
+    noise = noise * (10 ** (-25 / 20) / rmsnoise).unsqueeze(1)
+    rmsnoise = ((noise**2 * mask).sum(dim=1) / num).sqrt().clamp(min=1e-10)
+    # Set the noise level for a given SNR
+    noisescalar = torch.sqrt(rmsclean / (10 ** (snr / 20)) / rmsnoise)
+    return (clean + noise * noisescalar.unsqueeze(1)) * mask
+
+
+class VCAugmentor:
+    """Noise (and optional reverb) augmentation on a padded batch on device.
+
+    Args:
+        noise_bank: ``NoiseBank`` to draw noise segments from
+        rir_bank: optional ``RIRBank``, used with probability ``reverb_prob``
+        snr_range: uniform range of the mixing SNR in dB
+    """
+
+    def __init__(
+        self, noise_bank, rir_bank=None, reverb_prob=0.0, snr_range=(0.0, 20.0)
+    ):
+        self.noise_bank = noise_bank
+        self.rir_bank = rir_bank
+        self.reverb_prob = reverb_prob if rir_bank is not None else 0.0
+        self.snr_range = snr_range
+
+    @torch.no_grad()
+    def __call__(self, speech, mask, hop_length=200):
+        """
+        Args:
+            speech: (B, L) padded waveforms
+            mask: (B, L // hop_length) frame mask of the valid part
+        Returns:
+            noisy speech of shape (B, L), zero in the padded part
+        """
+        B, L = speech.shape
+        device = speech.device
+        sample_mask = mask.repeat_interleave(hop_length, dim=1)[:, :L].to(speech.dtype)
+        if self.reverb_prob > 0:
+            use_reverb = torch.rand(B, device=device) < self.reverb_prob
+            if use_reverb.any():
+                rirs = torch.from_numpy(self.rir_bank.sample(B)).to(device)
+                reverb = fft_convolve_same(speech, rirs) * sample_mask
+                speech = torch.where(use_reverb.unsqueeze(1), reverb, speech)
+        noise = torch.from_numpy(self.noise_bank.sample(L, B)).to(
+            device, non_blocking=True
+        )
+        snr = torch.empty(B, device=device).uniform_(*self.snr_range)
+        return snr_mixer_batch(speech, noise, snr, sample_mask)
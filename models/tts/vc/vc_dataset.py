@@ -8,20 +8,19 @@ from utils.data_utils import *
 from models.base.base_dataset import (
     BaseCollator,
 )
-from multiprocessing import Pool, Lock
+from multiprocessing import Pool
 import random
+import time
 import torchaudio
-import rir_generator as rir
+import scipy.signal
+from models.tts.vc.vc_feature_store import VCFeatureStore
+from models.tts.vc.vc_metadata_index import VCMetadataIndex
+from models.tts.vc.vc_augment import NoiseBank, RIRBank
 
 
 NUM_WORKERS = 64
-lock = Lock()  # 创建一个全局锁
 SAMPLE_RATE = 16000
 
-def get_metadata(file_path):
-    metadata = torchaudio.info(file_path)
-    return file_path, metadata.num_frames
-
 def get_speaker(file_path):
     speaker_id = file_path.split(os.sep)[-3]
     if 'mls' in file_path:
@@ -30,14 +29,14 @@ def get_speaker(file_path):
         speaker = 'libri_' + speaker_id
     return file_path, speaker
 
-def safe_write_to_file(data, file_path, mode='w'):
-    try:
-        with lock, open(file_path, mode, encoding='utf-8') as f:
-            json.dump(data, f)
-            f.flush()
-            os.fsync(f.fileno())
-    except IOError as e:
-        print(f"Error writing to {file_path}: {e}")
+
+def set_default_cache_dirs(args, root):
+    """Place the metadata index and the noise/RIR banks under ``root`` (e.g. the
+    experiment directory) unless trans_exp sets them explicitly."""
+    if args.metadata_index_dir is None:
+        args.metadata_index_dir = os.path.join(root, "metadata_index")
+    if "augment_bank_dir" not in args or args.augment_bank_dir is None:
+        args.augment_bank_dir = os.path.join(root, "augment_bank")
 
 
 class VCDataset(Dataset):
@@ -63,100 +62,59 @@ class VCDataset(Dataset):
         self.directory_list = directory_list
         print(f"Loading {len(directory_list)} directories: {directory_list}")
 
-        # Load metadata cache
-        # metadata_cache: {file_path: num_frames}
-        self.metadata_cache_path = '/mnt/data2/hehaorui/ckpt/rp_metadata_cache.json'
-        print(f"Loading metadata_cache from {self.metadata_cache_path}")
-        if os.path.exists(self.metadata_cache_path):
-            with open(self.metadata_cache_path, 'r', encoding='utf-8') as f:
-                self.metadata_cache = json.load(f)
-            print(f"Loaded {len(self.metadata_cache)} metadata_cache")
-        else:
-            print(f"metadata_cache not found, creating new")
-            self.metadata_cache = {}
-
-        # Load speaker cache
-        # speaker_cache: {file_path: speaker}
-        self.speaker_cache_path = '/mnt/data2/hehaorui/ckpt/rp_file2speaker.json'
-        print(f"Loading speaker_cache from {self.speaker_cache_path}")
-        if os.path.exists(self.speaker_cache_path):
-            with open(self.speaker_cache_path, 'r', encoding='utf-8') as f:
-                self.speaker_cache = json.load(f)
-            print(f"Loaded {len(self.speaker_cache)} speaker_cache")
-        else:
-            print(f"speaker_cache not found, creating new")
-            self.speaker_cache = {}
-        
-        self.files = []
-        # Load all flac files
-        for directory in directory_list:
-            print(f"Loading {directory}")
-            files = self.get_flac_files(directory)
-            random.shuffle(files)
-            print(f"Loaded {len(files)} files")
-            self.files.extend(files)
-            del files
-            print(f"Now {len(self.files)} files")
-            self.meta_data_cache = self.process_files()
-            self.speaker_cache = self.process_speakers()
-            temp_cache_path = self.metadata_cache_path.replace('.json', f'_{directory.split("/")[-1]}.json')
-            if not os.path.exists(temp_cache_path):
-                safe_write_to_file(self.meta_data_cache, temp_cache_path)
-                print(f"Saved metadata cache to {temp_cache_path}")
-            temp_cache_path = self.speaker_cache_path.replace('.json', f'_{directory.split("/")[-1]}.json')
-            if not os.path.exists(temp_cache_path):
-                safe_write_to_file(self.speaker_cache, temp_cache_path)
-                print(f"Saved speaker cache to {temp_cache_path}")
-        
-        print(f"Loaded {len(self.files)} files")
-        random.shuffle(self.files)  # Shuffle the files.
-
-        self.filtered_files, self.all_num_frames, index2numframes, index2speakerid = self.filter_files()
-        #只有3-30s的语音才会被保留
-        print(f"Loaded {len(self.filtered_files)} files")
-
-        self.index2numframes = index2numframes#index to 每条utt的长度
-        self.index2speaker = index2speakerid #index to 每条utt的speaker
-        self.speaker2id = self.create_speaker2id() #每条utt的speaker to 每条utt的speaker_id
-        self.num_frame_sorted = np.array(sorted(self.all_num_frames))
-        self.num_frame_indices = np.array(
-            sorted(
-                range(len(self.all_num_frames)), key=lambda k: self.all_num_frames[k]
+        # Load metadata index
+        # only new or modified files are probed, the filtered file list is memory-mapped
+        self.metadata_index = VCMetadataIndex(args.metadata_index_dir, num_workers=NUM_WORKERS)
+        min_frames, max_frames = SAMPLE_RATE * 3, SAMPLE_RATE * 30 #只有3-30s的语音才会被保留
+        index = self.metadata_index.load(directory_list, min_frames, max_frames)
+        if index is None or args.refresh_metadata_index:
+            print(f"Updating metadata index in {args.metadata_index_dir}")
+            legacy_metadata_cache = None
+            if "legacy_metadata_cache" in args:
+                legacy_metadata_cache = args.legacy_metadata_cache
+            self.metadata_index.update(
+                directory_list,
+                speaker_fn=get_speaker,
+                legacy_metadata_cache=legacy_metadata_cache,
             )
-        )
-        del self.meta_data_cache, self.speaker_cache
+            self.metadata_index.export(directory_list, min_frames, max_frames)
+            index = self.metadata_index.load(directory_list, min_frames, max_frames)
+            while index is None:  # another rank is replacing the export
+                time.sleep(1)
+                index = self.metadata_index.load(directory_list, min_frames, max_frames)
+        self.filtered_files, self.num_frames, self.speaker_ids, speakers = index
+        print(f"Loaded {len(self.filtered_files)} files")
 
+        self.speaker2id = {speaker: i for i, speaker in enumerate(speakers)} #每条utt的speaker to 每条utt的speaker_id
+        # shuffle before the stable sort, so that the files of equal lengths (which are
+        # sorted by path) do not make single-speaker batches. Seeded by the random
+        # module (train.random_seed) like the rest of the sampling, same on all ranks
+        shuffled = np.random.RandomState(random.getrandbits(32)).permutation(len(self.num_frames))
+        self.num_frame_indices = shuffled[np.argsort(self.num_frames[shuffled], kind="stable")]
+
+        # Noise files are decoded once into a memory-mapped noise bank (and RIRs into a RIR bank)
+        # with augment_on_device, the noisy speech is created by the trainer on the batch instead
+        self.augment_on_device = args.augment_on_device
+        self.reverb_prob = args.reverb_prob
+        self.noise_bank, self.rir_bank = None, None
         if self.use_ref_noise or self.use_source_noise:
-            if TRAIN_MODE:
-                self.noise_filenames = self.get_all_flac(args.noise_dir)
-            else:
-                self.noise_filenames = self.get_all_flac(args.test_noise_dir)
-
-    def process_files(self):
-        print(f"Processing metadata...")
-        files_to_process = [file for file in self.files if file not in self.metadata_cache]
-        if files_to_process:
-            with Pool(processes=NUM_WORKERS) as pool:
-                results = list(tqdm(pool.imap_unordered(get_metadata, files_to_process), total=len(files_to_process)))
-            for file, num_frames in results:
-                self.metadata_cache[file] = num_frames 
-            safe_write_to_file(self.metadata_cache, self.metadata_cache_path)
-        else:
-            print(f"Skipping processing metadata, loaded {len(self.metadata_cache)} files")
-        return self.metadata_cache
-
-    def process_speakers(self):
-        print(f"Processing speakers...")
-        files_to_process = [file for file in self.files if file not in self.speaker_cache]
-        if files_to_process:
-            with Pool(processes=NUM_WORKERS) as pool:
-                results = list(tqdm(pool.imap_unordered(get_speaker, files_to_process), total=len(files_to_process)))
-            for file, speaker in results:
-                self.speaker_cache[file] = speaker
-            safe_write_to_file(self.speaker_cache, self.speaker_cache_path)
-        else:
-            print(f"Skipping processing speakers, loaded {len(self.speaker_cache)} files")
-        return self.speaker_cache
+            noise_dir = args.noise_dir if TRAIN_MODE else args.test_noise_dir
+            # built by a single rank, see NoiseBank.build
+            bank_dir = NoiseBank.get_bank_dir(args.augment_bank_dir, noise_dir)
+            if not NoiseBank.exists(bank_dir):
+                NoiseBank.build(self.get_all_flac(noise_dir), bank_dir, num_workers=NUM_WORKERS)
+            self.noise_bank = NoiseBank(bank_dir)
+            print(f"Loaded noise bank of {len(self.noise_bank.noise) / SAMPLE_RATE / 3600:.2f} hours")
+            if args.reverb_prob > 0:
+                if not RIRBank.exists(bank_dir):
+                    RIRBank.build(bank_dir, num_rirs=args.rir_bank_size)
+                self.rir_bank = RIRBank(bank_dir)
+
+        # Precomputed clean content codes and f0, see models/tts/vc/vc_precompute.py
+        self.feature_store = None
+        if args.feature_cache_dir:
+            self.feature_store = VCFeatureStore(args.feature_cache_dir)
+            print(f"Loaded {len(self.feature_store)} cached features from {args.feature_cache_dir}")
 
     def get_flac_files(self, directory):
         flac_files = []
@@ -179,35 +137,7 @@ class VCDataset(Dataset):
         return results
     
     def get_num_frames(self, index):
-        return self.index2numframes[index]
-    
-    def filter_files(self):
-        # Filter files
-        metadata_cache = self.meta_data_cache
-        speaker_cache = self.speaker_cache
-        filtered_files = []
-        all_num_frames = []
-        index2numframes = {}
-        index2speaker = {}
-        for file in self.files:
-            num_frames = metadata_cache[file]
-            if SAMPLE_RATE * 3 <= num_frames <= SAMPLE_RATE * 30:
-                filtered_files.append(file)
-                all_num_frames.append(num_frames)
-                index2speaker[len(filtered_files) - 1] = speaker_cache[file]
-                index2numframes[len(filtered_files) - 1] = num_frames
-        return filtered_files, all_num_frames, index2numframes, index2speaker
-    
-    def create_speaker2id(self):
-        speaker2id = {}
-        unique_id = 0  # 开始的唯一 ID
-        print(f"Creating speaker2id from {len(self.index2speaker)} utterences")
-        for _, speaker in tqdm(self.index2speaker.items()):
-            if speaker not in speaker2id:
-                speaker2id[speaker] = unique_id
-                unique_id += 1  # 为下一个唯一 speaker 增加 ID
-        print(f"Created speaker2id with {len(speaker2id)} speakers")
-        return speaker2id
+        return int(self.num_frames[index])
     
     def snr_mixer(self, clean, noise, snr):
         # Normalizing to -25 dB FS
@@ -230,19 +160,10 @@ class VCDataset(Dataset):
         return noisyspeech_tensor
     
     def add_noise(self, clean):
-        # self.noise_filenames: list of noise files
-        random_idx = np.random.randint(0, np.size(self.noise_filenames))
-        noise, _ = librosa.load(self.noise_filenames[random_idx], sr=SAMPLE_RATE)
+        if self.rir_bank is not None and random.random() < self.reverb_prob:
+            clean = self.add_reverb(clean)
         clean = clean.cpu().numpy()
-        if len(noise)>=len(clean):
-            noise = noise[0:len(clean)] #截取噪声的长度
-        else:
-            while len(noise)<=len(clean): #如果噪声的长度小于语音的长度
-                random_idx = (random_idx + 1)%len(self.noise_filenames) #随机读一个噪声
-                newnoise, fs = librosa.load(self.noise_filenames[random_idx], sr=SAMPLE_RATE)
-                noiseconcat = np.append(noise, np.zeros(int(fs * 0.2)))#在噪声后面加上0.2静音
-                noise = np.append(noiseconcat, newnoise)#拼接噪声
-        noise = noise[0:len(clean)] #截取噪声的长度
+        noise = self.noise_bank.sample(len(clean)) #随机截取噪声
         #随机sample一个小于20大于0的随机数
         snr = random.uniform(0.0,20.0)
         noisyspeech = self.snr_mixer(clean=clean, noise=noise, snr=snr) #根据随机的SNR级别，混合生成带噪音频
@@ -250,33 +171,17 @@ class VCDataset(Dataset):
         return noisyspeech
     
     def add_reverb(self, speech):
-        room_dim = [np.random.uniform(1, 12) for _ in range(3)]  # [length, width, height]
-        mic_pos = [np.random.uniform(0, dim) for dim in room_dim] # 随机选择麦克风位置
-        distance = np.random.normal(2, 4) # 确定声源与麦克风的距离
-        while distance <= 0 or distance > 5:
-            distance = np.random.normal(2, 4)
-        source_pos = [mic_pos[0] + distance, mic_pos[1], mic_pos[2]] # 随机选择声源位置，确保它在以麦克风为中心的球内
-        rt60 = np.random.uniform(0.05, 1.0) # 随机选择RT60值
-        try: 
-            rir_filter = rir.generate(
-                c=340,                  # 声速
-                fs=SAMPLE_RATE,
-                r=[mic_pos],            # 麦克风位置
-                s=source_pos,           # 声源位置
-                L=room_dim,             # 房间尺寸
-                reverberation_time=rt60,# RT60值
-                nsample=4096,           # IR长度
-            )
-            # 应用混响
-            speech_reverb = np.convolve(speech.cpu().numpy(), rir_filter[:, 0], mode='same')
-            speech = torch.tensor(speech_reverb, dtype=torch.float32)
+        if self.rir_bank is None:
             return speech
-        except:
-            return speech #如果遇到ValueError: s is outside the room，直接返回没加混响的声音
+        rir_filter = self.rir_bank.sample()
+        # 应用混响
+        speech_reverb = scipy.signal.fftconvolve(speech.cpu().numpy(), rir_filter, mode='same')
+        speech = torch.tensor(speech_reverb, dtype=torch.float32)
+        return speech
 
     
     def __len__(self):
-        return len(self.files)
+        return len(self.filtered_files)
 
     def __getitem__(self, idx):
         file_path = self.filtered_files[idx]
@@ -285,9 +190,15 @@ class VCDataset(Dataset):
             speech = speech[:30 * SAMPLE_RATE]
         speech = torch.tensor(speech, dtype=torch.float32)
         inputs = self._get_reference_vc(speech, hop_length=200)
-        speaker = self.index2speaker[idx]
-        speaker_id = self.speaker2id[speaker]
-        inputs["speaker_id"] = speaker_id
+        if self.feature_store is not None and file_path in self.feature_store:
+            # the source part starts right after the reference clip
+            start = inputs["ref_mask"].shape[0]
+            end = start + inputs["mask"].shape[0]
+            content_code, pitch = self.feature_store.get(file_path, start, end)
+            if len(content_code) == end - start:
+                inputs["content_code"] = torch.from_numpy(content_code)
+                inputs["pitch"] = torch.from_numpy(pitch)
+        inputs["speaker_id"] = int(self.speaker_ids[idx])
         return inputs
     
     def _get_reference_vc(self, speech, hop_length):
@@ -306,8 +217,8 @@ class VCDataset(Dataset):
         ref_mask = torch.ones(len(ref_speech) // hop_length)
         mask = torch.ones(len(new_speech) // hop_length)
 
-        if not (self.use_source_noise or self.use_ref_noise):
-            # 不使用噪声
+        if not (self.use_source_noise or self.use_ref_noise) or self.augment_on_device:
+            # 不使用噪声, or noise is added on device
             return {"speech": new_speech, "ref_speech": ref_speech, "ref_mask": ref_mask, "mask": mask}
         elif self.use_source_noise and self.use_ref_noise:
             # 使用噪声
@@ -328,8 +239,9 @@ class VCCollator(BaseCollator):
         BaseCollator.__init__(self, cfg)
         #self.use_noise = cfg.trans_exp.use_noise
 
-        self.use_source_noise = self.cfg.trans_exp.use_source_noise
-        self.use_ref_noise = self.cfg.trans_exp.use_ref_noise
+        # with augment_on_device the noisy speech is created by the trainer
+        self.use_source_noise = self.cfg.trans_exp.use_source_noise and not self.cfg.trans_exp.augment_on_device
+        self.use_ref_noise = self.cfg.trans_exp.use_ref_noise and not self.cfg.trans_exp.augment_on_device
  
         print(f"use_source_noise: {self.use_source_noise}")
         print(f"use_ref_noise: {self.use_ref_noise}")
@@ -372,6 +284,14 @@ class VCCollator(BaseCollator):
             # Process 'noisy_ref_speech' data
             noisy_ref_speeches = [process_tensor(b['noisy_ref_speech']) for b in batch]
             packed_batch_features['noisy_ref_speech'] = pad_sequence(noisy_ref_speeches, batch_first=True, padding_value=0)
+        if all('content_code' in b for b in batch):
+            # Process cached 'content_code' and 'pitch' data, only used when every item is cached
+            content_codes = [b['content_code'] for b in batch]
+            packed_batch_features['content_code'] = pad_sequence(content_codes, batch_first=True, padding_value=0)
+            # pad f0 with the last value, same as interpolating the f0 of zero-padded speech
+            max_len = packed_batch_features['mask'].shape[1]
+            pitches = [torch.cat((b['pitch'], b['pitch'][-1:].repeat(max_len - len(b['pitch'])))) for b in batch]
+            packed_batch_features['pitch'] = torch.stack(pitches, dim=0)
         return packed_batch_features
 
 
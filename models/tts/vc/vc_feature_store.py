@@ -0,0 +1,111 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import glob
+import json
+import numpy as np
+
+
+class VCFeatureStore:
+    """Read-only view of precomputed clean content codes and f0.
+
+    The store directory holds shards written by ``VCFeatureWriter``:
+        {prefix}_{k}.codes.npy: int16, all mHuBERT cluster ids of the shard concatenated
+        {prefix}_{k}.pitch.npy: float32, all interpolated WORLD f0 of the shard concatenated
+        {prefix}_{k}.json: {file_path: [offset, num_frames]}
+    Both arrays share the same frame offsets (hop size 200 at 16 kHz). Shards are
+    memory-mapped lazily, so every dataloader worker opens its own handles.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        self.shards = []
+        for index_path in sorted(glob.glob(os.path.join(root, "*.json"))):
+            shard = index_path[: -len(".json")]
+            shard_id = len(self.shards)
+            self.shards.append(shard)
+            with open(index_path, "r", encoding="utf-8") as f:
+                for file_path, (offset, num_frames) in json.load(f).items():
+                    self.index[file_path] = (shard_id, offset, num_frames)
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, file_path):
+        return file_path in self.index
+
+    def _get_arrays(self, shard_id):
+        if shard_id not in self._arrays:
+            shard = self.shards[shard_id]
+            self._arrays[shard_id] = (
+                np.load(shard + ".codes.npy", mmap_mode="r"),
+                np.load(shard + ".pitch.npy", mmap_mode="r"),
+            )
+        return self._arrays[shard_id]
+
+    def get(self, file_path, start=0, end=None):
+        """Return (codes, pitch) frames [start, end) of an utterance as new arrays."""
+        shard_id, offset, num_frames = self.index[file_path]
+        end = num_frames if end is None else min(end, num_frames)
+        codes, pitch = self._get_arrays(shard_id)
+        codes = np.array(codes[offset + start : offset + end], dtype=np.int64)
+        pitch = np.array(pitch[offset + start : offset + end], dtype=np.float32)
+        return codes, pitch
+
+    def __getstate__(self):
+        # memmaps are reopened in each worker process
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+
+class VCFeatureWriter:
+    """Append per-utterance features into shards readable by ``VCFeatureStore``.
+
+    A shard is only visible to readers once its json index is written, which
+    happens last, so an interrupted run can be resumed by skipping the paths
+    already present in the store.
+    """
+
+    def __init__(self, root, prefix="shard", shard_size=5000):
+        self.root = root
+        self.prefix = prefix
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+        self.shard_id = len(glob.glob(os.path.join(root, f"{prefix}_*.json")))
+        self._reset()
+
+    def _reset(self):
+        self.codes = []
+        self.pitch = []
+        self.index = {}
+        self.offset = 0
+
+    def add(self, file_path, codes, pitch):
+        assert len(codes) == len(pitch), (file_path, len(codes), len(pitch))
+        self.codes.append(np.asarray(codes, dtype=np.int16))
+        self.pitch.append(np.asarray(pitch, dtype=np.float32))
+        self.index[file_path] = [self.offset, len(codes)]
+        self.offset += len(codes)
+        if len(self.index) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.index) == 0:
+            return
+        shard = os.path.join(self.root, "{}_{:05d}".format(self.prefix, self.shard_id))
+        np.save(shard + ".codes.npy", np.concatenate(self.codes))
+        np.save(shard + ".pitch.npy", np.concatenate(self.pitch))
+        with open(shard + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(shard + ".json.tmp", shard + ".json")
+        self.shard_id += 1
+        self._reset()
+
+    def close(self):
+        self.flush()
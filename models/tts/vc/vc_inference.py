@@ -1,13 +1,15 @@
 import argparse
+import concurrent.futures
 import torch
+import torch.nn.functional as F
 import numpy as np
-import torch
+import torchaudio
 from tqdm import tqdm
 from safetensors.torch import load_model
 import librosa
-from utils.util import load_config
 import os
 import json
+from torch.nn.utils.rnn import pad_sequence
 from models.tts.vc.vc_trainer import VCTrainer
 from utils.util import load_config
 from models.tts.vc.ns2_uniamphion import UniAmphionVC
@@ -33,6 +35,213 @@ def build_trainer(args, cfg):
     return trainer
 
 
+def load_wav(wav_path, multiple):
+    wav, _ = librosa.load(wav_path, sr=16000)
+    wav = np.pad(wav, (0, multiple - len(wav) % multiple))
+    return torch.from_numpy(wav)
+
+
+def get_duration(wav_path):
+    info = torchaudio.info(wav_path)
+    return info.num_frames / info.sample_rate
+
+
+def length_mask(lengths, max_length=None):
+    max_length = max_length or int(max(lengths))
+    lengths = torch.as_tensor(lengths)
+    return torch.arange(max_length)[None, :] < lengths[:, None]
+
+
+class VCInferenceEngine:
+    """Batched zero-shot voice conversion on top of ``UniAmphionVC.inference``.
+
+    Test cases are bucketed by source length, so a batch holds utterances of
+    similar duration (at most ``max_batch_size`` items and ``max_frames`` padded
+    source frames). Audio of the next batches is decoded on background threads
+    while the current one is on the GPU.
+
+    Python API:
+        engine = VCInferenceEngine.from_checkpoint(cfg, checkpoint_path, device)
+        for case, outputs in engine.convert(test_cases):
+            outputs["recon_mel"]  # (80, T) numpy array
+    where every test case is a dict with ``source_wav_path`` and
+    ``prompt_wav_path`` (and optionally ``target_wav_path``).
+    """
+
+    def __init__(
+        self,
+        model,
+        w2v,
+        device,
+        inference_steps=200,
+        sigma=1.2,
+        ode_solve_method=None,
+        time_schedule=None,
+        max_batch_size=16,
+        max_frames=16000,
+        num_workers=8,
+        prefetch_batches=2,
+    ):
+        self.model = model
+        self.w2v = w2v
+        self.device = device
+        self.inference_steps = inference_steps
+        self.sigma = sigma
+        self.ode_solve_method = ode_solve_method
+        self.time_schedule = time_schedule
+        self.max_batch_size = max_batch_size
+        self.max_frames = max_frames
+        self.num_workers = num_workers
+        self.prefetch_batches = prefetch_batches
+
+    @classmethod
+    def from_checkpoint(cls, cfg, checkpoint_path, device, content_extractor=None, **kwargs):
+        if content_extractor is None:
+            content_extractor = "whisper" if "whisper" in checkpoint_path else "mhubert"
+        if content_extractor == "mhubert":
+            w2v = HubertWithKmeans()
+            cfg.model.vc_feature.content_feature_dim = 768
+        elif content_extractor == "whisper":
+            print("using whisper")
+            w2v = WhisperNormal()
+            cfg.model.vc_feature.content_feature_dim = 512
+        else:
+            raise ValueError("Invalid content extractor: {}".format(content_extractor))
+        w2v = w2v.to(device=device)
+        w2v.eval()
+
+        model = UniAmphionVC(cfg=cfg.model)
+        print("loading model")
+        if "pytorch_model.bin" in checkpoint_path:
+            model.load_state_dict(torch.load(checkpoint_path))
+        elif "model.safetensors" in checkpoint_path:
+            load_model(model, checkpoint_path)
+        print("model loaded")
+        model.to(device)
+        model.eval()
+        return cls(model, w2v, device, **kwargs)
+
+    def make_batches(self, test_cases):
+        """Group test case indices of similar source length."""
+        with concurrent.futures.ThreadPoolExecutor(self.num_workers) as executor:
+            durations = list(
+                executor.map(get_duration, [case["source_wav_path"] for case in test_cases])
+            )
+        batches, batch = [], []
+        for index in np.argsort(durations, kind="stable"):
+            # padded source frames of the batch if index is added
+            frames = (len(batch) + 1) * int(durations[index] * 16000 / 200 + 8)
+            if batch and (len(batch) >= self.max_batch_size or frames > self.max_frames):
+                batches.append(batch)
+                batch = []
+            batch.append(int(index))
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def load_case(self, case):
+        audio = {
+            "source": load_wav(case["source_wav_path"], 1600),
+            "prompt": load_wav(case["prompt_wav_path"], 200),
+        }
+        if case.get("target_wav_path") is not None:
+            audio["target"] = load_wav(case["target_wav_path"], 1600)
+        return audio
+
+    @torch.no_grad()
+    def convert_batch(self, sources, prompts):
+        """Convert lists of 1D waveforms (16 kHz, padded to 1600 / 200 samples).
+
+        Returns a list of (80, T) mel spectrograms, one per source. The sources and
+        the prompts are zero-padded to the longest of the batch, the content
+        features, f0 and reference embeddings are computed once on the padded batch
+        and the padded frames are masked (x_mask, x_ref_mask). The GroupNorm over time
+        of HuBERT still sees the padding, hence the batches of similar lengths.
+        """
+        device = self.device
+        frame_lengths = [len(source) // 200 for source in sources]
+        x_mask = length_mask(frame_lengths).to(device)
+
+        audio = pad_sequence(sources, batch_first=True).to(device, non_blocking=True)
+        _, content_feature = self.w2v(audio, mask=x_mask)
+        content_feature = content_feature.to(device=device)
+        pitch_raw = extract_world_f0(audio)
+
+        # normalize pitch over the valid frames of each utterance only
+        mask = x_mask.to(pitch_raw.dtype)
+        num = mask.sum(dim=1, keepdim=True)
+        mean = (pitch_raw * mask).sum(dim=1, keepdim=True) / num
+        std = torch.sqrt(
+            ((pitch_raw - mean) ** 2 * mask).sum(dim=1, keepdim=True) / (num - 1).clamp(min=1)
+        )
+        pitch = (pitch_raw - mean) / (std + 1e-6) * mask
+
+        ref_lengths = [len(prompt) // 200 for prompt in prompts]
+        x_ref_mask = length_mask(ref_lengths).to(device)
+        # the right reflect padding of mel_spectrogram ((n_fft - hop) / 2 samples) is
+        # done per prompt, so that its last frames do not see the zero padding
+        ref_audio = [
+            F.pad(prompt[None], (0, (1024 - 200) // 2), "reflect")[0]
+            for prompt in prompts
+        ]
+        ref_audio = pad_sequence(ref_audio, batch_first=True)
+        ref_audio = ref_audio.to(device, non_blocking=True)
+        x_ref = mel_spectrogram(ref_audio)[:, :, : max(ref_lengths)].transpose(1, 2)
+
+        x0 = self.model.inference(
+            content_feature=content_feature,
+            pitch=pitch,
+            x_ref=x_ref,
+            x_ref_mask=x_ref_mask,
+            inference_steps=self.inference_steps,
+            sigma=self.sigma,
+            ode_solve_method=self.ode_solve_method,
+            time_schedule=self.time_schedule,
+            x_mask=x_mask,
+        )
+        x0 = x0.transpose(1, 2).cpu().numpy()
+        return [x0[i, :, :length] for i, length in enumerate(frame_lengths)]
+
+    def convert(self, test_cases):
+        """Yield (test_case, outputs) in bucketed order.
+
+        outputs holds (80, T) numpy mels: recon_mel, source_mel, prompt_mel and
+        target_mel when the test case has a target_wav_path.
+        """
+        batches = self.make_batches(test_cases)
+        loader = concurrent.futures.ThreadPoolExecutor(self.num_workers)
+        prefetcher = concurrent.futures.ThreadPoolExecutor(1)
+
+        def load(batch):
+            return list(loader.map(self.load_case, [test_cases[i] for i in batch]))
+
+        # keep prefetch_batches batches decoding while the GPU works
+        pending = [prefetcher.submit(load, batch) for batch in batches[: self.prefetch_batches]]
+        try:
+            for batch_id, batch in enumerate(batches):
+                audios = pending.pop(0).result()
+                if batch_id + self.prefetch_batches < len(batches):
+                    pending.append(
+                        prefetcher.submit(load, batches[batch_id + self.prefetch_batches])
+                    )
+                recon_mels = self.convert_batch(
+                    [audio["source"] for audio in audios],
+                    [audio["prompt"] for audio in audios],
+                )
+                for index, audio, recon_mel in zip(batch, audios, recon_mels):
+                    outputs = {"recon_mel": recon_mel}
+                    with torch.no_grad():
+                        for key in audio:
+                            mel = mel_spectrogram(audio[key].to(self.device)[None, :])
+                            outputs[key + "_mel"] = mel[0].cpu().numpy()
+                    yield test_cases[index], outputs
+        finally:
+            for future in pending:
+                future.cancel()
+            prefetcher.shutdown()
+            loader.shutdown()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -81,6 +290,22 @@ def main():
         "--source_noisy",
         action="store_true",
     )
+    parser.add_argument("--inference_steps", type=int, default=200)
+    parser.add_argument("--sigma", type=float, default=1.2)
+    parser.add_argument("--ode_solve_method", type=str, default=None)
+    parser.add_argument("--time_schedule", type=str, default=None)
+    parser.add_argument(
+        "--batch_size", type=int, default=16, help="max number of utterances per batch"
+    )
+    parser.add_argument(
+        "--max_frames",
+        type=int,
+        default=16000,
+        help="max padded source frames (hop 200) per batch",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="threads decoding audio / writing mels"
+    )
     parser.add_argument("--local_rank", default=-1, type=int)
     args = parser.parse_args()
     cfg = load_config(args.config)
@@ -96,32 +321,20 @@ def main():
 
     with torch.cuda.device(args.local_rank):
         torch.cuda.empty_cache()
-    ckpt_path = args.checkpoint_path
     zero_shot_json_file_path = args.zero_shot_json_file_path
-    if args.content_extractor == "mhubert":
-        w2v  = HubertWithKmeans()
-    elif args.content_extractor == "whisper":
-        print("using whisper")
-        w2v = WhisperNormal()
-    else:
-        raise ValueError("Invalid content extractor: {}".format(args.content_extractor))
-    
-    if "whisper" in args.content_extractor:
-        cfg.model.vc_feature.content_feature_dim = 512
-    else:
-       cfg.model.vc_feature.content_feature_dim = 768
-    w2v = w2v.to(device=args.local_rank)
-    w2v.eval()
-
-    model = UniAmphionVC(cfg=cfg.model)
-    print("loading model")
-    if "pytorch_model.bin" in ckpt_path:
-        model.load_state_dict(torch.load(ckpt_path))
-    elif "model.safetensors" in ckpt_path:
-        load_model(model, ckpt_path)
-    print("model loaded")
-    model.cuda(args.local_rank)
-    model.eval()
+    engine = VCInferenceEngine.from_checkpoint(
+        cfg,
+        args.checkpoint_path,
+        args.local_rank,
+        content_extractor=args.content_extractor,
+        inference_steps=args.inference_steps,  # 150-300 0.95-1.5
+        sigma=args.sigma,
+        ode_solve_method=args.ode_solve_method,
+        time_schedule=args.time_schedule,
+        max_batch_size=args.batch_size,
+        max_frames=args.max_frames,
+        num_workers=args.num_workers,
+    )
     print("loading zero shot json")
     with open(zero_shot_json_file_path, "r") as f:
         zero_shot_json = json.load(f)
@@ -157,89 +370,53 @@ def main():
     if os.path.exists(args.output_dir):
         os.system(f"rm -r {args.output_dir}")
     os.makedirs(args.output_dir, exist_ok=True)
-    test_cases = []
 
     os.makedirs(f"{args.output_dir}/recon/mel", exist_ok=True)
     os.makedirs(f"{args.output_dir}/target/mel", exist_ok=True)
     os.makedirs(f"{args.output_dir}/source/mel", exist_ok=True)
     os.makedirs(f"{args.output_dir}/prompt/mel", exist_ok=True)
 
-    temp_id = 0
-    all_keys = utt_dict.keys()
-    # random sample 20 samples
-    # sample_keys = list(utt_dict.keys())[:10]
     sample_keys = list(utt_dict.keys())
-    # 应该有30个
-    for utt_id in tqdm(sample_keys):
-        utt = utt_dict[utt_id]
-        # source is the input
-        wav_path = utt["source_speech"]
-        wav, _ = librosa.load(wav_path, sr=16000)
-        wav = np.pad(wav, (0, 1600 - len(wav) % 1600))
-        audio = torch.from_numpy(wav).to(args.local_rank)
-        audio = audio[None, :]
-        
-        # target is the ground truth
-        tgt_wav_path = utt["target_speech"]
-        tgt_wav,_ = librosa.load(tgt_wav_path, sr=16000)
-        tgt_wav = np.pad(tgt_wav, (0, 1600 - len(tgt_wav) % 1600))
-        tgt_audio = torch.from_numpy(tgt_wav).to(args.local_rank)
-        tgt_audio = tgt_audio[None, :]
-
-        # prompt is the reference
-        ref_wav_path = utt["prompt_speech"]
-        ref_wav,_ = librosa.load(ref_wav_path, sr=16000)
-        ref_wav = np.pad(ref_wav, (0, 200 - len(ref_wav) % 200))
-        ref_audio = torch.from_numpy(ref_wav).to(args.local_rank)
-        ref_audio = ref_audio[None, :]
-
-        with torch.no_grad():
-            ref_mel = mel_spectrogram(ref_audio)
-            tgt_mel = mel_spectrogram(tgt_audio)
-            source_mel = mel_spectrogram(audio)
-            ref_mel = ref_mel.transpose(1, 2).to(device=args.local_rank)
-            ref_mask = torch.ones(ref_mel.shape[0], ref_mel.shape[1]).to(args.local_rank).bool()
-
-            # shifted_speech, need_shift = get_pitch_shifted_speech(audio)
-            # if not need_shift:
-            #     _, content_feature = w2v(audio)
-            # else:
-            #     print("pitch shifted....")
-            #     _, content_feature = w2v(shifted_speech)   
-
-            _, content_feature = w2v(audio)
-            content_feature = content_feature.to(device=args.local_rank)
-
-            pitch_raw = extract_world_f0(audio)
-            pitch = (pitch_raw - pitch_raw.mean(dim=1, keepdim=True)) / (
-                pitch_raw.std(dim=1, keepdim=True) + 1e-6
-            )  
-            x0 = model.inference(
-                content_feature=content_feature,
-                pitch=pitch,
-                x_ref=ref_mel,
-                x_ref_mask=ref_mask,
-                inference_steps=200, 
-                sigma=1.2,
-            )# 150-300 0.95-1.5
-
-            test_case = dict()
-            recon_path = f"{args.output_dir}/recon/mel/recon_{utt_id}.npy"
-            ref_path = f"{args.output_dir}/target/mel/target_{utt_id}.npy"
-            source_path = f"{args.output_dir}/source/mel/source_{utt_id}.npy"
-            prompt_path = f"{args.output_dir}/prompt/mel/prompt_{utt_id}.npy"
-            
-            test_case["recon_ref_wav_path"] = recon_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
-            test_case["reference_wav_path"] = ref_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
-            test_case["source_wav_path"] = source_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
-            test_case["prompt_wav_path"] = prompt_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
-
-            np.save(recon_path, x0.transpose(1, 2).detach().cpu().numpy())
-            np.save(prompt_path, ref_mel.transpose(1, 2).detach().cpu().numpy())
-            np.save(ref_path, tgt_mel.detach().cpu().numpy())
-            np.save(source_path, source_mel.detach().cpu().numpy())
-            test_cases.append(test_case)
-    del model, w2v, ref_mel, ref_mask, content_feature, pitch, x0, ref_audio, tgt_audio, audio, tgt_mel, source_mel
+    cases = [
+        {
+            "uid": utt_id,
+            "source_wav_path": utt_dict[utt_id]["source_speech"],
+            "target_wav_path": utt_dict[utt_id]["target_speech"],
+            "prompt_wav_path": utt_dict[utt_id]["prompt_speech"],
+        }
+        for utt_id in sample_keys
+    ]
+    # mels are written on background threads, recon.json keeps the test case order
+    writer = concurrent.futures.ThreadPoolExecutor(args.num_workers)
+    futures = []
+    test_cases = {}
+    for case, outputs in tqdm(engine.convert(cases), total=len(cases)):
+        utt_id = case["uid"]
+        test_case = dict()
+        recon_path = f"{args.output_dir}/recon/mel/recon_{utt_id}.npy"
+        ref_path = f"{args.output_dir}/target/mel/target_{utt_id}.npy"
+        source_path = f"{args.output_dir}/source/mel/source_{utt_id}.npy"
+        prompt_path = f"{args.output_dir}/prompt/mel/prompt_{utt_id}.npy"
+
+        test_case["recon_ref_wav_path"] = recon_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
+        test_case["reference_wav_path"] = ref_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
+        test_case["source_wav_path"] = source_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
+        test_case["prompt_wav_path"] = prompt_path.replace("/mel/", "/wav/").replace(".npy", ".wav")
+
+        for path, key in [
+            (recon_path, "recon_mel"),
+            (prompt_path, "prompt_mel"),
+            (ref_path, "target_mel"),
+            (source_path, "source_mel"),
+        ]:
+            # (1, 80, T) as saved by the single utterance loop
+            futures.append(writer.submit(np.save, path, outputs[key][None]))
+        test_cases[utt_id] = test_case
+    for future in futures:
+        future.result()
+    writer.shutdown()
+    test_cases = [test_cases[utt_id] for utt_id in sample_keys]
+    del engine
     data = dict()
     data["dataset"] = "recon"
     data["test_cases"] = test_cases
@@ -0,0 +1,235 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import json
+import sqlite3
+import hashlib
+import shutil
+import numpy as np
+import torchaudio
+from tqdm import tqdm
+from multiprocessing import Pool
+
+
+def get_num_frames(file_path):
+    return file_path, torchaudio.info(file_path).num_frames
+
+
+def scan_audio_files(directory):
+    """Return [(file_path, mtime)] of all flac/wav files under directory."""
+    audio_files = []
+    stack = [directory]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=True):
+                stack.append(entry.path)
+            elif entry.name.endswith(".flac") or entry.name.endswith(".wav"):
+                audio_files.append((entry.path, entry.stat().st_mtime))
+    return audio_files
+
+
+def prefix_range(directory):
+    # all paths starting with "directory/" sort in ["directory/", "directory0")
+    directory = directory.rstrip(os.sep)
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)
+
+
+class PathArray:
+    """Memory-mapped list of utf-8 paths: one byte blob plus an offset array."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class VCMetadataIndex:
+    """Persistent metadata of the VC training corpus.
+
+    Per-file metadata (mtime, num_frames, speaker) lives in a SQLite database
+    and is only recomputed for new or modified files. The filtered file list
+    used by ``VCDataset`` is exported as flat numpy arrays that every
+    dataloader worker memory-maps instead of holding Python dicts:
+        paths_blob.npy, paths_offsets.npy: utf-8 paths (see ``PathArray``)
+        num_frames.npy: int64 number of samples per file
+        speaker_ids.npy: int32 index into speakers.json
+    """
+
+    def __init__(self, index_dir, num_workers=os.cpu_count()):
+        self.index_dir = index_dir
+        self.num_workers = num_workers
+        os.makedirs(index_dir, exist_ok=True)
+        self.db_path = os.path.join(index_dir, "metadata.db")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=600)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, mtime REAL, num_frames INTEGER, speaker TEXT)"
+        )
+        return conn
+
+    def update(self, directory_list, speaker_fn, legacy_metadata_cache=None):
+        """Scan directories and refresh the rows of new, modified and removed files."""
+        conn = self._connect()
+        legacy_metadata = None
+        for directory in directory_list:
+            print(f"Scanning {directory}")
+            subdirs = [
+                os.path.join(directory, d)
+                for d in os.listdir(directory)
+                if os.path.isdir(os.path.join(directory, d))
+            ]
+            audio_files = [
+                (entry.path, entry.stat().st_mtime)
+                for entry in os.scandir(directory)
+                if entry.is_file()
+                and (entry.name.endswith(".flac") or entry.name.endswith(".wav"))
+            ]
+            with Pool(processes=self.num_workers) as pool:
+                for result in pool.imap_unordered(scan_audio_files, subdirs):
+                    audio_files.extend(result)
+
+            known = dict(
+                conn.execute(
+                    "SELECT path, mtime FROM files WHERE path >= ? AND path < ?",
+                    prefix_range(directory),
+                )
+            )
+            mtimes = dict(audio_files)
+            removed = [(path,) for path in known if path not in mtimes]
+            to_process = [
+                path for path, mtime in audio_files if known.get(path) != mtime
+            ]
+            print(
+                f"Found {len(audio_files)} files, {len(to_process)} new or modified, {len(removed)} removed"
+            )
+
+            rows = []
+            if (
+                to_process
+                and legacy_metadata_cache
+                and os.path.exists(legacy_metadata_cache)
+            ):
+                if legacy_metadata is None:
+                    with open(legacy_metadata_cache, "r", encoding="utf-8") as f:
+                        legacy_metadata = json.load(f)
+                    print(
+                        f"Loaded {len(legacy_metadata)} entries from {legacy_metadata_cache}"
+                    )
+                # trust the old json cache for files it already covers
+                rows = [
+                    (path, mtimes[path], legacy_metadata[path], speaker_fn(path)[1])
+                    for path in to_process
+                    if path in legacy_metadata and path not in known
+                ]
+                migrated = set(row[0] for row in rows)
+                to_process = [path for path in to_process if path not in migrated]
+            if to_process:
+                with Pool(processes=self.num_workers) as pool:
+                    for path, num_frames in tqdm(
+                        pool.imap_unordered(get_num_frames, to_process, chunksize=64),
+                        total=len(to_process),
+                    ):
+                        rows.append(
+                            (path, mtimes[path], num_frames, speaker_fn(path)[1])
+                        )
+            with conn:
+                conn.executemany("DELETE FROM files WHERE path = ?", removed)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows
+                )
+        conn.close()
+
+    def export_dir(self, directory_list, min_frames, max_frames):
+        key = json.dumps([sorted(directory_list), min_frames, max_frames])
+        return os.path.join(self.index_dir, hashlib.md5(key.encode()).hexdigest())
+
+    def export(self, directory_list, min_frames, max_frames):
+        """Write the arrays of files with min_frames <= num_frames <= max_frames."""
+        conn = self._connect()
+        paths, num_frames, speakers = [], [], []
+        for directory in sorted(directory_list):
+            for path, frames, speaker in conn.execute(
+                "SELECT path, num_frames, speaker FROM files "
+                "WHERE path >= ? AND path < ? AND num_frames BETWEEN ? AND ? ORDER BY path",
+                (*prefix_range(directory), min_frames, max_frames),
+            ):
+                paths.append(path.encode("utf-8"))
+                num_frames.append(frames)
+                speakers.append(speaker)
+        conn.close()
+
+        speaker_list = sorted(set(speakers))
+        speaker2id = {speaker: i for i, speaker in enumerate(speaker_list)}
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(path) for path in paths])
+        arrays = {
+            "paths_blob": np.frombuffer(b"".join(paths), dtype=np.uint8),
+            "paths_offsets": offsets,
+            "num_frames": np.array(num_frames, dtype=np.int64),
+            "speaker_ids": np.array([speaker2id[s] for s in speakers], dtype=np.int32),
+        }
+
+        # write to a temporary directory first, readers never see partial exports
+        out_dir = self.export_dir(directory_list, min_frames, max_frames)
+        tmp_dir = f"{out_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), array)
+        with open(os.path.join(tmp_dir, "speakers.json"), "w", encoding="utf-8") as f:
+            json.dump(speaker_list, f)
+        if os.path.exists(out_dir):
+            # refresh: move the previous export away (unless another rank just did)
+            old_dir = f"{out_dir}.old{os.getpid()}"
+            try:
+                os.replace(out_dir, old_dir)
+                shutil.rmtree(old_dir)
+            except FileNotFoundError:
+                pass
+        try:
+            os.replace(tmp_dir, out_dir)
+        except OSError:
+            # another rank published the same export (ENOTEMPTY/EEXIST) in between,
+            # which is read instead
+            if not os.path.exists(os.path.join(out_dir, "speakers.json")):
+                raise
+            shutil.rmtree(tmp_dir)
+        return out_dir
+
+    def load(self, directory_list, min_frames, max_frames):
+        """Memory-map an export, returns (paths, num_frames, speaker_ids, speakers)."""
+        out_dir = self.export_dir(directory_list, min_frames, max_frames)
+        if not os.path.exists(os.path.join(out_dir, "speakers.json")):
+            return None
+        try:
+            arrays = {
+                name: np.load(os.path.join(out_dir, name + ".npy"), mmap_mode="r")
+                for name in ["paths_blob", "paths_offsets", "num_frames", "speaker_ids"]
+            }
+            with open(
+                os.path.join(out_dir, "speakers.json"), "r", encoding="utf-8"
+            ) as f:
+                speakers = json.load(f)
+        except FileNotFoundError:
+            # moved away by the export of another rank
+            return None
+        paths = PathArray(arrays["paths_blob"], arrays["paths_offsets"])
+        return paths, arrays["num_frames"], arrays["speaker_ids"], speakers
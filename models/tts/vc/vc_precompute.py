@@ -0,0 +1,113 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import concurrent.futures
+import librosa
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch.nn.utils.rnn import pad_sequence
+
+from utils.util import load_config
+from models.tts.vc.vc_dataset import VCDataset, SAMPLE_RATE, set_default_cache_dirs
+from models.tts.vc.hubert_kmeans import HubertWithKmeans
+from models.tts.vc.vc_utils import extract_world_f0
+from models.tts.vc.vc_feature_store import VCFeatureStore, VCFeatureWriter
+
+
+def load_speech(file_path):
+    # same preprocessing as VCDataset.__getitem__ and _get_reference_vc
+    speech, _ = librosa.load(file_path, sr=SAMPLE_RATE)
+    speech = speech[: 30 * SAMPLE_RATE]
+    speech = np.pad(speech, (0, 1600 - len(speech) % 1600))
+    return torch.tensor(speech, dtype=torch.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="config.json",
+        help="json files for configurations.",
+        required=True,
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="feature store directory, defaults to trans_exp.feature_cache_dir",
+    )
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--shard_size", type=int, default=5000)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--rank", type=int, default=0)
+    parser.add_argument("--world_size", type=int, default=1)
+    parser.add_argument("--cuda_id", type=int, default=0)
+    args = parser.parse_args()
+    cfg = load_config(args.config)
+
+    output_dir = args.output_dir or cfg.trans_exp.feature_cache_dir
+    assert (
+        output_dir is not None
+    ), "Please specify --output_dir or trans_exp.feature_cache_dir"
+    device = torch.device(f"cuda:{args.cuda_id}")
+
+    # only the file list and frame counts are needed, noise augmentation stays off
+    cfg.trans_exp.use_source_noise = False
+    cfg.trans_exp.use_ref_noise = False
+    cfg.trans_exp.feature_cache_dir = None
+    set_default_cache_dirs(cfg.trans_exp, output_dir)
+    dataset = VCDataset(cfg.trans_exp)
+    store = VCFeatureStore(output_dir)
+    indices = [
+        i
+        for i in range(args.rank, len(dataset.filtered_files), args.world_size)
+        if dataset.filtered_files[i] not in store
+    ]
+    # sort by length to keep padding small inside a batch
+    indices = sorted(indices, key=lambda i: dataset.num_frames[i])
+    print(f"Extracting features for {len(indices)} files, {len(store)} already cached")
+    del store
+
+    w2v = HubertWithKmeans().to(device)
+    w2v.eval()
+    writer = VCFeatureWriter(
+        output_dir, prefix=f"rank{args.rank}", shard_size=args.shard_size
+    )
+    batches = [
+        indices[i : i + args.batch_size]
+        for i in range(0, len(indices), args.batch_size)
+    ]
+    loader = concurrent.futures.ThreadPoolExecutor(args.num_workers)
+    prefetcher = concurrent.futures.ThreadPoolExecutor(1)
+
+    def load(batch):
+        return list(loader.map(load_speech, [dataset.filtered_files[i] for i in batch]))
+
+    # decode the next batch while the current one is on the GPU
+    next_speeches = prefetcher.submit(load, batches[0]) if batches else None
+    for batch_id, batch in enumerate(tqdm(batches)):
+        speeches = next_speeches.result()
+        if batch_id + 1 < len(batches):
+            next_speeches = prefetcher.submit(load, batches[batch_id + 1])
+        speech = pad_sequence(speeches, batch_first=True, padding_value=0).to(device)
+        with torch.no_grad():
+            codes, _ = w2v(speech)
+            pitch = extract_world_f0(speech)
+        codes = codes.cpu().numpy()
+        pitch = pitch.cpu().numpy()
+        for i, idx in enumerate(batch):
+            frame_num = len(speeches[i]) // 200
+            writer.add(
+                dataset.filtered_files[idx], codes[i, :frame_num], pitch[i, :frame_num]
+            )
+    writer.close()
+    prefetcher.shutdown()
+    loader.shutdown()
+
+
+if __name__ == "__main__":
+    main()
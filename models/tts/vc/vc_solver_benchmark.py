@@ -0,0 +1,175 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Quality vs. number of function evaluations (NFE) of the ODE solvers of
+# UniAmphionVC. Every setting starts from the same noise as a reference run
+# (euler with --ref_steps), the mel L1 distance to the reference is reported.
+
+import argparse
+import json
+import time
+import librosa
+import numpy as np
+import torch
+from tqdm import tqdm
+from safetensors.torch import load_model
+
+from utils.util import load_config
+from models.tts.vc.ns2_uniamphion import UniAmphionVC
+from models.tts.vc.hubert_kmeans import HubertWithKmeans
+from models.tts.vc.vc_utils import mel_spectrogram, extract_world_f0
+
+
+def load_wav(wav_path, multiple, device):
+    wav, _ = librosa.load(wav_path, sr=16000)
+    wav = np.pad(wav, (0, multiple - len(wav) % multiple))
+    return torch.from_numpy(wav).to(device)[None, :]
+
+
+@torch.no_grad()
+def run(model, inputs, steps, ode_solve_method, time_schedule, seed, sigma):
+    torch.manual_seed(seed)
+    torch.cuda.synchronize()
+    start = time.time()
+    x0 = model.inference(
+        **inputs,
+        inference_steps=steps,
+        sigma=sigma,
+        ode_solve_method=ode_solve_method,
+        time_schedule=time_schedule,
+    )
+    torch.cuda.synchronize()
+    return x0, time.time() - start, model.diffusion.nfe
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="config.json",
+        help="json files for configurations.",
+        required=True,
+    )
+    parser.add_argument("--checkpoint_path", type=str, required=True)
+    parser.add_argument("--zero_shot_json_file_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, default="solver_benchmark.json")
+    parser.add_argument("--num_utterances", type=int, default=20)
+    parser.add_argument("--ref_steps", type=int, default=1000)
+    parser.add_argument(
+        "--solvers",
+        type=str,
+        default="euler:uniform,midpoint:uniform,heun:uniform,heun:logsnr,dpm_solver:uniform,dpm_solver:logsnr,dpm_solver:quadratic",
+        help="comma separated solver:time_schedule pairs",
+    )
+    parser.add_argument("--steps", type=str, default="5,10,15,20,30,50")
+    parser.add_argument(
+        "--rk45_tols",
+        type=str,
+        default="1e-2,3e-3,1e-3",
+        help="rtol = atol values of rk45",
+    )
+    parser.add_argument("--sigma", type=float, default=1.2)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--cuda_id", type=int, default=0)
+    args = parser.parse_args()
+    cfg = load_config(args.config)
+    device = torch.device(f"cuda:{args.cuda_id}")
+
+    w2v = HubertWithKmeans().to(device)
+    w2v.eval()
+    cfg.model.vc_feature.content_feature_dim = 768
+    model = UniAmphionVC(cfg=cfg.model)
+    if "pytorch_model.bin" in args.checkpoint_path:
+        model.load_state_dict(torch.load(args.checkpoint_path))
+    elif "model.safetensors" in args.checkpoint_path:
+        load_model(model, args.checkpoint_path)
+    model.to(device)
+    model.eval()
+
+    with open(args.zero_shot_json_file_path, "r") as f:
+        test_cases = json.load(f)["test_cases"][: args.num_utterances]
+
+    settings = []
+    for solver in args.solvers.split(","):
+        ode_solve_method, time_schedule = solver.split(":")
+        for steps in args.steps.split(","):
+            steps = int(steps)
+            if ode_solve_method in ["midpoint", "heun"]:
+                # compare at about the same NFE
+                steps = max(steps // 2, 1)
+            settings.append((ode_solve_method, time_schedule, steps))
+    for tol in args.rk45_tols.split(","):
+        settings.append(("rk45", "uniform", float(tol)))
+
+    results = {setting: {"l1": [], "nfe": [], "time": []} for setting in settings}
+    for info in tqdm(test_cases):
+        audio = load_wav(info["source_wav_path"], 1600, device)
+        ref_audio = load_wav(info["prompt_wav_path"], 200, device)
+        ref_mel = mel_spectrogram(ref_audio).transpose(1, 2)
+        _, content_feature = w2v(audio)
+        pitch = extract_world_f0(audio)
+        pitch = (pitch - pitch.mean(dim=1, keepdim=True)) / (
+            pitch.std(dim=1, keepdim=True) + 1e-6
+        )
+        inputs = {
+            "content_feature": content_feature,
+            "pitch": pitch,
+            "x_ref": ref_mel,
+            "x_ref_mask": torch.ones(ref_mel.shape[0], ref_mel.shape[1])
+            .to(device)
+            .bool(),
+        }
+        reference, _, _ = run(
+            model, inputs, args.ref_steps, "euler", "uniform", args.seed, args.sigma
+        )
+        for setting in settings:
+            ode_solve_method, time_schedule, steps = setting
+            if ode_solve_method == "rk45":
+                model.diffusion.cfg.ode_rtol = model.diffusion.cfg.ode_atol = steps
+            x0, elapsed, nfe = run(
+                model,
+                inputs,
+                int(steps),
+                ode_solve_method,
+                time_schedule,
+                args.seed,
+                args.sigma,
+            )
+            results[setting]["l1"].append((x0 - reference).abs().mean().item())
+            results[setting]["nfe"].append(nfe)
+            results[setting]["time"].append(elapsed)
+
+    summary = []
+    print(
+        "{:<12}{:<10}{:>8}{:>8}{:>10}{:>10}".format(
+            "solver", "schedule", "steps", "NFE", "mel L1", "time(s)"
+        )
+    )
+    for (ode_solve_method, time_schedule, steps), result in results.items():
+        item = {
+            "solver": ode_solve_method,
+            "time_schedule": time_schedule,
+            "steps": steps,
+            "nfe": float(np.mean(result["nfe"])),
+            "mel_l1": float(np.mean(result["l1"])),
+            "time": float(np.mean(result["time"])),
+        }
+        summary.append(item)
+        print(
+            "{:<12}{:<10}{:>8}{:>8.1f}{:>10.4f}{:>10.3f}".format(
+                item["solver"],
+                item["time_schedule"],
+                item["steps"],
+                item["nfe"],
+                item["mel_l1"],
+                item["time"],
+            )
+        )
+    with open(args.output_path, "w") as f:
+        json.dump({"ref_steps": args.ref_steps, "results": summary}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
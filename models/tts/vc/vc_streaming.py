@@ -0,0 +1,266 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Chunked voice conversion of long inputs. The source is cut at silences found
+# by utils.audio_slicer.Slicer, every chunk is converted with the same reference
+# embedding and neighbouring chunks are crossfaded on a few overlapping mel
+# frames. Mel (and audio, with a vocoder) is produced chunk by chunk, so memory
+# does not grow with the input length and the first output is ready after one
+# chunk.
+
+import argparse
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+from utils.util import load_config
+from utils.audio_slicer import Slicer
+from models.tts.vc.vc_utils import mel_spectrogram, extract_world_f0
+from models.tts.vc.vc_inference import VCInferenceEngine, load_wav
+
+SAMPLE_RATE = 16000
+HOP_SIZE = 200
+
+
+def get_cut_points(speech, sr=SAMPLE_RATE, threshold=-40.0, min_interval=300):
+    """Mel frame indices in the middle of the silences between sliced clips."""
+    slicer = Slicer(
+        sr=sr, threshold=threshold, min_length=1000, min_interval=min_interval
+    )
+    chunks = slicer.slice(speech, return_chunks_positions=True)
+    if not isinstance(chunks, tuple):
+        return []
+    _, positions = chunks
+    return [
+        int((end + next_begin) // 2 // HOP_SIZE)
+        for (_, end), (next_begin, _) in zip(positions[:-1], positions[1:])
+    ]
+
+
+def get_chunks(num_frames, cut_points, max_chunk_frames, min_chunk_frames):
+    """Split [0, num_frames) into chunks of at most max_chunk_frames frames.
+
+    A chunk ends at the last cut point in [min_chunk_frames, max_chunk_frames]
+    after its start, or at max_chunk_frames if there is none.
+    """
+    chunks, start = [], 0
+    while num_frames - start > max_chunk_frames:
+        candidates = [
+            cut
+            for cut in cut_points
+            if start + min_chunk_frames <= cut <= start + max_chunk_frames
+        ]
+        end = candidates[-1] if candidates else start + max_chunk_frames
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, num_frames))
+    return chunks
+
+
+class StreamingVC:
+    """Chunked conversion with ``UniAmphionVC`` for arbitrarily long sources.
+
+    Args:
+        model: ``UniAmphionVC`` in eval mode
+        w2v: content extractor, ``HubertWithKmeans`` or ``WhisperNormal``
+        max_chunk_seconds: upper bound of a chunk, also bounds the memory
+        overlap_frames: mel frames converted twice and crossfaded between chunks
+        vocoder: optional callable mapping a (1, 80, T) mel to T * 200 samples
+        vocoder_context_frames: mel frames of context on each side of the
+            vocoded segments, so that segment borders are inaudible
+    """
+
+    def __init__(
+        self,
+        model,
+        w2v,
+        device,
+        inference_steps=200,
+        sigma=1.2,
+        ode_solve_method=None,
+        time_schedule=None,
+        max_chunk_seconds=10.0,
+        overlap_frames=8,
+        slicer_threshold=-40.0,
+        vocoder=None,
+        vocoder_context_frames=16,
+    ):
+        self.model = model
+        self.w2v = w2v
+        self.device = device
+        self.inference_steps = inference_steps
+        self.sigma = sigma
+        self.ode_solve_method = ode_solve_method
+        self.time_schedule = time_schedule
+        self.max_chunk_frames = int(max_chunk_seconds * SAMPLE_RATE / HOP_SIZE)
+        self.overlap_frames = overlap_frames
+        self.slicer_threshold = slicer_threshold
+        self.vocoder = vocoder
+        self.vocoder_context_frames = vocoder_context_frames
+        self.reference_embedding = None
+
+    @torch.no_grad()
+    def set_reference(self, ref_audio):
+        """Encode the reference (1D waveform, padded to a multiple of 200) once."""
+        ref_audio = ref_audio.to(self.device)[None, :]
+        ref_mel = mel_spectrogram(ref_audio).transpose(1, 2)
+        ref_mask = torch.ones(ref_mel.shape[0], ref_mel.shape[1]).to(self.device).bool()
+        self.reference_embedding = self.model.get_reference_embedding(ref_mel, ref_mask)
+
+    @torch.no_grad()
+    def convert_chunk(self, speech):
+        """Convert a 1D waveform of N * 200 samples into an (80, N) mel."""
+        num_frames = len(speech) // HOP_SIZE
+        speech = np.pad(speech, (0, 1600 - len(speech) % 1600))
+        audio = torch.from_numpy(speech).to(self.device)[None, :]
+        _, content_feature = self.w2v(audio)
+        content_feature = content_feature.to(device=self.device)
+        # per chunk normalization, as for the training clips
+        pitch = extract_world_f0(audio)
+        pitch = (pitch - pitch.mean(dim=1, keepdim=True)) / (
+            pitch.std(dim=1, keepdim=True) + 1e-6
+        )
+        x0 = self.model.inference(
+            content_feature=content_feature,
+            pitch=pitch,
+            inference_steps=self.inference_steps,
+            sigma=self.sigma,
+            ode_solve_method=self.ode_solve_method,
+            time_schedule=self.time_schedule,
+            reference_embedding=self.reference_embedding,
+        )
+        return x0[0, :num_frames].transpose(0, 1).cpu().numpy()
+
+    def convert(self, speech):
+        """Yield consecutive (80, n) mel segments of the converted speech.
+
+        speech: 1D numpy waveform at 16 kHz, the output has len(speech) // 200 frames
+        """
+        assert self.reference_embedding is not None, "call set_reference first"
+        num_frames = len(speech) // HOP_SIZE
+        chunks = get_chunks(
+            num_frames,
+            get_cut_points(speech, threshold=self.slicer_threshold),
+            self.max_chunk_frames,
+            self.max_chunk_frames // 2,
+        )
+        overlap = self.overlap_frames
+        fade_in = np.linspace(0.0, 1.0, overlap + 2, dtype=np.float32)[1:-1]
+        tail = None
+        for start, end in chunks:
+            # convert overlap more frames, they are crossfaded with the next chunk
+            end_ = min(end + overlap, num_frames)
+            mel = self.convert_chunk(speech[start * HOP_SIZE : end_ * HOP_SIZE])
+            if tail is not None:
+                n = tail.shape[1]
+                mel[:, :n] = tail * (1 - fade_in[:n]) + mel[:, :n] * fade_in[:n]
+            tail = mel[:, end - start :]
+            if end - start > 0:
+                yield mel[:, : end - start]
+
+    @torch.no_grad()
+    def vocode(self, mel_segments):
+        """Incrementally vocode mel segments, yield consecutive 1D waveforms."""
+        context = self.vocoder_context_frames
+        buffer, left = None, 0  # buffer starts with `left` frames already vocoded
+        for mel in mel_segments:
+            buffer = mel if buffer is None else np.concatenate([buffer, mel], axis=1)
+            ready = buffer.shape[1] - context
+            if ready <= left:
+                continue
+            audio = self.vocoder(torch.from_numpy(buffer).to(self.device)[None])
+            yield audio[left * HOP_SIZE : ready * HOP_SIZE].cpu().numpy()
+            keep = min(context, ready)
+            buffer, left = buffer[:, ready - keep :], keep
+        if buffer is not None and buffer.shape[1] > left:
+            audio = self.vocoder(torch.from_numpy(buffer).to(self.device)[None])
+            yield audio[left * HOP_SIZE : buffer.shape[1] * HOP_SIZE].cpu().numpy()
+
+    def stream(self, speech):
+        """Yield waveform segments if a vocoder is set, mel segments otherwise."""
+        mel_segments = self.convert(speech)
+        if self.vocoder is None:
+            return mel_segments
+        return self.vocode(mel_segments)
+
+
+def load_vocoder(vocoder_config, vocoder_path, device):
+    from models.vocoders.vocoder_inference import load_nnvocoder
+
+    vocoder_cfg = load_config(vocoder_config)
+    vocoder = load_nnvocoder(
+        vocoder_cfg,
+        vocoder_cfg.model.generator,
+        weights_file=vocoder_path,
+        from_multi_gpu=True,
+    ).to(device)
+    return lambda mel: vocoder(mel).reshape(-1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="config.json",
+        help="json files for configurations.",
+        required=True,
+    )
+    parser.add_argument("--checkpoint_path", type=str, required=True)
+    parser.add_argument("--source_wav_path", type=str, required=True)
+    parser.add_argument("--prompt_wav_path", type=str, required=True)
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="output .wav with --vocoder_path, otherwise a (1, 80, T) mel .npy",
+    )
+    parser.add_argument("--vocoder_config", type=str, default=None)
+    parser.add_argument("--vocoder_path", type=str, default=None)
+    parser.add_argument("--max_chunk_seconds", type=float, default=10.0)
+    parser.add_argument("--overlap_frames", type=int, default=8)
+    parser.add_argument("--inference_steps", type=int, default=200)
+    parser.add_argument("--sigma", type=float, default=1.2)
+    parser.add_argument("--ode_solve_method", type=str, default=None)
+    parser.add_argument("--time_schedule", type=str, default=None)
+    parser.add_argument("--cuda_id", type=int, default=0)
+    args = parser.parse_args()
+    cfg = load_config(args.config)
+    device = torch.device(f"cuda:{args.cuda_id}")
+
+    engine = VCInferenceEngine.from_checkpoint(cfg, args.checkpoint_path, device)
+    vocoder = None
+    if args.vocoder_path is not None:
+        vocoder = load_vocoder(args.vocoder_config, args.vocoder_path, device)
+    streaming_vc = StreamingVC(
+        engine.model,
+        engine.w2v,
+        device,
+        inference_steps=args.inference_steps,
+        sigma=args.sigma,
+        ode_solve_method=args.ode_solve_method,
+        time_schedule=args.time_schedule,
+        max_chunk_seconds=args.max_chunk_seconds,
+        overlap_frames=args.overlap_frames,
+        vocoder=vocoder,
+    )
+    streaming_vc.set_reference(load_wav(args.prompt_wav_path, 200))
+    speech, _ = librosa.load(args.source_wav_path, sr=SAMPLE_RATE)
+
+    if vocoder is not None:
+        # segments are appended to the file as soon as they are ready
+        with sf.SoundFile(
+            args.output_path, "w", samplerate=SAMPLE_RATE, channels=1
+        ) as f:
+            for audio in streaming_vc.stream(speech):
+                f.write(audio)
+    else:
+        mel = np.concatenate(list(streaming_vc.stream(speech)), axis=1)
+        np.save(args.output_path, mel[None])
+    print("Saved to {}".format(args.output_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,6 @@ from scipy.io import wavfile
 
 # from pystoi import stoi
 import numpy as np
-from transformers import Wav2Vec2FeatureExtractor, WavLMForXVector
 import torch
 import scipy.signal as signal
 
@@ -18,30 +17,19 @@ import scipy.signal as signal
 import soundfile as sf
 import librosa
 
+from models.tts.vc.evaluation import VCEvaluator
+
 
 # feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained("microsoft/wavlm-base-plus-sv")
 # model = WavLMForXVector.from_pretrained("microsoft/wavlm-base-plus-sv")
 
 
 
-def WavLM_SV(ge_audio, ref_audio):
-    audio = [ge_audio, ref_audio]
-    inputs = feature_extractor(audio, padding=True, sampling_rate=16000, return_tensors="pt")
-    for key in inputs.keys():
-        inputs[key] = inputs[key].to(device)
-    with torch.no_grad():
-        embeddings = model(**inputs).embeddings
-        embeddings = torch.nn.functional.normalize(embeddings, dim=-1).cpu()
-        cosine_sim = torch.nn.CosineSimilarity(dim=-1)
-        similarity = cosine_sim(embeddings[0], embeddings[1])
-    return similarity
-
-
-def calculate_speaker_similarity(ref_dir, deg_dir):
+def calculate_speaker_similarity(ref_dir, deg_dir, evaluator):
     deg_files = glob.glob(f"{deg_dir}/*.wav")
     if len(deg_files) < 1:
         raise RuntimeError(f"Found no wavs in {deg_dir}")
-    similarity_scores = []
+    deg_wavs, ref_wavs = [], []
     for deg_wav in tqdm(deg_files):
         deg_wav_file_name = os.path.basename(deg_wav)# recon_p251_004_generated_e2e.wav
         # --> p251_004_generated_e2e.wav
@@ -53,25 +41,31 @@ def calculate_speaker_similarity(ref_dir, deg_dir):
         if os.path.exists(ref_wav) == False:
             print(f"Reference file {ref_wav} not found, skipping")
             continue
-        ref, _ = librosa.load(ref_wav, sr=16000)
-        deg, _ = librosa.load(deg_wav, sr=16000)
-        similarity = WavLM_SV(deg, ref)
-        similarity_scores.append(similarity.item())
+        deg_wavs.append(deg_wav)
+        ref_wavs.append(ref_wav)
+    # batched WavLM-SV, each shared prompt is embedded once
+    similarity_scores = evaluator.speaker_similarity(deg_wavs, ref_wavs)
     return np.mean(similarity_scores)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compute speaker similarity_score")
-    parser.add_argument("--wavlm_path", help="Degraded wave folder.")
+    parser.add_argument(
+        "--wavlm_path", default="microsoft/wavlm-base-plus-sv", help="WavLM-SV model."
+    )
     parser.add_argument(
         "-r", "--ref_dir", required=True, help="Reference wave folder or file list."
     )
     parser.add_argument("-d", "--deg_dir", required=True, help="Degraded wave folder.")
     parser.add_argument("-g", "--gpu", type=int, default=7, help="GPU ID")
+    parser.add_argument("--batch_size", type=int, default=16)
     args = parser.parse_args()
-    feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(args.wavlm_path)
-    model = WavLMForXVector.from_pretrained(args.wavlm_path)
-    device = torch.device(f"cuda:{args.gpu}")
-    model = model.to(device)
-    similarity_score = calculate_speaker_similarity(args.ref_dir, args.deg_dir)
+    evaluator = VCEvaluator(
+        device=f"cuda:{args.gpu}",
+        batch_size=args.batch_size,
+        sv_model=args.wavlm_path,
+    )
+    similarity_score = calculate_speaker_similarity(
+        args.ref_dir, args.deg_dir, evaluator
+    )
     print(f"SIM-O: {similarity_score}")
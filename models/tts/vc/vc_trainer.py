@@ -22,12 +22,18 @@ from accelerate.logging import get_logger
 from accelerate.utils import ProjectConfiguration
 
 from models.tts.vc.ns2_uniamphion import UniAmphionVC
-from models.tts.vc.vc_dataset import  VCCollator, VCDataset, batch_by_size
+from models.tts.vc.vc_dataset import (
+    VCCollator,
+    VCDataset,
+    batch_by_size,
+    set_default_cache_dirs,
+)
 # from models.tts.vc.vc_new_dataset import VCCollator, VCDataset, batch_by_size # used on ailab sever
 from models.tts.vc.hubert_kmeans import HubertWithKmeans
 from models.tts.vc.whisper_feature import WhisperNormal
 from models.tts.vc.vc_loss import diff_loss, ConstractiveSpeakerLoss
-from models.tts.vc.vc_utils import mel_spectrogram, extract_world_f0
+from models.tts.vc.vc_utils import mel_spectrogram, extract_world_f0, extract_f0
+from models.tts.vc.vc_augment import VCAugmentor
 
 
 class VCTrainer(TTSTrainer):
@@ -49,12 +55,15 @@ class VCTrainer(TTSTrainer):
         self.use_source_noise = self.cfg.trans_exp.use_source_noise
         self.use_ref_noise = self.cfg.trans_exp.use_ref_noise
         self.use_speaker = self.cfg.trans_exp.use_speaker
+        self.f0_extractor = self.cfg.trans_exp.f0_extractor
+        self.f0_num_workers = self.cfg.trans_exp.f0_num_workers
 
         # 在主进程中记录配置信息
         if self.accelerator.is_main_process:
             self.logger.info(f"use_source_noise: {self.use_source_noise}")
             self.logger.info(f"use_ref_noise: {self.use_ref_noise}")
             self.logger.info(f"use_speaker: {self.use_speaker}")
+            self.logger.info(f"f0_extractor: {self.f0_extractor}")
 
         # 初始化一个时间窗口，用于监控或记录某些度量
         self.time_window = ValueWindow(50)
@@ -101,6 +110,7 @@ class VCTrainer(TTSTrainer):
                 self.logger.info("Building dataset...")
             self.train_dataloader = self._build_dataloader()
             self.speaker_num = len(self.train_dataloader.dataset.speaker2id)
+            self.augmentor = self._build_augmentor()
             if self.accelerator.is_main_process:
                 self.logger.info("Speaker num: {}".format(self.speaker_num))
             
@@ -208,6 +218,7 @@ class VCTrainer(TTSTrainer):
         np.random.seed(int(time.time()))
         if self.accelerator.is_main_process:
             self.logger.info("Use Dynamic Batchsize......")
+        set_default_cache_dirs(self.cfg.trans_exp, self.exp_dir)
         train_dataset = VCDataset(self.cfg.trans_exp)
         train_collate = VCCollator(self.cfg)
         batch_sampler = batch_by_size(
@@ -238,6 +249,17 @@ class VCTrainer(TTSTrainer):
         self.accelerator.wait_for_everyone()
         return train_loader
 
+    def _build_augmentor(self):
+        # noise is mixed into the padded batch on device, see trans_exp.augment_on_device
+        dataset = self.train_dataloader.dataset
+        if not self.cfg.trans_exp.augment_on_device or dataset.noise_bank is None:
+            return None
+        return VCAugmentor(
+            dataset.noise_bank,
+            rir_bank=dataset.rir_bank,
+            reverb_prob=self.cfg.trans_exp.reverb_prob,
+        )
+
     def _build_optimizer(self):
         optimizer = torch.optim.AdamW(
             filter(lambda p: p.requires_grad, self.model.parameters()),
@@ -296,6 +318,9 @@ class VCTrainer(TTSTrainer):
         self.optimizer.load_state_dict(checkpoint["optimizer"])
         self.scheduler.load_state_dict(checkpoint["scheduler"])
 
+    def _extract_f0(self, speech):
+        return extract_f0(speech, method=self.f0_extractor, num_workers=self.f0_num_workers)
+
     def _train_step(self, batch):
         total_loss = 0.0
         train_losses = {}
@@ -306,6 +331,11 @@ class VCTrainer(TTSTrainer):
 
         speech = batch["speech"] 
         ref_speech = batch["ref_speech"] 
+        if self.augmentor is not None:
+            if self.use_source_noise:
+                batch["noisy_speech"] = self.augmentor(speech, batch["mask"])
+            if self.use_ref_noise:
+                batch["noisy_ref_speech"] = self.augmentor(ref_speech, batch["ref_mask"])
         
         with torch.set_grad_enabled(False):
             # 提取需要的特征和光谱图
@@ -315,19 +345,32 @@ class VCTrainer(TTSTrainer):
             ref_mask = batch["ref_mask"]
             
             # 提取 pitch 和 content_feature
-            if not self.use_source_noise:
-                pitch = extract_world_f0(speech)
+            # clean features may come precomputed from the dataset (trans_exp.feature_cache_dir)
+            use_cached_feature = "content_code" in batch
+            if use_cached_feature:
+                cluster_centers = self.accelerator.unwrap_model(self.w2v).cluster_centers
+                content_feature = F.embedding(batch["content_code"], cluster_centers)
+                pitch = batch["pitch"]
+                pitch = (pitch - pitch.mean(dim=1, keepdim=True)) / (pitch.std(dim=1, keepdim=True) + 1e-6) # Normalize pitch (B,T)
+
+            if not self.use_source_noise and not use_cached_feature:
+                pitch = self._extract_f0(speech)
                 pitch = (pitch - pitch.mean(dim=1, keepdim=True)) / (pitch.std(dim=1, keepdim=True) + 1e-6) # Normalize pitch (B,T)
                 _, content_feature = self.w2v(speech) # semantic (B, T, 768)
 
             if self.use_ref_noise:
                 noisy_ref_mel = mel_spectrogram(batch["noisy_ref_speech"]).transpose(1, 2)
                 
-            if self.use_source_noise:
+            if self.use_source_noise and use_cached_feature:
+                # only the noisy branch needs the extractors
+                _, noisy_content_feature = self.w2v(batch["noisy_speech"])
+                noisy_pitch = self._extract_f0(batch["noisy_speech"])
+                noisy_pitch = (noisy_pitch - noisy_pitch.mean(dim=1, keepdim=True)) / (noisy_pitch.std(dim=1, keepdim=True) + 1e-6)
+            elif self.use_source_noise:
                 combined_speech = torch.cat((speech, batch["noisy_speech"]), dim=0)
                 _, combined_features = self.w2v(combined_speech)
                 content_feature, noisy_content_feature = torch.split(combined_features, speech.shape[0], dim=0)
-                combined_pitch = extract_world_f0(combined_speech)
+                combined_pitch = self._extract_f0(combined_speech)
                 clean_pitch, noisy_pitch = torch.split(combined_pitch, speech.shape[0], dim=0)
                 pitch = (clean_pitch - clean_pitch.mean(dim=1, keepdim=True)) / (clean_pitch.std(dim=1, keepdim=True) + 1e-6)
                 noisy_pitch = (noisy_pitch - noisy_pitch.mean(dim=1, keepdim=True)) / (noisy_pitch.std(dim=1, keepdim=True) + 1e-6)
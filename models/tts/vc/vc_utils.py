@@ -1,3 +1,4 @@
+import os
 import torch
 import pyworld as pw
 import numpy as np
@@ -55,29 +56,159 @@ def mel_spectrogram(
 
 def interpolate(f0):
     uv = f0 == 0
-    if len(f0[~uv]) > 0:
+    voiced_idx = np.flatnonzero(~uv)
+    if len(voiced_idx) > 0:
         # interpolate the unvoiced f0
-        f0[uv] = np.interp(np.where(uv)[0], np.where(~uv)[0], f0[~uv])
+        f0[uv] = np.interp(np.flatnonzero(uv), voiced_idx, f0[voiced_idx])
         uv = uv.astype("float")
-        uv = np.min(np.array([uv[:-2], uv[1:-1], uv[2:]]), axis=0)
+        uv = np.minimum(np.minimum(uv[:-2], uv[1:-1]), uv[2:])
         uv = np.pad(uv, (1, 1))
     return f0, uv
 
-def extract_world_f0(speech):
-    audio = speech.cpu().numpy()
-    f0s = []
-    for i in range(audio.shape[0]):
-        wav = audio[i]
-        frame_num = len(wav) // 200
-        f0, t = pw.dio(wav.astype(np.float64), 16000, frame_period=12.5)
-        f0 = pw.stonemask(wav.astype(np.float64), f0, t, 16000)
-        f0, _ = interpolate(f0)
-        f0 = torch.from_numpy(f0).to(speech.device)
-        f0s.append(f0[:frame_num])
-    f0s = torch.stack(f0s, dim=0).float()
+
+def interpolate_batch(f0):
+    """Batched version of ``interpolate`` on a (B, T) tensor, 0 marks unvoiced frames.
+
+    Every unvoiced frame is linearly interpolated between its nearest voiced
+    neighbours (held constant at the edges, like ``np.interp``), rows without
+    any voiced frame are returned unchanged.
+    """
+    B, T = f0.shape
+    voiced = f0 > 0
+    idx = torch.arange(T, device=f0.device).expand(B, T)
+    prev_idx = torch.where(voiced, idx, torch.full_like(idx, -1)).cummax(dim=1).values
+    next_idx = (
+        torch.where(voiced, idx, torch.full_like(idx, T)).flip(1).cummin(dim=1).values.flip(1)
+    )
+    left = torch.where(prev_idx >= 0, prev_idx, next_idx).clamp(0, T - 1)
+    right = torch.where(next_idx < T, next_idx, prev_idx).clamp(0, T - 1)
+    left_f0 = f0.gather(1, left)
+    right_f0 = f0.gather(1, right)
+    weight = (idx - left).clamp(min=0).to(f0.dtype) / (right - left).clamp(min=1).to(f0.dtype)
+    weight = torch.where(right == left, torch.zeros_like(weight), weight)
+    has_voiced = voiced.any(dim=1, keepdim=True)
+    f0 = torch.where(has_voiced, left_f0 + weight * (right_f0 - left_f0), f0)
+
+    uv = (~voiced).float()
+    if T > 2:
+        uv = torch.minimum(torch.minimum(uv[:, :-2], uv[:, 1:-1]), uv[:, 2:])
+        uv = torch.nn.functional.pad(uv, (1, 1))
+    uv = torch.where(has_voiced, uv, torch.ones_like(uv))
+    return f0, uv
+
+
+# WORLD f0 extraction runs on a persistent pool, pyworld releases the GIL so
+# threads are enough in most cases; a process pool can be requested instead.
+f0_executor = None
+f0_executor_config = None
+
+
+def get_f0_executor(num_workers=None, pool="thread"):
+    global f0_executor, f0_executor_config
+    if num_workers is None:
+        num_workers = min(32, os.cpu_count() or 1)
+    if f0_executor is None or f0_executor_config != (num_workers, pool):
+        if f0_executor is not None:
+            f0_executor.shutdown(wait=True)
+        if pool == "process":
+            f0_executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+        else:
+            f0_executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        f0_executor_config = (num_workers, pool)
+    return f0_executor
+
+
+def world_f0(wav, sr=16000, frame_period=12.5):
+    wav = wav.astype(np.float64)
+    f0, t = pw.dio(wav, sr, frame_period=frame_period)
+    f0 = pw.stonemask(wav, f0, t, sr)
+    return f0
+
+
+def extract_world_f0(speech, num_workers=None, pool="thread"):
+    audio = speech.detach().cpu().numpy()
+    frame_num = audio.shape[-1] // 200
+    executor = get_f0_executor(num_workers, pool)
+    f0s = np.stack(list(executor.map(world_f0, audio)), axis=0)
+    f0s = torch.from_numpy(f0s).to(speech.device)
+    f0s, _ = interpolate_batch(f0s)
+    f0s = f0s[:, :frame_num].float()
     return f0s
 
 
+def extract_torch_f0(
+    speech,
+    sr=16000,
+    hop_size=200,
+    win_size=1024,
+    f0_min=50,
+    f0_max=1100,
+    threshold=0.15,
+    silence_threshold=1e-4,
+):
+    """Batched YIN pitch estimator that stays on the device of ``speech``.
+
+    Returns interpolated f0 of shape (B, len // hop_size), aligned with
+    ``extract_world_f0`` (frame period of 12.5 ms at 16 kHz).
+    """
+    B, L = speech.shape
+    frame_num = L // hop_size
+    x = torch.nn.functional.pad(
+        speech.float().unsqueeze(1), (win_size // 2, win_size // 2), mode="reflect"
+    ).squeeze(1)
+    frames = x.unfold(-1, win_size, hop_size)[:, :frame_num]  # (B, T, N)
+    frames = frames - frames.mean(dim=-1, keepdim=True)
+
+    tau_min = max(int(sr / f0_max), 2)
+    tau_max = min(int(sr / f0_min), win_size - 2)
+
+    # difference function d(tau) = e1(tau) + e2(tau) - 2 r(tau), r via FFT
+    spec = torch.fft.rfft(frames, n=2 * win_size)
+    acf = torch.fft.irfft(spec.real.pow(2) + spec.imag.pow(2), n=2 * win_size)
+    acf = acf[..., : tau_max + 2]
+    energy = frames.pow(2).cumsum(dim=-1)
+    taus = torch.arange(tau_max + 2, device=speech.device)
+    e1 = energy[..., win_size - 1 - taus]
+    e2 = energy[..., -1:] - torch.nn.functional.pad(energy, (1, 0))[..., taus]
+    diff = (e1 + e2 - 2 * acf)[..., 1:].clamp(min=0)
+
+    # cumulative mean normalized difference, index k corresponds to tau = k + 1
+    cmnd = diff * taus[1:] / diff.cumsum(dim=-1).clamp(min=1e-8)
+    cmnd = cmnd[..., tau_min - 1 :]
+
+    # absolute threshold: take the minimum of the first dip below the threshold
+    below = cmnd < threshold
+    first = below.float().argmax(dim=-1, keepdim=True)
+    lag = torch.arange(cmnd.shape[-1], device=speech.device)
+    after = lag >= first
+    dip = after & below & ((after & ~below).cumsum(dim=-1) == 0)
+    best = torch.where(dip, cmnd, torch.full_like(cmnd, float("inf"))).argmin(dim=-1)
+
+    # parabolic refinement around the selected lag
+    left = cmnd.gather(-1, (best - 1).clamp(min=0).unsqueeze(-1)).squeeze(-1)
+    center = cmnd.gather(-1, best.unsqueeze(-1)).squeeze(-1)
+    right = cmnd.gather(-1, (best + 1).clamp(max=cmnd.shape[-1] - 1).unsqueeze(-1)).squeeze(-1)
+    denom = left - 2 * center + right
+    shift = torch.where(
+        denom.abs() > 1e-8, 0.5 * (left - right) / denom, torch.zeros_like(denom)
+    ).clamp(-1, 1)
+    period = best.float() + tau_min + shift
+
+    voiced = below.any(dim=-1) & (frames.pow(2).mean(dim=-1).sqrt() > silence_threshold)
+    f0 = torch.where(voiced, sr / period, torch.zeros_like(period))
+    f0, _ = interpolate_batch(f0)
+    return f0
+
+
+def extract_f0(speech, method="world", num_workers=None, pool="thread"):
+    if method == "world":
+        return extract_world_f0(speech, num_workers=num_workers, pool=pool)
+    elif method == "torch":
+        return extract_torch_f0(speech)
+    else:
+        raise NotImplementedError("Unsupported f0 extractor: {}".format(method))
+
+
 def get_pitch_shifted_speech(speech, sr = 16000):
     # pitch shift
     shifted_speech = torch.zeros_like(speech)
@@ -1,14 +1,15 @@
 import torch
-from transformers import Wav2Vec2Processor, HubertForCTC
-import librosa
-import numpy as np
 import os
 import json
 import re
 
+from models.tts.vc.evaluation import VCEvaluator
+
 #这个是模型
-processor = Wav2Vec2Processor.from_pretrained("facebook/hubert-large-ls960-ft")
-model = HubertForCTC.from_pretrained("facebook/hubert-large-ls960-ft")
+# HuBERT-CTC loaded once, on GPU when available, transcribing length-sorted batches
+evaluator = VCEvaluator(
+    asr="hubert", asr_model="facebook/hubert-large-ls960-ft", batch_size=16
+)
 
 # ds = load_dataset("patrickvonplaten/librispeech_asr_dummy", "clean", split="validation")
 
@@ -30,22 +31,18 @@ for test_case in test_cases:
 # gt2text = {}
 syn2text = {}
 
-for wav_file in os.listdir(wav_files_path):
+wav_files = sorted(os.listdir(wav_files_path))
+# 怎么转录出text------------------------------
+transcriptions = evaluator.transcribe(
+    [os.path.join(wav_files_path, wav_file) for wav_file in wav_files]
+)
+# 怎么转录出text------------------------------
+for wav_file, transcription in zip(wav_files, transcriptions):
     utt_id = wav_file.split(".")[0][4 : -len("_generated_e2e")]
     print(utt_id)
-    # 怎么转录出text------------------------------
-    audio_input, _ = librosa.load(os.path.join(wav_files_path, wav_file), sr=16000)
-    audio_input = np.array(audio_input)
-    input_values = processor(
-        audio_input, return_tensors="pt"
-    ).input_values  # Batch size 1
-    logits = model(input_values).logits
-    predicted_ids = torch.argmax(logits, dim=-1)
-    transcription = processor.decode(predicted_ids[0])
     print(transcription)
-     # 怎么转录出text------------------------------
     syn2text[utt_id] = transcription
-    
+
     # audio_input, _ = librosa.load(os.path.join(gt_files_path, utt_id + ".wav"), sr=16000)
     # audio_input = np.array(audio_input)
     # input_values = processor(audio_input, return_tensors="pt").input_values  # Batch size 1
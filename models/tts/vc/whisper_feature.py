@@ -34,13 +34,16 @@ class WhisperNormal(nn.Module):
         return embed
     
     @torch.inference_mode()
-    def forward(self, wav_input, inference=False):
+    def forward(self, wav_input, inference=False, mask=None):
+        # mask: (B, T) valid frames of the output, the padded frames are zeroed
         self.whisper_encoder.to(wav_input.device)
         with torch.no_grad():
             whisper_mel, real_num_tokens = self.extract_whisper_input(wav_input, inference) 
             embed = self.whisper_encoder(whisper_mel).last_hidden_state 
             embed= embed[:, :real_num_tokens, :] 
             embed = self.scale_to_target_hop_size(embed)
+            if mask is not None:
+                embed = embed * mask[:, :, None].to(embed.dtype)
         return None, embed
 
     def spec_augment(self, mel, height):
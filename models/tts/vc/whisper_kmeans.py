@@ -7,7 +7,13 @@ import whisper
 from transformers import WhisperModel
 import warnings
 import logging
-from einops import rearrange, repeat
+from einops import rearrange
+
+from models.tts.vc.kmeans_quantizer import (
+    KmeansQuantizer,
+    remap_cluster_centers,
+    resample_frames,
+)
 
 def noop(*args, **kwargs):
     pass
@@ -46,6 +52,8 @@ class WhisperWithKmeans(nn.Module):
         self,
         whisper_path,
         kmeans_path,
+        search_dtype=None,
+        rerank_top_k=None,
     ):
         super().__init__()
         whisper_path = Path(whisper_path)
@@ -62,10 +70,21 @@ class WhisperWithKmeans(nn.Module):
 
         self.kmeans = kmeans
 
-        self.register_buffer(
-            "cluster_centers", torch.from_numpy(kmeans.cluster_centers_)
+        # see KmeansQuantizer for search_dtype (e.g. torch.float16) and rerank_top_k
+        self.quantizer = KmeansQuantizer(
+            torch.from_numpy(kmeans.cluster_centers_),
+            search_dtype=search_dtype,
+            rerank_top_k=rerank_top_k,
         )
 
+    @property
+    def cluster_centers(self):
+        return self.quantizer.cluster_centers
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        remap_cluster_centers(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @property
     def groups(self):
         return 1
@@ -86,20 +105,12 @@ class WhisperWithKmeans(nn.Module):
         return mel
 
     @torch.inference_mode()
-    def forward(self, wav_input, flatten=True):
+    def forward(self, wav_input, flatten=True, mask=None):
         whisper_mel = self.extract_whisper_input(wav_input, wav_input.device) #(B, 1500, 80)
         embed = self.model(whisper_mel).last_hidden_state #(B, 1500, 1024)
-        embed = embed.permute((0, 2, 1))
-        embed = F.interpolate(embed, scale_factor=8, mode="nearest")
-        embed = F.interpolate(embed, scale_factor=0.2, mode="nearest")
-        embed = embed.permute((0, 2, 1))
+        embed = resample_frames(embed, (8, 0.2))
 
-        batched_cluster_centers = repeat(
-            self.cluster_centers, "c d -> b c d", b=embed.shape[0]
-        )
-        dists = -torch.cdist(embed, batched_cluster_centers, p=2)
-        clusters = dists.argmax(dim=-1)
-        quantize = F.embedding(clusters, self.cluster_centers)
+        clusters, quantize = self.quantizer(embed, mask)
 
         if flatten:
             return clusters, quantize
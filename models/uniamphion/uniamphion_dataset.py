@@ -12,6 +12,7 @@ from models.base.base_dataset import (
 )
 from text.cmudict import valid_symbols
 from utils.f0 import get_f0_features_using_dio
+from utils.feature_store import PackedFeatureReader
 import torchaudio
 
 class JsonHParams:
@@ -92,8 +93,21 @@ class UniAmphionDataset(torch.utils.data.Dataset):
                     self.spkid2utt[spkid] = []
                 self.spkid2utt[spkid].append(utt)
 
-        # get phone to id / id to phone map
-        self.phone2id, self.id2phone = self.get_phone_map()
+        # get phone to id / id to phone map from dictionary.dict, once for all the
+        # samples
+        self.phones_set, self.phone_to_id = self.parse_phones_and_create_map(
+            self.mfa_dictionary_path
+        )
+        self.phone2id = self.phone_to_id
+        self.id2phone = {i: s for s, i in self.phone_to_id.items()}
+
+        # durations, phone ids, trimming and pitch compiled by
+        # bins/tts/pack_features.py, otherwise compiled for each sample
+        self.packed_features = None
+        if cfg.preprocess.read_packed:
+            self.packed_features = PackedFeatureReader(
+                os.path.join(processed_data_dir, cfg.preprocess.packed_dir)
+            )
 
         self.all_num_frames = []
         for i in range(len(self.metadata)):
@@ -166,40 +180,81 @@ class UniAmphionDataset(torch.utils.data.Dataset):
         return durations, phone_ids, starts, ends
 
 
-    def trim_silence_from_audio(speech, duration, starts, ends, phone_ids, phone_to_id, sr = 160000):
+    def trim_silence(self, starts, ends, phone_ids):
+        """Frames [start, end) from the first to the last non-silence phone, and the
+        durations (in frames) and ids of the phones between them"""
+        hop_size = self.cfg.preprocess.hop_size
+        frames_per_second = self.cfg.preprocess.sample_rate / hop_size
+        # rounding the boundaries keeps the sum of the durations exact
+        start_frames = np.round(np.array(starts) * frames_per_second).astype(np.int64)
+        end_frames = np.round(np.array(ends) * frames_per_second).astype(np.int64)
+        phone_ids = np.array(phone_ids, dtype=np.int64)
+
         # 找到第一个和最后一个非 silence 的 phone
-        non_silence_indices = [i for i, p_id in enumerate(phone_ids) if (p_id != -1 and p_id!=phone_to_id[""])]
-        if not non_silence_indices:
-            return speech  
-
-        start_trim = starts[non_silence_indices[0]]
-        end_trim = ends[non_silence_indices[-1]]
-
-        # 将时间转换为样本索引
-        start_sample = int(start_trim * sr)
-        end_sample = int(end_trim * sr)
-
-        # 裁剪音频
-        trimmed_speech = speech[:, start_sample:end_sample]
-        trimmed_duration = duration[start_trim:end_trim]
-        trimmed_phone_ids = phone_ids[start_trim:end_trim]
-        return trimmed_speech, trimmed_duration, trimmed_phone_ids
-    
+        silence_id = self.phone_to_id.get("", -1)
+        non_silence = (phone_ids != -1) & (phone_ids != silence_id)
+        non_silence_indices = np.nonzero(non_silence)[0]
+        if len(non_silence_indices) == 0:
+            first, last = 0, len(phone_ids) - 1
+        else:
+            first, last = non_silence_indices[0], non_silence_indices[-1]
+
+        duration = end_frames[first : last + 1] - start_frames[first : last + 1]
+        phone_id = phone_ids[first : last + 1]
+        return start_frames[first], end_frames[last], duration, phone_id
+
+    def load_speech(self, utt_info):
+        # get speech(.flac files)
+        speech, sr = torchaudio.load(utt_info["Path"])
+        speech = speech[:1]
+        # resample to 16k (sample_rate)
+        target_sr = self.cfg.preprocess.sample_rate
+        if sr != target_sr:
+            speech = torchaudio.transforms.Resample(sr, target_sr)(speech)
+        return speech
+
+    def compile_alignment(self, utt_info, speech=None):
+        """Return the trimmed frames [start, end), the phone durations (in frames)
+        and ids from the TextGrid, and the DIO pitch of the trimmed speech"""
+        dataset = utt_info["Dataset"]
+        uid = utt_info["Uid"]
+        utt = "{}_{}".format(dataset, uid)
+
+        if speech is None:
+            speech = self.load_speech(utt_info)
+
+        # get duration/phone_id from textgrid
+        textgrid_path = self.utt2duration_path[utt]
+        _, phone_ids, starts, ends = self.get_duration_phone_id_start_end(
+            textgrid_path, self.phone_to_id
+        )
+
+        # trim silence at begginning and end in speech based on durations and phone_ids
+        start_frame, end_frame, duration, phone_id = self.trim_silence(
+            starts, ends, phone_ids
+        )
+
+        # get pitch
+        hop_size = self.cfg.preprocess.hop_size
+        trimmed_speech = speech[0, start_frame * hop_size : end_frame * hop_size]
+        pitch = get_f0_features_using_dio(
+            trimmed_speech.numpy(), self.cfg.preprocess
+        ).astype(np.float32)
+
+        return {
+            "trim": np.array([start_frame, end_frame], dtype=np.int64),
+            "duration": duration,
+            "phone_id": phone_id,
+            "pitch": pitch,
+        }
+
     def align_length(self, speech, pitch, duration):
-        # 获取 trimmed_speech 的总长度（毫秒）
-        trimmed_speech_length_ms = (trimmed_speech.shape[1] / self.sr) * 1000
-
-        # 获取 duration 的总和（毫秒）
-        duration_sum = sum(duration)
-        min_len = min(trimmed_speech_length_ms, duration_sum)
-        # 对齐 trimmed_speech 的长度到 duration 的总和
-        if trimmed_speech_length_ms > min_len:
-            end_sample = int((duration_sum / 1000) * self.sr)
-            trimmed_speech = trimmed_speech[:, :end_sample]
-        elif duration_sum > min_len:
-            excess_duration = duration_sum - trimmed_speech_length_ms
-            duration[-1] -= excess_duration
-            assert duration[-1] >= 0
+        # aligh lenght of speech, pitch and duration, in frames
+        hop_size = self.cfg.preprocess.hop_size
+        speech_len = speech.shape[1] // hop_size
+        dur_sum = int(sum(duration))
+        min_len = min(speech_len, dur_sum)
+        speech = speech[:, : min_len * hop_size]
 
         pitch_len = len(pitch)
         if pitch_len >= min_len:
@@ -207,8 +262,11 @@ class UniAmphionDataset(torch.utils.data.Dataset):
         else:
             pitch = np.pad(pitch, (0, min_len - pitch_len), mode="edge")
 
+        if dur_sum > min_len:
+            assert (duration[-1] - (dur_sum - min_len)) >= 0
+            duration[-1] = duration[-1] - (dur_sum - min_len)
+
         return speech, pitch, duration
-    
 
     def get_target_and_reference(self, speech, pitch, duration, phone_id, frame_nums):
         phone_nums = len(phone_id)
@@ -231,8 +289,12 @@ class UniAmphionDataset(torch.utils.data.Dataset):
         end_frames = sum(duration[:end_idx])
 
         # 调整 speech 张量
-        new_speech = np.concatenate((speech[:, :start_frames], speech[:, end_frames:]), axis=1)
-        ref_speech = speech[:, start_frames:end_frames]
+        hop_size = self.cfg.preprocess.hop_size
+        start_sample, end_sample = start_frames * hop_size, end_frames * hop_size
+        new_speech = np.concatenate(
+            (speech[:, :start_sample], speech[:, end_sample:]), axis=1
+        )
+        ref_speech = speech[:, start_sample:end_sample]
 
         # 调整 pitch, duration, phone_id
         new_pitch = np.append(pitch[:start_frames], pitch[end_frames:])
@@ -272,31 +334,27 @@ class UniAmphionDataset(torch.utils.data.Dataset):
         # get speaker_id
         spkid = self.utt2spkid[utt]
 
-        # get speech(.flac files)
-        speech, sr = torchaudio.load(utt_info["Path"])[0]
-        # resample to 16k
-        if sr != 16000:
-            speech = torchaudio.transforms.Resample(sr, 16000)(speech)
-
-        # get phone to id map from dictionary.dict
-        phones_set, phone_to_id = self.parse_phones_and_create_map(self.mfa_dictionary_path)
-        
-        # get duration/phone_id from textgrid
-        textgrid_path = self.utt2duration_path[utt]
-        durations, phone_ids, starts, ends= self.get_duration_phone_id_start_end(textgrid_path, phone_to_id)
+        speech = self.load_speech(utt_info)
 
-        # trim silence at begginning and end in speech based on durations and phone_ids
-        trimmed_speech, trimmed_duration, trimmed_phone_ids = self.trim_silence_from_audio(speech, durations, starts, ends, phone_ids, phone_to_id, sr = 160000)
-            
-        # get frame_nums
-        frame_nums = trimmed_speech.shape[1]
+        # durations, phone ids, trimming and pitch are slices of the packed store
+        if self.packed_features is not None:
+            features = self.packed_features.get(uid)
+        else:
+            features = self.compile_alignment(utt_info, speech)
+        start_frame, end_frame = features["trim"]
+        # duration is modified in place by align_length
+        duration = np.array(features["duration"])
+        phone_id = features["phone_id"]
 
-        # get pitch
-        trimmed_pitch = get_f0_features_using_dio(trimmed_speech, self.cfg)
+        # trim silence at begginning and end
+        hop_size = self.cfg.preprocess.hop_size
+        speech = speech[:, start_frame * hop_size : end_frame * hop_size].numpy()
 
         # align length
-        speech, pitch, duration = self.align_length(trimmed_speech, trimmed_pitch, trimmed_duration)
-        frame_nums = speech.shape[1]
+        speech, pitch, duration = self.align_length(
+            speech, features["pitch"], duration
+        )
+        frame_nums = speech.shape[1] // hop_size
 
         # get target and reference
         out = self.get_target_and_reference(speech, pitch, duration, phone_id, frame_nums)
@@ -307,16 +365,10 @@ class UniAmphionDataset(torch.utils.data.Dataset):
         frame_nums, ref_frame_nums = out["frame_nums"], out["ref_frame_nums"]
 
         assert len(phone_id) == len(duration)
-        phone_id_frame = []
-        for i in range(len(phone_id)):
-            phone_id_frame.extend([phone_id[i] for _ in range(duration[i])])
-        phone_id_frame = np.array(phone_id_frame)
+        phone_id_frame = np.repeat(phone_id, duration)
 
         assert len(ref_phone_id) == len(ref_duration)
-        ref_phone_id_frame = []
-        for i in range(len(ref_phone_id)):
-            ref_phone_id_frame.extend([ref_phone_id[i] for _ in range(ref_duration[i])])
-        ref_phone_id_frame = np.array(ref_phone_id_frame)
+        ref_phone_id_frame = np.repeat(ref_phone_id, ref_duration)
 
         single_feature.update(
             {
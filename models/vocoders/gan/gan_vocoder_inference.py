@@ -5,8 +5,6 @@
 
 import torch
 
-from utils.util import pad_mels_to_tensors, pad_f0_to_tensors
-
 
 def vocoder_inference(cfg, model, mels, f0s=None, device=None, fast_inference=False):
     """Inference the vocoder
@@ -38,59 +36,88 @@ def vocoder_inference(cfg, model, mels, f0s=None, device=None, fast_inference=Fa
         return output.squeeze(1).detach().cpu()
 
 
-def synthesis_audios(cfg, model, mels, f0s=None, batch_size=None, fast_inference=False):
+def synthesis_audios(
+    cfg,
+    model,
+    mels,
+    f0s=None,
+    batch_size=None,
+    fast_inference=False,
+    max_batch_frames=None,
+    half=False,
+):
     """Inference the vocoder
     Args:
         mels: A list of mel-specs
+        f0s: A list of f0s for the vocoders conditioned on pitch (e.g. NSF-HiFiGAN)
+        batch_size: The max number of mel-specs in a forward pass, all if None
+        max_batch_frames: The max number of padded frames in a forward pass, no limit
+            if None. It can make the batches smaller than batch_size, and a mel-spec
+            longer than it is inferred alone
+        half: Run the generator in float16 autocast on GPU
     Returns:
         audios: A list of audios
     """
     # Get the device
     device = next(model.parameters()).device
+    hop_size = model.cfg.preprocess.hop_size
+    if batch_size is None:
+        batch_size = len(mels)
+
+    # Sort by length so that each batch is padded to similar lengths
+    order = sorted(range(len(mels)), key=lambda i: mels[i].shape[-1], reverse=True)
+    batches = []
+    for i in order:
+        # the first mel-spec of a batch is the longest one
+        if len(batches) > 0 and (
+            len(batches[-1]) < batch_size
+            and (
+                max_batch_frames is None
+                or (len(batches[-1]) + 1) * mels[batches[-1][0]].shape[-1]
+                <= max_batch_frames
+            )
+        ):
+            batches[-1].append(i)
+        else:
+            batches.append([i])
 
-    audios = []
-
-    # Pad the given list into tensors
-    mel_batches, mel_frames = pad_mels_to_tensors(mels, batch_size)
-    if f0s != None:
-        f0_batches = pad_f0_to_tensors(f0s, batch_size)
-
-    if f0s == None:
-        for mel_batch, mel_frame in zip(mel_batches, mel_frames):
-            for i in range(mel_batch.shape[0]):
-                mel = mel_batch[i]
-                frame = mel_frame[i]
-                audio = vocoder_inference(
-                    cfg,
-                    model,
-                    mel.unsqueeze(0),
-                    device=device,
-                    fast_inference=fast_inference,
-                ).squeeze(0)
-
-                # calculate the audio length
-                audio_length = frame * model.cfg.preprocess.hop_size
-                audio = audio[:audio_length]
-
-                audios.append(audio)
-    else:
-        for mel_batch, f0_batch, mel_frame in zip(mel_batches, f0_batches, mel_frames):
-            for i in range(mel_batch.shape[0]):
-                mel = mel_batch[i]
-                f0 = f0_batch[i]
-                frame = mel_frame[i]
-                audio = vocoder_inference(
-                    cfg,
-                    model,
-                    mel.unsqueeze(0),
-                    f0s=f0.unsqueeze(0),
-                    device=device,
-                    fast_inference=fast_inference,
-                ).squeeze(0)
+    audios = [None] * len(mels)
+    for batch in batches:
+        mel_batch = _pad_to_tensor([mels[i] for i in batch], device)
+        f0_batch = None
+        if f0s != None:
+            f0_batch = _pad_to_tensor([f0s[i] for i in batch], device)
+
+        with torch.autocast(
+            device_type=device.type,
+            dtype=torch.float16,
+            enabled=half and device.type == "cuda",
+        ):
+            audio_batch = vocoder_inference(
+                cfg,
+                model,
+                mel_batch,
+                f0s=f0_batch,
+                device=device,
+                fast_inference=fast_inference,
+            ).float()
+
+        for j, i in enumerate(batch):
+            # calculate the audio length
+            audio_length = mels[i].shape[-1] * hop_size
+            audios[i] = audio_batch[j, :audio_length]
+    return audios
 
-                # calculate the audio length
-                audio_length = frame * model.cfg.preprocess.hop_size
-                audio = audio[:audio_length]
 
-                audios.append(audio)
-    return audios
+def _pad_to_tensor(features, device):
+    """Pad features of shape (..., frames) to a (batch_size, ..., frames) tensor"""
+    features = [torch.as_tensor(x, device=device).float() for x in features]
+    tensor = torch.zeros(
+        len(features),
+        *features[0].shape[:-1],
+        max(x.shape[-1] for x in features),
+        device=device,
+    )
+    for i, x in enumerate(features):
+        tensor[i, ..., : x.shape[-1]] = x
+    return tensor
@@ -476,11 +476,16 @@ def synthesis(
     f0s=None,
     batch_size=64,
     fast_inference=False,
+    max_batch_frames=None,
+    half=False,
 ):
     """Synthesis audios from a given vocoder and series of given features.
     cfg: vocoder config.
     vocoder_weight_file: a folder of accelerator state dict or a path to the .pt file.
     pred: a list of numpy arrays. [(seq_len1, acoustic_features_dim), (seq_len2, acoustic_features_dim), ...]
+    max_batch_frames: GAN vocoders only, the max number of padded frames in a forward pass
+        (fewer than batch_size mel-specs for long ones), no limit if None.
+    half: GAN vocoders only, run the generator in float16 autocast on GPU.
     """
 
     vocoder_name = cfg.model.generator
@@ -504,6 +509,13 @@ def synthesis(
     # pred: (frame_len, n_mels) -> (n_mels, frame_len)
     mels_pred = tensorize([p.T for p in pred], device, n_samples)
     print("For predicted mels, #sample = {}...".format(len(mels_pred)))
+    kwargs = {}
+    if _vocoder_infer_funcs[vocoder_name] is gan_vocoder_inference.synthesis_audios:
+        kwargs = {"max_batch_frames": max_batch_frames, "half": half}
+    elif max_batch_frames is not None or half:
+        raise ValueError(
+            "max_batch_frames and half are only supported by the GAN vocoders"
+        )
     audios_pred = _vocoder_infer_funcs[vocoder_name](
         cfg,
         vocoder,
@@ -511,5 +523,6 @@ def synthesis(
         f0s=f0s,
         batch_size=batch_size,
         fast_inference=fast_inference,
+        **kwargs,
     )
     return audios_pred
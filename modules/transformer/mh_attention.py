@@ -415,3 +415,51 @@ class MultiheadAttention(Module):
             return attn_output.transpose(1, 0), attn_output_weights
         else:
             return attn_output, attn_output_weights
+
+    def infer(
+        self,
+        x: Tensor,
+        kv_cache: Tuple[Tensor, Tensor],
+        offset: int,
+        attn_mask: Optional[Tensor] = None,
+    ) -> Tensor:
+        r"""Incremental self-attention of new positions over a key/value cache.
+
+        The keys and values of ``x`` are written to ``kv_cache`` at
+        ``[offset, offset + L)`` and the queries attend to ``[0, offset + L)``.
+        Only for inference with ``batch_first=True``, the packed input projection
+        and no ``bias_k``/``bias_v``/``add_zero_attn``.
+
+        Args:
+            x: new positions of shape :math:`(N, L, E)`.
+            kv_cache: key and value buffers of shape :math:`(N, H, S_{max}, E / H)`,
+                e.g. from ``TransformerEncoder.init_kv_cache``.
+            offset: number of positions already in the cache.
+            attn_mask: float mask of shape :math:`(N, 1, L, offset + L)` added to the
+                attention weights, -inf for the positions not allowed to attend.
+
+        Outputs:
+            - **attn_output** - of shape :math:`(N, L, E)`.
+        """
+        assert self.batch_first and self._qkv_same_embed_dim
+        assert self.bias_k is None and not self.add_zero_attn
+
+        N, L, E = x.shape
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = [
+            t.view(N, L, self.num_heads, self.head_dim).transpose(1, 2)
+            for t in (q, k, v)
+        ]
+
+        k_cache, v_cache = kv_cache
+        k_cache[:, :, offset : offset + L] = k
+        v_cache[:, :, offset : offset + L] = v
+
+        attn_output = F.scaled_dot_product_attention(
+            q,
+            k_cache[:, :, : offset + L],
+            v_cache[:, :, : offset + L],
+            attn_mask=attn_mask,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(N, L, E)
+        return self.out_proj(attn_output)
@@ -55,6 +55,14 @@ class SinePositionalEmbedding(nn.Module):
         output = output * self.x_scale + self.alpha * self.pe[:, : x.size(1)]
         return self.dropout(output)
 
+    def forward_at(self, x: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        """Same as forward, but x (N, T, D) is at the given positions (N, T)
+        instead of 0..T-1, e.g. the new step of incremental decoding. The encodings
+        must already cover the positions, see ``extend_pe``."""
+        self.extend_pe(x[:, :1])
+        output = x * self.x_scale + self.alpha * self.pe[0, positions]
+        return self.dropout(output)
+
 
 # import torch
 # import torch.nn as nn
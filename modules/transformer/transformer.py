@@ -159,6 +159,33 @@ class TransformerEncoderLayer(nn.Module):
         x = self.linear2(self.dropout(self.activation(self.linear1(x))))
         return self.dropout2(x)
 
+    def infer(
+        self,
+        x: Tensor,
+        kv_cache: tuple,
+        offset: int,
+        attn_mask: Optional[Tensor] = None,
+    ) -> Tensor:
+        r"""Incremental forward of new positions, see ``MultiheadAttention.infer``.
+
+        Args:
+            x: the new positions (N, L, E).
+            kv_cache: key and value buffers of this layer.
+            offset: the number of positions already in the cache.
+            attn_mask: the float mask of the new positions (N, 1, L, offset + L).
+        """
+        if self.norm_first:
+            x = x + self.dropout1(
+                self.self_attn.infer(self.norm1(x), kv_cache, offset, attn_mask)
+            )
+            x = x + self._ff_block(self.norm2(x))
+        else:
+            x = self.norm1(
+                x + self.dropout1(self.self_attn.infer(x, kv_cache, offset, attn_mask))
+            )
+            x = self.norm2(x + self._ff_block(x))
+        return x
+
 
 class TransformerEncoder(nn.Module):
     """TransformerEncoder is a stack of N encoder layers."""
@@ -190,6 +217,38 @@ class TransformerEncoder(nn.Module):
 
         return (layer_states, output) if return_layer_states else output
 
+    def init_kv_cache(self, batch_size, max_len, device=None, dtype=None):
+        """Key and value buffers of each layer for ``infer``"""
+        kv_caches = []
+        for mod in self.layers:
+            attn = mod.self_attn
+            shape = (batch_size, attn.num_heads, max_len, attn.head_dim)
+            kv_caches.append(
+                (
+                    torch.zeros(shape, device=device, dtype=dtype),
+                    torch.zeros(shape, device=device, dtype=dtype),
+                )
+            )
+        return kv_caches
+
+    def infer(
+        self,
+        x: Tensor,
+        kv_caches: List[tuple],
+        offset: int,
+        attn_mask: Optional[Tensor] = None,
+    ) -> Tensor:
+        """Incremental decoding: run the new positions x (N, L, E) over the key/value
+        caches of the ``offset`` previous positions, which are not recomputed."""
+        output = x
+        for mod, kv_cache in zip(self.layers, kv_caches):
+            output = mod.infer(output, kv_cache, offset, attn_mask)
+
+        if self.norm is not None:
+            output = self.norm(output)
+
+        return output
+
     def _apply_module(self, module, output, mask, key_padding_mask, layer_states):
         # Apply a single transformer module
         output = module(output, src_mask=mask, src_key_padding_mask=key_padding_mask)
@@ -271,6 +271,9 @@ def main(output_path, dataset_path, cfg):
 
     # Whisper model id
     model_id = cfg.whisper_model_id  # id of whisper model to use for transcription
+    asr_batch_size = cfg.whisper_batch_size  # files transcribed together, per gpu
+    asr_num_beams = cfg.whisper_num_beams  # beam size, 1 for greedy decoding
+    asr_num_workers = cfg.whisper_num_workers  # audio loading processes, per gpu
 
     subsets = [
         d
@@ -333,7 +336,14 @@ def main(output_path, dataset_path, cfg):
         txt_files = get_txt_files(processed_dir)
         #if number of wav files in processed_dir == number of txt files in processed_dir, transcription is not needed
         if len(wav_files) != len(txt_files):
-            asr_main(processed_dir, n_gpus, model_id)
+            asr_main(
+                processed_dir,
+                n_gpus,
+                model_id,
+                batch_size=asr_batch_size,
+                num_beams=asr_num_beams,
+                num_workers=asr_num_workers,
+            )
         else:
             print("Audio files already transcribed. Skipping...")
 
@@ -4,18 +4,22 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import copy
+import functools
+import multiprocessing
 import torch
 import numpy as np
 
 import json
 from tqdm import tqdm
-from sklearn.preprocessing import StandardScaler
-from utils.io import save_feature, save_txt, save_torch_audio
+from utils.io import save_feature, save_npy, save_txt, save_torch_audio
 from utils.util import has_existed
 from utils.tokenizer import extract_encodec_token
 from utils.stft import TacotronSTFT
 from utils.dsp import compress, audio_to_label
 from utils.data_utils import remove_outlier
+from utils.running_stats import RunningStats
+from utils.feature_store import BackgroundSaver
 from preprocessors.metadata import replace_augment_name
 from scipy.interpolate import interp1d
 from utils.mel import (
@@ -27,27 +31,207 @@ from utils.mel import (
 ZERO = 1e-12
 
 
-def extract_utt_acoustic_features_parallel(metadata, dataset_output, cfg, n_workers=1):
+def extract_utt_acoustic_features_parallel(
+    metadata, dataset_output, cfg, n_workers=1, chunksize=16, gpu_batch_size=32
+):
     """Extract acoustic features from utterances using muliprocess
 
+    Utterances whose features all exist already are skipped. The others are split
+    into chunks of ``chunksize`` utterances and processed by a pool of ``n_workers``
+    processes, each keeping its STFT objects between utterances. With a GPU, the
+    STFT-based mel (and energy from mel) is computed in batches of
+    ``gpu_batch_size`` utterances in the main process instead of by the workers.
+
     Args:
         metadata (dict): dictionary that stores data in train.json and test.json files
         dataset_output (str): directory to store acoustic features
         cfg (dict): dictionary that stores configurations
         n_workers (int, optional): num of processes to extract features in parallel. Defaults to 1.
+        chunksize (int, optional): num of utterances sent to a worker at once. Defaults to 16.
+        gpu_batch_size (int, optional): num of utterances per batch of the GPU mel path. Defaults to 32.
+    """
+    todo = [
+        utt
+        for utt in metadata
+        if not all(
+            os.path.exists(path)
+            for path in get_acoustic_feature_paths(dataset_output, cfg, utt["Uid"])
+        )
+    ]
+    print(
+        "Extracting acoustic features of {} utterances, {} already extracted".format(
+            len(todo), len(metadata) - len(todo)
+        )
+    )
+    if len(todo) == 0:
+        return
+
+    use_gpu_mel = (
+        torch.cuda.is_available()
+        and cfg.preprocess.extract_mel
+        and cfg.preprocess.mel_extract_mode != "taco"
+        and not cfg.preprocess.extract_duration
+    )
+    worker_cfg = cfg
+    if use_gpu_mel:
+        # the workers skip mel (and energy from mel) and return the waveforms
+        worker_cfg = copy.deepcopy(cfg)
+        worker_cfg.preprocess.extract_mel = False
+        if cfg.preprocess.energy_extract_mode == "from_mel":
+            worker_cfg.preprocess.extract_energy = False
+        device = torch.device("cuda")
+
+    chunks = [todo[i : i + chunksize] for i in range(0, len(todo), chunksize)]
+    if n_workers > 1:
+        # spawn: workers may use CUDA (e.g. crepe) after the main process did
+        pool = multiprocessing.get_context("spawn").Pool(
+            n_workers,
+            initializer=_init_acoustic_worker,
+            initargs=(dataset_output, worker_cfg, use_gpu_mel),
+        )
+        results = pool.imap_unordered(_extract_acoustic_features_chunk, chunks)
+    else:
+        pool = None
+        _init_acoustic_worker(dataset_output, worker_cfg, use_gpu_mel)
+        results = map(_extract_acoustic_features_chunk, chunks)
+
+    wavs = []
+    # the GPU mels are saved in the background while the next batches are extracted
+    saver = BackgroundSaver()
+    with tqdm(total=len(todo)) as pbar:
+        for chunk_wavs in results:
+            pbar.update(len(chunk_wavs))
+            if not use_gpu_mel:
+                continue
+            wavs.extend(chunk_wavs)
+            while len(wavs) >= gpu_batch_size:
+                _save_mel_batch(
+                    dataset_output, cfg, wavs[:gpu_batch_size], device, saver
+                )
+                wavs = wavs[gpu_batch_size:]
+    if wavs:
+        _save_mel_batch(dataset_output, cfg, wavs, device, saver)
+    saver.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def get_acoustic_feature_paths(dataset_output, cfg, uid):
+    """Output files of extract_utt_acoustic_features_* for an utterance"""
+    paths = []
+
+    def add(feature_dir, suffix=".npy"):
+        paths.append(os.path.join(dataset_output, feature_dir, uid + suffix))
+
+    if cfg.preprocess.extract_duration:
+        add(cfg.preprocess.duration_dir)
+        add(cfg.preprocess.lab_dir, ".txt")
+    if cfg.preprocess.extract_linear_spec and cfg.task_type != "vocoder":
+        add(cfg.preprocess.linear_dir)
+    if cfg.preprocess.extract_mel:
+        add(cfg.preprocess.mel_dir)
+    if cfg.preprocess.extract_energy:
+        add(cfg.preprocess.energy_dir)
+        if cfg.preprocess.extract_duration:
+            add(cfg.preprocess.phone_energy_dir)
+    if cfg.preprocess.extract_pitch:
+        add(cfg.preprocess.pitch_dir)
+        if cfg.preprocess.extract_duration:
+            add(cfg.preprocess.phone_pitch_dir)
+        if cfg.preprocess.extract_uv:
+            add(cfg.preprocess.uv_dir)
+    if cfg.preprocess.extract_audio:
+        add(cfg.preprocess.audio_dir, ".wav" if cfg.task_type == "tts" else ".npy")
+    if cfg.preprocess.extract_label:
+        add(cfg.preprocess.label_dir)
+    if cfg.preprocess.extract_acoustic_token and cfg.task_type != "vocoder":
+        add(cfg.preprocess.acoustic_token_dir)
+    if cfg.preprocess.extract_amplitude_phase and cfg.task_type == "vocoder":
+        add(cfg.preprocess.log_amplitude_dir)
+        add(cfg.preprocess.phase_dir)
+        add(cfg.preprocess.real_dir)
+        add(cfg.preprocess.imaginary_dir)
+    return paths
+
+
+_worker_args = {}
+
+
+def _init_acoustic_worker(dataset_output, cfg, return_wavs):
+    torch.set_num_threads(1)
+    _worker_args.update(dataset_output=dataset_output, cfg=cfg, return_wavs=return_wavs)
+
+
+def _extract_acoustic_features_chunk(utts):
+    """Extract the features of a chunk of utterances in a worker
 
     Returns:
-        list: acoustic features
+        list: [(uid, waveform)] if the mels are extracted on GPU, otherwise [(uid, None)]
     """
-    for utt in tqdm(metadata):
-        if cfg.task_type == "tts":
-            extract_utt_acoustic_features_tts(dataset_output, cfg, utt)
-        if cfg.task_type == "svc":
-            extract_utt_acoustic_features_svc(dataset_output, cfg, utt)
-        if cfg.task_type == "vocoder":
-            extract_utt_acoustic_features_vocoder(dataset_output, cfg, utt)
-        if cfg.task_type == "tta":
-            extract_utt_acoustic_features_tta(dataset_output, cfg, utt)
+    dataset_output = _worker_args["dataset_output"]
+    cfg = _worker_args["cfg"]
+    extract_utt_acoustic_features = {
+        "tts": extract_utt_acoustic_features_tts,
+        "svc": extract_utt_acoustic_features_svc,
+        "vocoder": extract_utt_acoustic_features_vocoder,
+        "tta": extract_utt_acoustic_features_tta,
+    }[cfg.task_type]
+
+    results = []
+    for utt in utts:
+        wav_torch = extract_utt_acoustic_features(dataset_output, cfg, utt)
+        if _worker_args["return_wavs"]:
+            results.append((utt["Uid"], wav_torch.cpu().numpy()))
+        else:
+            results.append((utt["Uid"], None))
+    return results
+
+
+def _save_mel_batch(dataset_output, cfg, wavs, device, saver):
+    """Batched GPU extract_mel_features (and energy from mel) of [(uid, waveform)],
+    saved by saver (a utils.feature_store.BackgroundSaver)"""
+    from utils.mel import extract_mel_features_batch
+
+    ys = [torch.from_numpy(wav).to(device) for _, wav in wavs]
+    with torch.no_grad():
+        mels = extract_mel_features_batch(ys, cfg.preprocess)
+    save_energy = (
+        cfg.preprocess.extract_energy
+        and cfg.preprocess.energy_extract_mode == "from_mel"
+    )
+    mel_dir = os.path.join(dataset_output, cfg.preprocess.mel_dir)
+    energy_dir = os.path.join(dataset_output, cfg.preprocess.energy_dir)
+    os.makedirs(mel_dir, exist_ok=True)
+    if save_energy:
+        os.makedirs(energy_dir, exist_ok=True)
+    # saved through temporary files, an interrupted run leaves no partial feature
+    # that the next run would take for extracted
+    for (uid, _), mel in zip(wavs, mels):
+        saver.submit(save_npy, os.path.join(mel_dir, uid + ".npy"), mel.cpu().numpy())
+        if save_energy:
+            energy = (mel.exp() ** 2).sum(0).sqrt().cpu().numpy()
+            saver.submit(save_npy, os.path.join(energy_dir, uid + ".npy"), energy)
+
+
+_tacotron_stft = {}
+
+
+def get_tacotron_stft(cfg):
+    """TacotronSTFT of the preprocess config, built once per process"""
+    key = (cfg.sample_rate, cfg.win_size, cfg.hop_size, cfg.n_fft, cfg.n_mel)
+    key += (cfg.fmin, cfg.fmax)
+    if key not in _tacotron_stft:
+        _tacotron_stft[key] = TacotronSTFT(
+            sampling_rate=cfg.sample_rate,
+            win_length=cfg.win_size,
+            hop_length=cfg.hop_size,
+            filter_length=cfg.n_fft,
+            n_mel_channels=cfg.n_mel,
+            mel_fmin=cfg.fmin,
+            mel_fmax=cfg.fmax,
+        )
+    return _tacotron_stft[key]
 
 
 def avg_phone_feature(feature, duration, interpolation=False):
@@ -134,53 +318,15 @@ def __extract_utt_acoustic_features(dataset_output, cfg, utt):
                 dataset_output, cfg.preprocess.linear_dir, uid, linear.cpu().numpy()
             )
 
-        if cfg.preprocess.extract_mel:
-            if cfg.preprocess.mel_extract_mode == "taco":
-                _stft = TacotronSTFT(
-                    sampling_rate=cfg.preprocess.sample_rate,
-                    win_length=cfg.preprocess.win_size,
-                    hop_length=cfg.preprocess.hop_size,
-                    filter_length=cfg.preprocess.n_fft,
-                    n_mel_channels=cfg.preprocess.n_mel,
-                    mel_fmin=cfg.preprocess.fmin,
-                    mel_fmax=cfg.preprocess.fmax,
-                )
-                mel = extract_mel_features(
-                    wav_torch.unsqueeze(0), cfg.preprocess, taco=True, _stft=_stft
-                )
-                if cfg.preprocess.extract_duration:
-                    mel = mel[:, : sum(durations)]
-            else:
-                mel = extract_mel_features(wav_torch.unsqueeze(0), cfg.preprocess)
-            save_feature(dataset_output, cfg.preprocess.mel_dir, uid, mel.cpu().numpy())
+        features = extract_acoustic_features_from_wav(
+            wav_torch, cfg, durations if cfg.preprocess.extract_duration else None
+        )
+        if "mel" in features:
+            save_feature(dataset_output, cfg.preprocess.mel_dir, uid, features["mel"])
 
-        if cfg.preprocess.extract_energy:
-            if (
-                cfg.preprocess.energy_extract_mode == "from_mel"
-                and cfg.preprocess.extract_mel
-            ):
-                energy = (mel.exp() ** 2).sum(0).sqrt().cpu().numpy()
-            elif cfg.preprocess.energy_extract_mode == "from_waveform":
-                energy = audio.energy(wav, cfg.preprocess)
-            elif cfg.preprocess.energy_extract_mode == "from_tacotron_stft":
-                _stft = TacotronSTFT(
-                    sampling_rate=cfg.preprocess.sample_rate,
-                    win_length=cfg.preprocess.win_size,
-                    hop_length=cfg.preprocess.hop_size,
-                    filter_length=cfg.preprocess.n_fft,
-                    n_mel_channels=cfg.preprocess.n_mel,
-                    mel_fmin=cfg.preprocess.fmin,
-                    mel_fmax=cfg.preprocess.fmax,
-                )
-                _, energy = audio.get_energy_from_tacotron(wav, _stft)
-            else:
-                assert cfg.preprocess.energy_extract_mode in [
-                    "from_mel",
-                    "from_waveform",
-                    "from_tacotron_stft",
-                ], f"{cfg.preprocess.energy_extract_mode} not in supported energy_extract_mode [from_mel, from_waveform, from_tacotron_stft]"
+        if "energy" in features:
+            energy = features["energy"]
             if cfg.preprocess.extract_duration:
-                energy = energy[: sum(durations)]
                 phone_energy = avg_phone_feature(energy, durations)
                 save_feature(
                     dataset_output, cfg.preprocess.phone_energy_dir, uid, phone_energy
@@ -188,20 +334,17 @@ def __extract_utt_acoustic_features(dataset_output, cfg, utt):
 
             save_feature(dataset_output, cfg.preprocess.energy_dir, uid, energy)
 
-        if cfg.preprocess.extract_pitch:
-            pitch = f0.get_f0(wav, cfg.preprocess)
+        if "pitch" in features:
+            pitch = features["pitch"]
             if cfg.preprocess.extract_duration:
-                pitch = pitch[: sum(durations)]
                 phone_pitch = avg_phone_feature(pitch, durations, interpolation=True)
                 save_feature(
                     dataset_output, cfg.preprocess.phone_pitch_dir, uid, phone_pitch
                 )
             save_feature(dataset_output, cfg.preprocess.pitch_dir, uid, pitch)
 
-            if cfg.preprocess.extract_uv:
-                assert isinstance(pitch, np.ndarray)
-                uv = pitch != 0
-                save_feature(dataset_output, cfg.preprocess.uv_dir, uid, uv)
+            if "uv" in features:
+                save_feature(dataset_output, cfg.preprocess.uv_dir, uid, features["uv"])
 
         if cfg.preprocess.extract_audio:
             save_feature(dataset_output, cfg.preprocess.audio_dir, uid, wav)
@@ -220,6 +363,73 @@ def __extract_utt_acoustic_features(dataset_output, cfg, utt):
                     dataset_output, cfg.preprocess.acoustic_token_dir, uid, codes
                 )
 
+    return wav_torch
+
+
+def extract_acoustic_features_from_wav(wav_torch, cfg, durations=None):
+    """Extract the mel, energy, pitch and uv features of an in-memory waveform,
+    as extract_utt_acoustic_features_svc saves them
+
+    Args:
+        wav_torch (tensor): (T,) waveform at cfg.preprocess.sample_rate
+        cfg (dict): dictionary that stores configurations
+        durations (list, optional): phone durations, the features are cut to their
+            sum (the mel only in "taco" mode)
+
+    Returns:
+        dict: {"mel": (n_mel, T), "energy": (T,), "pitch": (T,), "uv": (T,)},
+              only the features enabled in cfg.preprocess
+    """
+    from utils import audio, f0
+
+    features = {}
+    with torch.no_grad():
+        wav = wav_torch.cpu().numpy()
+
+        if cfg.preprocess.extract_mel:
+            if cfg.preprocess.mel_extract_mode == "taco":
+                _stft = get_tacotron_stft(cfg.preprocess)
+                mel = extract_mel_features(
+                    wav_torch.unsqueeze(0), cfg.preprocess, taco=True, _stft=_stft
+                )
+                if durations is not None:
+                    mel = mel[:, : sum(durations)]
+            else:
+                mel = extract_mel_features(wav_torch.unsqueeze(0), cfg.preprocess)
+            features["mel"] = mel.cpu().numpy()
+
+        if cfg.preprocess.extract_energy:
+            if (
+                cfg.preprocess.energy_extract_mode == "from_mel"
+                and cfg.preprocess.extract_mel
+            ):
+                energy = (mel.exp() ** 2).sum(0).sqrt().cpu().numpy()
+            elif cfg.preprocess.energy_extract_mode == "from_waveform":
+                energy = audio.energy(wav, cfg.preprocess)
+            elif cfg.preprocess.energy_extract_mode == "from_tacotron_stft":
+                _stft = get_tacotron_stft(cfg.preprocess)
+                _, energy = audio.get_energy_from_tacotron(wav, _stft)
+            else:
+                assert cfg.preprocess.energy_extract_mode in [
+                    "from_mel",
+                    "from_waveform",
+                    "from_tacotron_stft",
+                ], f"{cfg.preprocess.energy_extract_mode} not in supported energy_extract_mode [from_mel, from_waveform, from_tacotron_stft]"
+            if durations is not None:
+                energy = energy[: sum(durations)]
+            features["energy"] = energy
+
+        if cfg.preprocess.extract_pitch:
+            pitch = f0.get_f0(wav, cfg.preprocess)
+            if durations is not None:
+                pitch = pitch[: sum(durations)]
+            features["pitch"] = pitch
+            if cfg.preprocess.extract_uv:
+                assert isinstance(pitch, np.ndarray)
+                features["uv"] = pitch != 0
+
+    return features
+
 
 # TODO: refactor extract_utt_acoustic_features_task function due to many duplicated code
 def extract_utt_acoustic_features_tts(dataset_output, cfg, utt):
@@ -274,15 +484,7 @@ def extract_utt_acoustic_features_tts(dataset_output, cfg, utt):
             from utils.mel import extract_mel_features
 
             if cfg.preprocess.mel_extract_mode == "taco":
-                _stft = TacotronSTFT(
-                    sampling_rate=cfg.preprocess.sample_rate,
-                    win_length=cfg.preprocess.win_size,
-                    hop_length=cfg.preprocess.hop_size,
-                    filter_length=cfg.preprocess.n_fft,
-                    n_mel_channels=cfg.preprocess.n_mel,
-                    mel_fmin=cfg.preprocess.fmin,
-                    mel_fmax=cfg.preprocess.fmax,
-                )
+                _stft = get_tacotron_stft(cfg.preprocess)
                 mel = extract_mel_features_tts(
                     wav_torch.unsqueeze(0), cfg.preprocess, taco=True, _stft=_stft
                 )
@@ -301,15 +503,7 @@ def extract_utt_acoustic_features_tts(dataset_output, cfg, utt):
             elif cfg.preprocess.energy_extract_mode == "from_waveform":
                 energy = audio.energy(wav, cfg.preprocess)
             elif cfg.preprocess.energy_extract_mode == "from_tacotron_stft":
-                _stft = TacotronSTFT(
-                    sampling_rate=cfg.preprocess.sample_rate,
-                    win_length=cfg.preprocess.win_size,
-                    hop_length=cfg.preprocess.hop_size,
-                    filter_length=cfg.preprocess.n_fft,
-                    n_mel_channels=cfg.preprocess.n_mel,
-                    mel_fmin=cfg.preprocess.fmin,
-                    mel_fmax=cfg.preprocess.fmax,
-                )
+                _stft = get_tacotron_stft(cfg.preprocess)
                 _, energy = audio.get_energy_from_tacotron(wav, _stft)
             else:
                 assert cfg.preprocess.energy_extract_mode in [
@@ -364,13 +558,15 @@ def extract_utt_acoustic_features_tts(dataset_output, cfg, utt):
                     dataset_output, cfg.preprocess.acoustic_token_dir, uid, codes
                 )
 
+    return wav_torch
+
 
 def extract_utt_acoustic_features_svc(dataset_output, cfg, utt):
-    __extract_utt_acoustic_features(dataset_output, cfg, utt)
+    return __extract_utt_acoustic_features(dataset_output, cfg, utt)
 
 
 def extract_utt_acoustic_features_tta(dataset_output, cfg, utt):
-    __extract_utt_acoustic_features(dataset_output, cfg, utt)
+    return __extract_utt_acoustic_features(dataset_output, cfg, utt)
 
 
 def extract_utt_acoustic_features_vocoder(dataset_output, cfg, utt):
@@ -448,6 +644,8 @@ def extract_utt_acoustic_features_vocoder(dataset_output, cfg, utt):
             label = audio_to_label(wav, cfg.preprocess.bits)
             save_feature(dataset_output, cfg.preprocess.label_dir, uid, label)
 
+    return wav_torch
+
 
 def cal_normalized_mel(mel, dataset_name, cfg):
     mel_min, mel_max = load_mel_extrema(cfg, dataset_name)
@@ -455,44 +653,15 @@ def cal_normalized_mel(mel, dataset_name, cfg):
     return mel_norm
 
 
-def cal_mel_min_max(dataset, output_path, cfg, metadata=None):
-    dataset_output = os.path.join(output_path, dataset)
-
-    if metadata is None:
-        metadata = []
-        for dataset_type in ["train", "test"] if "eval" not in dataset else ["test"]:
-            dataset_file = os.path.join(dataset_output, "{}.json".format(dataset_type))
-            with open(dataset_file, "r") as f:
-                metadata.extend(json.load(f))
-
-    tmp_mel_min = []
-    tmp_mel_max = []
-    for item in metadata:
-        mel_path = os.path.join(
-            dataset_output, cfg.preprocess.mel_dir, item["Uid"] + ".npy"
-        )
-        if not os.path.exists(mel_path):
-            continue
-        mel = np.load(mel_path)
-        if mel.shape[0] != cfg.preprocess.n_mel:
-            mel = mel.T
-        # mel: (n_mels, T)
-        assert mel.shape[0] == cfg.preprocess.n_mel
-
-        tmp_mel_min.append(np.min(mel, axis=-1))
-        tmp_mel_max.append(np.max(mel, axis=-1))
-
-    mel_min = np.min(tmp_mel_min, axis=0)
-    mel_max = np.max(tmp_mel_max, axis=0)
-
-    ## save mel min max data
-    mel_min_max_dir = os.path.join(dataset_output, cfg.preprocess.mel_min_max_stats_dir)
-    os.makedirs(mel_min_max_dir, exist_ok=True)
-
-    mel_min_path = os.path.join(mel_min_max_dir, "mel_min.npy")
-    mel_max_path = os.path.join(mel_min_max_dir, "mel_max.npy")
-    np.save(mel_min_path, mel_min)
-    np.save(mel_max_path, mel_max)
+def cal_mel_min_max(dataset, output_path, cfg, metadata=None, n_workers=1):
+    cal_acoustic_statistics(
+        dataset,
+        output_path,
+        cfg,
+        mel_min_max=True,
+        metadata=metadata,
+        n_workers=n_workers,
+    )
 
 
 def denorm_for_pred_mels(cfg, dataset_name, split, pred):
@@ -534,26 +703,27 @@ def normalize_mel_channel(mel, mel_min, mel_max):
     return (mel - mel_min) / (mel_max - mel_min + ZERO) * 2 - 1
 
 
-def normalize(dataset, feat_dir, cfg):
+def normalize(dataset, feat_dir, cfg, n_workers=1):
     dataset_output = os.path.join(cfg.preprocess.processed_dir, dataset)
     print(f"normalize {feat_dir}")
 
-    max_value = np.finfo(np.float64).min
-    min_value = np.finfo(np.float64).max
-
-    scaler = StandardScaler()
-    feat_files = os.listdir(os.path.join(dataset_output, feat_dir))
-
-    for feat_file in tqdm(feat_files):
-        feat_file = os.path.join(dataset_output, feat_dir, feat_file)
-        if not feat_file.endswith(".npy"):
-            continue
-        feat = np.load(feat_file)
-        max_value = max(max_value, max(feat))
-        min_value = min(min_value, min(feat))
-        scaler.partial_fit(feat.reshape((-1, 1)))
-    mean = scaler.mean_[0]
-    std = scaler.scale_[0]
+    feat_files = sorted(os.listdir(os.path.join(dataset_output, feat_dir)))
+    utts = [(f[: -len(".npy")], None) for f in feat_files if f.endswith(".npy")]
+    specs = {
+        "feature": {
+            "dir": feat_dir,
+            "reduce": _flatten,
+            "per_speaker": False,
+            "quantiles": False,
+        }
+    }
+    stats = cal_feature_statistics(dataset_output, utts, specs, n_workers)
+    feat_stats = stats[("feature", None, "values")]
+
+    mean = float(feat_stats.mean)
+    # same as StandardScaler, which keeps constant features unscaled
+    std = float(feat_stats.std) if feat_stats.std > 0 else 1.0
+    min_value, max_value = float(feat_stats.min), float(feat_stats.max)
     stat = np.array([min_value, max_value, mean, std])
     stat_npy = os.path.join(dataset_output, f"{feat_dir}_stat.npy")
     np.save(stat_npy, stat)
@@ -567,273 +737,246 @@ def load_normalized(feat_dir, dataset_name, cfg):
     return mean, std, min_value, max_value
 
 
-def cal_pitch_statistics_svc(dataset, output_path, cfg, metadata=None):
-    # path of dataset
-    dataset_dir = os.path.join(output_path, dataset)
-    save_dir = os.path.join(dataset_dir, cfg.preprocess.pitch_dir)
-    os.makedirs(save_dir, exist_ok=True)
-    if has_existed(os.path.join(save_dir, "statistics.json")):
-        return
+def cal_pitch_statistics_svc(dataset, output_path, cfg, metadata=None, n_workers=1):
+    cal_acoustic_statistics(
+        dataset,
+        output_path,
+        cfg,
+        pitch="voiced",
+        metadata=metadata,
+        n_workers=n_workers,
+    )
 
-    if metadata is None:
-        # load singers and ids
-        singers = json.load(open(os.path.join(dataset_dir, "singers.json"), "r"))
 
-        # combine train and test metadata
-        metadata = []
-        for dataset_type in ["train", "test"] if "eval" not in dataset else ["test"]:
-            dataset_file = os.path.join(dataset_dir, "{}.json".format(dataset_type))
-            with open(dataset_file, "r") as f:
-                metadata.extend(json.load(f))
-    else:
-        singers = list(set([item["Singer"] for item in metadata]))
-        singers = {
-            "{}_{}".format(dataset, name): idx for idx, name in enumerate(singers)
-        }
+def cal_pitch_statistics(dataset, output_path, cfg, n_workers=1):
+    cal_acoustic_statistics(
+        dataset, output_path, cfg, pitch="outlier", n_workers=n_workers
+    )
 
-    # use different scalers for each singer
-    pitch_scalers = [[] for _ in range(len(singers))]
-    total_pitch_scalers = [[] for _ in range(len(singers))]
 
-    for utt_info in tqdm(metadata, desc="Loading F0..."):
-        # utt = f'{utt_info["Dataset"]}_{utt_info["Uid"]}'
-        singer = utt_info["Singer"]
-        pitch_path = os.path.join(
-            dataset_dir, cfg.preprocess.pitch_dir, utt_info["Uid"] + ".npy"
-        )
-        # total_pitch contains all pitch including unvoiced frames
-        if not os.path.exists(pitch_path):
-            continue
-        total_pitch = np.load(pitch_path)
-        assert len(total_pitch) > 0
-        # pitch contains only voiced frames
-        pitch = total_pitch[total_pitch != 0]
-        spkid = singers[f"{replace_augment_name(dataset)}_{singer}"]
-
-        # update pitch scalers
-        pitch_scalers[spkid].extend(pitch.tolist())
-        # update total pitch scalers
-        total_pitch_scalers[spkid].extend(total_pitch.tolist())
-
-    # save pitch statistics for each singer in dict
-    sta_dict = {}
-    for singer in tqdm(singers, desc="Singers statistics"):
-        spkid = singers[singer]
-        # voiced pitch statistics
-        mean, std, min, max, median = (
-            np.mean(pitch_scalers[spkid]),
-            np.std(pitch_scalers[spkid]),
-            np.min(pitch_scalers[spkid]),
-            np.max(pitch_scalers[spkid]),
-            np.median(pitch_scalers[spkid]),
-        )
+def cal_energy_statistics(dataset, output_path, cfg, n_workers=1):
+    cal_acoustic_statistics(dataset, output_path, cfg, energy=True, n_workers=n_workers)
 
-        # total pitch statistics
-        mean_t, std_t, min_t, max_t, median_t = (
-            np.mean(total_pitch_scalers[spkid]),
-            np.std(total_pitch_scalers[spkid]),
-            np.min(total_pitch_scalers[spkid]),
-            np.max(total_pitch_scalers[spkid]),
-            np.median(total_pitch_scalers[spkid]),
-        )
-        sta_dict[singer] = {
-            "voiced_positions": {
-                "mean": mean,
-                "std": std,
-                "median": median,
-                "min": min,
-                "max": max,
-            },
-            "total_positions": {
-                "mean": mean_t,
-                "std": std_t,
-                "median": median_t,
-                "min": min_t,
-                "max": max_t,
-            },
-        }
 
-    # save statistics
-    with open(os.path.join(save_dir, "statistics.json"), "w") as f:
-        json.dump(sta_dict, f, indent=4, ensure_ascii=False)
+def cal_acoustic_statistics(
+    dataset,
+    output_path,
+    cfg,
+    mel_min_max=False,
+    pitch=None,
+    energy=False,
+    metadata=None,
+    n_workers=1,
+):
+    """Calculate the statistics of acoustic features in one pass over the dataset
 
+    Every feature file is read once and folded into streaming accumulators
+    (utils.running_stats), so the memory does not grow with the corpus size. The
+    medians are approximate, within 0.1% of the exact ones.
 
-def cal_pitch_statistics(dataset, output_path, cfg):
-    # path of dataset
+    Args:
+        dataset (str): name of dataset, e.g. opencpop
+        output_path (str): directory that stores train, test and feature files of datasets
+        cfg (dict): dictionary that stores configurations
+        mel_min_max (bool, optional): save the per-channel mel min and max. Defaults to False.
+        pitch (str, optional): save the per-singer pitch statistics, whose voiced positions
+            are the non-zero frames ("voiced", for svc) or the frames kept by
+            remove_outlier ("outlier"). Defaults to None.
+        energy (bool, optional): save the per-singer energy statistics. Defaults to False.
+        metadata (list, optional): utterances to use. Defaults to the train and test sets.
+        n_workers (int, optional): num of processes to read features in parallel. Defaults to 1.
+    """
+    assert pitch in [None, "voiced", "outlier"]
     dataset_dir = os.path.join(output_path, dataset)
-    if cfg.preprocess.use_phone_pitch:
-        pitch_dir = cfg.preprocess.phone_pitch_dir
-    else:
-        pitch_dir = cfg.preprocess.pitch_dir
-    save_dir = os.path.join(dataset_dir, pitch_dir)
-
-    os.makedirs(save_dir, exist_ok=True)
-    if has_existed(os.path.join(save_dir, "statistics.json")):
-        return
-    # load singers and ids
-    singers = json.load(open(os.path.join(dataset_dir, "singers.json"), "r"))
-
-    # combine train and test metadata
-    metadata = []
-    for dataset_type in ["train", "test"] if "eval" not in dataset else ["test"]:
-        dataset_file = os.path.join(dataset_dir, "{}.json".format(dataset_type))
-        with open(dataset_file, "r") as f:
-            metadata.extend(json.load(f))
-
-    # use different scalers for each singer
-    pitch_scalers = [[] for _ in range(len(singers))]
-    total_pitch_scalers = [[] for _ in range(len(singers))]
 
-    for utt_info in metadata:
-        utt = f'{utt_info["Dataset"]}_{utt_info["Uid"]}'
-        singer = utt_info["Singer"]
-        pitch_path = os.path.join(dataset_dir, pitch_dir, utt_info["Uid"] + ".npy")
-        # total_pitch contains all pitch including unvoiced frames
-        if not os.path.exists(pitch_path):
-            continue
-        total_pitch = np.load(pitch_path)
-        assert len(total_pitch) > 0
-        # pitch contains only voiced frames
-        # pitch = total_pitch[total_pitch != 0]
-        if cfg.preprocess.pitch_remove_outlier:
-            pitch = remove_outlier(total_pitch)
-        spkid = singers[f"{replace_augment_name(dataset)}_{singer}"]
-
-        # update pitch scalers
-        pitch_scalers[spkid].extend(pitch.tolist())
-        # update total pitch scalers
-        total_pitch_scalers[spkid].extend(total_pitch.tolist())
-
-    # save pitch statistics for each singer in dict
-    sta_dict = {}
-    for singer in singers:
-        spkid = singers[singer]
-        # voiced pitch statistics
-        mean, std, min, max, median = (
-            np.mean(pitch_scalers[spkid]),
-            np.std(pitch_scalers[spkid]),
-            np.min(pitch_scalers[spkid]),
-            np.max(pitch_scalers[spkid]),
-            np.median(pitch_scalers[spkid]),
-        )
-
-        # total pitch statistics
-        mean_t, std_t, min_t, max_t, median_t = (
-            np.mean(total_pitch_scalers[spkid]),
-            np.std(total_pitch_scalers[spkid]),
-            np.min(total_pitch_scalers[spkid]),
-            np.max(total_pitch_scalers[spkid]),
-            np.median(total_pitch_scalers[spkid]),
-        )
-        sta_dict[singer] = {
-            "voiced_positions": {
-                "mean": mean,
-                "std": std,
-                "median": median,
-                "min": min,
-                "max": max,
-            },
-            "total_positions": {
-                "mean": mean_t,
-                "std": std_t,
-                "median": median_t,
-                "min": min_t,
-                "max": max_t,
-            },
+    specs = {}
+    if mel_min_max:
+        specs["mel"] = {
+            "dir": cfg.preprocess.mel_dir,
+            "reduce": functools.partial(_mel_channels, n_mel=cfg.preprocess.n_mel),
+            "per_speaker": False,
+            "quantiles": False,
         }
-
-    # save statistics
-    with open(os.path.join(save_dir, "statistics.json"), "w") as f:
-        json.dump(sta_dict, f, indent=4, ensure_ascii=False)
-
-
-def cal_energy_statistics(dataset, output_path, cfg):
-    # path of dataset
-    dataset_dir = os.path.join(output_path, dataset)
-    if cfg.preprocess.use_phone_energy:
-        energy_dir = cfg.preprocess.phone_energy_dir
-    else:
-        energy_dir = cfg.preprocess.energy_dir
-    save_dir = os.path.join(dataset_dir, energy_dir)
-    os.makedirs(save_dir, exist_ok=True)
-    print(os.path.join(save_dir, "statistics.json"))
-    if has_existed(os.path.join(save_dir, "statistics.json")):
+    if pitch == "voiced":
+        pitch_dir, voiced = cfg.preprocess.pitch_dir, _non_zero
+    elif pitch == "outlier":
+        if cfg.preprocess.use_phone_pitch:
+            pitch_dir = cfg.preprocess.phone_pitch_dir
+        else:
+            pitch_dir = cfg.preprocess.pitch_dir
+        voiced = remove_outlier if cfg.preprocess.pitch_remove_outlier else None
+    if pitch is not None and not has_existed(
+        os.path.join(dataset_dir, pitch_dir, "statistics.json")
+    ):
+        specs["pitch"] = {
+            "dir": pitch_dir,
+            "reduce": functools.partial(_voiced_and_total, voiced=voiced),
+            "per_speaker": True,
+            "quantiles": True,
+        }
+    if energy:
+        if cfg.preprocess.use_phone_energy:
+            energy_dir = cfg.preprocess.phone_energy_dir
+        else:
+            energy_dir = cfg.preprocess.energy_dir
+        voiced = remove_outlier if cfg.preprocess.energy_remove_outlier else None
+        if not has_existed(os.path.join(dataset_dir, energy_dir, "statistics.json")):
+            specs["energy"] = {
+                "dir": energy_dir,
+                "reduce": functools.partial(_voiced_and_total, voiced=voiced),
+                "per_speaker": True,
+                "quantiles": True,
+            }
+    if len(specs) == 0:
         return
-    # load singers and ids
-    singers = json.load(open(os.path.join(dataset_dir, "singers.json"), "r"))
 
-    # combine train and test metadata
-    metadata = []
-    for dataset_type in ["train", "test"] if "eval" not in dataset else ["test"]:
-        dataset_file = os.path.join(dataset_dir, "{}.json".format(dataset_type))
-        with open(dataset_file, "r") as f:
-            metadata.extend(json.load(f))
+    singers = None
+    if metadata is None:
+        # combine train and test metadata
+        metadata = []
+        for dataset_type in ["train", "test"] if "eval" not in dataset else ["test"]:
+            dataset_file = os.path.join(dataset_dir, "{}.json".format(dataset_type))
+            with open(dataset_file, "r") as f:
+                metadata.extend(json.load(f))
+        if "pitch" in specs or "energy" in specs:
+            with open(os.path.join(dataset_dir, "singers.json"), "r") as f:
+                singers = list(json.load(f).keys())
+    speaker_prefix = replace_augment_name(dataset)
+    utts = [
+        (utt["Uid"], "{}_{}".format(speaker_prefix, utt.get("Singer")))
+        for utt in metadata
+    ]
+    if singers is None:
+        singers = sorted(set(speaker for _, speaker in utts))
+
+    stats = cal_feature_statistics(dataset_dir, utts, specs, n_workers)
 
-    # use different scalers for each singer
-    energy_scalers = [[] for _ in range(len(singers))]
-    total_energy_scalers = [[] for _ in range(len(singers))]
+    if "mel" in specs:
+        mel_stats = stats.get(("mel", None, "channels"))
+        if mel_stats is None:
+            print("No mel features of {} found".format(dataset))
+        else:
+            mel_min_max_dir = os.path.join(
+                dataset_dir, cfg.preprocess.mel_min_max_stats_dir
+            )
+            os.makedirs(mel_min_max_dir, exist_ok=True)
+            np.save(os.path.join(mel_min_max_dir, "mel_min.npy"), mel_stats.min)
+            np.save(os.path.join(mel_min_max_dir, "mel_max.npy"), mel_stats.max)
 
-    for utt_info in metadata:
-        utt = f'{utt_info["Dataset"]}_{utt_info["Uid"]}'
-        singer = utt_info["Singer"]
-        energy_path = os.path.join(dataset_dir, energy_dir, utt_info["Uid"] + ".npy")
-        # total_energy contains all energy including unvoiced frames
-        if not os.path.exists(energy_path):
+    for name in ["pitch", "energy"]:
+        if name not in specs:
             continue
-        total_energy = np.load(energy_path)
-        assert len(total_energy) > 0
-        # energy contains only voiced frames
-        # energy = total_energy[total_energy != 0]
-        if cfg.preprocess.energy_remove_outlier:
-            energy = remove_outlier(total_energy)
-        spkid = singers[f"{replace_augment_name(dataset)}_{singer}"]
-
-        # update energy scalers
-        energy_scalers[spkid].extend(energy.tolist())
-        # update total energyscalers
-        total_energy_scalers[spkid].extend(total_energy.tolist())
-
-    # save energy statistics for each singer in dict
-    sta_dict = {}
-    for singer in singers:
-        spkid = singers[singer]
-        # voiced energy statistics
-        mean, std, min, max, median = (
-            np.mean(energy_scalers[spkid]),
-            np.std(energy_scalers[spkid]),
-            np.min(energy_scalers[spkid]),
-            np.max(energy_scalers[spkid]),
-            np.median(energy_scalers[spkid]),
-        )
+        # statistics for each singer
+        sta_dict = {}
+        for singer in singers:
+            total_stats = stats.get((name, singer, "total_positions"))
+            voiced_stats = stats.get((name, singer, "voiced_positions"), total_stats)
+            sta_dict[singer] = {
+                "voiced_positions": _statistics_dict(voiced_stats),
+                "total_positions": _statistics_dict(total_stats),
+            }
+        save_dir = os.path.join(dataset_dir, specs[name]["dir"])
+        os.makedirs(save_dir, exist_ok=True)
+        with open(os.path.join(save_dir, "statistics.json"), "w") as f:
+            json.dump(sta_dict, f, indent=4, ensure_ascii=False)
+
+
+def cal_feature_statistics(dataset_dir, utts, specs, n_workers=1, chunksize=64):
+    """Accumulate statistics of feature files, reading each file once
 
-        # total energy statistics
-        mean_t, std_t, min_t, max_t, median_t = (
-            np.mean(total_energy_scalers[spkid]),
-            np.std(total_energy_scalers[spkid]),
-            np.min(total_energy_scalers[spkid]),
-            np.max(total_energy_scalers[spkid]),
-            np.median(total_energy_scalers[spkid]),
-        )
-        sta_dict[singer] = {
-            "voiced_positions": {
-                "mean": mean,
-                "std": std,
-                "median": median,
-                "min": min,
-                "max": max,
-            },
-            "total_positions": {
-                "mean": mean_t,
-                "std": std_t,
-                "median": median_t,
-                "min": min_t,
-                "max": max_t,
-            },
-        }
+    Args:
+        dataset_dir (str): directory of the feature directories
+        utts (list): (uid, speaker) of the utterances
+        specs (dict): name -> {"dir": feature directory, "reduce": function mapping a
+            feature to {group: values}, "per_speaker": bool, "quantiles": bool}
+        n_workers (int, optional): num of processes to read features in parallel. Defaults to 1.
+        chunksize (int, optional): num of utterances sent to a worker at once. Defaults to 64.
 
-    # save statistics
-    with open(os.path.join(save_dir, "statistics.json"), "w") as f:
-        json.dump(sta_dict, f, indent=4, ensure_ascii=False)
+    Returns:
+        dict: (name, speaker or None, group) -> RunningStats, reduced over the last
+            axis of the values
+    """
+    # specs sharing a feature directory share the file reads
+    dir_specs = {}
+    for name, spec in specs.items():
+        dir_specs.setdefault(spec["dir"], []).append((name, spec))
+
+    chunks = [
+        (dataset_dir, utts[i : i + chunksize], dir_specs)
+        for i in range(0, len(utts), chunksize)
+    ]
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap_unordered(_feature_statistics_chunk, chunks)
+    else:
+        pool = None
+        results = map(_feature_statistics_chunk, chunks)
+
+    stats = {}
+    for chunk_stats in tqdm(results, total=len(chunks), desc="Feature statistics"):
+        for key, value in chunk_stats.items():
+            if key in stats:
+                stats[key].merge(value)
+            else:
+                stats[key] = value
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return stats
+
+
+def _feature_statistics_chunk(args):
+    dataset_dir, utts, dir_specs = args
+    stats = {}
+    for uid, speaker in utts:
+        for feat_dir, specs in dir_specs.items():
+            feat_path = os.path.join(dataset_dir, feat_dir, uid + ".npy")
+            if not os.path.exists(feat_path):
+                continue
+            feat = np.load(feat_path)
+            for name, spec in specs:
+                for group, values in spec["reduce"](feat).items():
+                    key = (name, speaker if spec["per_speaker"] else None, group)
+                    if key not in stats:
+                        stats[key] = RunningStats(quantiles=spec["quantiles"])
+                    stats[key].update(values)
+    return stats
+
+
+def _mel_channels(mel, n_mel):
+    if mel.shape[0] != n_mel:
+        mel = mel.T
+    # mel: (n_mels, T)
+    assert mel.shape[0] == n_mel
+    return {"channels": mel}
+
+
+def _voiced_and_total(feat, voiced=None):
+    # without a voiced selection, the voiced positions are all the frames
+    values = {"total_positions": feat}
+    if voiced is not None:
+        values["voiced_positions"] = voiced(feat)
+    return values
+
+
+def _non_zero(feat):
+    return feat[feat != 0]
+
+
+def _flatten(feat):
+    return {"values": feat.reshape(-1)}
+
+
+def _statistics_dict(stats):
+    if stats is None or stats.count == 0:
+        return {key: np.nan for key in ["mean", "std", "median", "min", "max"]}
+    return {
+        "mean": float(stats.mean),
+        "std": float(stats.std),
+        "median": float(stats.median),
+        "min": float(stats.min),
+        "max": float(stats.max),
+    }
 
 
 def copy_acoustic_features(metadata, dataset_dir, src_dataset_dir, cfg):
@@ -5,6 +5,8 @@
 
 import os
 import torch
+import torch.nn.functional as F
+import torchaudio
 import numpy as np
 import yaml
 import copy
@@ -15,11 +17,13 @@ from torch.utils.data import DataLoader
 from fairseq import checkpoint_utils
 from transformers import AutoModel, Wav2Vec2FeatureExtractor
 
-from utils.io_optim import (
-    TorchaudioDataset,
-    LibrosaDataset,
-    FFmpegDataset,
-    collate_batch,
+from utils.io import save_npy
+from utils.io_optim import TorchaudioDataset, collate_batch
+from utils.data_utils import average_content_features
+from utils.feature_store import (
+    PackedFeatureWriter,
+    BackgroundSaver,
+    packed_feature_dir,
 )
 import whisper
 from modules.wenet_extractor.utils.init_model import init_model
@@ -34,10 +38,10 @@ from modules.wenet_extractor.utils.checkpoint import load_checkpoint
 
     Pipeline:
         in preprocess.py:
-            call extract_utt_content_features() to extract content features for each utterance
-            extract_utt_content_features() envelopes the following steps:
-                1. load the model (whisper, contentvec, wenet)
-                2. extract the content features
+            call extract_utt_content_features_dataloader() to extract content features for each utterance
+            extract_utt_content_features_dataloader() envelopes the following steps:
+                1. load the models (whisper, contentvec, wenet, mert) to extract with
+                2. decode each batch of waveforms once, and extract all the content features
                 3. save the content features into files
         in svc_dataset.py:
             call offline_align() to align the content features to the given target length
@@ -63,6 +67,8 @@ class BaseExtractor:
         self.cfg = cfg
         self.extractor_type = None
         self.model = None
+        # the largest alignment error logged, read from the log on first use
+        self.align_max_err = None
 
     def offline_align(self, content, target_len):
         """
@@ -72,6 +78,18 @@ class BaseExtractor:
         return:
             mapped_feature: (target_len, dim)
         """
+        return self.offline_align_batch([content], [target_len])[0]
+
+    def offline_align_batch(self, contents, target_lens):
+        """Align the content features of several utterances at once
+
+        args:
+            contents: list of (source_len, dim), numpy arrays or torch tensors on the
+                same device (cpu or gpu)
+            target_lens: list of target lengths
+        return:
+            list of mapped_feature: (target_len, dim)
+        """
         target_hop = self.cfg.preprocess.hop_size
 
         assert self.extractor_type in ["whisper", "contentvec", "wenet"]
@@ -97,47 +115,51 @@ class BaseExtractor:
         source_hop //= factor
         target_hop //= factor
 
-        # (source_len, 256)
-        _, width = content.shape
         # slice the content from padded feature
-        source_len = min(target_len * target_hop // source_hop + 1, len(content))
-
-        # const ~= target_len * target_hop
-        const = source_len * source_hop // target_hop * target_hop
-
-        # (source_len * source_hop, dim)
-        up_sampling_feats = np.repeat(content, source_hop, axis=0)
-        # (const, dim) -> (const/target_hop, target_hop, dim) -> (const/target_hop, dim)
-        down_sampling_feats = np.average(
-            up_sampling_feats[:const].reshape(-1, target_hop, width), axis=1
+        contents = [
+            content[: min(target_len * target_hop // source_hop + 1, len(content))]
+            for content, target_len in zip(contents, target_lens)
+        ]
+        # (source_len * source_hop // target_hop, dim)
+        down_sampling_feats = average_content_features(contents, source_hop, target_hop)
+
+        mapped_features = []
+        for feats, target_len in zip(down_sampling_feats, target_lens):
+            err = abs(target_len - len(feats))
+            if err > 8:
+                self.log_align_err(err)
+
+            if len(feats) < target_len:
+                # (1, dim) -> (err, dim)
+                end = feats[-1:]
+                if isinstance(feats, torch.Tensor):
+                    feats = torch.cat([feats, end.expand(err, -1)], dim=0)
+                else:
+                    feats = np.concatenate([feats, end.repeat(err, axis=0)], axis=0)
+
+            # (target_len, dim)
+            mapped_features.append(feats[:target_len])
+        return mapped_features
+
+    def log_align_err(self, err):
+        """Record the largest alignment error in {processed_dir}/align_max_err.log,
+        which is read once and only rewritten when the error exceeds it"""
+        # err_log_dir is indeterminate
+        err_log_dir = os.path.join(
+            self.cfg.preprocess.processed_dir, "align_max_err.log"
         )
-
-        err = abs(target_len - len(down_sampling_feats))
-        if err > 8:
-            # err_log_dir is indeterminate
-            err_log_dir = os.path.join(
-                self.cfg.preprocess.processed_dir, "align_max_err.log"
-            )
+        if self.align_max_err is None:
             try:
                 with open(err_log_dir, "r") as f:
-                    err_num = int(f.read())
+                    self.align_max_err = int(f.read())
             except:
                 with open(err_log_dir, "w") as f:
                     f.write("0")
-                err_num = 0
-            if err > err_num:
-                with open(err_log_dir, "w") as f:
-                    f.write(str(err))
-
-        if len(down_sampling_feats) < target_len:
-            # (1, dim) -> (err, dim)
-            end = down_sampling_feats[-1][None, :].repeat(err, axis=0)
-            down_sampling_feats = np.concatenate([down_sampling_feats, end], axis=0)
-
-        # (target_len, dim)
-        mapped_feature = down_sampling_feats[:target_len]
-
-        return mapped_feature
+                self.align_max_err = 0
+        if err > self.align_max_err:
+            self.align_max_err = err
+            with open(err_log_dir, "w") as f:
+                f.write(str(err))
 
     def save_feature(self, utt, content_feature):
         """Save a single utternace to path {cfg.preprocess.processed_dir}
@@ -146,15 +168,30 @@ class BaseExtractor:
             utt (dict): one item in metadata, containing information for one utterance
             content_feature (tensor): content feature of one utterance
         """
-        uid = utt["Uid"]
+        save_path = self.feature_path(utt)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        content_feature = self.trim_feature(content_feature, utt["Duration"])
+        np.save(save_path, content_feature)
+
+    def feature_path(self, utt):
+        """The path of the content feature file of a single utterance"""
         assert self.extractor_type != None
-        out_dir = os.path.join(
-            self.cfg.preprocess.processed_dir, utt["Dataset"], self.extractor_type
+        return os.path.join(
+            self.cfg.preprocess.processed_dir,
+            utt["Dataset"],
+            self.extractor_type,
+            utt["Uid"] + ".npy",
         )
-        os.makedirs(out_dir, exist_ok=True)
-        save_path = os.path.join(out_dir, uid + ".npy")
-        # only keep effective parts
-        duration = utt["Duration"]
+
+    def trim_feature(self, content_feature, duration):
+        """Keep the frames of the valid (unpadded) part of a single utterance
+
+        Args:
+            content_feature (tensor): (num_frames, dim) content feature of one utterance
+            duration (float): duration of the utterance in seconds
+        Returns:
+            numpy array: (valid_frames, dim)
+        """
         if self.extractor_type == "whisper":
             frameshift = (
                 self.cfg.preprocess.whisper_frameshift
@@ -178,7 +215,7 @@ class BaseExtractor:
             len(content_feature.shape) == 2
         ), "content feature shape error, it should be (num_frames, dim)"
         content_feature = content_feature[:num_frames, :]
-        np.save(save_path, content_feature.cpu().detach().numpy())
+        return content_feature.cpu().detach().numpy()
 
 
 class WhisperExtractor(BaseExtractor):
@@ -186,6 +223,11 @@ class WhisperExtractor(BaseExtractor):
         super(WhisperExtractor, self).__init__(config)
         self.extractor_type = "whisper"
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # encode the batch padded to its longest utterance instead of to 30s
+        self.variable_length = (
+            "whisper_variable_length" in config.preprocess
+            and config.preprocess.whisper_variable_length
+        )
 
     def load_model(self):
         # load whisper checkpoint
@@ -223,6 +265,22 @@ class WhisperExtractor(BaseExtractor):
             wavs: tensor (batch_size, T)
             lens: list
         """
+        if self.variable_length:
+            # one encoder frame (20ms) more than the longest utterance, at most 30s
+            frame_samples = whisper.audio.HOP_LENGTH * 2
+            num_samples = min(
+                (max(lens) // frame_samples + 2) * frame_samples,
+                whisper.audio.N_SAMPLES,
+            )
+            # wavs: (batch, num_samples)
+            wavs = whisper.pad_or_trim(wavs, num_samples)
+            # batch_mel: (batch, 80, num_samples // 160)
+            batch_mel = whisper.log_mel_spectrogram(wavs, device=self.model.device)
+            with torch.no_grad():
+                # (batch, num_samples // 320, 1024)
+                features = self.encode_variable_length(batch_mel)
+            return features
+
         # wavs: (batch, max_len)
         wavs = whisper.pad_or_trim(wavs)
         # batch_mel: (batch, 80, 3000)
@@ -232,6 +290,24 @@ class WhisperExtractor(BaseExtractor):
             features = self.model.embed_audio(batch_mel)
         return features
 
+    def encode_variable_length(self, batch_mel):
+        """The forward of the whisper encoder for mels of up to 3000 frames, which adds
+        the first positional embeddings only instead of requiring exactly 3000 frames
+
+        Args:
+            batch_mel: tensor (batch, n_mels, n_frames)
+        Returns:
+            tensor (batch, n_frames // 2, dim)
+        """
+        encoder = self.model.encoder
+        x = F.gelu(encoder.conv1(batch_mel))
+        x = F.gelu(encoder.conv2(x))
+        x = x.permute(0, 2, 1)
+        x = (x + encoder.positional_embedding[: x.shape[1]]).to(x.dtype)
+        for block in encoder.blocks:
+            x = block(x)
+        return encoder.ln_post(x)
+
 
 class ContentvecExtractor(BaseExtractor):
     def __init__(self, cfg):
@@ -405,15 +481,15 @@ class MertExtractor(BaseExtractor):
             )
             mert_features = []
             # wav: (len)
-            for wav in wavs:
+            for wav, length in zip(wavs, lens):
                 # {input_values: tensor, attention_mask: tensor}
                 inputs = self.preprocessor(
-                    wavs, sampling_rate=sample_rate, return_tensors="pt"
+                    wav[:length].cpu().numpy(),
+                    sampling_rate=sample_rate,
+                    return_tensors="pt",
                 ).to(device)
 
                 outputs = self.model(**inputs, output_hidden_states=True)
-                # (25 layers, time steps, 1024 feature_dim)
-                all_layer_hidden_states = torch.stack(outputs.hidden_states).squeeze()
                 # (1, frame_len, 1024) -> (frame_len, 1024)
                 feature = outputs.hidden_states[
                     self.cfg.preprocess.mert_feature_layer
@@ -423,140 +499,146 @@ class MertExtractor(BaseExtractor):
         return mert_features
 
 
+# the extractor of each content feature, in the order of extraction
+CONTENT_EXTRACTORS = {
+    "whisper": WhisperExtractor,
+    "contentvec": ContentvecExtractor,
+    "wenet": WenetExtractor,
+    "mert": MertExtractor,
+}
+
+
 def extract_utt_content_features_dataloader(cfg, metadata, num_workers):
+    """Extract the enabled content features of the utterances of metadata in one pass:
+    each batch is decoded once (at the highest sample rate of the extractors, and
+    resampled for the others) and fed to every extractor
+
+    The features are saved in the background, either as one file per utterance, or,
+    with cfg.preprocess.pack_content_features, appended to the packed store of each
+    feature (see utils.feature_store). The utterances whose feature file exists, or
+    which are in a complete shard of the store, are not extracted again.
+
+    Args:
+        cfg (dict): dictionary that stores configurations
+        metadata (list): the utterances of a dataset
+        num_workers (int): num of processes to decode the waveforms
+    """
     dataset_name = metadata[0]["Dataset"]
-    with torch.no_grad():
-        if cfg.preprocess.extract_whisper_feature:
-            feat_dir = os.path.join(
-                cfg.preprocess.processed_dir, dataset_name, "whisper"
+    dataset_dir = os.path.join(cfg.preprocess.processed_dir, dataset_name)
+    pack = (
+        "pack_content_features" in cfg.preprocess
+        and cfg.preprocess.pack_content_features
+    )
+
+    extractors = []
+    todo_uids = {}
+    writers = {}
+    for extractor_type, extractor_class in CONTENT_EXTRACTORS.items():
+        if not cfg.preprocess["extract_{}_feature".format(extractor_type)]:
+            continue
+        extractor = extractor_class(cfg)
+
+        if pack:
+            writer = PackedFeatureWriter(
+                packed_feature_dir(dataset_dir, extractor_type),
+                [extractor_type],
+                resume=True,
+                background=True,
+                bytes_per_shard=cfg.preprocess.content_feature_shard_mb << 20,
             )
-            os.makedirs(feat_dir, exist_ok=True)
-            feat_files_num = len(os.listdir(feat_dir))
-
-            if feat_files_num != len(metadata):
-                whisper_waveforms = FFmpegDataset(
-                    cfg,
-                    dataset_name,
-                    cfg.preprocess.whisper_sample_rate,
-                    metadata=metadata,
-                )
-                data_loader = DataLoader(
-                    whisper_waveforms,
-                    num_workers=num_workers,
-                    shuffle=False,
-                    pin_memory=cfg.preprocess.pin_memory,
-                    batch_size=cfg.preprocess.content_feature_batch_size,
-                    collate_fn=collate_batch,
-                    drop_last=False,
-                )
-                extractor = WhisperExtractor(cfg)
-                extractor.load_model()
-                for batch_idx, items in enumerate(tqdm(data_loader)):
-                    _metadata, wavs, lens = items
-
-                    batch_content_features = extractor.extract_content_features(
-                        wavs,
-                        lens,
-                    )
-                    for index, utt in enumerate(_metadata):
-                        extractor.save_feature(utt, batch_content_features[index])
-
-        if cfg.preprocess.extract_contentvec_feature:
-            feat_dir = os.path.join(
-                cfg.preprocess.processed_dir, dataset_name, "contentvec"
+            todo = {utt["Uid"] for utt in metadata if utt["Uid"] not in writer}
+        else:
+            os.makedirs(os.path.join(dataset_dir, extractor_type), exist_ok=True)
+            todo = {
+                utt["Uid"]
+                for utt in metadata
+                if not os.path.exists(extractor.feature_path(utt))
+            }
+        print(
+            "Extracting {} features of {} utterances, {} already extracted".format(
+                extractor_type, len(todo), len(metadata) - len(todo)
             )
-            os.makedirs(feat_dir, exist_ok=True)
-            feat_files_num = len(os.listdir(feat_dir))
-
-            if feat_files_num != len(metadata):
-                contentvec_waveforms = LibrosaDataset(
-                    cfg,
-                    dataset_name,
-                    cfg.preprocess.contentvec_sample_rate,
-                    metadata=metadata,
-                )
-                data_loader = DataLoader(
-                    contentvec_waveforms,
-                    num_workers=num_workers,
-                    shuffle=False,
-                    pin_memory=cfg.preprocess.pin_memory,
-                    batch_size=cfg.preprocess.content_feature_batch_size,
-                    collate_fn=collate_batch,
-                    drop_last=False,
-                )
-                extractor = ContentvecExtractor(cfg)
-                extractor.load_model()
-                for batch_idx, items in enumerate(tqdm(data_loader)):
-                    _metadata, wavs, lens = items
+        )
 
-                    batch_content_features = extractor.extract_content_features(
-                        wavs, lens
-                    )
-                    for index, utt in enumerate(_metadata):
-                        extractor.save_feature(utt, batch_content_features[index])
-
-        if cfg.preprocess.extract_wenet_feature:
-            feat_dir = os.path.join(cfg.preprocess.processed_dir, dataset_name, "wenet")
-            os.makedirs(feat_dir, exist_ok=True)
-            feat_files_num = len(os.listdir(feat_dir))
-
-            if feat_files_num != len(metadata):
-                wenet_waveforms = TorchaudioDataset(
-                    cfg,
-                    dataset_name,
-                    cfg.preprocess.wenet_sample_rate,
-                    metadata=metadata,
-                )
-                data_loader = DataLoader(
-                    wenet_waveforms,
-                    num_workers=num_workers,
-                    shuffle=False,
-                    pin_memory=cfg.preprocess.pin_memory,
-                    batch_size=cfg.preprocess.content_feature_batch_size,
-                    collate_fn=collate_batch,
-                    drop_last=False,
-                )
-                extractor = WenetExtractor(cfg)
-                extractor.load_model()
-                for batch_idx, items in enumerate(tqdm(data_loader)):
-                    _metadata, wavs, lens = items
-
-                    batch_content_features = extractor.extract_content_features(
-                        wavs,
-                        lens,
+        if len(todo) > 0:
+            extractors.append(extractor)
+            todo_uids[extractor_type] = todo
+            if pack:
+                writers[extractor_type] = writer
+        elif pack:
+            # write the index of a store whose shards were all written before
+            writer.close()
+    if len(extractors) == 0:
+        return
+
+    sample_rates = {
+        extractor.extractor_type: cfg.preprocess[
+            "{}_sample_rate".format(extractor.extractor_type)
+        ]
+        for extractor in extractors
+    }
+    sample_rate = max(sample_rates.values())
+    todo_metadata = [
+        utt
+        for utt in metadata
+        if any(utt["Uid"] in todo for todo in todo_uids.values())
+    ]
+    waveforms = TorchaudioDataset(
+        cfg,
+        dataset_name,
+        sample_rate,
+        # batch the utterances of similar lengths together to reduce the padding
+        metadata=sorted(todo_metadata, key=lambda utt: utt["Duration"]),
+    )
+    data_loader = DataLoader(
+        waveforms,
+        num_workers=num_workers,
+        shuffle=False,
+        pin_memory=cfg.preprocess.pin_memory,
+        batch_size=cfg.preprocess.content_feature_batch_size,
+        collate_fn=collate_batch,
+        drop_last=False,
+    )
+    for extractor in extractors:
+        extractor.load_model()
+
+    saver = BackgroundSaver()
+    with torch.no_grad():
+        for batch_idx, items in enumerate(tqdm(data_loader)):
+            _metadata, wavs, lens = items
+
+            for extractor in extractors:
+                extractor_type = extractor.extractor_type
+                extractor_sample_rate = sample_rates[extractor_type]
+                if extractor_sample_rate != sample_rate:
+                    extractor_wavs = torchaudio.functional.resample(
+                        wavs, sample_rate, extractor_sample_rate
                     )
-                    for index, utt in enumerate(_metadata):
-                        extractor.save_feature(utt, batch_content_features[index])
-
-        if cfg.preprocess.extract_mert_feature:
-            feat_dir = os.path.join(cfg.preprocess.processed_dir, dataset_name, "mert")
-            os.makedirs(feat_dir, exist_ok=True)
-            feat_files_num = len(os.listdir(feat_dir))
-
-            if feat_files_num != len(metadata):
-                mert_waveforms = TorchaudioDataset(
-                    cfg,
-                    dataset_name,
-                    cfg.preprocess.mert_sample_rate,
-                    metadata=metadata,
-                )
-                data_loader = DataLoader(
-                    mert_waveforms,
-                    num_workers=num_workers,
-                    shuffle=False,
-                    pin_memory=cfg.preprocess.pin_memory,
-                    batch_size=cfg.preprocess.content_feature_batch_size,
-                    collate_fn=collate_batch,
-                    drop_last=False,
+                    extractor_lens = [
+                        int(np.ceil(length * extractor_sample_rate / sample_rate))
+                        for length in lens
+                    ]
+                else:
+                    extractor_wavs, extractor_lens = wavs, lens
+
+                batch_content_features = extractor.extract_content_features(
+                    extractor_wavs,
+                    extractor_lens,
                 )
-                extractor = MertExtractor(cfg)
-                extractor.load_model()
-                for batch_idx, items in enumerate(tqdm(data_loader)):
-                    _metadata, wavs, lens = items
-
-                    batch_content_features = extractor.extract_content_features(
-                        wavs,
-                        lens,
+                for index, utt in enumerate(_metadata):
+                    if utt["Uid"] not in todo_uids[extractor_type]:
+                        continue
+                    content_feature = extractor.trim_feature(
+                        batch_content_features[index], utt["Duration"]
                     )
-                    for index, utt in enumerate(_metadata):
-                        extractor.save_feature(utt, batch_content_features[index])
+                    if pack:
+                        writers[extractor_type].add(
+                            utt["Uid"], **{extractor_type: content_feature}
+                        )
+                    else:
+                        saver.submit(
+                            save_npy, extractor.feature_path(utt), content_feature
+                        )
+    saver.close()
+    for writer in writers.values():
+        writer.close()
@@ -0,0 +1,121 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""The sampling with the step-invariant condition cache (cache_condition) matches
+the uncached sampling, for every ODE solver and both diffusion estimators."""
+
+import pytest
+import torch
+
+from models.tts.vc.ns2_uniamphion import (
+    Diffusion,
+    DiffTransformer,
+    DiffWaveNet,
+    JsonHParams,
+)
+
+HIDDEN = 32
+
+
+def build_estimator(diff_model_type):
+    if diff_model_type == "WaveNet":
+        return DiffWaveNet(
+            cfg=JsonHParams(
+                input_size=8,
+                hidden_size=HIDDEN,
+                out_size=8,
+                num_layers=6,
+                cross_attn_per_layer=3,
+                dilation_cycle=2,
+                attn_head=4,
+                drop_out=0.2,
+            )
+        )
+    return DiffTransformer(
+        encoder_layer=2,
+        encoder_hidden=HIDDEN,
+        encoder_head=4,
+        conv_filter_size=64,
+        conv_kernel_size=3,
+        encoder_dropout=0.2,
+        use_cln=True,
+        use_skip_connection=False,
+        use_new_ffn=True,
+        add_diff_step=True,
+        cat_diff_step=False,
+        in_dim=8,
+        out_dim=8,
+        cond_dim=HIDDEN,
+    )
+
+
+def build_diffusion(diff_model_type, cache_condition):
+    torch.manual_seed(0)
+    estimator = build_estimator(diff_model_type)
+    # the output projection of DiffWaveNet is zero-initialized
+    for parameter in estimator.parameters():
+        if (parameter == 0).all():
+            torch.nn.init.normal_(parameter, std=0.1)
+    cfg = JsonHParams(
+        beta_min=0.05,
+        beta_max=20,
+        sigma=1.0,
+        noise_factor=1.0,
+        ode_solve_method="euler",
+        time_schedule="uniform",
+        ode_rtol=1e-3,
+        ode_atol=1e-3,
+        cache_condition=cache_condition,
+    )
+    # float64, so that the adaptive steps of rk45 do not amplify rounding errors
+    return Diffusion(cfg, estimator).double().eval()
+
+
+def sample(diffusion, ode_solve_method):
+    generator = torch.Generator().manual_seed(1)
+    z = torch.randn(2, 12, 8, generator=generator, dtype=torch.float64)
+    condition = torch.randn(2, 12, HIDDEN, generator=generator, dtype=torch.float64)
+    reference = torch.randn(2, 5, HIDDEN, generator=generator, dtype=torch.float64)
+    x_mask = torch.ones(2, 12, dtype=torch.float64)
+    x_mask[1, 9:] = 0
+    if ode_solve_method == "from_t":
+        return diffusion.reverse_diffusion_from_t(
+            z, condition, x_mask, reference, n_timesteps=4, t_start=0.6
+        )
+    return diffusion.reverse_diffusion(
+        z, condition, x_mask, reference, 4, ode_solve_method=ode_solve_method
+    )
+
+
+@pytest.mark.parametrize("diff_model_type", ["WaveNet", "Transformer"])
+@pytest.mark.parametrize(
+    "ode_solve_method", ["euler", "midpoint", "heun", "dpm_solver", "rk45", "from_t"]
+)
+def test_cached_sampling_matches_uncached(diff_model_type, ode_solve_method):
+    cached = build_diffusion(diff_model_type, cache_condition=True)
+    uncached = build_diffusion(diff_model_type, cache_condition=False)
+
+    precompute = cached.diff_estimator.precompute
+    calls = []
+
+    def counted_precompute(*args):
+        calls.append(args)
+        return precompute(*args)
+
+    cached.diff_estimator.precompute = counted_precompute
+
+    expected = sample(uncached, ode_solve_method)
+    result = sample(cached, ode_solve_method)
+
+    assert len(calls) == 1
+    assert cached.nfe == uncached.nfe
+    assert cached.estimator_cache is None
+    torch.testing.assert_close(result, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_cache_is_opt_in():
+    diffusion = build_diffusion("WaveNet", cache_condition=False)
+    del diffusion.cfg.cache_condition
+    assert not Diffusion(diffusion.cfg, diffusion.diff_estimator).use_condition_cache
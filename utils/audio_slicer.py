@@ -441,11 +441,22 @@ def merge_segments_encodec(wav_files, fs, output_path, overlap_duration=1.0):
         save_audio(output_path, waveforms[0], fs, add_silence=False, turn_up=False)
         return
 
+    merged_waveform = merge_waveforms_encodec(waveforms, int(overlap_duration * fs))
+    save_audio(output_path, merged_waveform, fs, add_silence=False, turn_up=True)
+
+
+def merge_waveforms_encodec(waveforms, overlap_len):
+    """Merge in-memory segments (may have overlaps) with the triangular weights of Encodec
+
+    waveforms:
+        A list of (T,) tensors.
+    overlap_len:
+        The number of overlapping samples of each segment with its next segment.
+    """
     device = waveforms[0].device
     dtype = waveforms[0].dtype
     shape = waveforms[0].shape[:-1]
 
-    overlap_len = int(overlap_duration * fs)
     segments_lens = [len(wav) for wav in waveforms]
     merged_waveform_len = sum(segments_lens) - overlap_len * (len(waveforms) - 1)
 
@@ -472,5 +483,4 @@ def merge_segments_encodec(wav_files, fs, output_path, overlap_duration=1.0):
         offset += frame_length - overlap_len
 
     assert sum_weight.min() > 0
-    merged_waveform = out / sum_weight
-    save_audio(output_path, merged_waveform, fs, add_silence=False, turn_up=True)
+    return out / sum_weight
@@ -5,8 +5,10 @@
 
 import json
 import os
+from functools import lru_cache
 
 import numpy as np
+import torch
 from scipy.interpolate import interp1d
 from tqdm import tqdm
 from sklearn.preprocessing import StandardScaler
@@ -483,6 +485,85 @@ def align_length(feature, target_len, pad_value=0.0):
     return feature
 
 
+@lru_cache(maxsize=None)
+def frame_average_kernel(source_hop, target_hop):
+    """The source frames and weights averaged into each target frame, when frames of
+    source_hop samples are mapped to frames of target_hop samples (coprime hops).
+
+    Target frame j averages the samples [j * target_hop, (j + 1) * target_hop), so
+    each source frame weighs its overlap with them. The pattern repeats every
+    source_hop target frames, shifted by target_hop source frames, so only the first
+    source_hop target frames are computed.
+
+    Returns:
+        index: (source_hop, width) source frames of target frames 0..source_hop-1
+        weights: (source_hop, width)
+    """
+    width = (target_hop - 1) // source_hop + 2
+    target = np.arange(source_hop)[:, None]
+    index = target * target_hop // source_hop + np.arange(width)[None, :]
+    overlap = np.minimum((index + 1) * source_hop, (target + 1) * target_hop)
+    overlap -= np.maximum(index * source_hop, target * target_hop)
+    weights = np.clip(overlap, 0, None) / target_hop
+    return index, weights
+
+
+def average_content_features(features, source_hop, target_hop):
+    """Map content features of frame hop source_hop to frame hop target_hop.
+
+    Equals np.average(np.repeat(feature, source_hop, axis=0)[:const].reshape(-1,
+    target_hop, dim), axis=1) for each feature, but gathers the (at most a few)
+    source frames of each target frame instead of upsampling, and processes all the
+    features at once.
+
+    Args:
+        features: list of (source_len, dim) numpy arrays, or torch tensors on the same
+            device
+        source_hop (int): hop size of the source frames, in samples
+        target_hop (int): hop size of the target frames, in samples
+    Returns:
+        list of (source_len * source_hop // target_hop, dim), of the type of features
+    """
+    factor = np.gcd(source_hop, target_hop)
+    source_hop //= factor
+    target_hop //= factor
+    kernel_index, kernel_weights = frame_average_kernel(source_hop, target_hop)
+
+    indexes, weights, output_lens = [], [], []
+    offset = 0
+    for feature in features:
+        source_len = len(feature)
+        output_len = source_len * source_hop // target_hop
+        target = np.arange(output_len)
+        index = (target // source_hop * target_hop)[:, None] + kernel_index[
+            target % source_hop
+        ]
+        # the frames past the end of the last target frames have a zero weight
+        indexes.append(np.minimum(index, source_len - 1) + offset)
+        weights.append(kernel_weights[target % source_hop])
+        output_lens.append(output_len)
+        offset += source_len
+    index = np.concatenate(indexes)
+    weights = np.concatenate(weights)
+
+    if isinstance(features[0], torch.Tensor):
+        source = torch.cat(list(features))
+        index = torch.from_numpy(index).to(source.device)
+        weights = torch.from_numpy(weights).to(source)
+    else:
+        source = np.concatenate(features)
+        weights = weights.astype(source.dtype)
+
+    # (sum(output_lens), dim)
+    output = weights[:, 0, None] * source[index[:, 0]]
+    for k in range(1, index.shape[1]):
+        output += weights[:, k, None] * source[index[:, k]]
+
+    if isinstance(output, torch.Tensor):
+        return list(torch.split(output, output_lens))
+    return np.split(output, np.cumsum(output_lens)[:-1])
+
+
 def align_whisper_feauture_length(
     feature, target_len, fast_mapping=True, source_hop=320, target_hop=256
 ):
@@ -498,8 +579,6 @@ def align_whisper_feauture_length(
     max_source_len = 1500
     target_len = min(target_len, max_source_len * source_hop // target_hop)
 
-    width = feature.shape[-1]
-
     if fast_mapping:
         source_len = target_len * target_hop // source_hop + 1
         feature = feature[:source_len]
@@ -507,15 +586,10 @@ def align_whisper_feauture_length(
     else:
         source_len = max_source_len
 
-    # const ~= target_len * target_hop
-    const = source_len * source_hop // target_hop * target_hop
-
-    # (source_len * source_hop, dim)
-    up_sampling_feats = np.repeat(feature, source_hop, axis=0)
-    # (const, dim) -> (const/target_hop, target_hop, dim) -> (const/target_hop, dim)
-    down_sampling_feats = np.average(
-        up_sampling_feats[:const].reshape(-1, target_hop, width), axis=1
-    )
+    # (source_len * source_hop // target_hop, dim)
+    down_sampling_feats = average_content_features(
+        [feature[:source_len]], source_hop, target_hop
+    )[0]
     assert len(down_sampling_feats) >= target_len
 
     # (target_len, dim)
@@ -534,24 +608,13 @@ def align_content_feature_length(feature, target_len, source_hop=320, target_hop
     #     )
     # )
 
-    # (source_len, 256)
-    source_len, width = feature.shape
-
-    # const ~= target_len * target_hop
-    const = source_len * source_hop // target_hop * target_hop
-
-    # (source_len * source_hop, dim)
-    up_sampling_feats = np.repeat(feature, source_hop, axis=0)
-    # (const, dim) -> (const/target_hop, target_hop, dim) -> (const/target_hop, dim)
-    down_sampling_feats = np.average(
-        up_sampling_feats[:const].reshape(-1, target_hop, width), axis=1
-    )
+    # (source_len * source_hop // target_hop, dim)
+    down_sampling_feats = average_content_features([feature], source_hop, target_hop)[0]
 
     err = abs(target_len - len(down_sampling_feats))
     if err > 4:  ## why 4 not 3?
         print("target_len:", target_len)
         print("raw feature:", feature.shape)
-        print("up_sampling:", up_sampling_feats.shape)
         print("down_sampling_feats:", down_sampling_feats.shape)
         exit()
     if len(down_sampling_feats) < target_len:
@@ -0,0 +1,326 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class PackedFeatureWriter(object):
+    """Write the features of many utterances into a few large shards.
+
+    Each feature (e.g. code, pitch, duration, phone_id) of the utterances of a shard
+    is concatenated along its first axis into one ``.npy`` file, and ``index.npz``
+    keeps the shard and the [start, end) rows of every feature of every utterance,
+    so that ``PackedFeatureReader`` can memory-map the shards and slice them.
+
+    Each shard also gets its own ``index.npz``, written last, which marks it complete:
+    with ``resume``, the utterances of the complete shards of a previous (interrupted)
+    run are kept, ``uid in writer`` tells whether an utterance is already packed, and
+    the new shards follow them. With ``background``, the shards are written by a
+    thread while the next one is filled.
+
+    A shard is written once it holds ``utts_per_shard`` utterances or, if
+    ``bytes_per_shard`` is set, ``bytes_per_shard`` bytes of features, which bounds
+    the memory of the buffered shards (two of them with ``background``).
+
+    Usage:
+        with PackedFeatureWriter(output_dir, ["code", "pitch"]) as writer:
+            for uid, code, pitch in ...:
+                writer.add(uid, code=code.T, pitch=pitch)
+    """
+
+    def __init__(
+        self,
+        output_dir,
+        feature_names,
+        utts_per_shard=10000,
+        resume=False,
+        background=False,
+        bytes_per_shard=None,
+    ):
+        self.output_dir = output_dir
+        self.feature_names = list(feature_names)
+        self.utts_per_shard = utts_per_shard
+        self.bytes_per_shard = bytes_per_shard
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.uids = []
+        self.shards = []
+        self.offsets = []
+        self.num_shards = 0
+        if resume:
+            self._load_shards()
+        self.packed = set(self.uids)
+
+        self.executor = ThreadPoolExecutor(1) if background else None
+        self.pending = None
+        self._new_shard()
+
+    @staticmethod
+    def shard_dir(output_dir, shard):
+        return os.path.join(output_dir, "shard_{:05d}".format(shard))
+
+    def _load_shards(self):
+        """Load the index of the complete shards of a previous run"""
+        features_file = os.path.join(self.output_dir, "features.json")
+        if os.path.exists(features_file):
+            with open(features_file, "r") as f:
+                assert json.load(f)["features"] == self.feature_names
+        while True:
+            shard_dir = self.shard_dir(self.output_dir, self.num_shards)
+            if not os.path.exists(os.path.join(shard_dir, "index.npz")):
+                break
+            index = np.load(os.path.join(shard_dir, "index.npz"))
+            self.uids.extend(index["uids"].tolist())
+            self.shards.extend([self.num_shards] * len(index["uids"]))
+            self.offsets.extend(index["offsets"].tolist())
+            self.num_shards += 1
+
+    def _new_shard(self):
+        self.buffer = {name: [] for name in self.feature_names}
+        self.buffer_rows = {name: 0 for name in self.feature_names}
+        self.buffer_utts = 0
+        self.buffer_bytes = 0
+
+    def __contains__(self, uid):
+        return uid in self.packed
+
+    def add(self, uid, **features):
+        """Add an utterance, the features are split on their first axis"""
+        assert set(features.keys()) == set(self.feature_names), features.keys()
+        assert uid not in self.packed, "{} is already packed".format(uid)
+        offsets = []
+        for name in self.feature_names:
+            feature = np.asarray(features[name])
+            self.buffer[name].append(feature)
+            self.buffer_bytes += feature.nbytes
+            start = self.buffer_rows[name]
+            self.buffer_rows[name] += len(feature)
+            offsets += [start, self.buffer_rows[name]]
+
+        self.uids.append(uid)
+        self.shards.append(self.num_shards)
+        self.offsets.append(offsets)
+        self.packed.add(uid)
+        self.buffer_utts += 1
+        if self.buffer_utts >= self.utts_per_shard or (
+            self.bytes_per_shard is not None
+            and self.buffer_bytes >= self.bytes_per_shard
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.buffer_utts == 0:
+            return
+        args = (
+            self.num_shards,
+            self.buffer,
+            self.uids[-self.buffer_utts :],
+            self.offsets[-self.buffer_utts :],
+        )
+        self.num_shards += 1
+        self._new_shard()
+
+        if self.executor is None:
+            self._write_shard(*args)
+        else:
+            # at most one shard is being written while the next one is filled
+            self.wait()
+            self.pending = self.executor.submit(self._write_shard, *args)
+
+    def _write_shard(self, shard, buffer, uids, offsets):
+        shard_dir = self.shard_dir(self.output_dir, shard)
+        os.makedirs(shard_dir, exist_ok=True)
+        for name in self.feature_names:
+            np.save(
+                os.path.join(shard_dir, name + ".npy"),
+                np.concatenate(buffer[name], axis=0),
+            )
+        # the shard is complete once its index is written
+        np.savez(
+            os.path.join(shard_dir, "index.npz"),
+            uids=np.array(uids),
+            offsets=np.array(offsets, dtype=np.int64),
+        )
+
+    def wait(self):
+        """Wait for the shard being written in the background"""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.flush()
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+        np.savez(
+            os.path.join(self.output_dir, "index.npz"),
+            uids=np.array(self.uids),
+            shards=np.array(self.shards, dtype=np.int32),
+            offsets=np.array(self.offsets, dtype=np.int64).reshape(
+                -1, 2 * len(self.feature_names)
+            ),
+        )
+        with open(os.path.join(self.output_dir, "features.json"), "w") as f:
+            json.dump(
+                {"features": self.feature_names, "num_shards": self.num_shards},
+                f,
+                indent=4,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the complete shards for resuming
+            self.wait()
+
+
+class PackedFeatureReader(object):
+    """Zero-copy access to the features written by ``PackedFeatureWriter``.
+
+    The shards are memory-mapped on first use in each process (so the reader can be
+    created before the DataLoader workers are forked), and ``get`` returns read-only
+    views into them. Copy a feature before modifying it in place.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "features.json"), "r") as f:
+            info = json.load(f)
+        self.feature_names = info["features"]
+        self.num_shards = info["num_shards"]
+
+        index = np.load(os.path.join(store_dir, "index.npz"))
+        self.shards = index["shards"]
+        self.offsets = index["offsets"]
+        self.uid2index = {uid: i for i, uid in enumerate(index["uids"].tolist())}
+        self._mmaps = {}
+
+    def __contains__(self, uid):
+        return uid in self.uid2index
+
+    def __len__(self):
+        return len(self.uid2index)
+
+    def _shard(self, shard, name):
+        key = (shard, name)
+        if key not in self._mmaps:
+            shard_dir = PackedFeatureWriter.shard_dir(self.store_dir, shard)
+            self._mmaps[key] = np.load(
+                os.path.join(shard_dir, name + ".npy"), mmap_mode="r"
+            )
+        return self._mmaps[key]
+
+    def get(self, uid, names=None):
+        """Return a dict of the features of uid"""
+        index = self.uid2index[uid]
+        shard = self.shards[index]
+        offsets = self.offsets[index]
+
+        features = {}
+        for i, name in enumerate(self.feature_names):
+            if names is not None and name not in names:
+                continue
+            start, end = offsets[2 * i], offsets[2 * i + 1]
+            features[name] = self._shard(shard, name)[start:end]
+        return features
+
+    def __getstate__(self):
+        # the memory maps are reopened in the worker processes
+        state = self.__dict__.copy()
+        state["_mmaps"] = {}
+        return state
+
+
+def packed_feature_dir(dataset_dir, feature_dir):
+    """Directory of the packed store of the per-utterance features of feature_dir"""
+    return os.path.join(dataset_dir, feature_dir + "_packed")
+
+
+class UtteranceFeatures(object):
+    """One feature of the utterances of metadata, by utt ("{dataset}_{uid}").
+
+    The feature of an utterance is read from the packed store of its dataset
+    (``packed_feature_dir``) when it holds the utterance, and from the
+    ``{processed_dir}/{dataset}/{feature_dir}/{uid}.npy`` file otherwise.
+    """
+
+    def __init__(self, metadata, processed_dir, feature_dir):
+        self.utt2path = {}
+        self.utt2packed = {}
+
+        readers = {}
+        for utt_info in metadata:
+            dataset = utt_info["Dataset"]
+            uid = utt_info["Uid"]
+            utt = "{}_{}".format(dataset, uid)
+
+            if dataset not in readers:
+                store_dir = packed_feature_dir(
+                    os.path.join(processed_dir, dataset), feature_dir
+                )
+                if os.path.exists(os.path.join(store_dir, "index.npz")):
+                    readers[dataset] = PackedFeatureReader(store_dir)
+                else:
+                    readers[dataset] = None
+            reader = readers[dataset]
+
+            if reader is not None and uid in reader:
+                self.utt2packed[utt] = (reader, uid)
+            else:
+                self.utt2path[utt] = os.path.join(
+                    processed_dir, dataset, feature_dir, uid + ".npy"
+                )
+
+    def __getitem__(self, utt):
+        if utt in self.utt2packed:
+            reader, uid = self.utt2packed[utt]
+            # the only feature of the store
+            return reader.get(uid)[reader.feature_names[0]]
+        return np.load(self.utt2path[utt])
+
+
+class BackgroundSaver(object):
+    """Run the saving of per-utterance features (e.g. ``np.save``) in a thread, so that
+    the extraction does not wait for the filesystem. At most ``max_pending`` saves are
+    queued, and the errors are raised in the caller.
+
+    Usage:
+        with BackgroundSaver() as saver:
+            for uid, feature in ...:
+                saver.submit(np.save, path, feature)
+    """
+
+    def __init__(self, max_pending=256):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = collections.deque()
+
+    def submit(self, func, *args, **kwargs):
+        self.pending.append(self.executor.submit(func, *args, **kwargs))
+        while len(self.pending) > self.max_pending or (
+            len(self.pending) > 0 and self.pending[0].done()
+        ):
+            self.pending.popleft().result()
+
+    def close(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
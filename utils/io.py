@@ -30,6 +30,15 @@ def save_feature(process_dir, feature_dir, item, feature, overrides=True):
         np.save(out_path, feature)
 
 
+def save_npy(out_path, feature):
+    """np.save to a temporary file renamed to out_path, so that an interrupted run
+    never leaves a partial feature file"""
+    tmp_path = "{}.{}.tmp".format(out_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, feature)
+    os.replace(tmp_path, out_path)
+
+
 def save_txt(process_dir, feature_dir, item, feature, overrides=True):
     process_dir = os.path.join(process_dir, feature_dir)
     os.makedirs(process_dir, exist_ok=True)
@@ -57,19 +57,7 @@ def mel_spectrogram_torch(y, cfg, center=False):
     if torch.max(y) > 1.0:
         print("max value is ", torch.max(y))
 
-    global mel_basis, hann_window
-    if cfg.fmax not in mel_basis:
-        mel = librosa_mel_fn(
-            sr=cfg.sample_rate,
-            n_fft=cfg.n_fft,
-            n_mels=cfg.n_mel,
-            fmin=cfg.fmin,
-            fmax=cfg.fmax,
-        )
-        mel_basis[str(cfg.fmax) + "_" + str(y.device)] = (
-            torch.from_numpy(mel).float().to(y.device)
-        )
-        hann_window[str(y.device)] = torch.hann_window(cfg.win_size).to(y.device)
+    mel_filter, window = get_mel_basis(cfg, y.device)
 
     y = torch.nn.functional.pad(
         y.unsqueeze(1),
@@ -83,7 +71,7 @@ def mel_spectrogram_torch(y, cfg, center=False):
         cfg.n_fft,
         hop_length=cfg.hop_size,
         win_length=cfg.win_size,
-        window=hann_window[str(y.device)],
+        window=window,
         center=center,
         pad_mode="reflect",
         normalized=False,
@@ -94,7 +82,7 @@ def mel_spectrogram_torch(y, cfg, center=False):
     spec = torch.view_as_real(spec)
     spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
 
-    spec = torch.matmul(mel_basis[str(cfg.fmax) + "_" + str(y.device)], spec)
+    spec = torch.matmul(mel_filter, spec)
     spec = spectral_normalize_torch(spec)
 
     return spec
@@ -104,6 +92,24 @@ mel_basis = {}
 hann_window = {}
 
 
+def get_mel_basis(cfg, device):
+    """Mel filterbank and STFT window of cfg, built once per process and device"""
+    key = "{}_{}_{}_{}_{}_{}_{}".format(
+        cfg.sample_rate, cfg.n_fft, cfg.n_mel, cfg.fmin, cfg.fmax, cfg.win_size, device
+    )
+    if key not in mel_basis:
+        mel = librosa_mel_fn(
+            sr=cfg.sample_rate,
+            n_fft=cfg.n_fft,
+            n_mels=cfg.n_mel,
+            fmin=cfg.fmin,
+            fmax=cfg.fmax,
+        )
+        mel_basis[key] = torch.from_numpy(mel).float().to(device)
+        hann_window[key] = torch.hann_window(cfg.win_size).to(device)
+    return mel_basis[key], hann_window[key]
+
+
 def extract_mel_features(
     y,
     cfg,
@@ -125,19 +131,7 @@ def extract_mel_features(
     if torch.max(y) > 1.0:
         print("max value is ", torch.max(y))
 
-    global mel_basis, hann_window
-    if cfg.fmax not in mel_basis:
-        mel = librosa_mel_fn(
-            sr=cfg.sample_rate,
-            n_fft=cfg.n_fft,
-            n_mels=cfg.n_mel,
-            fmin=cfg.fmin,
-            fmax=cfg.fmax,
-        )
-        mel_basis[str(cfg.fmax) + "_" + str(y.device)] = (
-            torch.from_numpy(mel).float().to(y.device)
-        )
-        hann_window[str(y.device)] = torch.hann_window(cfg.win_size).to(y.device)
+    mel_filter, window = get_mel_basis(cfg, y.device)
 
     y = torch.nn.functional.pad(
         y.unsqueeze(1),
@@ -152,7 +146,7 @@ def extract_mel_features(
         cfg.n_fft,
         hop_length=cfg.hop_size,
         win_length=cfg.win_size,
-        window=hann_window[str(y.device)],
+        window=window,
         center=center,
         pad_mode="reflect",
         normalized=False,
@@ -162,12 +156,53 @@ def extract_mel_features(
     spec = torch.view_as_real(spec)
     spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
 
-    spec = torch.matmul(mel_basis[str(cfg.fmax) + "_" + str(y.device)], spec)
+    spec = torch.matmul(mel_filter, spec)
     spec = spectral_normalize_torch(spec)
 
     return spec.squeeze(0)
 
 
+def extract_mel_features_batch(ys, cfg):
+    """Extract mel features of waveforms of different lengths in one STFT
+
+    Args:
+        ys (list): (T,) audio tensors on the same device
+        cfg (dict): configuration in cfg.preprocess
+
+    Returns:
+        list: (n_mel, frames) tensors, the same as extract_mel_features(y.unsqueeze(0), cfg)
+    """
+    mel_filter, window = get_mel_basis(cfg, ys[0].device)
+    pad = int((cfg.n_fft - cfg.hop_size) / 2)
+
+    # reflect padding per waveform, so the last frames do not see the zero padding
+    ys = [
+        torch.nn.functional.pad(y[None, None], (pad, pad), mode="reflect")[0, 0]
+        for y in ys
+    ]
+    frames = [(len(y) - cfg.n_fft) // cfg.hop_size + 1 for y in ys]
+    y = torch.nn.utils.rnn.pad_sequence(ys, batch_first=True)
+
+    spec = torch.stft(
+        y,
+        cfg.n_fft,
+        hop_length=cfg.hop_size,
+        win_length=cfg.win_size,
+        window=window,
+        center=False,
+        normalized=False,
+        onesided=True,
+        return_complex=True,
+    )
+    spec = torch.view_as_real(spec)
+    spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
+
+    spec = torch.matmul(mel_filter, spec)
+    spec = spectral_normalize_torch(spec)
+
+    return [spec[i, :, :n] for i, n in enumerate(frames)]
+
+
 def extract_mel_features_tts(
     y,
     cfg,
@@ -192,19 +227,7 @@ def extract_mel_features_tts(
         if torch.max(y) > 1.0:
             print("max value is ", torch.max(y))
 
-        global mel_basis, hann_window
-        if cfg.fmax not in mel_basis:
-            mel = librosa_mel_fn(
-                sr=cfg.sample_rate,
-                n_fft=cfg.n_fft,
-                n_mels=cfg.n_mel,
-                fmin=cfg.fmin,
-                fmax=cfg.fmax,
-            )
-            mel_basis[str(cfg.fmax) + "_" + str(y.device)] = (
-                torch.from_numpy(mel).float().to(y.device)
-            )
-            hann_window[str(y.device)] = torch.hann_window(cfg.win_size).to(y.device)
+        mel_filter, window = get_mel_basis(cfg, y.device)
 
         y = torch.nn.functional.pad(
             y.unsqueeze(1),
@@ -219,7 +242,7 @@ def extract_mel_features_tts(
             cfg.n_fft,
             hop_length=cfg.hop_size,
             win_length=cfg.win_size,
-            window=hann_window[str(y.device)],
+            window=window,
             center=center,
             pad_mode="reflect",
             normalized=False,
@@ -229,7 +252,7 @@ def extract_mel_features_tts(
         spec = torch.view_as_real(spec)
         spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
 
-        spec = torch.matmul(mel_basis[str(cfg.fmax) + "_" + str(y.device)], spec)
+        spec = torch.matmul(mel_filter, spec)
         spec = spectral_normalize_torch(spec)
     else:
         audio = torch.clip(y, -1, 1)
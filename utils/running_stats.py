@@ -0,0 +1,133 @@
+# Copyright (c) 2023 Amphion.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with a bounded relative error (DDSketch)
+
+    Values are counted in logarithmically spaced buckets, so every quantile is
+    within ``relative_accuracy`` of the exact one while the memory only grows with
+    the dynamic range of the values, not with their number.
+    """
+
+    def __init__(self, relative_accuracy=1e-3, min_value=1e-9):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        # |x| <= min_value is counted as zero
+        self.min_value = min_value
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        self._add(self.positive, values[values > self.min_value])
+        self._add(self.negative, -values[values < -self.min_value])
+        self.zero_count += int(np.sum(np.abs(values) <= self.min_value))
+        self.count += len(values)
+
+    def _add(self, store, values):
+        index = np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+        keys, counts = np.unique(index, return_counts=True)
+        for k, c in zip(keys.tolist(), counts.tolist()):
+            store[k] = store.get(k, 0) + c
+
+    def merge(self, other):
+        for store, other_store in [
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ]:
+            for k, c in other_store.items():
+                store[k] = store.get(k, 0) + c
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for k in sorted(self.negative, reverse=True):
+            seen += self.negative[k]
+            if seen > rank:
+                return -self._bucket_value(k)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for k in sorted(self.positive):
+            seen += self.positive[k]
+            if seen > rank:
+                return self._bucket_value(k)
+
+    def _bucket_value(self, index):
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+
+class RunningStats(object):
+    """Streaming count, mean, variance, min and max of a feature
+
+    Each ``update`` reduces a batch of values over its last axis (a (n_mel, T) mel
+    gives per-channel statistics) and folds it in with the parallel Welford update.
+    Accumulators of different workers are combined with ``merge``. With
+    ``quantiles``, a QuantileSketch of all values gives the approximate median.
+    """
+
+    def __init__(self, quantiles=True, relative_accuracy=1e-3):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(relative_accuracy) if quantiles else None
+
+    def update(self, values):
+        values = np.asarray(values)
+        n = values.shape[-1]
+        if n == 0:
+            return
+        x = values.astype(np.float64)
+        mean = x.mean(axis=-1)
+        m2 = ((x - np.expand_dims(mean, -1)) ** 2).sum(axis=-1)
+        self._combine(n, mean, m2, values.min(axis=-1), values.max(axis=-1))
+        if self.sketch is not None:
+            self.sketch.update(values)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    def _combine(self, n, mean, m2, min_value, max_value):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n, mean, m2
+            self.min, self.max = min_value, max_value
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * n / total
+        self.min = np.minimum(self.min, min_value)
+        self.max = np.maximum(self.max, max_value)
+        self.count = total
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count > 0 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def median(self):
+        return self.sketch.quantile(0.5)
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
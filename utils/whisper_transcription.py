@@ -7,14 +7,13 @@ import os
 import pathlib
 import string
 import time
-from multiprocessing import Pool, Value, Lock
+import multiprocessing as mp
 from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
 import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
 import whisper
 
-processed_files_count = Value("i", 0)  # count of processed files
-lock = Lock()  # lock for the count
-
 def get_txt_files(directory):
     """get all txt files in the dataset"""
     txt_files = []
@@ -30,30 +29,64 @@ def preprocess_text(text):
     return text.lower().translate(str.maketrans("", "", string.punctuation))
 
 
-def transcribe_audio(model, processor, audio_file, device):
-    """Transcribe audio file"""
-    audio = whisper.load_audio(audio_file)  # load from path
+def load_mel(audio_file):
+    """Load an audio file as the whisper log-mel spectrogram of its first 30 seconds"""
+    audio = whisper.load_audio(str(audio_file))  # load from path
     audio = whisper.pad_or_trim(audio)  # default 30 seconds
-    inputs = whisper.log_mel_spectrogram(audio).to(
-        device=device
-    )  # convert to spectrogram
-    inputs = inputs.unsqueeze(0).type(torch.cuda.HalfTensor)  # add batch dimension
+    return whisper.log_mel_spectrogram(audio)  # convert to spectrogram
+
+
+class MelDataset(Dataset):
+    """The log-mel spectrograms of audio files, computed in the DataLoader workers"""
+
+    def __init__(self, audio_files):
+        self.audio_files = audio_files
+
+    def __len__(self):
+        return len(self.audio_files)
+
+    def __getitem__(self, index):
+        try:
+            mel = load_mel(self.audio_files[index])
+        except Exception as e:
+            print(f"Error loading file {self.audio_files[index]}: {e}")
+            mel = None
+        return index, mel
+
+
+def collate_mels(batch):
+    """Stack the mels of a batch, dropping the files that failed to load"""
+    batch = [(index, mel) for index, mel in batch if mel is not None]
+    if len(batch) == 0:
+        return [], None
+    indices, mels = zip(*batch)
+    return list(indices), torch.stack(mels)
 
-    outputs = model.generate(
-        inputs=inputs, max_new_tokens=128
-    )  # generate transcription
-    transcription = processor.batch_decode(outputs, skip_special_tokens=True)[
-        0
-    ]  # decode
-    transcription_processed = preprocess_text(transcription)  # preprocess
-    return transcription_processed
+
+def transcribe_batch(model, processor, mels, num_beams=1):
+    """Transcribe a batch of (batch, n_mels, 3000) log-mel spectrograms, with greedy
+    (num_beams=1) or beam search decoding"""
+    inputs = mels.to(device=model.device, dtype=model.dtype)
+    # generate transcriptions
+    outputs = model.generate(inputs=inputs, max_new_tokens=128, num_beams=num_beams)
+    transcriptions = processor.batch_decode(outputs, skip_special_tokens=True)
+    return [preprocess_text(transcription) for transcription in transcriptions]
+
+
+def transcribe_audio(model, processor, audio_file, device, num_beams=1):
+    """Transcribe audio file"""
+    mel = load_mel(audio_file).unsqueeze(0).to(device)  # add batch dimension
+    return transcribe_batch(model, processor, mel, num_beams)[0]
 
 
 def write_transcription(audio_file, transcription):
     """Write transcription to txt file"""
     txt_file = audio_file.with_suffix(".txt")
-    with open(txt_file, "w") as file:
+    # write then rename, so that an interrupted run never leaves a partial transcript
+    tmp_file = audio_file.with_suffix(".txt.tmp")
+    with open(tmp_file, "w") as file:
         file.write(transcription)
+    os.replace(tmp_file, txt_file)
 
 
 def init_whisper(model_id, device):
@@ -64,71 +97,105 @@ def init_whisper(model_id, device):
         model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=False
     )
     distil_model = distil_model.to(device)
+    distil_model.eval()
     processor = AutoProcessor.from_pretrained(model_id)
     return distil_model, processor
 
-def count_processed_files(start_time, total_files):
-    with lock:
-        processed_files_count.value += 1
-        if processed_files_count.value % 10000 == 0:
-            current_time = time.time()
-            avg_time_per_file = (current_time - start_time) / (
-                processed_files_count.value
-            )
-            remaining_files = total_files - processed_files_count.value
-            estimated_time_remaining = avg_time_per_file * remaining_files
-            remaining_time_formatted = time.strftime(
-                "%H:%M:%S", time.gmtime(estimated_time_remaining)
-            )
-            print(
-                f"Processed {processed_files_count.value}/{total_files} files, time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}, Estimated time remaining: {remaining_time_formatted}"
-            )
-            
-def asr_wav_files(file_list, gpu_id, total_files, model_id):
-    """Transcribe wav files in a list"""
+
+def shard_wav_files(wav_files, num_shards):
+    """Assign every file to one of num_shards shards: the k-th file of the sorted
+    list goes to the shard k % num_shards"""
+    wav_files = sorted(wav_files)
+    return [wav_files[i::num_shards] for i in range(num_shards)]
+
+
+def asr_wav_files(
+    file_list, gpu_id, model_id, batch_size=16, num_beams=1, num_workers=2
+):
+    """Transcribe the wav files of a list that have no transcript yet, in batches"""
     device = f"cuda:{gpu_id}" if torch.cuda.is_available() else "cpu"
+    # if corresponding txt file exists, skip
+    todo = [
+        audio_file
+        for audio_file in file_list
+        if not audio_file.with_suffix(".txt").exists()
+    ]
+    print(
+        f"{device}: {len(file_list) - len(todo)}/{len(file_list)} files "
+        "already transcribed"
+    )
+    if len(todo) == 0:
+        return
+    # batch the files of similar lengths (sizes) together, whose transcriptions are
+    # decoded in a similar number of steps
+    todo.sort(key=lambda audio_file: audio_file.stat().st_size)
+
     whisper_model, processor = init_whisper(model_id, device)
     print(f"Processing on {device} starts")
+    data_loader = DataLoader(
+        MelDataset(todo),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=collate_mels,
+        pin_memory=torch.cuda.is_available(),
+    )
     start_time = time.time()
-    for audio_file in file_list:
-        try:
-            # if corressponding txt file exists, skip
-            txt_file = audio_file.with_suffix(".txt")
-            if txt_file.exists():
-                # print(f"Skipping {audio_file}")
-                count_processed_files(start_time, total_files)
+    with torch.no_grad():
+        for indices, mels in tqdm(data_loader, position=gpu_id, desc=device):
+            if len(indices) == 0:
                 continue
-            transcription = transcribe_audio(
-                whisper_model, processor, audio_file, device
-            )
-            write_transcription(audio_file, transcription)
-            count_processed_files(start_time, total_files)
-        except Exception as e:
-            print(f"Error processing file {audio_file}: {e}")
+            try:
+                transcriptions = transcribe_batch(
+                    whisper_model, processor, mels, num_beams
+                )
+            except Exception as e:
+                print(f"Error processing files {[str(todo[i]) for i in indices]}: {e}")
+                continue
+            for index, transcription in zip(indices, transcriptions):
+                write_transcription(todo[index], transcription)
+    print(
+        f"Processing on {device} done, {len(todo)} files in "
+        f"{time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}"
+    )
 
 
-def asr_main(input_dir, num_gpus, model_id):
-    """Transcribe wav files in a directory"""
-    num_processes = min(num_gpus, os.cpu_count())
-    print(f"Using {num_processes} GPUs for transcription")
+def asr_main(
+    input_dir, num_gpus, model_id, batch_size=16, num_beams=1, num_workers=2
+):
+    """Transcribe wav files in a directory, with one process per GPU
+
+    Args:
+        input_dir (str): directory of the wav files, whose transcripts are written
+            next to them (.txt)
+        num_gpus (int): number of GPUs (one process on the CPU if 0)
+        model_id (str): id of the whisper model, e.g. distil-whisper/distil-large-v2
+        batch_size (int, optional): number of files transcribed together
+        num_beams (int, optional): beam size of the decoding, 1 for greedy decoding
+        num_workers (int, optional): num of processes to load the audio files, per GPU
+    """
+    num_processes = max(num_gpus, 1)
+    print(f"Using {num_gpus} GPUs for transcription")
     wav_files = list(pathlib.Path(input_dir).rglob("*.wav"))
     total_files = len(wav_files)
     print(f"Found {total_files} wav files in {input_dir}")
-    files_per_process = len(wav_files) // num_processes
-    print(f"Processing {files_per_process} files per process")
-    with Pool(num_processes) as p:
-        p.starmap(
-            asr_wav_files,
-            [
-                (
-                    wav_files[i * files_per_process : (i + 1) * files_per_process],
-                    i % num_gpus,
-                    total_files,
-                    model_id,
-                )
-                for i in range(num_processes)
-            ],
+    shards = shard_wav_files(wav_files, num_processes)
+    print(f"Processing {len(shards[0])} files per process")
+
+    # not a Pool, whose daemon processes can not start the DataLoader workers
+    ctx = mp.get_context("spawn")
+    processes = []
+    for gpu_id, file_list in enumerate(shards):
+        process = ctx.Process(
+            target=asr_wav_files,
+            args=(file_list, gpu_id, model_id, batch_size, num_beams, num_workers),
         )
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Transcription processes {failed} failed")
     print("Done!")
 
 